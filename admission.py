@@ -0,0 +1,223 @@
+"""
+Waiting-room admission and adaptive capacity.
+
+With WAITING_ROOM=true, callers that arrive while every line is busy are not
+turned away. They hear a hold message, and every HOLD_SECONDS Twilio asks
+/queue_admit again. Waiting callers are admitted in arrival order as lines
+free up. At most WAITING_ROOM_SIZE callers wait, and later callers get the
+busy message. A caller that stops polling is dropped after a few missed
+polls, since its hang-up was missed.
+
+With ADAPTIVE_CAPACITY=true the number of lines follows the app's load.
+Every ADJUST_INTERVAL seconds, two readings since the last adjustment are
+compared with their targets:
+
+- the p95 latency of the Twilio webhooks, read from the request latency
+  histograms, against ADMISSION_TARGET_LATENCY_MS
+- the CPU time used by this process, against ADMISSION_TARGET_CPU
+
+If either reading is over its target the capacity is cut by a quarter.
+Otherwise it grows by one line, up to MAX_CALLS (additive increase,
+multiplicative decrease). Each process adapts its own limit.
+"""
+
+from collections import deque
+import logging
+import os
+import threading
+import time
+
+from metrics import REQUEST_LATENCY, WAITING_ROOM_WAIT
+from twilio_utils import get_hold_seconds
+
+logger = logging.getLogger(__name__)
+
+_wait_histogram = WAITING_ROOM_WAIT.labels()
+
+DEFAULT_WAITING_ROOM_SIZE = 100
+
+# Missed hold polls after which a waiting caller is dropped
+MISSED_POLLS = 3
+
+DEFAULT_TARGET_LATENCY_MS = 250
+DEFAULT_TARGET_CPU = 0.9
+
+# Seconds between capacity adjustments, and the fewest webhooks measured
+# in that time for their latency to count
+ADJUST_INTERVAL = 5.0
+MIN_SAMPLES = 20
+
+# Capacity cut applied when over a target
+DECREASE_FACTOR = 0.75
+
+# Routes whose latency drives the capacity: the Twilio webhooks
+WEBHOOK_ROUTES = ('/incoming_call', '/queue_admit', '/handle_ivr', '/outbound_call', '/call_status')
+
+# Waits kept for the dashboard's percentiles
+WAIT_SAMPLES = 1000
+
+def _env_flag(name):
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes')
+
+def _env_number(name, default, type=int):
+    try:
+        value = type(os.environ.get(name, default))
+        return value if value > 0 else default
+    except ValueError:
+        logger.warning(f"Invalid {name} value, using {default}")
+        return default
+
+def waiting_room_enabled():
+    """Whether callers over capacity wait instead of getting the busy message."""
+    return _env_flag('WAITING_ROOM')
+
+def get_waiting_room_size():
+    """
+    Get the most callers that may wait.
+
+    Returns:
+        int: Value of WAITING_ROOM_SIZE, or DEFAULT_WAITING_ROOM_SIZE if unset or invalid
+    """
+    return _env_number('WAITING_ROOM_SIZE', DEFAULT_WAITING_ROOM_SIZE)
+
+def get_waiter_timeout():
+    """
+    Get the seconds after which a waiting caller that stopped polling is dropped.
+
+    Returns:
+        float: MISSED_POLLS hold periods, plus time for the hold message
+    """
+    return MISSED_POLLS * get_hold_seconds() + 15.0
+
+def adaptive_capacity_enabled():
+    """Whether the capacity is lowered under load."""
+    return _env_flag('ADAPTIVE_CAPACITY')
+
+def _percentile(bounds, counts, fraction):
+    """Upper bound of the histogram bucket holding a percentile of the counts."""
+    rank = sum(counts) * fraction
+    cumulative = 0
+    for bound, count in zip(bounds, counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return float('inf')
+
+class AdaptiveCapacity:
+    """Limit on active calls that adapts to webhook latency and CPU use."""
+
+    def __init__(self, routes=WEBHOOK_ROUTES, interval=ADJUST_INTERVAL,
+                 min_samples=MIN_SAMPLES, min_calls=1):
+        """
+        Args:
+            routes: Routes whose request latency is measured
+            interval (float): Seconds between adjustments
+            min_samples (int): Fewest requests for a latency reading to count
+            min_calls (int): Lowest capacity
+        """
+        self._histograms = [REQUEST_LATENCY.labels(route) for route in routes]
+        self._bounds = REQUEST_LATENCY.buckets + (float('inf'),)
+        self.interval = interval
+        self.min_samples = min_samples
+        self.min_calls = min_calls
+        # None until the first call to get() sets it to the maximum
+        self.capacity = None
+        self._counts = self._read_counts()
+        self._cpu = time.process_time()
+        self._adjusted_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _read_counts(self):
+        counts = [0] * len(self._bounds)
+        for histogram in self._histograms:
+            for index, count in enumerate(list(histogram.counts)):
+                counts[index] += count
+        return counts
+
+    def get(self, max_calls):
+        """
+        Get the current capacity, adjusting it if an interval has passed.
+
+        Args:
+            max_calls (int): The configured maximum (MAX_CALLS)
+
+        Returns:
+            int: Number of calls to admit
+        """
+        if self.capacity is None or self.capacity > max_calls:
+            self.capacity = max_calls
+        now = time.monotonic()
+        # Only one request adjusts; the others use the current value
+        if now - self._adjusted_at >= self.interval and self._lock.acquire(blocking=False):
+            try:
+                self._adjust(now, max_calls)
+            finally:
+                self._lock.release()
+        return self.capacity
+
+    def _adjust(self, now, max_calls):
+        counts = self._read_counts()
+        cpu = time.process_time()
+        window = [count - previous for count, previous in zip(counts, self._counts)]
+        cpu_use = (cpu - self._cpu) / (now - self._adjusted_at)
+        self._counts, self._cpu, self._adjusted_at = counts, cpu, now
+
+        target_latency = _env_number('ADMISSION_TARGET_LATENCY_MS', DEFAULT_TARGET_LATENCY_MS,
+                                     float) / 1000
+        target_cpu = _env_number('ADMISSION_TARGET_CPU', DEFAULT_TARGET_CPU, float)
+        latency = (_percentile(self._bounds, window, 0.95)
+                   if sum(window) >= self.min_samples else 0.0)
+
+        previous = self.capacity
+        if latency > target_latency or cpu_use > target_cpu:
+            self.capacity = max(self.min_calls, int(self.capacity * DECREASE_FACTOR))
+        else:
+            self.capacity = min(max_calls, self.capacity + 1)
+        if self.capacity != previous:
+            logger.info("Admission capacity %d -> %d (webhook p95 %.3fs, CPU %.0f%%)",
+                        previous, self.capacity, latency, cpu_use * 100)
+
+class WaitStats:
+    """Recent waits of callers admitted from the waiting room."""
+
+    def __init__(self, size=WAIT_SAMPLES):
+        self._waits = deque(maxlen=size)
+        self.admitted = 0
+        self.abandoned = 0
+
+    def record(self, seconds):
+        """Record the wait of a caller admitted from the waiting room."""
+        self._waits.append(seconds)
+        self.admitted += 1
+        _wait_histogram.observe(seconds)
+
+    def record_abandoned(self):
+        """Count a caller that hung up while waiting."""
+        self.abandoned += 1
+
+    def percentiles(self):
+        """
+        Get percentiles of the recent waits.
+
+        Returns:
+            dict: p50, p95 and max wait in seconds (0 without waits), and
+                the callers admitted and abandoned
+        """
+        waits = sorted(self._waits)
+
+        def percentile(fraction):
+            if not waits:
+                return 0.0
+            return waits[min(int(len(waits) * fraction), len(waits) - 1)]
+
+        return {
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'max': waits[-1] if waits else 0.0,
+            'admitted': self.admitted,
+            'abandoned': self.abandoned
+        }
+
+# Capacity and wait statistics of this process
+capacity = AdaptiveCapacity()
+wait_stats = WaitStats()
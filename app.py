@@ -1,11 +1,13 @@
 import os
 import logging
-from flask import Flask, render_template, request, jsonify, Response, send_from_directory
+from flask import Flask, render_template, request, jsonify, Response, g, abort
 import json
-from datetime import datetime
+import time
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+from logging_config import configure_logging
+
+# Configure logging (LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Create the app
@@ -13,108 +15,106 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "telephony-test-app-secret")
 
 # Import after app creation to avoid circular imports
-from twilio_utils import generate_twiml_response, get_twilio_client
-from call_handler import (
-    handle_call_start, 
-    handle_call_end, 
-    update_call_ivr,
-    get_active_calls, 
-    get_call_count
-)
+from twilio_utils import get_twilio_client
+from broadcaster import broadcaster
+from audio_assets import audio_assets
+import metrics
+import webhooks
+from call_handler import start_reaper, start_cluster, start_exporter
+from cluster import cluster_enabled
+from admission import waiting_room_enabled
+from webhooks import PUSH_UPDATES, SSE_KEEPALIVE_SECONDS, SSE_MAX_SECONDS
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.before_request
+def forward_to_owner():
+    # In cluster mode, webhooks of calls owned by another node are sent there
+    if request.path not in webhooks.SHARDED_WEBHOOKS or not webhooks.cluster_node.running:
+        return None
+    forwarded = webhooks.forward_webhook(request.path, request.full_path.rstrip('?'),
+                                         request.query_string, request.get_data(),
+                                         request.headers)
+    if forwarded is None:
+        return None
+    status, headers, body = forwarded
+    return Response(body, status=status, headers=headers)
+
+@app.after_request
+def record_request_latency(response):
+    # Streamed responses (SSE) are timed until the response starts
+    start = g.get('request_start')
+    if start is not None:
+        _route_latency.get(request.endpoint, _unmatched_latency).observe(
+            time.perf_counter() - start)
+    return response
+
+def twiml_response(twiml):
+    """Build a Flask response serving a cached TwiML document."""
+    return Response(twiml.body, mimetype='text/xml', headers={
+        'ETag': twiml.etag,
+        'Content-Length': twiml.content_length
+    })
+
+def webhook_values(route):
+    """
+    Parse a Twilio webhook request, aborting with 403 if its signature is invalid.
+
+    Returns:
+        dict: The fields the webhook uses
+    """
+    path_qs = request.path
+    if request.query_string:
+        path_qs += '?' + request.query_string.decode('latin-1')
+    values = webhooks.parse_webhook(
+        route, webhooks.webhook_url(path_qs, request.url), request.query_string,
+        request.get_data(), request.headers.get('X-Twilio-Signature'))
+    if values is None:
+        abort(403)
+    return values
 
 @app.route('/')
 def dashboard():
     """Render the dashboard page."""
-    return render_template('dashboard.html')
+    return render_template('dashboard.html', push_updates=PUSH_UPDATES,
+                           waiting_room=waiting_room_enabled(), cluster=cluster_enabled())
 
 @app.route('/incoming_call', methods=['POST'])
 def incoming_call():
     """Handle incoming calls from Twilio."""
-    try:
-        # Extract call data
-        call_sid = request.values.get('CallSid', 'unknown')
-        from_number = request.values.get('From', 'unknown')
-        to_number = request.values.get('To', 'unknown')
-        
-        logger.debug(f"Incoming call from {from_number} to {to_number} with SID {call_sid}")
-        
-        # Check if we can accept more calls
-        active_calls = get_call_count()
-        if active_calls >= 30:
-            logger.warning(f"Max calls reached ({active_calls}/30). Rejecting call from {from_number}")
-            response = generate_twiml_response("busy")
-            return Response(str(response), mimetype='text/xml')
-        
-        # Handle the new call
-        handle_call_start(call_sid, from_number, to_number)
-        
-        # Generate TwiML for IVR menu
-        response = generate_twiml_response("welcome")
-        return Response(str(response), mimetype='text/xml')
-    
-    except Exception as e:
-        logger.error(f"Error handling incoming call: {str(e)}")
-        # Return a basic response in case of error
-        response = generate_twiml_response("error")
-        return Response(str(response), mimetype='text/xml')
+    return twiml_response(webhooks.incoming_call(webhook_values('incoming_call')))
+
+@app.route('/queue_admit', methods=['POST'])
+def queue_admit():
+    """Admit a caller from the waiting room, or keep it on hold."""
+    return twiml_response(webhooks.queue_admit(webhook_values('queue_admit')))
 
 @app.route('/handle_ivr', methods=['POST'])
 def handle_ivr():
     """Process IVR selection."""
-    try:
-        digits = request.values.get('Digits', '')
-        call_sid = request.values.get('CallSid', 'unknown')
-        
-        logger.debug(f"IVR selection: {digits} for call {call_sid}")
-        
-        if digits == '1':
-            # Option 1: Play music
-            response = generate_twiml_response("music")
-            
-            # Update call record with choice
-            update_call_ivr(call_sid, "music")
-                    
-        elif digits == '2':
-            # Option 2: Play beep every 3 seconds
-            response = generate_twiml_response("beep")
-            
-            # Update call record with choice
-            update_call_ivr(call_sid, "beep")
-        else:
-            # Invalid option, repeat menu
-            response = generate_twiml_response("invalid")
-            
-        return Response(str(response), mimetype='text/xml')
-    
-    except Exception as e:
-        logger.error(f"Error handling IVR: {str(e)}")
-        response = generate_twiml_response("error")
-        return Response(str(response), mimetype='text/xml')
+    return twiml_response(webhooks.handle_ivr(webhook_values('handle_ivr')))
+
+@app.route('/outbound_call', methods=['POST'])
+def outbound_call():
+    """Play the flow of an outbound test call when it is answered."""
+    return twiml_response(webhooks.outbound_call(webhook_values('outbound_call')))
 
 @app.route('/call_status', methods=['POST'])
 def call_status():
     """Handle call status updates from Twilio."""
-    try:
-        call_sid = request.values.get('CallSid', 'unknown')
-        call_status = request.values.get('CallStatus', 'unknown')
-        
-        logger.debug(f"Call status update: {call_sid} - {call_status}")
-        
-        if call_status in ['completed', 'busy', 'failed', 'canceled', 'no-answer']:
-            handle_call_end(call_sid)
-        
-        return jsonify({"status": "success"})
-    
-    except Exception as e:
-        logger.error(f"Error handling call status: {str(e)}")
-        return jsonify({"status": "error", "message": str(e)})
+    return jsonify(webhooks.call_status(webhook_values('call_status')))
 
 @app.route('/api/calls', methods=['GET'])
 def api_calls():
-    """API endpoint to get active calls."""
+    """API endpoint to get a page of the active calls, newest first."""
     try:
-        calls = get_active_calls()
-        return jsonify(calls)
+        offset, limit = webhooks.calls_page(request.args.get('offset', type=int),
+                                            request.args.get('limit', type=int))
+        body, total = webhooks.calls_json(offset, limit)
+        return Response(body, mimetype='application/json',
+                        headers={'X-Total-Count': str(total)})
     except Exception as e:
         logger.error(f"Error fetching calls: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -123,51 +123,117 @@ def api_calls():
 def api_call_count():
     """API endpoint to get current call count."""
     try:
-        count = get_call_count()
-        return jsonify({"count": count})
+        return jsonify(webhooks.call_count())
     except Exception as e:
         logger.error(f"Error fetching call count: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-# Modified API endpoint for dashboard updates - replaces SSE
 @app.route('/api/dashboard_data')
 def dashboard_data():
     """API endpoint to get dashboard data (calls and count)."""
     try:
-        count = get_call_count()
-        calls = get_active_calls()
-        data = {
-            "count": count,
-            "calls": calls,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        return jsonify(data)
+        return Response(webhooks.dashboard_data(), mimetype='application/json')
     except Exception as e:
         logger.error(f"Error fetching dashboard data: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/dashboard_changes')
+def dashboard_changes():
+    """API endpoint to get changes to the active calls since a version."""
+    try:
+        since = request.args.get('since', type=int)
+        return jsonify(webhooks.dashboard_changes(since))
+    except Exception as e:
+        logger.error(f"Error fetching dashboard changes: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/queue')
+def api_queue():
+    """API endpoint to get the waiting room depth and wait percentiles."""
+    try:
+        return jsonify(webhooks.queue_status())
+    except Exception as e:
+        logger.error(f"Error fetching queue status: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/history/stats')
+def history_stats():
+    """API endpoint to get statistics for completed calls in a time window."""
+    try:
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        return jsonify(webhooks.history_stats(start, end))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error fetching history stats: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/events')
+def events():
+    """Server-sent event stream of changes to the active calls."""
+    subscription = broadcaster.subscribe()
+
+    def stream():
+        try:
+            # Ask the client to wait a little before reconnecting
+            yield b"retry: 3000\n\n"
+            deadline = time.monotonic() + SSE_MAX_SECONDS
+            while time.monotonic() < deadline:
+                frames = subscription.get_frames(timeout=SSE_KEEPALIVE_SECONDS)
+                if frames is None:
+                    # Fell too far behind; the client reconnects and resyncs
+                    logger.warning("Dropping slow event stream subscriber")
+                    break
+                yield b"".join(frames) if frames else b": keep-alive\n\n"
+        finally:
+            subscription.close()
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/events/poll')
+def events_poll():
+    """Long-poll fallback for the event stream."""
+    try:
+        after, timeout = webhooks.long_poll_window(
+            request.args.get('after', type=int),
+            request.args.get('timeout', type=float)
+        )
+        body = broadcaster.wait_for_events(after, timeout)
+        return Response(body, mimetype='application/json')
+    except Exception as e:
+        logger.error(f"Error long-polling events: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/static/audio/<filename>')
 def serve_audio(filename):
     """Serve audio files for Twilio."""
-    if filename.endswith('.mp3.txt'):
-        # If requesting the placeholder txt file
-        return send_from_directory('static/audio', filename)
-    
-    # For actual MP3 files, check if they exist
-    if os.path.exists(os.path.join('static/audio', filename)):
-        return send_from_directory('static/audio', filename)
-    
-    # If requested MP3 doesn't exist but we have a placeholder, use Twilio's demos
-    placeholder = f"{filename}.txt"
-    if os.path.exists(os.path.join('static/audio', placeholder)):
-        if filename == 'beep.mp3':
-            return Response("Redirecting to Twilio demo beep", 
-                          headers={"Location": "https://demo.twilio.com/docs/classic.mp3"}, 
-                          status=302)
-        elif filename == 'music.mp3':
-            return Response("Redirecting to Twilio demo music", 
-                          headers={"Location": "https://demo.twilio.com/docs/classic.mp3"}, 
-                          status=302)
-    
-    # File not found
-    return Response("Audio file not found", status=404)
+    audio = audio_assets.respond(
+        filename,
+        if_none_match=request.headers.get('If-None-Match'),
+        range_header=request.headers.get('Range'),
+        if_range=request.headers.get('If-Range')
+    )
+    return Response(audio.body, status=audio.status, headers=audio.headers)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose the app's metrics in the Prometheus text format."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# Request latency histograms per route, looked up by endpoint name
+_route_latency = {rule.endpoint: metrics.REQUEST_LATENCY.labels(rule.rule)
+                  for rule in app.url_map.iter_rules()}
+_unmatched_latency = metrics.REQUEST_LATENCY.labels('unmatched')
+
+# Expire calls whose status callback never arrives (REAPER_ENABLED)
+start_reaper()
+
+# Join the cluster (CLUSTER_COORDINATOR)
+start_cluster()
+
+# Export ended calls (CALL_EXPORT_DIR)
+start_exporter()
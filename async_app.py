@@ -0,0 +1,374 @@
+"""
+Asyncio serving mode.
+
+Serves the same routes as the Flask app (app.py) from a single asyncio event
+loop using aiohttp, which is already installed as a dependency of the twilio
+package. Webhooks and API reads never wait on another connection, so
+dashboards holding SSE streams or long polls open cannot starve call setup.
+
+Request handling is shared with the Flask app through webhooks.py, so call
+storage behaves identically. With the in-memory store, storage calls run
+directly on the event loop (they never block); with a shared store such as
+SQLite they run in a thread pool.
+
+Run with:
+    python async_app.py --port 5000
+or under gunicorn:
+    gunicorn async_app:app --bind 0.0.0.0:5000 --worker-class aiohttp.GunicornWebWorker
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+import jinja2
+
+from load_env import load_env_variables
+from logging_config import configure_logging
+from broadcaster import broadcaster
+from audio_assets import audio_assets
+from call_storage import get_call_store
+from call_store_backends import MemoryCallStore
+import metrics
+import webhooks
+from call_handler import (start_reaper, start_cluster, start_exporter, cluster_node,
+                          reaper, call_exporter)
+from cluster import cluster_enabled, response_headers_to_return, FORWARD_TIMEOUT
+from admission import waiting_room_enabled
+from webhooks import PUSH_UPDATES, SSE_KEEPALIVE_SECONDS, SSE_MAX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+async def _run_storage(func, *args):
+    """Run a function that touches call storage without blocking the event loop."""
+    # In cluster mode admissions and call ends also wait on the coordinator
+    if isinstance(get_call_store(), MemoryCallStore) and not cluster_node.running:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+def _query(request, name, type):
+    """Get a query parameter converted to a type, or None if missing or invalid."""
+    try:
+        return type(request.query[name])
+    except (KeyError, ValueError):
+        return None
+
+async def _webhook_values(request, route):
+    """
+    Parse a Twilio webhook request, raising 403 if its signature is invalid.
+
+    Returns:
+        dict: The fields the webhook uses
+    """
+    body = await request.read()
+    values = webhooks.parse_webhook(
+        route, webhooks.webhook_url(request.path_qs, str(request.url)),
+        request.query_string.encode('latin-1'), body,
+        request.headers.get('X-Twilio-Signature'))
+    if values is None:
+        raise web.HTTPForbidden()
+    return values
+
+def _twiml_response(twiml):
+    return web.Response(body=twiml.body, content_type='text/xml', headers={
+        'ETag': twiml.etag
+    })
+
+def _json_response(data, status=200):
+    return web.Response(body=json.dumps(data).encode('utf-8'), status=status,
+                        content_type='application/json')
+
+def _error_response(message, e):
+    logger.error(f"{message}: {str(e)}")
+    return _json_response({"error": str(e)}, status=500)
+
+def _wakeup(loop, event):
+    """Build a broadcaster notify callback that sets an asyncio event from any thread."""
+    def notify():
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(event.set)
+    return notify
+
+def _static_url(endpoint, filename):
+    """Stand-in for Flask's url_for in the templates, which only link static files."""
+    return f'/{endpoint}/{filename}'
+
+_templates = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+                                autoescape=jinja2.select_autoescape(['html']))
+_templates.globals['url_for'] = _static_url
+
+_dashboard_html = None
+
+async def dashboard(request):
+    """Render the dashboard page."""
+    global _dashboard_html
+    if _dashboard_html is None:
+        # The page only depends on configuration, so it is rendered once
+        _dashboard_html = _templates.get_template('dashboard.html').render(
+            push_updates=PUSH_UPDATES, waiting_room=waiting_room_enabled(),
+            cluster=cluster_enabled())
+    return web.Response(text=_dashboard_html, content_type='text/html')
+
+async def incoming_call(request):
+    """Handle incoming calls from Twilio."""
+    values = await _webhook_values(request, 'incoming_call')
+    return _twiml_response(await _run_storage(webhooks.incoming_call, values))
+
+async def queue_admit(request):
+    """Admit a caller from the waiting room, or keep it on hold."""
+    values = await _webhook_values(request, 'queue_admit')
+    return _twiml_response(await _run_storage(webhooks.queue_admit, values))
+
+async def handle_ivr(request):
+    """Process IVR selection."""
+    values = await _webhook_values(request, 'handle_ivr')
+    return _twiml_response(await _run_storage(webhooks.handle_ivr, values))
+
+async def outbound_call(request):
+    """Play the flow of an outbound test call when it is answered."""
+    values = await _webhook_values(request, 'outbound_call')
+    return _twiml_response(webhooks.outbound_call(values))
+
+async def call_status(request):
+    """Handle call status updates from Twilio."""
+    values = await _webhook_values(request, 'call_status')
+    return _json_response(await _run_storage(webhooks.call_status, values))
+
+async def api_calls(request):
+    """API endpoint to get a page of the active calls, newest first."""
+    try:
+        offset, limit = webhooks.calls_page(_query(request, 'offset', int),
+                                            _query(request, 'limit', int))
+        body, total = await _run_storage(webhooks.calls_json, offset, limit)
+        return web.Response(body=body, content_type='application/json',
+                            headers={'X-Total-Count': str(total)})
+    except Exception as e:
+        return _error_response("Error fetching calls", e)
+
+async def api_call_count(request):
+    """API endpoint to get current call count."""
+    try:
+        return _json_response(await _run_storage(webhooks.call_count))
+    except Exception as e:
+        return _error_response("Error fetching call count", e)
+
+async def dashboard_data(request):
+    """API endpoint to get dashboard data (calls and count)."""
+    try:
+        body = await _run_storage(webhooks.dashboard_data)
+        return web.Response(body=body, content_type='application/json')
+    except Exception as e:
+        return _error_response("Error fetching dashboard data", e)
+
+async def dashboard_changes(request):
+    """API endpoint to get changes to the active calls since a version."""
+    try:
+        since = _query(request, 'since', int)
+        return _json_response(await _run_storage(webhooks.dashboard_changes, since))
+    except Exception as e:
+        return _error_response("Error fetching dashboard changes", e)
+
+async def api_queue(request):
+    """API endpoint to get the waiting room depth and wait percentiles."""
+    try:
+        return _json_response(await _run_storage(webhooks.queue_status))
+    except Exception as e:
+        return _error_response("Error fetching queue status", e)
+
+async def history_stats(request):
+    """API endpoint to get statistics for completed calls in a time window."""
+    try:
+        start = _query(request, 'start', float)
+        end = _query(request, 'end', float)
+        return _json_response(webhooks.history_stats(start, end))
+    except ValueError as e:
+        return _json_response({"error": str(e)}, status=400)
+    except Exception as e:
+        return _error_response("Error fetching history stats", e)
+
+async def events(request):
+    """Server-sent event stream of changes to the active calls."""
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    subscription = broadcaster.subscribe(notify=_wakeup(loop, wakeup))
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    try:
+        await response.prepare(request)
+        # Ask the client to wait a little before reconnecting
+        await response.write(b"retry: 3000\n\n")
+        deadline = loop.time() + SSE_MAX_SECONDS
+        while loop.time() < deadline:
+            try:
+                await asyncio.wait_for(wakeup.wait(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+                continue
+            wakeup.clear()
+            frames = subscription.get_frames(timeout=0)
+            if frames is None:
+                # Fell too far behind; the client reconnects and resyncs
+                logger.warning("Dropping slow event stream subscriber")
+                break
+            if frames:
+                await response.write(b"".join(frames))
+    except ConnectionResetError:
+        pass
+    finally:
+        subscription.close()
+    return response
+
+async def events_poll(request):
+    """Long-poll fallback for the event stream."""
+    try:
+        after, timeout = webhooks.long_poll_window(
+            _query(request, 'after', int), _query(request, 'timeout', float))
+
+        if timeout > 0 and broadcaster.get_last_id() == after:
+            wakeup = asyncio.Event()
+            subscription = broadcaster.subscribe(
+                notify=_wakeup(asyncio.get_running_loop(), wakeup))
+            try:
+                # Check again now that we are subscribed, so no event is missed
+                if broadcaster.get_last_id() == after:
+                    await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                subscription.close()
+
+        body = broadcaster.wait_for_events(after, 0)
+        return web.Response(body=body, content_type='application/json')
+    except Exception as e:
+        return _error_response("Error long-polling events", e)
+
+async def serve_audio(request):
+    """Serve audio files for Twilio."""
+    audio = audio_assets.respond(
+        request.match_info['filename'],
+        if_none_match=request.headers.get('If-None-Match'),
+        range_header=request.headers.get('Range'),
+        if_range=request.headers.get('If-Range')
+    )
+    return web.Response(body=audio.body, status=audio.status, headers=audio.headers)
+
+async def metrics_endpoint(request):
+    """Expose the app's metrics in the Prometheus text format."""
+    return web.Response(body=metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+# Request latency histograms per route, filled in by create_app()
+_route_latency = {}
+_unmatched_latency = metrics.REQUEST_LATENCY.labels('unmatched')
+
+@web.middleware
+async def record_request_latency(request, handler):
+    # Streamed responses (SSE) are timed until they end
+    start = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        route = request.match_info.route.resource
+        histogram = _route_latency.get(route.canonical) if route is not None else None
+        (histogram or _unmatched_latency).observe(time.perf_counter() - start)
+
+_forward_session = None
+
+@web.middleware
+async def forward_to_owner(request, handler):
+    # In cluster mode, webhooks of calls owned by another node are sent there.
+    # Forwarding must not hold a thread: nodes forwarding to each other could
+    # otherwise use up each other's thread pools
+    global _forward_session
+    if request.path in webhooks.SHARDED_WEBHOOKS and cluster_node.running:
+        body = await request.read()
+        url = webhooks.webhook_owner(request.path, request.query_string.encode('latin-1'),
+                                     body, request.headers)
+        if url is not None:
+            if _forward_session is None:
+                _forward_session = aiohttp.ClientSession(
+                    timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT))
+            try:
+                async with _forward_session.post(url + request.path_qs, data=body,
+                                                 headers=cluster_node.forward_headers(request.headers)
+                                                 ) as response:
+                    return web.Response(body=await response.read(), status=response.status,
+                                        headers=response_headers_to_return(response.headers))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # The owner is probably gone; it drops out of the shards shortly
+                logger.error(f"Error forwarding webhook to {url}: {str(e)}")
+    return await handler(request)
+
+async def start_services(application):
+    """Configure logging and start the background services, also under gunicorn."""
+    configure_logging()
+    load_env_variables()
+    start_reaper()
+    start_cluster()
+    start_exporter()
+
+async def stop_services(application):
+    """Stop the background services and close the forwarding session."""
+    global _forward_session
+    if cluster_node.running:
+        cluster_node.stop()
+    call_exporter.close()
+    reaper.stop()
+    if _forward_session is not None:
+        await _forward_session.close()
+        _forward_session = None
+
+def create_app():
+    """
+    Create the aiohttp application.
+
+    Returns:
+        web.Application: The application with all routes registered
+    """
+    application = web.Application(middlewares=[record_request_latency, forward_to_owner])
+    application.router.add_get('/', dashboard)
+    application.router.add_post('/incoming_call', incoming_call)
+    application.router.add_post('/queue_admit', queue_admit)
+    application.router.add_post('/handle_ivr', handle_ivr)
+    application.router.add_post('/outbound_call', outbound_call)
+    application.router.add_post('/call_status', call_status)
+    application.router.add_get('/api/calls', api_calls)
+    application.router.add_get('/api/call_count', api_call_count)
+    application.router.add_get('/api/dashboard_data', dashboard_data)
+    application.router.add_get('/api/dashboard_changes', dashboard_changes)
+    application.router.add_get('/api/queue', api_queue)
+    application.router.add_get('/api/history/stats', history_stats)
+    application.router.add_get('/api/events', events)
+    application.router.add_get('/api/events/poll', events_poll)
+    # Registered before the static route so it takes precedence
+    application.router.add_get('/static/audio/{filename}', serve_audio)
+    application.router.add_static('/static', STATIC_DIR)
+    application.router.add_get('/metrics', metrics_endpoint)
+    for resource in application.router.resources():
+        _route_latency[resource.canonical] = metrics.REQUEST_LATENCY.labels(resource.canonical)
+    application.on_startup.append(start_services)
+    application.on_cleanup.append(stop_services)
+    return application
+
+app = create_app()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the app in asyncio serving mode.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    web.run_app(app, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
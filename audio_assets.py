@@ -0,0 +1,421 @@
+"""
+In-memory cache of the audio files Twilio plays to callers.
+
+The files in static/audio are read and validated once at startup and served
+from memory with strong ETags, Cache-Control, conditional GET (304) and
+single byte-range support. The directory is rescanned at most once per
+RELOAD_CHECK_SECONDS, so files that are added, changed or removed on disk are
+picked up without a restart. Rescans run in a background thread, one at a
+time, and requests are served from the current files meanwhile.
+
+Responses are built as framework-neutral AudioResponse tuples that the Flask
+and asyncio servers wrap in their own response types.
+"""
+
+from collections import namedtuple
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+AUDIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'audio')
+
+# Seconds between checks of the audio directory for changed files
+RELOAD_CHECK_SECONDS = 1.0
+
+# How long clients may reuse an audio file before revalidating it
+CACHE_MAX_AGE = 3600
+
+# The beep played every few seconds for IVR option 2, and the generated track
+# holding one cycle of it (the beep followed by silence)
+BEEP_SOURCE_NAME = 'beep-02.mp3'
+BEEP_TRACK_NAME = 'beep-cycle.mp3'
+BEEP_SILENCE_SECONDS = 3
+
+# Used when an MP3 is missing but has a .txt placeholder
+FALLBACK_AUDIO_URL = "https://demo.twilio.com/docs/classic.mp3"
+
+AudioAsset = namedtuple('AudioAsset', ['name', 'body', 'etag', 'content_type', 'mtime', 'size'])
+
+AudioResponse = namedtuple('AudioResponse', ['status', 'headers', 'body'])
+
+# MPEG audio header tables, indexed by the header's version bits (0: MPEG 2.5,
+# 2: MPEG 2, 3: MPEG 1) and bitrate/sample rate indexes
+_MPEG_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MPEG_BITRATES[0] = _MPEG_BITRATES[2]
+_MPEG_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def _is_valid_mp3(body):
+    """Check that data starts with an ID3 tag or an MPEG audio frame header."""
+    return body[:3] == b'ID3' or (len(body) >= 2 and body[0] == 0xFF and body[1] & 0xE0 == 0xE0)
+
+def _make_asset(name, body, mtime=0.0, size=None):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if name.endswith('.mp3'):
+        # Some platforms map .mp3 to audio/mp3, which not every client accepts
+        content_type = 'audio/mpeg'
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return AudioAsset(name, body, etag, content_type, mtime, len(body) if size is None else size)
+
+def _etag_matches(header, etag):
+    """Check an If-None-Match header (weak comparison) against an ETag."""
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate == etag or candidate == 'W/' + etag:
+            return True
+    return False
+
+def _parse_range(header, size):
+    """
+    Parse a Range header for a single byte range.
+
+    Args:
+        header (str): The Range header value
+        size (int): Size of the asset in bytes
+
+    Returns:
+        tuple: (start, end) inclusive, None to serve the whole asset (missing,
+            malformed or multi-range headers), or False if unsatisfiable
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if first == '':
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+def _parse_frame_header(body, offset):
+    """
+    Parse an MPEG Layer III frame header.
+
+    Returns:
+        tuple: (frame length, samples per frame, sample rate, header bytes),
+            or None if there is no valid header at offset
+    """
+    if offset + 4 > len(body) or body[offset] != 0xFF or body[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (body[offset + 1] >> 3) & 0x03
+    layer = (body[offset + 1] >> 1) & 0x03
+    bitrate_index = body[offset + 2] >> 4
+    rate_index = (body[offset + 2] >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = _MPEG_BITRATES[version][bitrate_index] * 1000
+    sample_rate = _MPEG_SAMPLE_RATES[version][rate_index]
+    padding = (body[offset + 2] >> 1) & 0x01
+    samples = 1152 if version == 3 else 576
+    length = samples // 8 * bitrate // sample_rate + padding
+    return length, samples, sample_rate, body[offset:offset + 4]
+
+def _mp3_frames(body):
+    """
+    Strip the tags (ID3v2, ID3v1) and any Xing/Info header frame from an MP3.
+
+    Returns:
+        tuple: (audio frames as bytes, header of the first frame), or
+            (b'', None) if no frames are found
+    """
+    start = 0
+    if body[:3] == b'ID3' and len(body) >= 10:
+        size = 0
+        for byte in body[6:10]:
+            size = (size << 7) | byte
+        start = 10 + size
+    end = len(body) - 128 if body[-128:-125] == b'TAG' else len(body)
+
+    offset = start
+    first_header = None
+    while offset < end:
+        frame = _parse_frame_header(body, offset)
+        if frame is None:
+            break
+        length, _, _, header = frame
+        if first_header is None:
+            if b'Xing' in body[offset:offset + 64] or b'Info' in body[offset:offset + 64]:
+                # A VBR header frame describes the original file's length
+                start = offset + length
+            first_header = header
+        offset += length
+    return body[start:min(offset, end)], first_header
+
+def mp3_duration(body):
+    """
+    Compute the playing time of an MP3 from its frame headers.
+
+    Returns:
+        float: Duration in seconds, or None if no MPEG Layer III frames are found
+    """
+    frames, header = _mp3_frames(body)
+    if header is None:
+        return None
+    offset = 0
+    seconds = 0.0
+    while offset < len(frames):
+        frame = _parse_frame_header(frames, offset)
+        if frame is None:
+            break
+        length, samples, sample_rate, _ = frame
+        seconds += samples / sample_rate
+        offset += length
+    return seconds
+
+def silent_mp3_frames(header, seconds):
+    """
+    Build MP3 frames of silence matching a frame header.
+
+    A Layer III frame with all-zero side information has no audio data, so it
+    decodes to silence.
+
+    Args:
+        header (bytes): Four-byte frame header to copy the format from
+        seconds (float): Length of the silence
+
+    Returns:
+        bytes: The silent frames
+    """
+    # Same format without CRC or padding
+    header = bytes((header[0], header[1] | 0x01, header[2] & 0xFD, header[3]))
+    length, samples, sample_rate, _ = _parse_frame_header(header + b'\0', 0)
+    count = -(-int(seconds * sample_rate) // samples)
+    return (header + bytes(length - 4)) * count
+
+def build_beep_track(beep, silence_seconds):
+    """
+    Build one beep cycle: the beep followed by silence, as a single MP3.
+
+    Args:
+        beep (bytes): The beep MP3
+        silence_seconds (float): Seconds of silence after the beep
+
+    Returns:
+        bytes: The MP3, or None if the beep has no MPEG Layer III frames
+    """
+    frames, header = _mp3_frames(beep)
+    if header is None:
+        return None
+    return frames + silent_mp3_frames(header, silence_seconds)
+
+class AudioAssetCache:
+    """Audio files held in memory and kept in sync with a directory."""
+
+    def __init__(self, directory=AUDIO_DIR, reload_interval=RELOAD_CHECK_SECONDS):
+        """
+        Args:
+            directory (str): Directory with the audio files
+            reload_interval (float): Seconds between checks for changed files
+        """
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        # Held for a whole reload, so that only one runs at a time
+        self._reload_lock = threading.Lock()
+        # Key: file name, Value: AudioAsset
+        self._assets = {}
+        # Assets built in memory rather than loaded from the directory
+        self._generated = {}
+        # Key: asset name, Value: (source name, build function)
+        self._derived = {}
+        self._next_check = 0.0
+        self.reload()
+        # A reload thread may have held the locks when the process forked
+        os.register_at_fork(after_in_child=self._reset_locks)
+
+    def _reset_locks(self):
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def reload(self):
+        """Load new and changed files from the directory and drop removed ones."""
+        with self._reload_lock:
+            self._reload()
+
+    def _reload_in_background(self):
+        try:
+            self._reload()
+        finally:
+            self._reload_lock.release()
+
+    def _start_reload(self):
+        # Requests never wait for a reload, or start one while one is running
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        self._next_check = time.monotonic() + self.reload_interval
+        try:
+            threading.Thread(target=self._reload_in_background, name='audio-reload',
+                             daemon=True).start()
+        except RuntimeError as e:
+            self._reload_lock.release()
+            logger.error(f"Error starting audio reload: {str(e)}")
+
+    def _reload(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except OSError as e:
+            logger.error(f"Error scanning audio directory: {str(e)}")
+            entries = []
+
+        with self._lock:
+            assets = {}
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError as e:
+                    # Removed or replaced since the scan; picked up on the next one
+                    logger.warning(f"Skipping audio file {entry.name}: {str(e)}")
+                    continue
+                current = self._assets.get(entry.name)
+                if current and current.mtime == stat.st_mtime and current.size == stat.st_size:
+                    assets[entry.name] = current
+                    continue
+                try:
+                    with open(entry.path, 'rb') as f:
+                        body = f.read()
+                except OSError as e:
+                    logger.error(f"Error loading audio file {entry.name}: {str(e)}")
+                    continue
+                if entry.name.endswith('.mp3') and not _is_valid_mp3(body):
+                    logger.error(f"Skipping invalid audio file {entry.name}")
+                    continue
+                assets[entry.name] = _make_asset(entry.name, body, stat.st_mtime, stat.st_size)
+                logger.info(f"Loaded audio file {entry.name} ({len(body)} bytes)")
+            assets.update(self._generated)
+            for name, (source, build) in self._derived.items():
+                self._build_derived(assets, name, source, build)
+            self._assets = assets
+            self._next_check = time.monotonic() + self.reload_interval
+
+    def add(self, name, body):
+        """
+        Add an asset built in memory, e.g. a generated audio track.
+
+        Args:
+            name (str): File name the asset is served under
+            body (bytes): The asset data
+
+        Returns:
+            AudioAsset: The cached asset
+        """
+        asset = _make_asset(name, body)
+        with self._lock:
+            self._generated[name] = asset
+            self._assets[name] = asset
+        return asset
+
+    def add_derived(self, name, source, build):
+        """
+        Add an asset built from another asset; it is rebuilt whenever the
+        source file changes.
+
+        Args:
+            name (str): File name the asset is served under
+            source (str): File name of the source asset
+            build (callable): Function taking the source bytes and returning
+                the asset bytes, or None if it cannot be built
+        """
+        with self._lock:
+            self._derived[name] = (source, build)
+            assets = dict(self._assets)
+            self._build_derived(assets, name, source, build)
+            self._assets = assets
+
+    def _build_derived(self, assets, name, source, build):
+        source_asset = assets.get(source)
+        current = self._assets.get(name)
+        if source_asset is None:
+            assets.pop(name, None)
+            return
+        if current is not None and current.mtime == source_asset.mtime \
+                and current.size == source_asset.size:
+            assets[name] = current
+            return
+        try:
+            body = build(source_asset.body)
+        except Exception as e:
+            logger.error(f"Error building audio file {name}: {str(e)}")
+            body = None
+        if body is None:
+            assets.pop(name, None)
+            return
+        # Record the source's mtime and size so the asset is rebuilt when it changes
+        assets[name] = _make_asset(name, body, source_asset.mtime, source_asset.size)
+        logger.info(f"Built audio file {name} from {source} ({len(body)} bytes)")
+
+    def get(self, name):
+        """
+        Get an asset by file name.
+
+        Returns:
+            AudioAsset: The asset, or None if there is no such file
+        """
+        if time.monotonic() >= self._next_check:
+            self._start_reload()
+        return self._assets.get(name)
+
+    def respond(self, name, if_none_match=None, range_header=None, if_range=None):
+        """
+        Build the response for a request for an audio file.
+
+        Args:
+            name (str): Requested file name
+            if_none_match (str): The If-None-Match header, if any
+            range_header (str): The Range header, if any
+            if_range (str): The If-Range header, if any
+
+        Returns:
+            AudioResponse: Status, headers and body to send
+        """
+        asset = self.get(name)
+        if asset is None:
+            if name.endswith('.mp3') and self.get(name + '.txt') is not None:
+                # The MP3 doesn't exist but we have a placeholder, use Twilio's demos
+                return AudioResponse(302, {'Location': FALLBACK_AUDIO_URL},
+                                     b"Redirecting to Twilio demo audio")
+            return AudioResponse(404, {'Content-Type': 'text/plain'}, b"Audio file not found")
+
+        headers = {
+            'ETag': asset.etag,
+            'Cache-Control': f'public, max-age={CACHE_MAX_AGE}',
+            'Accept-Ranges': 'bytes'
+        }
+        if if_none_match and _etag_matches(if_none_match, asset.etag):
+            return AudioResponse(304, headers, b'')
+
+        headers['Content-Type'] = asset.content_type
+        size = len(asset.body)
+        byte_range = None
+        if range_header and (not if_range or if_range == asset.etag):
+            byte_range = _parse_range(range_header, size)
+        if byte_range is False:
+            headers['Content-Range'] = f'bytes */{size}'
+            return AudioResponse(416, headers, b'')
+        if byte_range is None:
+            return AudioResponse(200, headers, asset.body)
+
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        return AudioResponse(206, headers, asset.body[start:end + 1])
+
+# Audio files shared by the whole process, loaded at startup
+audio_assets = AudioAssetCache()
+audio_assets.add_derived(BEEP_TRACK_NAME, BEEP_SOURCE_NAME,
+                         lambda beep: build_beep_track(beep, BEEP_SILENCE_SECONDS))
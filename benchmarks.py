@@ -0,0 +1,1276 @@
+"""
+Microbenchmarks for the telephony testing platform.
+
+Run a single benchmark with:
+    python benchmarks.py <name> [options]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+def _timeit(func, iterations):
+    """
+    Time repeated calls of a function.
+
+    Args:
+        func (callable): Function to call with no arguments
+        iterations (int): Number of calls
+
+    Returns:
+        float: Average time per call in microseconds
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - start
+    return elapsed / iterations * 1e6
+
+def bench_audio(args):
+    """Audio file requests: send_from_directory per request vs. the in-memory asset cache."""
+    from flask import Flask, send_from_directory
+    from app import app
+    from audio_assets import AUDIO_DIR, audio_assets
+
+    legacy_app = Flask('legacy')
+
+    @legacy_app.route('/static/audio/<filename>')
+    def legacy_serve_audio(filename):
+        if os.path.exists(os.path.join(AUDIO_DIR, filename)):
+            return send_from_directory(AUDIO_DIR, filename)
+        return 'Audio file not found', 404
+
+    name = 'beep-02.mp3'
+    etag = audio_assets.get(name).etag
+    legacy_client = legacy_app.test_client()
+    client = app.test_client()
+    iterations = min(args.iterations, 5000)
+    print(f"GET /static/audio/{name}, {iterations} requests")
+    for label, func in [
+        ('send_from_directory', lambda: legacy_client.get(f'/static/audio/{name}').close()),
+        ('asset cache', lambda: client.get(f'/static/audio/{name}').close()),
+        ('asset cache, 304', lambda: client.get(f'/static/audio/{name}',
+                                                headers={'If-None-Match': etag}).close()),
+        ('asset cache, range', lambda: client.get(f'/static/audio/{name}',
+                                                  headers={'Range': 'bytes=0-1023'}).close()),
+    ]:
+        print(f"{label:<20} {_timeit(func, iterations):8.1f}us/request")
+
+def _start_fake_twilio(latency, fail_every=0):
+    """
+    Start a local HTTP server answering Twilio call fetch and update requests.
+
+    Args:
+        latency (float): Seconds each response is delayed
+        fail_every (int): Answer every Nth request with a 429, 0 for never
+
+    Returns:
+        tuple: (server, base URL, stats dict with request and connection counts)
+    """
+    import json
+    import socket
+    import uuid
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    stats = {'requests': 0, 'connections': 0}
+    lock = threading.Lock()
+
+    class FakeTwilio(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            # Headers and body are written separately; don't let Nagle delay the body
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with lock:
+                stats['connections'] += 1
+
+        def _respond(self, status):
+            length = int(self.headers.get('Content-Length') or 0)
+            self.rfile.read(length)
+            with lock:
+                stats['requests'] += 1
+                throttled = fail_every and stats['requests'] % fail_every == 0
+            time.sleep(latency)
+            call_sid = self.path.rsplit('/', 1)[-1].split('.')[0]
+            if call_sid == 'Calls':
+                # Creating a call
+                call_sid, status = 'CA' + uuid.uuid4().hex, 'queued'
+            if throttled:
+                code, body = 429, {'code': 20429, 'message': 'Too Many Requests', 'status': 429}
+            else:
+                code, body = 200, {'sid': call_sid, 'status': status}
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._respond('in-progress')
+
+        def do_POST(self):
+            self._respond('completed')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTwilio)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", stats
+
+def bench_twilio_batch(args):
+    """Twilio REST calls against a local fake API: client per call vs. cached client vs. batches."""
+    from twilio.rest import Client
+    import twilio_utils
+    from twilio_batch import fetch_call_statuses, hangup_calls
+
+    logging.getLogger('twilio').setLevel(logging.WARNING)
+    # Every throttled request logs its retry
+    logging.getLogger('twilio_batch').setLevel(logging.ERROR)
+    os.environ.setdefault('TWILIO_ACCOUNT_SID', 'AC' + '0' * 32)
+    os.environ.setdefault('TWILIO_AUTH_TOKEN', 'token')
+    calls = min(args.calls, 400)
+    call_sids = [f"CA{i:032d}" for i in range(calls)]
+    server, base_url, stats = _start_fake_twilio(latency=0.005)
+
+    def fresh_client():
+        # Previous behaviour: a new client and HTTP session for every request
+        client = Client(os.environ['TWILIO_ACCOUNT_SID'], os.environ['TWILIO_AUTH_TOKEN'])
+        client.api.base_url = base_url
+        return client
+
+    client = twilio_utils.get_twilio_client()
+    client.api.base_url = base_url
+    print(f"Fetching the status of {calls} calls, 5 ms server latency")
+    for label, func in [
+        ('client per call', lambda: [fresh_client().calls(sid).fetch() for sid in call_sids]),
+        ('cached client', lambda: [client.calls(sid).fetch() for sid in call_sids]),
+        ('batch, 8 concurrent', lambda: fetch_call_statuses(call_sids)),
+    ]:
+        stats.update(requests=0, connections=0)
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<22} {calls / elapsed:8.0f} calls/s, "
+              f"{stats['connections']:4d} connections opened")
+    server.shutdown()
+
+    server, base_url, stats = _start_fake_twilio(latency=0.005, fail_every=10)
+    client.api.base_url = base_url
+    start = time.perf_counter()
+    result = hangup_calls(call_sids, retries=5, backoff=0.01)
+    elapsed = time.perf_counter() - start
+    print(f"Hanging up {calls} calls with every 10th request throttled (429)")
+    print(f"  {len(result.results)} hung up, {len(result.errors)} failed, "
+          f"{stats['requests']} requests, {calls / elapsed:.0f} calls/s")
+    server.shutdown()
+
+def bench_signature(args):
+    """Webhook parsing and X-Twilio-Signature validation overhead."""
+    import io
+    import urllib.parse
+    from werkzeug.test import EnvironBuilder
+    from werkzeug.wrappers import Request
+    from twilio.request_validator import RequestValidator
+    from twilio_signature import SignatureValidator, parse_form, parse_form_pairs
+    from webhooks import WEBHOOK_FIELDS
+
+    # The fields Twilio sends with a voice webhook
+    fields = {
+        'AccountSid': 'AC' + 'a' * 32, 'ApiVersion': '2010-04-01', 'CallSid': 'CA' + 'b' * 32,
+        'CallStatus': 'ringing', 'Called': '+15550000000', 'CalledCity': 'SAN FRANCISCO',
+        'CalledCountry': 'US', 'CalledState': 'CA', 'CalledZip': '94105', 'Caller': '+15551234567',
+        'CallerCity': 'OAKLAND', 'CallerCountry': 'US', 'CallerState': 'CA', 'CallerZip': '94612',
+        'Direction': 'inbound', 'From': '+15551234567', 'FromCity': 'OAKLAND', 'FromCountry': 'US',
+        'FromState': 'CA', 'FromZip': '94612', 'To': '+15550000000', 'ToCity': 'SAN FRANCISCO',
+        'ToCountry': 'US', 'ToState': 'CA', 'ToZip': '94105'
+    }
+    body = urllib.parse.urlencode(fields).encode('ascii')
+    url = 'https://example.com/incoming_call'
+    names = WEBHOOK_FIELDS['incoming_call']
+    token = 'f' * 32
+    validator = SignatureValidator(token)
+    signature = validator.compute(url, fields.items())
+    reference = RequestValidator(token)
+
+    environ = EnvironBuilder(method='POST', data=body,
+                             content_type='application/x-www-form-urlencoded').get_environ()
+
+    def werkzeug_values():
+        # What request.values does: parse the query string and the form
+        request = Request(dict(environ, **{'wsgi.input': io.BytesIO(body)}))
+        return request.values['CallSid']
+
+    def cold_validate():
+        validator._verified.clear()
+        return validator.validate(url, body, signature)
+
+    iterations = min(args.iterations, 20000)
+    print(f"/incoming_call webhook, {len(fields)} fields, {len(body)} bytes, {iterations} iterations")
+    for label, func in [
+        ('request.values', werkzeug_values),
+        ('parse_form, 3 fields', lambda: parse_form(body, names)),
+        ('parse_form_pairs, all', lambda: parse_form_pairs(body)),
+        ('twilio RequestValidator', lambda: reference.validate(url, fields, signature)),
+        ('validate, uncached', cold_validate),
+        ('validate, cached retry', lambda: validator.validate(url, body, signature)),
+    ]:
+        print(f"  {label:<26} {_timeit(func, iterations):8.2f}us")
+
+def bench_storm(args):
+    """Outbound call storms against a local fake Twilio API: achieved vs. target rate per profile."""
+    from call_storage import set_call_store
+    from call_store_backends import MemoryCallStore
+    from call_storm import CallStorm
+    import twilio_utils
+
+    logging.getLogger('twilio').setLevel(logging.WARNING)
+    logging.getLogger('call_handler').setLevel(logging.WARNING)
+    os.environ.setdefault('TWILIO_ACCOUNT_SID', 'AC' + '0' * 32)
+    os.environ.setdefault('TWILIO_AUTH_TOKEN', 'token')
+    server, base_url, stats = _start_fake_twilio(latency=0.02)
+    client = twilio_utils.get_twilio_client()
+    client.api.base_url = base_url
+    calls = min(args.calls, 200)
+    print(f"{calls} calls per storm, 20 ms API latency")
+    for label, rate, profile, limit in [
+        ('constant 50/s', 50, 'constant', 1000),
+        ('ramp to 50/s over 2s', 50, 'ramp', 1000),
+        ('poisson 50/s', 50, 'poisson', 1000),
+        ('constant 50/s, 20 CPS limit', 50, 'constant', 20),
+    ]:
+        store = MemoryCallStore()
+        previous = set_call_store(store)
+        storm = CallStorm(['+15550000001'], '+15550000000', calls, rate, profile=profile,
+                          ramp_seconds=2.0, client=client, calls_per_second=limit)
+        summary = storm.run()
+        set_call_store(previous)
+        tracked = store.get_call_count()
+        print(f"  {label:<28} {summary['calls_per_second']:6.1f} calls/s in {summary['elapsed']:5.2f}s, "
+              f"{summary['placed']} placed, {tracked} tracked, create p95 {summary['p95_ms']:.0f} ms")
+    server.shutdown()
+
+def bench_twiml(args):
+    """Compare rendering TwiML per request with serving the cached bytes."""
+    from twilio_utils import generate_twiml_response, get_twiml, invalidate_twiml_cache
+    from ivr_flows import flows
+
+    invalidate_twiml_cache()
+    flow = flows.get()
+    print(f"{'response':<10} {'render (us)':>12} {'cached (us)':>12} {'speedup':>9}")
+    for node_id in flow.nodes:
+        render = _timeit(lambda: str(flow.nodes[node_id].render('https://example.com')).encode('utf-8'),
+                         args.iterations)
+        cached = _timeit(lambda: flow.twiml(node_id).body, args.iterations)
+        print(f"{node_id:<10} {render:>12.2f} {cached:>12.2f} {render / cached:>8.0f}x")
+    for response_type in ['busy', 'error', 'queued', 'hold']:
+        render = _timeit(lambda: str(generate_twiml_response(response_type)).encode('utf-8'),
+                         args.iterations)
+        cached = _timeit(lambda: get_twiml(response_type).body, args.iterations)
+        print(f"{response_type:<10} {render:>12.2f} {cached:>12.2f} {render / cached:>8.0f}x")
+
+def bench_ivr(args):
+    """Measure IVR flow compilation and per-webhook transitions as flows grow."""
+    from ivr_flows import CompiledFlow, flows
+    from twilio_utils import get_twiml
+
+    flow = flows.get()
+    message = _timeit(lambda: get_twiml('busy').body, args.iterations)
+    flow_time = _timeit(lambda: flow.twiml(flow.next_node('welcome', '2')).body, args.iterations)
+    print(f"default flow: transition + cached TwiML {flow_time:.3f} us "
+          f"(cached busy message alone {message:.3f} us)")
+
+    for size in [10, 1000, 10000]:
+        # A chain of menus; each offers 9 digits leading further down the chain
+        nodes = {}
+        for i in range(size):
+            nodes[f"menu{i}"] = {
+                'steps': [{'say': f"Menu {i}."},
+                          {'gather': {'say': "Choose an option.", 'num_digits': 1, 'timeout': 5}}],
+                'digits': {str(d): f"menu{(i + d) % size}" for d in range(1, 10)},
+                'otherwise': f"menu{i}"
+            }
+        t0 = time.perf_counter()
+        big = CompiledFlow({'start': 'menu0', 'nodes': nodes})
+        big.twiml('menu0')
+        compile_time = time.perf_counter() - t0
+        node_ids = [f"menu{i}" for i in range(0, size, max(size // 100, 1))]
+        transition = _timeit(lambda: [big.twiml(big.next_node(node_id, '5')).body
+                                      for node_id in node_ids], args.iterations // 100)
+        print(f"{size:>6,} nodes: compile + render {compile_time * 1e3:8.1f} ms, "
+              f"transition {transition / len(node_ids):.3f} us")
+
+def bench_routing(args):
+    """Measure routing dialed numbers to tenants as the number of numbers grows."""
+    from tenants import build_index, normalize_number, TenantRouter
+
+    e164 = _timeit(lambda: normalize_number('+15551230000'), args.iterations)
+    formatted = _timeit(lambda: normalize_number('(555) 123-0000'), args.iterations)
+    print(f"normalize: E.164 {e164:.3f} us, formatted {formatted:.3f} us")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in [10, 1000, 100000]:
+            # 10 numbers per tenant
+            tenants = {
+                f"tenant{t}": {'numbers': [f"+1555{t * 10 + n:07d}" for n in range(10)],
+                               'max_calls': 5}
+                for t in range(max(size // 10, 1))
+            }
+            path = os.path.join(tmpdir, f"tenants{size}.json")
+            with open(path, 'w') as f:
+                json.dump({'tenants': tenants}, f)
+            t0 = time.perf_counter()
+            build_index({'tenants': tenants})
+            build_time = time.perf_counter() - t0
+
+            router = TenantRouter(path)
+            router.reload()
+            numbers = [f"+1555{i:07d}" for i in range(0, size, max(size // 100, 1))]
+            hit = _timeit(lambda: [router.lookup(number) for number in numbers],
+                          args.iterations // 100) / len(numbers)
+            miss = _timeit(lambda: router.lookup('+15559999999'), args.iterations)
+            print(f"{size:>7,} numbers: lookup {hit:.3f} us, unrouted {miss:.3f} us, "
+                  f"rebuild {build_time * 1e3:8.1f} ms")
+
+def _admission_worker(path, worker_id, iterations, max_calls, results):
+    from call_store_backends import SqliteCallStore
+
+    store = SqliteCallStore(path)
+    admitted = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        call_sid = f"CA{worker_id:04d}{i:08d}"
+        if store.try_admit(call_sid, '+15550000000', '+15551111111', max_calls).status == 'admitted':
+            admitted += 1
+            store.end_call(call_sid)
+    results.put((admitted, time.perf_counter() - start))
+
+def bench_admission(args):
+    """Measure atomic admissions/sec on the shared SQLite store across processes."""
+    from call_store_backends import MemoryCallStore, SqliteCallStore
+
+    store = MemoryCallStore()
+    def admit_and_end():
+        if store.try_admit('CA1', '+15550000000', '+15551111111', 30).status == 'admitted':
+            store.end_call('CA1')
+    per_call = _timeit(admit_and_end, args.iterations)
+    print(f"memory, 1 process: {1e6 / per_call:,.0f} admissions/sec")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'calls.db')
+        SqliteCallStore(path)
+        iterations = max(args.iterations // 10, 1)
+        for workers in [1, 4, 16]:
+            results = multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(target=_admission_worker,
+                                        args=(path, i, iterations, 30, results))
+                for i in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            outcomes = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            # Workers run concurrently, so the slowest one bounds the wall time
+            elapsed = max(outcome[1] for outcome in outcomes)
+            admitted = sum(outcome[0] for outcome in outcomes)
+            print(f"sqlite, {workers:>2} processes: {admitted / elapsed:,.0f} admissions/sec "
+                  f"({admitted} admitted in {elapsed:.2f}s)")
+
+class _TimedLock:
+    """RLock wrapper recording how long the outermost acquisition is held."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._acquired_at = 0.0
+        self.hold_times = []
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            self._acquired_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            self.hold_times.append(time.perf_counter() - self._acquired_at)
+        self._lock.release()
+
+def _percentile(sorted_values, fraction):
+    """Return the value at the given fraction (0-1) of a sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def bench_admission_stress(args):
+    """
+    Hammer try_admit from hundreds of threads and verify the capacity limit.
+
+    Each thread repeatedly admits a call, checks the active count, keeps the
+    call for a millisecond and ends it. The benchmark fails if the count ever
+    exceeds the limit.
+    """
+    from call_store_backends import MemoryCallStore
+
+    store = MemoryCallStore()
+    store._lock = _TimedLock()
+    max_calls = args.max_calls
+    barrier = threading.Barrier(args.threads)
+    stats = {'admitted': 0, 'busy': 0, 'peak': 0}
+    stats_lock = threading.Lock()
+
+    def worker(worker_id):
+        admitted = busy = peak = 0
+        barrier.wait()
+        for i in range(args.iterations):
+            call_sid = f"CA{worker_id:04d}{i:08d}"
+            result = store.try_admit(call_sid, '+15550000000', '+15551111111', max_calls)
+            if result.status == 'admitted':
+                admitted += 1
+                peak = max(peak, store.get_call_count())
+                time.sleep(0.001)
+                store.end_call(call_sid)
+            else:
+                busy += 1
+        with stats_lock:
+            stats['admitted'] += admitted
+            stats['busy'] += busy
+            stats['peak'] = max(stats['peak'], peak)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    hold_times = sorted(store._lock.hold_times)
+    print(f"{args.threads} threads x {args.iterations} attempts in {elapsed:.2f}s")
+    print(f"admitted: {stats['admitted']}, busy: {stats['busy']}, "
+          f"peak active: {stats['peak']} (limit {max_calls})")
+    print(f"lock hold time: p50 {_percentile(hold_times, 0.5) * 1e6:.2f}us, "
+          f"p99 {_percentile(hold_times, 0.99) * 1e6:.2f}us, "
+          f"max {hold_times[-1] * 1e6:.2f}us")
+    if stats['peak'] > max_calls:
+        print("FAILED: capacity limit exceeded")
+        return 1
+    return 0
+
+def bench_export(args):
+    """Exporting ended calls: webhook-thread cost, batch writes and per-day aggregation."""
+    import gzip
+    import random
+    import tracemalloc
+    from call_export import CallExporter, FORMATS, aggregate, parquet_available
+    from call_store_backends import CallRecord, IvrSelection
+
+    rng = random.Random(1)
+    now = time.time()
+    numbers = [f"+1555{i:07d}" for i in range(200)]
+    selections = list(IvrSelection)
+
+    def make_calls(count, days=1, until=now):
+        calls = []
+        for i in range(count):
+            end_time = until - days * 86400 * (count - i) / count
+            calls.append((CallRecord(f"CA{i:032x}", rng.choice(numbers), numbers[0],
+                                     end_time - rng.uniform(5, 600), rng.choice(selections)),
+                          end_time))
+        return calls
+
+    iterations = args.iterations
+    calls = make_calls(iterations)
+    with tempfile.TemporaryDirectory() as directory:
+        # Synchronous: what a webhook would pay to append each call itself
+        path = os.path.join(directory, 'sync.jsonl.gz')
+
+        def write_sync(call, end_time):
+            line = json.dumps({'call_sid': call.call_sid, 'from_number': call.from_number,
+                               'to_number': call.to_number, 'start_time': call.start_time,
+                               'end_time': end_time, 'ivr_selection': call.ivr_selection.label})
+            with gzip.open(path, 'at') as f:
+                f.write(line + '\n')
+
+        start = time.perf_counter()
+        for call, end_time in calls:
+            write_sync(call, end_time)
+        sync = (time.perf_counter() - start) / iterations * 1e6
+
+        exporter = CallExporter(os.path.join(directory, 'batched'), flush_seconds=3600,
+                                batch_size=iterations * 2)
+        exporter.start()
+        start = time.perf_counter()
+        for call, end_time in calls:
+            exporter.record(call, end_time)
+        batched = (time.perf_counter() - start) / iterations * 1e6
+        exporter.close()
+        print(f"per ended call on the webhook thread ({iterations} calls)")
+        print(f"  synchronous gzip append {sync:8.2f}us")
+        print(f"  CallExporter.record     {batched:8.2f}us")
+
+    batch = 100000
+    calls = make_calls(batch)
+    print(f"writing batches of {batch:,} calls")
+    for name in FORMATS:
+        if name == 'parquet' and not parquet_available():
+            print("  parquet  skipped, pyarrow is not installed")
+            continue
+        with tempfile.TemporaryDirectory() as directory:
+            exporter = CallExporter(directory, formats=[name], flush_seconds=3600,
+                                    batch_size=batch * 2)
+            exporter.start()
+            for call, end_time in calls:
+                exporter.record(call, end_time)
+            start = time.perf_counter()
+            exporter.flush()
+            elapsed = time.perf_counter() - start
+            exporter.close()
+            size = sum(os.path.getsize(os.path.join(directory, entry))
+                       for entry in os.listdir(directory))
+            print(f"  {name:<8} {batch / elapsed:10,.0f} calls/s  "
+                  f"{size / 1024 / 1024:6.2f}MB per 100k calls ({size / batch:5.1f} bytes/call)")
+
+    total = 1000000
+    with tempfile.TemporaryDirectory() as directory:
+        exporter = CallExporter(directory, flush_seconds=3600, batch_size=batch * 2)
+        exporter.start()
+        for offset in range(0, total, batch):
+            # Each batch covers the next 0.7 days
+            until = now - (total - offset - batch) / batch * 0.7 * 86400
+            for call, end_time in make_calls(batch, days=0.7, until=until):
+                exporter.record(call, end_time)
+            exporter.flush()
+        exporter.close()
+        print(f"aggregating {total:,} calls ending over one week")
+        for name in exporter.formats:
+            start = time.perf_counter()
+            days = aggregate(directory, name)
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            aggregate(directory, name)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            calls_seen = sum(day['calls'] for day in days.values())
+            print(f"  {name:<8} {elapsed:6.2f}s ({calls_seen / elapsed:9,.0f} calls/s)  "
+                  f"peak {peak / 1024 / 1024:5.1f}MB  {len(days)} days")
+
+def bench_history(args):
+    """Fill the call history with a million calls and time window queries."""
+    import random
+    from call_history import CallHistory
+    from call_store_backends import CallRecord, IvrSelection
+
+    capacity = 1000000
+    history = CallHistory(capacity)
+    now = time.time()
+    numbers = [f"+1555{i:07d}" for i in range(200)]
+    selections = list(IvrSelection)
+    rng = random.Random(1)
+
+    start = time.perf_counter()
+    for i in range(capacity):
+        end_time = now - (capacity - i) * 0.5
+        history.record(CallRecord(f"CA{i}", rng.choice(numbers), numbers[0],
+                                  end_time - rng.uniform(5, 600), rng.choice(selections)),
+                       end_time=end_time)
+    elapsed = time.perf_counter() - start
+    print(f"recorded {capacity:,} calls: {elapsed / capacity * 1e6:.2f}us per call")
+
+    for label, window in [('1 hour', 3600), ('1 day', 86400), ('1 week', 7 * 86400)]:
+        per_query = _timeit(lambda: history.get_stats(now - window, now),
+                            max(args.iterations // 100, 1))
+        stats = history.get_stats(now - window, now)
+        print(f"stats over {label:<7}: {per_query / 1000:8.3f}ms "
+              f"({stats['calls']:,} calls, p95 {stats['p95_duration']:.0f}s)")
+
+def _legacy_call_record(call_sid, from_number, to_number):
+    """Call record as stored before CallRecord: a dict with an ISO timestamp."""
+    from datetime import datetime
+
+    return {
+        'call_sid': call_sid,
+        'from_number': from_number,
+        'to_number': to_number,
+        'start_time': datetime.utcnow().isoformat(),
+        'ivr_selection': None
+    }
+
+def bench_journal(args):
+    """Call throughput with and without the journal, and recovery time."""
+    import logging
+    from call_journal import CallJournal
+    from call_store_backends import MemoryCallStore
+
+    logging.disable(logging.INFO)
+    iterations = args.iterations
+    counter_values = iter(range(10 ** 9))
+
+    def call_sequence(store):
+        call_sid = f"CA{next(counter_values):010d}"
+        store.try_admit(call_sid, '+15550000000', '+15551111111', None)
+        store.update_ivr_selection(call_sid, 'beep')
+        store.end_call(call_sid)
+
+    with tempfile.TemporaryDirectory() as directory:
+        memory = MemoryCallStore()
+        journal = CallJournal(os.path.join(directory, 'throughput'))
+        journaled = MemoryCallStore(journal=journal)
+        print(f"{iterations} calls (admit, IVR, end)")
+        for label, store in [('in-memory only', memory), ('journaled', journaled)]:
+            per_call = _timeit(lambda: call_sequence(store), iterations)
+            print(f"  {label:<16} {1e6 / per_call:9.0f} calls/s ({per_call:6.2f}us/call)")
+        journal.close()
+
+        for active, tail in [(1000, 10000), (10000, 100000)]:
+            path = os.path.join(directory, f'recovery-{active}')
+            journal = CallJournal(path, snapshot_interval=10 ** 9)
+            store = MemoryCallStore(journal=journal)
+            for i in range(active):
+                store.try_admit(f"CAactive{i:08d}", '+15550000000', '+15551111111', None)
+            # Snapshot the active calls, then leave a tail of churn to replay
+            journal.rotate(store.get_active_calls())
+            for _ in range(tail // 3):
+                call_sequence(store)
+            journal.close()
+
+            start = time.perf_counter()
+            journal = CallJournal(path)
+            recovered = MemoryCallStore(journal=journal)
+            elapsed = time.perf_counter() - start
+            journal.close()
+            print(f"recovery of {recovered.get_call_count()} active calls + {tail} journal records: "
+                  f"{elapsed * 1000:.1f}ms")
+
+def bench_logging(args):
+    """/incoming_call throughput with synchronous DEBUG logging vs. queued JSON logging."""
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+    import queue
+    import call_storage
+    import logging_config
+    from call_store_backends import MemoryCallStore
+
+    logging.disable(logging.NOTSET)
+    from app import app
+    client_local = threading.local()
+    requests = min(args.iterations, 5000)
+    workers = 8
+
+    def sync_handler(stream, level):
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter(logging_config.TEXT_FORMAT))
+        return handler, level, None
+
+    def queued_handler(stream, level):
+        log_queue = queue.Queue(maxsize=logging_config.DEFAULT_QUEUE_SIZE)
+        writer = logging_config.BatchingLogWriter(log_queue, stream, logging_config.JsonFormatter())
+        writer.start()
+        return logging_config.QueueLogHandler(log_queue), level, writer
+
+    def post(i):
+        client = getattr(client_local, 'client', None)
+        if client is None:
+            client = client_local.client = app.test_client()
+        client.post('/incoming_call', data={
+            'CallSid': f"CA{i:08d}", 'From': '+15550000000', 'To': '+15551111111'}).close()
+
+    class SlowStream:
+        """Log sink where every flush costs a blocking write, like a pipe to a collector."""
+
+        def __init__(self, stream, latency):
+            self.stream = stream
+            self.latency = latency
+
+        def write(self, text):
+            self.stream.write(text)
+
+        def flush(self):
+            self.stream.flush()
+            time.sleep(self.latency)
+
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    previous_store = call_storage.get_call_store()
+    dropped = logging_config.LOG_DROPPED.labels()
+    os.environ['MAX_CALLS'] = str(requests + 1)
+    print(f"{requests} POST /incoming_call from {workers} threads")
+    try:
+        for sink, latency in [('file', 0), ('sink with 100us writes', 0.0001)]:
+            print(f"{sink}:")
+            for label, make_handler, level in [
+                ('sync text, DEBUG (before)', sync_handler, logging.DEBUG),
+                ('queued JSON, INFO', queued_handler, logging.INFO),
+                ('queued JSON, DEBUG', queued_handler, logging.DEBUG),
+            ]:
+                with tempfile.TemporaryFile('w') as file:
+                    stream = SlowStream(file, latency) if latency else file
+                    handler, level, writer = make_handler(stream, level)
+                    root.handlers = [handler]
+                    root.setLevel(level)
+                    call_storage.set_call_store(MemoryCallStore())
+                    dropped_before = dropped.value
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        list(executor.map(post, range(requests)))
+                    elapsed = time.perf_counter() - start
+                    if writer is not None:
+                        writer.stop()
+                    print(f"  {label:<26} {requests / elapsed:8.0f} requests/s  "
+                          f"dropped {dropped.value - dropped_before}")
+    finally:
+        root.handlers, root.level = saved_handlers, saved_level
+        call_storage.set_call_store(previous_store)
+        del os.environ['MAX_CALLS']
+
+def bench_metrics(args):
+    """Cost of metrics collection on the webhook hot path."""
+    import tracemalloc
+    import call_storage
+    import metrics
+    from call_store_backends import MemoryCallStore
+
+    histogram = metrics.Histogram('bench_latency_seconds', "Benchmark histogram.")
+    counter = metrics.Counter('bench_total', "Benchmark counter.")
+    child = histogram.labels()
+    count = counter.labels()
+    iterations = args.iterations
+    print(f"{iterations} iterations")
+    print(f"histogram observe   {_timeit(lambda: child.observe(0.0004), iterations) * 1000:8.0f}ns")
+    print(f"counter inc         {_timeit(count.inc, iterations) * 1000:8.0f}ns")
+
+    # Steady-state allocations: nothing should be retained per observation
+    tracemalloc.start()
+    for _ in range(1000):
+        child.observe(0.0004)
+    before = tracemalloc.take_snapshot()
+    for _ in range(iterations):
+        child.observe(0.0004)
+        count.inc()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print(f"retained after {iterations} observations: {retained} bytes "
+          f"(includes tracemalloc's own bookkeeping)")
+
+    # A webhook's storage work: admit, select IVR, end
+    plain = MemoryCallStore()
+    plain._lock = threading.RLock()
+    instrumented = MemoryCallStore()
+    previous = call_storage.set_call_store(instrumented)
+    counter_values = iter(range(10 ** 9))
+
+    def plain_call():
+        call_sid = f"CA{next(counter_values)}"
+        plain.try_admit(call_sid, '+15550000000', '+15551111111', 30)
+        plain.update_ivr_selection(call_sid, 'music')
+        plain.end_call(call_sid)
+
+    def instrumented_call():
+        call_sid = f"CA{next(counter_values)}"
+        call_storage.try_admit(call_sid, '+15550000000', '+15551111111', 30)
+        call_storage.update_ivr_selection(call_sid, 'music')
+        call_storage.end_call(call_sid)
+
+    try:
+        plain_us = _timeit(plain_call, iterations)
+        instrumented_us = _timeit(instrumented_call, iterations)
+    finally:
+        call_storage.set_call_store(previous)
+    print(f"call storage per call, uninstrumented {plain_us:8.2f}us")
+    print(f"call storage per call, instrumented   {instrumented_us:8.2f}us "
+          f"(+{instrumented_us - plain_us:.2f}us for 3 timed operations and 3 lock acquisitions)")
+
+    # For scale: the same call as three webhooks through the Flask app
+    import logging
+    logging.disable(logging.INFO)
+    from app import app
+    client = app.test_client()
+
+    def webhook_call():
+        fields = {'CallSid': f"CA{next(counter_values)}", 'From': '+15550000000',
+                  'To': '+15551111111'}
+        client.post('/incoming_call', data=fields).close()
+        client.post('/handle_ivr', data=dict(fields, Digits='1')).close()
+        client.post('/call_status', data=dict(fields, CallStatus='completed')).close()
+
+    webhook_us = _timeit(webhook_call, min(iterations, 2000))
+    print(f"webhooks per call (3 requests)        {webhook_us:8.2f}us")
+
+def bench_reaper(args):
+    """Measure expiring calls from the reaper's heap vs. scanning every call."""
+    import random
+    from call_reaper import CallReaper
+    from call_store_backends import CallRecord
+
+    # Every reaped call logs a warning
+    logging.getLogger('call_reaper').setLevel(logging.ERROR)
+    for calls in [10000, 100000, 1000000]:
+        start = 1000000.0
+        active = {}
+        reaper = CallReaper(active.get, active.pop, max_lifetime=4 * 3600, idle_timeout=120)
+        for i in range(calls):
+            call = CallRecord(f"CA{i:032d}", '+15550000000', '+15550000001',
+                              start + random.random() * 3600)
+            active[call.call_sid] = call
+        t0 = time.perf_counter()
+        for call in active.values():
+            reaper.schedule(call, now=call.start_time)
+        schedule = (time.perf_counter() - t0) / calls
+
+        # Each tick expires the calls that were admitted in the last second
+        now = start + 120
+        ticks = 100
+        scan_total = heap_total = 0.0
+        for _ in range(ticks):
+            now += 1.0
+            t0 = time.perf_counter()
+            [sid for sid, call in active.items() if call.start_time + 120 <= now]
+            scan_total += time.perf_counter() - t0
+            t0 = time.perf_counter()
+            reaper.reap(now)
+            heap_total += time.perf_counter() - t0
+        print(f"{calls:,} scheduled calls ({calls // 3600} expire per tick)")
+        print(f"  schedule:            {schedule * 1e6:8.2f} us/call")
+        print(f"  full scan per tick:  {scan_total / ticks * 1e3:8.3f} ms")
+        print(f"  heap reap per tick:  {heap_total / ticks * 1e3:8.3f} ms")
+
+def bench_records(args):
+    """Measure memory per active call and read-path allocations."""
+    import tracemalloc
+    from call_store_backends import MemoryCallStore
+
+    numbers = [f"+1555{i:07d}" for i in range(50)]
+
+    def webhook_value(value):
+        # Request parsing gives every webhook its own copy of the strings
+        return ''.join(list(value))
+
+    for calls in [10000, 100000]:
+        print(f"{calls:,} active calls")
+
+        # Legacy representation: dict of dicts, copied on read
+        tracemalloc.start()
+        legacy = {}
+        for i in range(calls):
+            call_sid = f"CA{i:032d}"
+            legacy[call_sid] = _legacy_call_record(
+                call_sid, webhook_value(numbers[i % 50]), webhook_value(numbers[0]))
+        legacy_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        snapshot = [call.copy() for call in legacy.values()]
+        legacy_read = tracemalloc.get_traced_memory()[1] - before
+        del snapshot
+        tracemalloc.stop()
+        del legacy
+
+        # CallRecord representation in the memory store
+        tracemalloc.start()
+        store = MemoryCallStore()
+        for i in range(calls):
+            store.add_call(f"CA{i:032d}", webhook_value(numbers[i % 50]),
+                           webhook_value(numbers[0]))
+        store_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        snapshot = store.get_active_calls()
+        store_read = tracemalloc.get_traced_memory()[1] - before
+        del snapshot
+        tracemalloc.stop()
+        del store
+
+        print(f"  dict records:   {legacy_size / calls:7.0f} bytes/call, "
+              f"read allocates {legacy_read / calls:6.1f} bytes/call")
+        print(f"  CallRecord:     {store_size / calls:7.0f} bytes/call, "
+              f"read allocates {store_read / calls:6.1f} bytes/call")
+
+def bench_calls_api(args):
+    """Measure /api/calls responses for a large set of active calls: full list vs. one page."""
+    from app import app
+    from call_storage import set_call_store
+    from call_store_backends import MemoryCallStore
+
+    client = app.test_client()
+    for calls in [1000, 10000]:
+        store = MemoryCallStore()
+        previous = set_call_store(store)
+        for i in range(calls):
+            store.add_call(f"CA{i:032d}", '+15550000000', '+15550000001')
+        iterations = max(20, min(args.iterations, 200000 // calls))
+        print(f"{calls:,} active calls, {iterations} requests")
+        for label, url in [('full list', '/api/calls'),
+                           ('limit=50', '/api/calls?limit=50'),
+                           ('offset=5000&limit=50', '/api/calls?offset=5000&limit=50')]:
+            size = len(client.get(url).data)
+            print(f"  {label:<22} {_timeit(lambda: client.get(url).close(), iterations):9.1f}us/request "
+                  f"{size:>10,} bytes")
+        set_call_store(previous)
+
+def bench_contention(args):
+    """Webhook write latency while many threads read the active calls."""
+    import json
+    from call_store_backends import MemoryCallStore
+
+    class LockedReadStore(MemoryCallStore):
+        """Read path before snapshots: copy the calls under the lock, then encode."""
+
+        def get_snapshot(self):
+            with self._lock:
+                calls = [call.to_dict() for call in self._active_calls.values()]
+            return json.dumps(calls).encode('utf-8')
+
+    def run(store, read):
+        for i in range(30):
+            store.try_admit(f"CAbase{i}", '+15550000000', '+15551111111')
+        stop = threading.Event()
+
+        def reader():
+            while not stop.is_set():
+                read(store)
+
+        readers = [threading.Thread(target=reader) for _ in range(args.threads)]
+        for thread in readers:
+            thread.start()
+
+        latencies = []
+        for i in range(args.iterations):
+            call_sid = f"CA{i:08d}"
+            start = time.perf_counter()
+            store.try_admit(call_sid, '+15550000000', '+15551111111')
+            store.update_ivr_selection(call_sid, 'music')
+            store.end_call(call_sid)
+            latencies.append(time.perf_counter() - start)
+
+        stop.set()
+        for thread in readers:
+            thread.join()
+        latencies.sort()
+        return latencies
+
+    readers = args.threads
+    print(f"{readers} reader threads, {args.iterations} webhook write sequences")
+    for label, store, read in [
+        ('locked reads', LockedReadStore(), lambda store: store.get_snapshot()),
+        ('snapshot reads', MemoryCallStore(), lambda store: store.get_snapshot().to_json()),
+    ]:
+        latencies = run(store, read)
+        print(f"{label:<15} write latency p50 {_percentile(latencies, 0.5) * 1e6:8.1f}us  "
+              f"p99 {_percentile(latencies, 0.99) * 1e6:8.1f}us  "
+              f"max {latencies[-1] * 1e6:8.1f}us")
+
+def _free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _start_server(command, base_url, timeout=15.0, env=None):
+    """Start a server subprocess and wait until it answers requests."""
+    import subprocess
+    import urllib.request
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + '/api/call_count', timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"Server did not start: {' '.join(command)}")
+
+def _long_poll_client(base_url, stop):
+    """Keep a dashboard long-poll request open until stopped."""
+    import json
+    import urllib.request
+    after = None
+    while not stop.is_set():
+        url = base_url + '/api/events/poll'
+        if after is not None:
+            url += f'?after={after}&timeout=5'
+        try:
+            with urllib.request.urlopen(url, timeout=30) as response:
+                after = json.loads(response.read())['last_id']
+        except OSError:
+            time.sleep(0.1)
+
+def _post_form(url, fields):
+    """POST form fields, returning the response body and the request's latency."""
+    import urllib.parse
+    import urllib.request
+    data = urllib.parse.urlencode(fields).encode('ascii')
+    start = time.perf_counter()
+    with urllib.request.urlopen(urllib.request.Request(url, data=data, method='POST'),
+                                timeout=30) as response:
+        body = response.read()
+    return body, time.perf_counter() - start
+
+def bench_cluster(args):
+    """Run a local cluster: shard lookups, lease costs and the cluster-wide limit under load."""
+    import random
+    import subprocess
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    from cluster import shard_owner, CoordinatorClient
+    from coordinator import CoordinationStore
+
+    call_sid = 'CA' + '0123456789abcdef' * 2
+    for size in [2, 8, 32]:
+        members = [(f"http://10.0.0.{i}:5000", f"http://10.0.0.{i}:5000") for i in range(size)]
+        print(f"shard lookup, {size:>2} nodes: "
+              f"{_timeit(lambda: shard_owner(members, call_sid), args.iterations):.3f} us")
+
+    # The coordinator and the nodes run as separate processes, as deployed
+    coordinator_url = f"http://127.0.0.1:{_free_port()}"
+    processes = [subprocess.Popen([sys.executable, 'coordinator.py', '--host', '127.0.0.1',
+                                   '--port', coordinator_url.rsplit(':', 1)[1]],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    client = CoordinatorClient(coordinator_url)
+
+    def leases():
+        # A heartbeat without a URL reads the cluster's state without joining it
+        return client.heartbeat('bench', 'bench', None)['leases']
+
+    def lease(coordinator):
+        coordinator.acquire('bench', 'bench', 'CA1', 30)
+        coordinator.release('CA1')
+
+    heartbeat = 0.5
+    urls = []
+    try:
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                leases()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        print(f"lease + release: in-process {_timeit(lambda: lease(CoordinationStore()), args.iterations):.1f} us, "
+              f"over HTTP {_timeit(lambda: lease(client), args.iterations // 10):.1f} us")
+
+        # A local cluster of async servers sharing the coordinator
+        for _ in range(3):
+            url = f"http://127.0.0.1:{_free_port()}"
+            env = dict(os.environ, CLUSTER_COORDINATOR=coordinator_url, CLUSTER_NODE_URL=url,
+                       MAX_CALLS=str(args.max_calls), CLUSTER_HEARTBEAT_SECONDS=str(heartbeat),
+                       REAPER_ENABLED='false', WAITING_ROOM='false', LOG_LEVEL='WARNING')
+            processes.append(_start_server([sys.executable, 'async_app.py', '--host', '127.0.0.1',
+                                            '--port', url.rsplit(':', 1)[1]], url, env=env))
+            urls.append(url)
+        # Wait until every node has seen the others
+        time.sleep(heartbeat * 2)
+        members = [(url, url) for url in urls]
+
+        # Unloaded latency of a webhook handled where it arrives vs. forwarded to its owner
+        idle = {'local': [], 'forwarded': []}
+        for index in range(100):
+            sid = f"CI{index:032x}"
+            target = urls[index % len(urls)]
+            _, latency = _post_form(target + '/incoming_call',
+                                    {'CallSid': sid, 'From': '+15550000000', 'To': '+15551111111'})
+            idle['local' if shard_owner(members, sid)[1] == target else 'forwarded'].append(latency)
+            _post_form(target + '/call_status', {'CallSid': sid, 'CallStatus': 'completed'})
+        print("incoming_call, one at a time: " + ", ".join(
+            f"{kind} p50 {sorted(values)[len(values) // 2] * 1e3:.2f} ms"
+            for kind, values in idle.items() if values))
+
+        latencies = {'local': [], 'forwarded': []}
+        outcomes = {'admitted': 0, 'busy': 0}
+        peak = [0]
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def sample_leases():
+            while not stop.is_set():
+                peak[0] = max(peak[0], leases())
+                time.sleep(0.005)
+
+        def simulate_call(index):
+            sid = f"CA{index:032x}"
+            owner = shard_owner(members, sid)[1]
+            target = random.choice(urls)
+            body, latency = _post_form(target + '/incoming_call',
+                                       {'CallSid': sid, 'From': '+15550000000', 'To': '+15551111111'})
+            admitted = b'<Gather' in body
+            with lock:
+                latencies['local' if target == owner else 'forwarded'].append(latency)
+                outcomes['admitted' if admitted else 'busy'] += 1
+            if admitted:
+                time.sleep(random.uniform(0.05, 0.2))
+            _post_form(random.choice(urls) + '/call_status', {'CallSid': sid, 'CallStatus': 'completed'})
+
+        sampler = threading.Thread(target=sample_leases, daemon=True)
+        sampler.start()
+        with ThreadPoolExecutor(max_workers=min(args.threads, 64)) as pool:
+            list(pool.map(simulate_call, range(args.calls)))
+        stop.set()
+        sampler.join()
+
+        for kind, values in latencies.items():
+            values.sort()
+            if values:
+                print(f"incoming_call {kind:>9}: p50 {values[len(values) // 2] * 1e3:6.2f} ms, "
+                      f"p99 {values[min(int(len(values) * 0.99), len(values) - 1)] * 1e3:6.2f} ms "
+                      f"({len(values)} calls)")
+        time.sleep(heartbeat * 2)
+        with urllib.request.urlopen(urls[0] + '/api/dashboard_data', timeout=10) as response:
+            merged = json.loads(response.read())
+        print(f"3 nodes, MAX_CALLS={args.max_calls}: {outcomes['admitted']} admitted, "
+              f"{outcomes['busy']} busy, peak leases {peak[0]} "
+              f"({'within' if peak[0] <= args.max_calls else 'OVER'} the limit); afterwards "
+              f"{merged['count']} calls and {leases()} leases across {len(merged['nodes'])} nodes")
+
+        # A node dies holding calls: its leases are freed when its heartbeat expires
+        for index in range(args.max_calls):
+            _post_form(random.choice(urls) + '/incoming_call',
+                       {'CallSid': f"CB{index:032x}", 'From': '+15550000000', 'To': '+15551111111'})
+        before = leases()
+        start = time.perf_counter()
+        processes[1].kill()
+        while leases() == before:
+            time.sleep(0.01)
+        print(f"node killed: its {before - leases()} of the {before} leases freed after "
+              f"{time.perf_counter() - start:.2f}s (heartbeat {heartbeat}s, TTL {heartbeat * 3}s)")
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+def bench_serving(args):
+    """Webhook latency of the sync and async servers while dashboards hold long polls."""
+    import loadgen
+
+    servers = [
+        ('sync (gunicorn)', lambda port: ['gunicorn', '--bind', f'127.0.0.1:{port}', 'main:app']),
+        ('async (aiohttp)', lambda port: [sys.executable, 'async_app.py',
+                                          '--host', '127.0.0.1', '--port', str(port)]),
+    ]
+    print(f"{args.calls} calls per run, 20 concurrent; webhook latency over all routes")
+    for label, command in servers:
+        for connections in (0, 10, 100):
+            port = _free_port()
+            base_url = f'http://127.0.0.1:{port}'
+            process = _start_server(command(port), base_url)
+            stop = threading.Event()
+            clients = [threading.Thread(target=_long_poll_client, args=(base_url, stop), daemon=True)
+                       for _ in range(connections)]
+            try:
+                for thread in clients:
+                    thread.start()
+                # Let the long polls connect before the webhooks start
+                time.sleep(0.5)
+                report = loadgen.run_load(loadgen.HttpTarget(base_url, timeout=5.0),
+                                          args.calls, 20, 0, 0)
+            finally:
+                stop.set()
+                process.terminate()
+                process.wait()
+
+            routes = report['routes'].values()
+            errors = sum(stats['errors'] for stats in routes)
+            p50 = max(stats['p50_ms'] for stats in routes)
+            p99 = max(stats['p99_ms'] for stats in routes)
+            print(f"{label:<16} {connections:>4} long polls  p50 {p50:8.2f}ms  "
+                  f"p99 {p99:8.2f}ms  errors {errors}")
+
+def bench_waiting_room(args):
+    """Measure waiting room polls, admissions and hang-ups at growing queue depths."""
+    from call_store_backends import MemoryCallStore, SqliteCallStore
+
+    max_calls = 30
+    for depth in [100, 10000]:
+        with tempfile.TemporaryDirectory() as tmp:
+            stores = [('memory', MemoryCallStore()),
+                      ('sqlite', SqliteCallStore(os.path.join(tmp, 'calls.db')))]
+            print(f"{depth:,} waiting callers, {max_calls} active")
+            for name, store in stores:
+                for i in range(max_calls):
+                    store.add_call(f"CA{i:032d}", '+15550000000', '+15550000001')
+                waiters = [f"CW{i:032d}" for i in range(depth)]
+                t0 = time.perf_counter()
+                for call_sid in waiters:
+                    store.try_admit_queued(call_sid, '+15550000000', '+15550000001',
+                                           max_calls, depth, 3600)
+                enqueue = (time.perf_counter() - t0) / depth
+
+                # Hold polls from the back of the queue
+                t0 = time.perf_counter()
+                for call_sid in waiters[-100:]:
+                    store.try_admit_queued(call_sid, '+15550000000', '+15550000001',
+                                           max_calls, depth, 3600)
+                poll = (time.perf_counter() - t0) / 100
+
+                # A call ends and the head of the queue takes its line
+                t0 = time.perf_counter()
+                for i in range(100):
+                    store.end_call(f"CA{i:032d}" if i < max_calls else waiters[i - max_calls])
+                    store.try_admit_queued(waiters[i], '+15550000000', '+15550000001',
+                                           max_calls, depth, 3600)
+                admit = (time.perf_counter() - t0) / 100
+
+                # Callers hang up from the middle of the queue
+                middle = waiters[depth // 2:depth // 2 + 50]
+                t0 = time.perf_counter()
+                for call_sid in middle:
+                    store.remove_waiter(call_sid)
+                remove = (time.perf_counter() - t0) / len(middle)
+                print(f"  {name:7} enqueue {enqueue * 1e6:8.1f} us  poll {poll * 1e6:8.1f} us  "
+                      f"end+admit {admit * 1e6:8.1f} us  hang-up {remove * 1e6:8.1f} us")
+
+BENCHMARKS = {
+    'audio': bench_audio,
+    'admission': bench_admission,
+    'admission-stress': bench_admission_stress,
+    'calls-api': bench_calls_api,
+    'cluster': bench_cluster,
+    'contention': bench_contention,
+    'export': bench_export,
+    'history': bench_history,
+    'ivr': bench_ivr,
+    'journal': bench_journal,
+    'logging': bench_logging,
+    'metrics': bench_metrics,
+    'reaper': bench_reaper,
+    'records': bench_records,
+    'routing': bench_routing,
+    'serving': bench_serving,
+    'signature': bench_signature,
+    'storm': bench_storm,
+    'twilio-batch': bench_twilio_batch,
+    'twiml': bench_twiml,
+    'waiting-room': bench_waiting_room,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--iterations', type=int, default=10000,
+                        help="Iterations per measurement")
+    parser.add_argument('--threads', type=int, default=300,
+                        help="Concurrent threads (admission-stress, contention)")
+    parser.add_argument('--max-calls', type=int, default=30,
+                        help="Capacity limit (admission-stress, cluster)")
+    parser.add_argument('--calls', type=int, default=200,
+                        help="Calls per run (serving, cluster)")
+    args = parser.parse_args(argv)
+    return BENCHMARKS[args.benchmark](args) or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
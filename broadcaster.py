@@ -0,0 +1,169 @@
+"""
+In-process fan-out of call events to dashboard clients.
+
+Each published event is serialized once and the same bytes are handed to
+every subscriber. Server-sent event (SSE) streams get a bounded queue per
+subscriber; a subscriber that falls too far behind is dropped and has to
+reconnect and resync. Long-poll clients read from a shared ring of recent
+events instead.
+
+Events only reach clients connected to the same process. With a shared call
+store (CALL_STORE=sqlite) and several workers, clients still pick up changes
+made by other workers when they resync.
+"""
+
+from collections import deque
+import json
+import threading
+
+# Events kept for long-poll clients
+DEFAULT_HISTORY_SIZE = 1000
+
+# Frames buffered per SSE subscriber before it is dropped
+DEFAULT_MAX_QUEUE = 256
+
+class Subscription:
+    """A subscriber's bounded queue of pre-encoded SSE frames."""
+
+    def __init__(self, broadcaster, max_queue, notify=None):
+        self._broadcaster = broadcaster
+        self.max_queue = max_queue
+        self.notify = notify
+        self.frames = deque()
+        self.overflowed = False
+
+    def get_frames(self, timeout):
+        """
+        Wait for frames published since the last call.
+
+        Args:
+            timeout (float): Seconds to wait for a frame
+
+        Returns:
+            list: SSE frames as bytes (empty on timeout), or None if the
+                subscriber overflowed and was dropped
+        """
+        with self._broadcaster._condition:
+            self._broadcaster._condition.wait_for(
+                lambda: self.frames or self.overflowed, timeout)
+            if self.overflowed:
+                return None
+            frames = list(self.frames)
+            self.frames.clear()
+            return frames
+
+    def close(self):
+        """Stop receiving events."""
+        self._broadcaster.unsubscribe(self)
+
+class Broadcaster:
+    """Publishes events to SSE subscribers and long-poll clients."""
+
+    def __init__(self, max_queue=DEFAULT_MAX_QUEUE, history_size=DEFAULT_HISTORY_SIZE):
+        self.max_queue = max_queue
+        self._condition = threading.Condition(threading.Lock())
+        self._subscribers = set()
+        # (event_id, payload) tuples, oldest first; payload is encoded JSON
+        self._history = deque(maxlen=history_size)
+        self._last_id = 0
+
+    def publish(self, event, data):
+        """
+        Publish an event to all subscribers.
+
+        Args:
+            event (str): SSE event name
+            data: JSON-serializable event data
+
+        Returns:
+            int: The event ID
+        """
+        payload = json.dumps(data, separators=(',', ':'))
+        with self._condition:
+            self._last_id += 1
+            event_id = self._last_id
+            frame = f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n".encode('utf-8')
+            self._history.append((event_id, payload))
+
+            for subscription in list(self._subscribers):
+                if len(subscription.frames) >= subscription.max_queue:
+                    # Never block the publisher on a slow client
+                    subscription.overflowed = True
+                    self._subscribers.discard(subscription)
+                else:
+                    subscription.frames.append(frame)
+                if subscription.notify is not None:
+                    try:
+                        subscription.notify()
+                    except Exception:
+                        # A broken waker must not stop delivery to the others
+                        pass
+
+            self._condition.notify_all()
+            return event_id
+
+    def subscribe(self, max_queue=None, notify=None):
+        """
+        Subscribe to events as SSE frames.
+
+        Args:
+            max_queue (int): Frames buffered before the subscriber is dropped
+            notify (callable): Called (with the broadcaster lock held) after
+                each frame is queued, e.g. to wake an asyncio task; must not
+                block
+
+        Returns:
+            Subscription: The new subscription
+        """
+        subscription = Subscription(self, max_queue or self.max_queue, notify)
+        with self._condition:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a subscription."""
+        with self._condition:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        """Return the number of SSE subscribers."""
+        with self._condition:
+            return len(self._subscribers)
+
+    def get_last_id(self):
+        """Return the ID of the most recent event."""
+        with self._condition:
+            return self._last_id
+
+    def wait_for_events(self, after, timeout):
+        """
+        Wait for events published after an event ID (long polling).
+
+        Args:
+            after (int): ID of the last event the client saw
+            timeout (float): Seconds to wait for a new event
+
+        Returns:
+            bytes: JSON object {"last_id", "resync", "events"}. resync is true
+                when events after `after` are no longer retained; the client
+                must then reload the full state.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._last_id != after, timeout)
+            last_id = self._last_id
+            retained = self._history[0][0] if self._history else last_id + 1
+            if after > last_id or (after < last_id and retained > after + 1):
+                payloads = []
+                resync = True
+            else:
+                payloads = [payload for event_id, payload in self._history if event_id > after]
+                resync = False
+
+        # Payloads are already encoded, so splice them in instead of re-encoding
+        return (
+            f'{{"last_id":{last_id},"resync":{"true" if resync else "false"},'
+            f'"events":[{",".join(payloads)}]}}'
+        ).encode('utf-8')
+
+# Broadcaster shared by the whole process
+broadcaster = Broadcaster()
@@ -0,0 +1,548 @@
+"""
+Export of ended calls to rotating, compressed files for post-test reports.
+
+With CALL_EXPORT_DIR set, call_handler hands every ended call to a
+CallExporter. Webhooks only append the call to an in-memory batch; a
+background thread writes the batch every CALL_EXPORT_FLUSH_SECONDS, or as
+soon as CALL_EXPORT_BATCH_SIZE calls are waiting, so webhooks never wait for
+the disk. If the writer falls MAX_PENDING_BATCHES batches behind, further
+calls are dropped and counted rather than growing memory without bound.
+
+Each flush writes one self-contained unit per format, so files can be read
+while they are written and a crash loses at most the unflushed batch:
+
+- JSONL (calls-*.jsonl.gz): one JSON object per call. Each flush appends a
+  new gzip member, which zcat and Python's gzip read as one stream.
+- CSV (calls-*.csv.gz): a header row, then one row per call, appended as
+  gzip members like JSONL.
+- Parquet (calls-*.parquet), when pyarrow is installed: one file per flush,
+  written under a temporary name and renamed when complete. Analytics tools
+  read the directory as one dataset. Without pyarrow, CSV is written
+  instead.
+
+All formats have the columns in COLUMNS; times are UTC epochs and
+ivr_selection is 'music', 'beep' or empty.
+
+Calls are filed by the UTC day they ended, in files named
+calls-<day>-<created>-<pid>.<extension>; a new JSONL or CSV file is started
+when the current one reaches CALL_EXPORT_ROTATE_MB. Several workers can
+export to one directory.
+
+Per-day aggregates over the files, streamed in constant memory:
+
+    python call_export.py aggregate DIR [--format jsonl|csv|parquet] [--json]
+"""
+
+import argparse
+import atexit
+from bisect import bisect_right
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from call_history import DURATION_BIN_EDGES, histogram_percentile
+from call_store_backends import IvrSelection, call_clock
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_SECONDS = 5.0
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_ROTATE_MB = 64
+DEFAULT_FORMATS = ('jsonl', 'parquet')
+
+# Batches that may wait for the writer before ended calls are dropped
+MAX_PENDING_BATCHES = 10
+
+COLUMNS = ('call_sid', 'from_number', 'to_number', 'start_time', 'end_time', 'duration',
+           'ivr_selection')
+
+# gzip level 6 is zlib's default trade-off; the writer isn't on the webhook path
+_COMPRESS_LEVEL = 6
+
+_FILE_PATTERN = re.compile(r'^calls-(\d{4}-\d{2}-\d{2})-\d+-\d+\.(jsonl\.gz|csv\.gz|parquet)$')
+
+EXPORT_FLUSH_LATENCY = Histogram(
+    'call_export_flush_seconds', "Time to write one batch of ended calls to the export files.")
+EXPORTED_CALLS = Counter(
+    'call_export_calls_total', "Ended calls written to the export files, by format.", ['format'])
+EXPORT_FAILED = Counter(
+    'call_export_failed_total', "Ended calls whose export write failed, by format.", ['format'])
+EXPORT_DROPPED = Counter(
+    'call_export_dropped_total', "Ended calls not exported because the writer fell behind.")
+EXPORT_PENDING = Gauge('call_export_pending_calls', "Ended calls waiting for the export writer.")
+
+def get_export_dir():
+    """
+    Get the directory ended calls are exported to.
+
+    Returns:
+        str: Value of CALL_EXPORT_DIR, or None if export is disabled
+    """
+    return os.environ.get('CALL_EXPORT_DIR') or None
+
+def _env_number(name, default, kind=float):
+    try:
+        value = kind(os.environ.get(name, default))
+    except ValueError:
+        logger.warning(f"Ignoring invalid {name}, using {default}")
+        return default
+    return value if value > 0 else default
+
+def _encode_jsonl(rows):
+    """Encode rows as one gzip member of JSON lines."""
+    lines = []
+    for call_sid, from_number, to_number, start, end, ivr in rows:
+        lines.append(json.dumps({
+            'call_sid': call_sid, 'from_number': from_number, 'to_number': to_number,
+            'start_time': start, 'end_time': end, 'duration': end - start,
+            'ivr_selection': IvrSelection(ivr).label
+        }, separators=(',', ':')))
+    lines.append('')
+    return gzip.compress('\n'.join(lines).encode('utf-8'), _COMPRESS_LEVEL)
+
+def _encode_csv(rows):
+    """Encode rows as one gzip member of CSV rows."""
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator='\n')
+    for call_sid, from_number, to_number, start, end, ivr in rows:
+        writer.writerow((call_sid, from_number, to_number, repr(start), repr(end),
+                         repr(end - start), IvrSelection(ivr).label or ''))
+    return gzip.compress(text.getvalue().encode('utf-8'), _COMPRESS_LEVEL)
+
+def _encode_parquet(rows):
+    """Encode rows as a complete Parquet file."""
+    import pyarrow
+    import pyarrow.parquet
+
+    call_sids, from_numbers, to_numbers, starts, ends, ivrs = zip(*rows)
+    table = pyarrow.table({
+        'call_sid': pyarrow.array(call_sids, pyarrow.string()),
+        'from_number': pyarrow.array(from_numbers, pyarrow.string()),
+        'to_number': pyarrow.array(to_numbers, pyarrow.string()),
+        'start_time': pyarrow.array(starts, pyarrow.float64()),
+        'end_time': pyarrow.array(ends, pyarrow.float64()),
+        'duration': pyarrow.array([end - start for start, end in zip(starts, ends)],
+                                  pyarrow.float64()),
+        'ivr_selection': pyarrow.array([IvrSelection(ivr).label or '' for ivr in ivrs],
+                                       pyarrow.string()).dictionary_encode(),
+    })
+    data = io.BytesIO()
+    pyarrow.parquet.write_table(table, data, compression='zstd')
+    return data.getvalue()
+
+def parquet_available():
+    """Whether pyarrow is installed, so Parquet files can be written and read."""
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+# Key: format name, Value: (file extension, batch encoder, header of a new
+# file or None, whether batches are appended to a file rather than each
+# written to its own)
+FORMATS = {
+    'jsonl': ('jsonl.gz', _encode_jsonl, None, True),
+    'csv': ('csv.gz', _encode_csv,
+            gzip.compress((','.join(COLUMNS) + '\n').encode('utf-8'), _COMPRESS_LEVEL), True),
+    'parquet': ('parquet', _encode_parquet, None, False),
+}
+
+class CallExporter:
+    """Batches ended calls and writes them to export files from a background thread."""
+
+    def __init__(self, directory=None, formats=None, flush_seconds=None, batch_size=None,
+                 rotate_bytes=None):
+        """
+        Unset arguments are read from the environment when the exporter starts.
+
+        Args:
+            directory (str): Export directory, defaults to get_export_dir()
+            formats: Names of the formats to write (see FORMATS)
+            flush_seconds (float): Most seconds an ended call waits to be written
+            batch_size (int): Waiting calls that trigger an early flush
+            rotate_bytes (int): Size at which a file is closed and a new one started
+        """
+        self.directory = directory
+        self.formats = formats
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.rotate_bytes = rotate_bytes
+        self._lock = threading.Lock()
+        # Ended calls as (call_sid, from_number, to_number, start, end, ivr code)
+        self._pending = []
+        self._max_pending = 0
+        # Serializes writing between the writer thread and close()
+        self._write_lock = threading.Lock()
+        # Key: (format, day), Value: (path, size) of the file being appended to
+        self._files = {}
+        # Key: day number since the epoch, Value: 'YYYY-MM-DD'
+        self._days = {}
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._fork_handler = False
+        self.running = False
+        self._flush_latency = EXPORT_FLUSH_LATENCY.labels()
+        # Key: format name, Value: its counter child, set when the exporter starts
+        self._exported = {}
+        self._failed = {}
+        self._dropped = EXPORT_DROPPED.labels()
+        self._pending_gauge = EXPORT_PENDING.labels()
+
+    def start(self):
+        """Start the writer thread. Does nothing if no export directory is configured."""
+        self.directory = self.directory or get_export_dir()
+        if self.directory is None or self.running:
+            return
+        if self.formats is None:
+            names = os.environ.get('CALL_EXPORT_FORMATS')
+            self.formats = ([name.strip() for name in names.split(',') if name.strip()]
+                            if names else list(DEFAULT_FORMATS))
+        unknown = [name for name in self.formats if name not in FORMATS]
+        if unknown or not self.formats:
+            raise ValueError(f"Unknown export formats {unknown}; use {', '.join(FORMATS)}")
+        if 'parquet' in self.formats and not parquet_available():
+            logger.warning("pyarrow is not installed, exporting CSV instead of Parquet")
+            self.formats = list(dict.fromkeys(
+                'csv' if name == 'parquet' else name for name in self.formats))
+        self._exported = {name: EXPORTED_CALLS.labels(name) for name in self.formats}
+        self._failed = {name: EXPORT_FAILED.labels(name) for name in self.formats}
+        if self.flush_seconds is None:
+            self.flush_seconds = _env_number('CALL_EXPORT_FLUSH_SECONDS', DEFAULT_FLUSH_SECONDS)
+        if self.batch_size is None:
+            self.batch_size = _env_number('CALL_EXPORT_BATCH_SIZE', DEFAULT_BATCH_SIZE, int)
+        if self.rotate_bytes is None:
+            self.rotate_bytes = int(_env_number('CALL_EXPORT_ROTATE_MB', DEFAULT_ROTATE_MB) * 1024 * 1024)
+        self._max_pending = self.batch_size * MAX_PENDING_BATCHES
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._stopped = False
+        self.running = True
+        self._start_thread()
+        if not self._fork_handler:
+            atexit.register(self.close)
+            # Threads don't survive fork(), e.g. gunicorn --preload workers
+            os.register_at_fork(after_in_child=self._restart)
+            self._fork_handler = True
+        logger.info(f"Exporting ended calls to {self.directory} ({', '.join(self.formats)})")
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, name='call-export', daemon=True)
+        self._thread.start()
+
+    def _restart(self):
+        # The locks may have been held by the parent's writer thread
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        if not self.running:
+            return
+        # The parent writes the calls waiting at the fork, to its own files
+        self._pending = []
+        self._files = {}
+        self._pending_gauge.set(0)
+        self._start_thread()
+
+    def close(self):
+        """Write the waiting calls and stop the writer thread."""
+        if not self.running:
+            return
+        self.running = False
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def record(self, call, end_time=None):
+        """
+        Queue an ended call for export.
+
+        Args:
+            call (CallRecord): The ended call
+            end_time (float): End epoch, defaults to call_clock()
+        """
+        if not self.running:
+            return
+        start = call.start_time
+        end = call_clock() if end_time is None else end_time
+        row = (call.call_sid, call.from_number or '', call.to_number or '',
+               start, max(end, start), int(call.ivr_selection))
+        with self._lock:
+            pending = len(self._pending)
+            if pending < self._max_pending:
+                self._pending.append(row)
+        if pending >= self._max_pending:
+            self._dropped.inc()
+        elif pending + 1 == self.batch_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Write the waiting calls now.
+
+        A batch that fails to be written in a format is logged and counted
+        in call_export_failed_total; it is not retried.
+
+        Returns:
+            int: Number of calls written in every format
+        """
+        with self._write_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                self._pending_gauge.set(0)
+                return 0
+            started = time.perf_counter()
+            by_day = {}
+            days = self._days
+            for row in rows:
+                day_number = int(row[4] // 86400)
+                day = days.get(day_number)
+                if day is None:
+                    day = days[day_number] = time.strftime('%Y-%m-%d', time.gmtime(row[4]))
+                by_day.setdefault(day, []).append(row)
+            written = dict.fromkeys(self.formats, 0)
+            for day, day_rows in by_day.items():
+                for name in self.formats:
+                    try:
+                        self._append(name, day, FORMATS[name][1](day_rows))
+                    except Exception as e:
+                        logger.error(f"Error exporting {len(day_rows)} calls as {name}: {str(e)}")
+                        self._failed[name].inc(len(day_rows))
+                        continue
+                    self._exported[name].inc(len(day_rows))
+                    written[name] += len(day_rows)
+            self._flush_latency.observe(time.perf_counter() - started)
+            with self._lock:
+                self._pending_gauge.set(len(self._pending))
+            return min(written.values())
+
+    def _new_path(self, name, day):
+        return os.path.join(self.directory, f'calls-{day}-{time.time_ns() // 1000}-'
+                                            f'{os.getpid()}.{FORMATS[name][0]}')
+
+    def _append(self, name, day, data):
+        """Write one encoded batch to the day's file of a format, rotating it when full."""
+        extension, _, header, appendable = FORMATS[name]
+        if not appendable:
+            # Readers never see a partly written file
+            path = self._new_path(name, day)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            return
+        path, size = self._files.get((name, day), (None, 0))
+        if path is None or size >= self.rotate_bytes:
+            # Calls end in order give or take a few seconds, so forget files of past days
+            oldest = time.strftime('%Y-%m-%d', time.gmtime(time.time() - 2 * 86400))
+            self._files = {key: value for key, value in self._files.items() if key[1] >= oldest}
+            path, size = self._new_path(name, day), 0
+        if size == 0 and header is not None:
+            data = header + data
+        with open(path, 'ab') as f:
+            f.write(data)
+        self._files[(name, day)] = (path, size + len(data))
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing call export: {str(e)}")
+
+# Exporter fed by call_handler when CALL_EXPORT_DIR is set
+call_exporter = CallExporter()
+
+# Reading and aggregating export files
+
+def list_export_files(directory, name):
+    """
+    List the export files of a format, oldest day first.
+
+    Args:
+        directory (str): The export directory
+        name (str): Format name (see FORMATS)
+
+    Returns:
+        list: Paths of the format's files
+    """
+    extension = FORMATS[name][0]
+    files = []
+    for entry in os.listdir(directory):
+        match = _FILE_PATTERN.match(entry)
+        if match and match.group(2) == extension:
+            files.append(entry)
+    return [os.path.join(directory, entry) for entry in sorted(files)]
+
+def read_jsonl(path):
+    """
+    Stream the calls of a JSONL export file.
+
+    A torn gzip member at the end of the file (from a crash mid-flush) ends
+    the stream with a warning.
+
+    Yields:
+        tuple: (start_time, end_time, ivr_selection code)
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                call = json.loads(line)
+                yield (call['start_time'], call['end_time'],
+                       int(IvrSelection.from_label(call['ivr_selection'])))
+        except (EOFError, OSError, ValueError) as e:
+            logger.warning(f"Stopped reading {path} at an incomplete batch: {str(e)}")
+
+def read_csv(path):
+    """
+    Stream the calls of a CSV export file.
+
+    A torn gzip member at the end of the file ends the stream with a warning.
+
+    Yields:
+        tuple: (start_time, end_time, ivr_selection code)
+    """
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+        try:
+            for call in csv.DictReader(f):
+                yield (float(call['start_time']), float(call['end_time']),
+                       int(IvrSelection.from_label(call['ivr_selection'] or None)))
+        except (EOFError, OSError, ValueError, csv.Error) as e:
+            logger.warning(f"Stopped reading {path} at an incomplete batch: {str(e)}")
+
+def read_parquet(path):
+    """
+    Stream the calls of a Parquet export file, reading only the columns needed.
+
+    Yields:
+        tuple: (start_time, end_time, ivr_selection code)
+    """
+    import pyarrow.parquet
+
+    codes = {selection.label or '': int(selection) for selection in IvrSelection}
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    for batch in parquet_file.iter_batches(columns=['start_time', 'end_time', 'ivr_selection']):
+        columns = batch.to_pydict()
+        for start, end, ivr in zip(columns['start_time'], columns['end_time'],
+                                   columns['ivr_selection']):
+            yield start, end, codes[ivr]
+
+# Key: format name, Value: reader of one of its files
+READERS = {
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+    'parquet': read_parquet,
+}
+
+class DayTotals:
+    """Aggregates of the calls that ended on one day."""
+
+    __slots__ = ('calls', 'duration_sum', 'ivr_counts', 'duration_bins', 'first_start', 'last_end')
+
+    def __init__(self):
+        self.calls = 0
+        self.duration_sum = 0.0
+        self.ivr_counts = [0] * len(IvrSelection)
+        self.duration_bins = [0] * (len(DURATION_BIN_EDGES) + 1)
+        self.first_start = None
+        self.last_end = None
+
+    def add(self, start, end, ivr_code):
+        duration = end - start
+        self.calls += 1
+        self.duration_sum += duration
+        self.ivr_counts[ivr_code] += 1
+        self.duration_bins[bisect_right(DURATION_BIN_EDGES, duration)] += 1
+        if self.first_start is None or start < self.first_start:
+            self.first_start = start
+        if self.last_end is None or end > self.last_end:
+            self.last_end = end
+
+    def to_dict(self):
+        calls = self.calls
+        return {
+            'calls': calls,
+            'avg_duration': self.duration_sum / calls if calls else 0.0,
+            'p50_duration': histogram_percentile(self.duration_bins, calls, 0.5),
+            'p95_duration': histogram_percentile(self.duration_bins, calls, 0.95),
+            'ivr_mix': {
+                (selection.label or 'none'): self.ivr_counts[selection]
+                for selection in IvrSelection
+            },
+            'first_start': self.first_start,
+            'last_end': self.last_end
+        }
+
+def aggregate(directory, name='jsonl'):
+    """
+    Compute per-day aggregates of the calls exported to a directory.
+
+    Files are streamed a batch at a time, so memory depends on the number of
+    days and the batch size, not on the number of calls.
+
+    Args:
+        directory (str): The export directory
+        name (str): Format to read (see FORMATS)
+
+    Returns:
+        dict: DayTotals.to_dict() by UTC day ('YYYY-MM-DD'), in day order
+    """
+    totals = {}
+    day_of = {}
+
+    def day_totals(end):
+        day_number = int(end // 86400)
+        day = day_of.get(day_number)
+        if day is None:
+            day = day_of[day_number] = totals.setdefault(
+                time.strftime('%Y-%m-%d', time.gmtime(end)), DayTotals())
+        return day
+
+    read = READERS[name]
+    for path in list_export_files(directory, name):
+        for start, end, ivr in read(path):
+            day_totals(end).add(start, end, ivr)
+    return {day: totals[day].to_dict() for day in sorted(totals)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report on exported calls.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    report = commands.add_parser('aggregate', help="Per-day aggregates of the exported calls")
+    report.add_argument('directory')
+    report.add_argument('--format', choices=sorted(FORMATS), default='jsonl')
+    report.add_argument('--json', action='store_true', help="Print one JSON object per day")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    days = aggregate(args.directory, args.format)
+    if args.json:
+        for day, stats in days.items():
+            print(json.dumps({'day': day, **stats}))
+        return
+    labels = [selection.label or 'none' for selection in IvrSelection]
+    print(f"{'day':<10} {'calls':>9} {'avg s':>8} {'p50 s':>8} {'p95 s':>8} "
+          + ' '.join(f'{label:>8}' for label in labels))
+    for day, stats in days.items():
+        print(f"{day:<10} {stats['calls']:>9} {stats['avg_duration']:>8.1f} "
+              f"{stats['p50_duration']:>8.1f} {stats['p95_duration']:>8.1f} "
+              + ' '.join(f"{stats['ivr_mix'][label]:>8}" for label in labels))
+    if not days:
+        print(f"No exported calls in {args.directory}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,231 @@
 import logging
-from datetime import datetime
-import json
+import os
 from call_storage import (
-    add_call,
+    try_admit as store_try_admit,
+    try_admit_queued as store_try_admit_queued,
+    remove_waiter,
+    get_waiting_count,
     end_call,
     update_ivr_selection,
     get_active_calls as get_calls,
+    get_call_tenants,
+    get_snapshot,
     get_call_count as get_count,
-    get_call
+    get_changes,
+    get_call,
+    AdmissionResult,
+    ADMITTED,
+    DUPLICATE,
+    BUSY,
+    QUEUED
 )
+from broadcaster import broadcaster
+from call_history import call_history
+from call_export import call_exporter
+from call_store_backends import call_clock
+from call_reaper import CallReaper, twilio_call_status
+from admission import (
+    capacity,
+    wait_stats,
+    waiting_room_enabled,
+    get_waiting_room_size,
+    get_waiter_timeout,
+    adaptive_capacity_enabled
+)
+from metrics import ADMISSIONS, IVR_SELECTIONS, ADMISSION_CAPACITY, WAITING_ROOM_ABANDONED
+from tenants import tenant_router
+from cluster import ClusterNode, cluster_enabled
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_CALLS = 30
+
+# Counters by admission status and IVR selection
+_admission_counters = {status: ADMISSIONS.labels(status)
+                       for status in (ADMITTED, DUPLICATE, BUSY, QUEUED)}
+_ivr_counters = {selection: IVR_SELECTIONS.labels(selection) for selection in ('music', 'beep')}
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+def _schedule_expiry(call, in_menu=True):
+    """Give a call a deadline in the reaper."""
+    try:
+        reaper.schedule(call, in_menu=in_menu)
+    except Exception as e:
+        # Expiry is a safety net and must never fail a webhook
+        logger.error(f"Error scheduling call expiry: {str(e)}")
+
+def _publish_change(added=(), updated=(), removed=()):
+    """Publish a change to the active calls to live dashboard clients."""
+    try:
+        now = call_clock()
+        broadcaster.publish('calls', {
+            'full': False,
+            'added': [call.to_dict(now) for call in added],
+            'updated': [call.to_dict(now) for call in updated],
+            'removed': list(removed)
+        })
+    except Exception as e:
+        # Live updates are best effort and must never fail a webhook
+        logger.error(f"Error publishing call change: {str(e)}")
+
+def get_max_calls():
+    """
+    Get the maximum number of simultaneous calls.
+
+    Returns:
+        int: Value of the MAX_CALLS environment variable, or 30 if unset
+    """
+    try:
+        return int(os.environ.get('MAX_CALLS', DEFAULT_MAX_CALLS))
+    except ValueError:
+        logger.warning(f"Invalid MAX_CALLS value, using {DEFAULT_MAX_CALLS}")
+        return DEFAULT_MAX_CALLS
+
+def get_capacity():
+    """
+    Get the number of calls to admit before callers wait or get the busy message.
+
+    Returns:
+        int: get_max_calls(), lowered under load with ADAPTIVE_CAPACITY
+    """
+    max_calls = get_max_calls()
+    if adaptive_capacity_enabled():
+        return capacity.get(max_calls)
+    return max_calls
+
+ADMISSION_CAPACITY.labels().set_function(
+    lambda: capacity.capacity if adaptive_capacity_enabled() and capacity.capacity else get_max_calls())
+
+def get_node_summary():
+    """
+    Summarize this node's calls for the other nodes of a cluster.
+    
+    Returns:
+        dict: Number of active calls and their count by IVR selection
+    """
+    snapshot = get_snapshot()
+    ivr = {'music': 0, 'beep': 0, 'none': 0}
+    for call in snapshot.calls:
+        ivr[call.ivr_selection.label or 'none'] += 1
+    return {'count': snapshot.count, 'ivr': ivr}
+
+def get_node_calls():
+    """
+    Get this node's calls for restoring their leases in a cluster.
+
+    Returns:
+        dict: Tenant (or None) of each active call, by call SID
+    """
+    tenants = get_call_tenants()
+    return {call.call_sid: tenants.get(call.call_sid) for call in get_calls()}
+
+# This instance's membership of a cluster (CLUSTER_COORDINATOR, see cluster)
+cluster_node = ClusterNode(get_node_summary, get_node_calls)
+
+def start_cluster():
+    """Join the cluster when CLUSTER_COORDINATOR is set."""
+    if not cluster_enabled():
+        return
+    if waiting_room_enabled():
+        logger.warning("The waiting room is not used in cluster mode")
+    try:
+        cluster_node.start()
+    except Exception as e:
+        logger.error(f"Error joining the cluster: {str(e)}")
+
+def _cluster_admit(call_sid, from_number, to_number, max_calls, route):
+    """Admit a call if the cluster-wide limits allow."""
+    try:
+        granted = cluster_node.acquire(call_sid, max_calls, route.tenant, route.max_calls)
+    except Exception as e:
+        logger.error(f"Error acquiring call lease: {str(e)}")
+        # Admit up to this node's share until the coordinator answers again
+        return store_try_admit(call_sid, from_number, to_number,
+                               cluster_node.get_fair_share(max_calls), route.tenant, route.max_calls)
+    if not granted:
+        return AdmissionResult(BUSY, None)
+    # The lease holds the call's place in the cluster-wide limits
+    return store_try_admit(call_sid, from_number, to_number, None, route.tenant, None)
+
+def try_admit(call_sid, from_number, to_number, max_calls=None, route=None):
+    """
+    Admit a new or waiting call if capacity allows.
+    
+    With WAITING_ROOM enabled, callers over capacity join the waiting room
+    and are admitted in arrival order when they ask again. Calls to a
+    tenant's number (see tenants) must also fit within the tenant's limit.
+    In cluster mode the limits hold across all nodes and the waiting room
+    is not used.
+    
+    Args:
+        call_sid (str): The Twilio call SID
+        from_number (str): The caller's phone number
+        to_number (str): The called phone number
+        max_calls (int): Capacity limit, defaults to get_capacity()
+        route (Route): Route of to_number, looked up if None
+    
+    Returns:
+        AdmissionResult: The admission decision ('admitted', 'duplicate',
+        'queued' or 'busy'), the call record and the seconds waited
+    """
+    try:
+        if max_calls is None:
+            max_calls = get_capacity()
+        if route is None:
+            route = tenant_router.lookup(to_number)
+        if cluster_node.running:
+            result = _cluster_admit(call_sid, from_number, to_number, max_calls, route)
+        elif waiting_room_enabled():
+            result = store_try_admit_queued(call_sid, from_number, to_number, max_calls,
+                                            get_waiting_room_size(), get_waiter_timeout(),
+                                            route.tenant, route.max_calls)
+        else:
+            result = store_try_admit(call_sid, from_number, to_number, max_calls,
+                                     route.tenant, route.max_calls)
+        _admission_counters[result.status].inc()
+        
+        if result.status == ADMITTED:
+            if result.waited is None:
+                logger.info("New call created: %s from %s", call_sid, from_number)
+            else:
+                logger.info("Call %s from %s admitted after waiting %.1fs",
+                            call_sid, from_number, result.waited)
+                wait_stats.record(result.waited)
+            _publish_change(added=[result.call])
+            _schedule_expiry(result.call)
+        elif result.status == DUPLICATE:
+            logger.warning("Call with SID %s already exists", call_sid)
+        elif result.status == QUEUED:
+            logger.debug("Call %s from %s is waiting for a line", call_sid, from_number)
+        elif waiting_room_enabled() and not cluster_node.running:
+            logger.warning("Waiting room full. Rejecting call from %s", from_number)
+        elif route.max_calls is not None:
+            logger.warning("Max calls reached (%d, or %d for tenant %s). Rejecting call from %s",
+                           max_calls, route.max_calls, route.tenant, from_number)
+        else:
+            logger.warning("Max calls reached (%d). Rejecting call from %s", max_calls, from_number)
+        
+        return result
+    
+    except Exception as e:
+        logger.error(f"Error admitting call: {str(e)}")
+        raise
+
+def _record_history(call):
+    """Add an ended call to the call history and the export (CALL_EXPORT_DIR)."""
+    try:
+        call_history.record(call)
+    except Exception as e:
+        # History is best effort and must never fail a webhook
+        logger.error(f"Error recording call history: {str(e)}")
+    try:
+        call_exporter.record(call)
+    except Exception as e:
+        logger.error(f"Error exporting call: {str(e)}")
+
 def handle_call_start(call_sid, from_number, to_number):
     """
     Handle a new incoming call.
@@ -23,20 +236,20 @@ def handle_call_start(call_sid, from_number, to_number):
         to_number (str): The called phone number
     
     Returns:
-        dict: The created call record
+        CallRecord: The created call record
     """
     try:
-        # Check if call already exists
-        existing_call = get_call(call_sid)
-        if existing_call and existing_call.get('call_sid'):
-            logger.warning(f"Call with SID {call_sid} already exists")
-            return existing_call
+        # Check for an existing call and create the record in one step
+        result = store_try_admit(call_sid, from_number, to_number)
+        _admission_counters[result.status].inc()
+        if result.status == DUPLICATE:
+            logger.warning("Call with SID %s already exists", call_sid)
+        else:
+            logger.info("New call created: %s from %s", call_sid, from_number)
+            _publish_change(added=[result.call])
+            _schedule_expiry(result.call)
         
-        # Create new call record
-        new_call = add_call(call_sid, from_number, to_number)
-        logger.info(f"New call created: {call_sid} from {from_number}")
-        
-        return new_call
+        return result.call
     
     except Exception as e:
         logger.error(f"Error handling call start: {str(e)}")
@@ -50,17 +263,31 @@ def handle_call_end(call_sid):
         call_sid (str): The Twilio call SID
     
     Returns:
-        dict: The removed call record
+        CallRecord: The removed call record
     """
     try:
         # Remove call from active calls
         call = end_call(call_sid)
+        if cluster_node.running:
+            # Also when the call isn't here: another node may have admitted
+            # it before the shards moved
+            cluster_node.release(call_sid)
         
         if not call:
-            logger.warning(f"Call with SID {call_sid} not found for call end")
+            waiter = remove_waiter(call_sid) if waiting_room_enabled() else None
+            if waiter:
+                logger.info("Call %s hung up after waiting %.1fs",
+                            call_sid, call_clock() - waiter.enqueued_at)
+                wait_stats.record_abandoned()
+                WAITING_ROOM_ABANDONED.labels().inc()
+            else:
+                logger.warning("Call with SID %s not found for call end", call_sid)
             return None
         
-        logger.info(f"Call ended: {call_sid}")
+        logger.info("Call ended: %s", call_sid)
+        reaper.forget(call_sid)
+        _publish_change(removed=[call_sid])
+        _record_history(call)
         return call
     
     except Exception as e:
@@ -76,27 +303,71 @@ def update_call_ivr(call_sid, selection):
         selection (str): The IVR selection ('music' or 'beep')
     
     Returns:
-        dict: The updated call record
+        CallRecord: The updated call record
     """
     try:
         call = update_ivr_selection(call_sid, selection)
         if not call:
-            logger.warning(f"Call with SID {call_sid} not found for IVR update")
+            logger.warning("Call with SID %s not found for IVR update", call_sid)
             return None
         
-        logger.info(f"Call {call_sid} updated with IVR selection: {selection}")
+        logger.info("Call %s updated with IVR selection: %s", call_sid, selection)
+        counter = _ivr_counters.get(selection)
+        if counter is not None:
+            counter.inc()
+        _publish_change(updated=[call])
+        _schedule_expiry(call)
         return call
     
     except Exception as e:
         logger.error(f"Error updating call IVR: {str(e)}")
         raise
 
+# Ends calls whose status callback never arrived (see call_reaper)
+reaper = CallReaper(get_call, handle_call_end,
+                    status_lookup=twilio_call_status if _env_flag('REAPER_RECONCILE', 'false') else None)
+
+def enter_call_node(call_sid, in_menu):
+    """
+    Reschedule a call's expiry when it enters a flow node without an IVR selection.
+
+    Args:
+        call_sid (str): The Twilio call SID
+        in_menu (bool): Whether the node waits for input; in other nodes
+            (e.g. announcements or audio) only the call's maximum lifetime applies
+    """
+    call = get_call(call_sid)
+    if call is not None:
+        _schedule_expiry(call, in_menu)
+
+def start_reaper():
+    """
+    Start the call reaper, unless disabled with REAPER_ENABLED=false.
+
+    Calls that are already active, e.g. recovered from the call journal, are
+    scheduled first.
+    """
+    if not _env_flag('REAPER_ENABLED', 'true'):
+        logger.info("Call reaper disabled")
+        return
+    try:
+        reaper.start(get_calls())
+    except Exception as e:
+        logger.error(f"Error starting call reaper: {str(e)}")
+
+def start_exporter():
+    """Start exporting ended calls when CALL_EXPORT_DIR is set (see call_export)."""
+    try:
+        call_exporter.start()
+    except Exception as e:
+        logger.error(f"Error starting call export: {str(e)}")
+
 def get_active_calls():
     """
     Get all active calls.
     
     Returns:
-        list: List of active calls as dictionaries
+        tuple: Active calls as CallRecord objects
     """
     try:
         return get_calls()
@@ -105,6 +376,20 @@ def get_active_calls():
         logger.error(f"Error getting active calls: {str(e)}")
         return []
 
+def get_calls_snapshot():
+    """
+    Get an immutable snapshot of the active calls.
+    
+    Returns:
+        CallSnapshot: Active calls with their count and cached JSON encoding
+    """
+    try:
+        return get_snapshot()
+    
+    except Exception as e:
+        logger.error(f"Error getting calls snapshot: {str(e)}")
+        raise
+
 def get_call_count():
     """
     Get count of active calls.
@@ -118,3 +403,60 @@ def get_call_count():
     except Exception as e:
         logger.error(f"Error getting call count: {str(e)}")
         return 0
+
+def get_queue_status():
+    """
+    Get the state of the waiting room.
+    
+    Returns:
+        dict: Whether it is enabled, the callers waiting, its size, the
+        current capacity and wait percentiles (see WaitStats.percentiles)
+    """
+    try:
+        status = {
+            'enabled': waiting_room_enabled(),
+            'waiting': get_waiting_count(),
+            'size': get_waiting_room_size(),
+            'capacity': get_capacity()
+        }
+        status.update(wait_stats.percentiles())
+        return status
+    
+    except Exception as e:
+        logger.error(f"Error getting queue status: {str(e)}")
+        raise
+
+def get_call_changes(since=None):
+    """
+    Get the changes to active calls since a version.
+    
+    Args:
+        since (int): Version the client last saw, or None for a full snapshot
+    
+    Returns:
+        dict: Delta or full snapshot (see call_storage.get_changes)
+    """
+    try:
+        return get_changes(since)
+    
+    except Exception as e:
+        logger.error(f"Error getting call changes: {str(e)}")
+        raise
+
+def get_history_stats(start=None, end=None):
+    """
+    Get statistics for completed calls.
+    
+    Args:
+        start (float): Window start epoch, defaults to one hour before end
+        end (float): Window end epoch, defaults to now
+    
+    Returns:
+        dict: Call rate, average and p95 duration and IVR mix for the window
+    """
+    try:
+        return call_history.get_stats(start, end)
+    
+    except Exception as e:
+        logger.error(f"Error getting history stats: {str(e)}")
+        raise
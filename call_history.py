@@ -0,0 +1,289 @@
+"""
+Memory-bounded history of completed calls.
+
+Ended calls are kept in a ring buffer of compact columnar arrays (start and
+end epoch, IVR selection code, interned phone numbers). Per-minute and
+per-hour bucket aggregates are maintained as calls are added and evicted, so
+statistics over any window only touch a few buckets, never the raw records.
+
+Numbers are interned with a count of the retained calls using them, and
+released when the last of those calls is evicted, so the intern table never
+holds more than two numbers per retained call.
+"""
+
+from array import array
+from bisect import bisect_right
+import logging
+import math
+import os
+import threading
+
+from call_store_backends import IvrSelection, call_clock
+
+logger = logging.getLogger(__name__)
+
+# Upper edges of the duration histogram bins in seconds (the last bin is open).
+# Sub-second bins keep percentiles meaningful for short test calls
+DURATION_BIN_EDGES = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                      1, 2, 3, 5, 7, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240,
+                      300, 450, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200)
+
+DEFAULT_CAPACITY = 100000
+DEFAULT_BUCKET_SECONDS = 60
+
+# Buckets per rollup bucket (one hour of one-minute buckets)
+ROLLUP_FACTOR = 60
+
+class _Bucket:
+    """Aggregates of the calls that ended within one bucket interval."""
+
+    __slots__ = ('count', 'duration_sum', 'ivr_counts', 'duration_bins')
+
+    def __init__(self):
+        self.count = 0
+        self.duration_sum = 0.0
+        self.ivr_counts = [0] * len(IvrSelection)
+        self.duration_bins = [0] * (len(DURATION_BIN_EDGES) + 1)
+
+    def add(self, duration, ivr_code, sign):
+        self.count += sign
+        self.duration_sum += sign * duration
+        self.ivr_counts[ivr_code] += sign
+        self.duration_bins[bisect_right(DURATION_BIN_EDGES, duration)] += sign
+
+    def merge_into(self, totals):
+        totals.count += self.count
+        totals.duration_sum += self.duration_sum
+        for i, value in enumerate(self.ivr_counts):
+            totals.ivr_counts[i] += value
+        for i, value in enumerate(self.duration_bins):
+            totals.duration_bins[i] += value
+
+class CallHistory:
+    """Ring buffer of completed calls with windowed aggregate queries."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, bucket_seconds=DEFAULT_BUCKET_SECONDS):
+        """
+        Args:
+            capacity (int): Number of calls retained; the oldest are evicted
+            bucket_seconds (int): Width of the aggregate buckets, which is
+                also the granularity of query windows
+
+        Raises:
+            ValueError: If capacity is less than 1
+        """
+        if capacity < 1:
+            raise ValueError("The call history needs a capacity of at least 1")
+        self.capacity = capacity
+        self.bucket_seconds = bucket_seconds
+        self._lock = threading.Lock()
+
+        # Columns of the ring buffer
+        self._start = array('d', bytes(8 * capacity))
+        self._end = array('d', bytes(8 * capacity))
+        self._ivr = array('B', bytes(capacity))
+        self._from = array('I', bytes(4 * capacity))
+        self._to = array('I', bytes(4 * capacity))
+        self._size = 0
+        self._next = 0
+
+        # Interned phone numbers: _from and _to index into _numbers, and
+        # _number_refs counts the retained calls using each number. Indexes
+        # of released numbers are reused
+        self._numbers = []
+        self._number_refs = []
+        self._number_index = {}
+        self._free_numbers = []
+
+        # Key: bucket number (end epoch // bucket_seconds), Value: _Bucket
+        self._buckets = {}
+        # Key: rollup number (bucket number // ROLLUP_FACTOR), Value: _Bucket
+        self._rollups = {}
+
+    def _intern(self, number):
+        index = self._number_index.get(number)
+        if index is None:
+            if self._free_numbers:
+                index = self._free_numbers.pop()
+                self._numbers[index] = number
+            else:
+                index = len(self._numbers)
+                self._numbers.append(number)
+                self._number_refs.append(0)
+            self._number_index[number] = index
+        self._number_refs[index] += 1
+        return index
+
+    def _release(self, index):
+        self._number_refs[index] -= 1
+        if self._number_refs[index] == 0:
+            del self._number_index[self._numbers[index]]
+            self._numbers[index] = None
+            self._free_numbers.append(index)
+
+    def _update_bucket(self, slot, sign):
+        bucket_key = int(self._end[slot] // self.bucket_seconds)
+        duration = self._end[slot] - self._start[slot]
+        for buckets, key in ((self._buckets, bucket_key),
+                             (self._rollups, bucket_key // ROLLUP_FACTOR)):
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = _Bucket()
+            bucket.add(duration, self._ivr[slot], sign)
+            if bucket.count == 0:
+                del buckets[key]
+
+    def _sum_buckets(self, buckets, first, last, totals):
+        """Add the buckets numbered first..last (inclusive) into totals."""
+        if last < first:
+            return
+        if last - first + 1 <= len(buckets):
+            selected = (buckets.get(key) for key in range(first, last + 1))
+        else:
+            selected = (bucket for key, bucket in buckets.items() if first <= key <= last)
+        for bucket in selected:
+            if bucket is not None:
+                bucket.merge_into(totals)
+
+    def record(self, call, end_time=None):
+        """
+        Add an ended call to the history.
+
+        Args:
+            call (CallRecord): The ended call
+            end_time (float): End epoch, defaults to now
+        """
+        start = call.start_time
+        # The same clock as the call's start, so durations don't drift
+        end = call_clock() if end_time is None else end_time
+
+        with self._lock:
+            slot = self._next
+            if self._size == self.capacity:
+                # Evict the oldest call from the aggregates before overwriting it
+                self._update_bucket(slot, -1)
+                self._release(self._from[slot])
+                self._release(self._to[slot])
+            else:
+                self._size += 1
+
+            self._start[slot] = start
+            self._end[slot] = max(end, start)
+            self._ivr[slot] = call.ivr_selection
+            self._from[slot] = self._intern(call.from_number)
+            self._to[slot] = self._intern(call.to_number)
+            self._update_bucket(slot, 1)
+            self._next = (slot + 1) % self.capacity
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def get_recent_calls(self, limit=50):
+        """
+        Get the most recently recorded calls.
+
+        Args:
+            limit (int): Maximum number of calls
+
+        Returns:
+            list: Dicts with from_number, to_number, start_time, end_time
+                (epochs), duration (seconds) and ivr_selection, newest first
+        """
+        calls = []
+        with self._lock:
+            slot = self._next
+            for _ in range(min(limit, self._size)):
+                slot = (slot - 1) % self.capacity
+                calls.append({
+                    'from_number': self._numbers[self._from[slot]],
+                    'to_number': self._numbers[self._to[slot]],
+                    'start_time': self._start[slot],
+                    'end_time': self._end[slot],
+                    'duration': self._end[slot] - self._start[slot],
+                    'ivr_selection': IvrSelection(self._ivr[slot]).label
+                })
+        return calls
+
+    def get_stats(self, start=None, end=None):
+        """
+        Compute statistics for calls that ended within a window.
+
+        The window is widened to whole buckets.
+
+        Args:
+            start (float): Window start epoch, defaults to one hour before end
+            end (float): Window end epoch, defaults to now
+
+        Returns:
+            dict: calls, calls_per_minute, avg_duration, p95_duration (estimated
+                from the duration histogram) and ivr_mix
+
+        Raises:
+            ValueError: If start or end isn't finite, or start is after end
+        """
+        end = call_clock() if end is None else end
+        start = end - 3600 if start is None else start
+        if not (math.isfinite(start) and math.isfinite(end)):
+            raise ValueError("The window's start and end must be finite")
+        if start > end:
+            raise ValueError("The window's start must not be after its end")
+        first = int(start // self.bucket_seconds)
+        last = int(end // self.bucket_seconds)
+
+        totals = _Bucket()
+        with self._lock:
+            # Whole rollups in the middle of the window, single buckets at the edges
+            first_rollup = -(-first // ROLLUP_FACTOR)
+            last_rollup = (last + 1) // ROLLUP_FACTOR - 1
+            if first_rollup <= last_rollup:
+                self._sum_buckets(self._buckets, first, first_rollup * ROLLUP_FACTOR - 1, totals)
+                self._sum_buckets(self._rollups, first_rollup, last_rollup, totals)
+                self._sum_buckets(self._buckets, (last_rollup + 1) * ROLLUP_FACTOR, last, totals)
+            else:
+                self._sum_buckets(self._buckets, first, last, totals)
+
+        count = totals.count
+        window_minutes = (last - first + 1) * self.bucket_seconds / 60
+        return {
+            'start': first * self.bucket_seconds,
+            'end': (last + 1) * self.bucket_seconds,
+            'calls': count,
+            'calls_per_minute': count / window_minutes,
+            'avg_duration': totals.duration_sum / count if count else 0.0,
+            'p95_duration': histogram_percentile(totals.duration_bins, count, 0.95),
+            'ivr_mix': {
+                (selection.label or 'none'): totals.ivr_counts[selection]
+                for selection in IvrSelection
+            }
+        }
+
+def histogram_percentile(bins, count, fraction):
+    """Estimate a percentile from the duration histogram by linear interpolation."""
+    if not count:
+        return 0.0
+    target = fraction * count
+    seen = 0
+    for i, value in enumerate(bins):
+        if value and seen + value >= target:
+            lower = DURATION_BIN_EDGES[i - 1] if i > 0 else 0
+            if i == len(DURATION_BIN_EDGES):
+                # Open-ended last bin: report its lower edge
+                return float(lower)
+            upper = DURATION_BIN_EDGES[i]
+            return lower + (upper - lower) * (target - seen) / value
+        seen += value
+    return float(DURATION_BIN_EDGES[-1])
+
+def _capacity_from_env():
+    try:
+        capacity = int(os.environ.get('CALL_HISTORY_SIZE', DEFAULT_CAPACITY))
+    except ValueError:
+        capacity = 0
+    if capacity < 1:
+        logger.warning(f"Invalid CALL_HISTORY_SIZE value, using {DEFAULT_CAPACITY}")
+        return DEFAULT_CAPACITY
+    return capacity
+
+# History shared by the whole process
+call_history = CallHistory(_capacity_from_env())
@@ -0,0 +1,442 @@
+"""
+Crash-safe journal of changes to the in-memory active calls.
+
+MemoryCallStore appends a small binary record for every call start, IVR
+selection, end and clear. A background thread writes the records that
+accumulated during each commit interval with one write and one fsync
+(group commit), so webhooks never wait for the disk; a crash loses at most
+the last interval.
+
+The journal is split into numbered segments. Every SNAPSHOT_INTERVAL records
+a new segment is started and a compacted snapshot of the active calls at
+that point is written next to it, after which older segments and snapshots
+are deleted. On startup the latest valid snapshot is memory-mapped and the
+segments after it are replayed, so the active calls survive a worker
+restart.
+
+File layout in the journal directory:
+    snapshot-<seq>.bin  Active calls at the start of segment <seq>
+    journal-<seq>.log   Records appended after that
+    journal.lock        Held by the process using the journal
+
+Record framing: payload length (uint16), CRC32 of the payload (uint32),
+payload. A torn or corrupt record at the end of a segment is truncated
+during recovery.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Seconds between group commits
+DEFAULT_COMMIT_INTERVAL = 0.005
+
+# Records appended before the journal is compacted into a snapshot
+SNAPSHOT_INTERVAL = 10000
+
+# Record types
+RECORD_START = 1
+RECORD_IVR = 2
+RECORD_END = 3
+RECORD_CLEAR = 4
+
+SNAPSHOT_MAGIC = b'CJS1'
+
+_FRAME = struct.Struct('<HI')
+_IVR = struct.Struct('<BBH')
+_END = struct.Struct('<BH')
+_CALL = struct.Struct('<dBHHH')
+_COUNT = struct.Struct('<I')
+
+_FILE_PATTERN = re.compile(r'^(journal|snapshot)-(\d{8})\.(log|bin)$')
+
+COMMIT_LATENCY = Histogram(
+    'call_journal_commit_seconds', "Time to write and fsync one group commit of the call journal.")
+JOURNAL_ERRORS = Counter(
+    'call_journal_errors_total', "Failed writes of the call journal, by operation.", ['operation'])
+
+class JournalLockedError(Exception):
+    """Another process is already using the journal directory."""
+
+class _Rotation:
+    """Marker in the write buffer: start segment `seq` with a snapshot of `calls`."""
+
+    __slots__ = ('seq', 'calls')
+
+    def __init__(self, seq, calls):
+        self.seq = seq
+        self.calls = calls
+
+def _frame(payload):
+    return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+def _encode_call(call):
+    """Encode a call (anything with CallRecord's attributes) for a snapshot."""
+    sid = call.call_sid.encode('utf-8')
+    from_number = (call.from_number or '').encode('utf-8')
+    to_number = (call.to_number or '').encode('utf-8')
+    return _CALL.pack(call.start_time, int(call.ivr_selection), len(sid),
+                      len(from_number), len(to_number)) + sid + from_number + to_number
+
+def _decode_call(buffer, offset):
+    """
+    Decode a call encoded by _encode_call.
+
+    Returns:
+        tuple: ((call_sid, from_number, to_number, start_time, ivr_selection),
+            offset after the call)
+    """
+    start_time, ivr, sid_len, from_len, to_len = _CALL.unpack_from(buffer, offset)
+    offset += _CALL.size
+    sid = bytes(buffer[offset:offset + sid_len]).decode('utf-8')
+    offset += sid_len
+    from_number = bytes(buffer[offset:offset + from_len]).decode('utf-8')
+    offset += from_len
+    to_number = bytes(buffer[offset:offset + to_len]).decode('utf-8')
+    offset += to_len
+    return (sid, from_number, to_number, start_time, ivr), offset
+
+def _apply(calls, payload):
+    """Apply one journal record to a dict of call tuples keyed by call SID."""
+    kind = payload[0]
+    if kind == RECORD_START:
+        call, _ = _decode_call(payload, 1)
+        calls[call[0]] = call
+    elif kind == RECORD_IVR:
+        _, ivr, sid_len = _IVR.unpack_from(payload, 0)
+        sid = payload[_IVR.size:_IVR.size + sid_len].decode('utf-8')
+        call = calls.get(sid)
+        if call is not None:
+            calls[sid] = call[:4] + (ivr,)
+    elif kind == RECORD_END:
+        _, sid_len = _END.unpack_from(payload, 0)
+        calls.pop(payload[_END.size:_END.size + sid_len].decode('utf-8'), None)
+    elif kind == RECORD_CLEAR:
+        calls.clear()
+    else:
+        raise ValueError(f"Unknown journal record type {kind}")
+
+class CallJournal:
+    """Append-only, group-committed journal with periodic snapshots."""
+
+    def __init__(self, directory, commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 snapshot_interval=SNAPSHOT_INTERVAL):
+        """
+        Args:
+            directory (str): Directory for the journal files (created if missing)
+            commit_interval (float): Seconds between group commits
+            snapshot_interval (int): Records between snapshots
+
+        Raises:
+            JournalLockedError: If another process holds the journal
+        """
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.snapshot_interval = snapshot_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock_file = open(os.path.join(directory, 'journal.lock'), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise JournalLockedError(f"Call journal {directory} is in use by another process")
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._records_since_snapshot = 0
+        self._segment_seq = None
+        self._file = None
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._commit_latency = COMMIT_LATENCY.labels()
+        self._commit_errors = JOURNAL_ERRORS.labels('commit')
+        self._snapshot_errors = JOURNAL_ERRORS.labels('snapshot')
+
+    def _path(self, kind, seq):
+        extension = 'log' if kind == 'journal' else 'bin'
+        return os.path.join(self.directory, f'{kind}-{seq:08d}.{extension}')
+
+    def _list_files(self):
+        """Return {'journal': [seq, ...], 'snapshot': [seq, ...]}, sorted."""
+        files = {'journal': [], 'snapshot': []}
+        for name in os.listdir(self.directory):
+            match = _FILE_PATTERN.match(name)
+            if match:
+                files[match.group(1)].append(int(match.group(2)))
+        for seqs in files.values():
+            seqs.sort()
+        return files
+
+    def _load_snapshot(self, seq):
+        """Read a snapshot file through mmap; returns a dict of call tuples or None if invalid."""
+        with open(self._path('snapshot', seq), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(SNAPSHOT_MAGIC) + _COUNT.size + 4:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    (crc,) = struct.unpack_from('<I', view, size - 4)
+                    if view[:4] != SNAPSHOT_MAGIC or zlib.crc32(view[:size - 4]) != crc:
+                        return None
+                    (count,) = _COUNT.unpack_from(view, 4)
+                    offset = 4 + _COUNT.size
+                    calls = {}
+                    for _ in range(count):
+                        call, offset = _decode_call(view, offset)
+                        calls[call[0]] = call
+                    return calls
+                finally:
+                    view.release()
+
+    def _replay_segment(self, seq, calls):
+        """Apply a segment's records; truncates a torn or corrupt tail. Returns the record count."""
+        path = self._path('journal', seq)
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        count = 0
+        while offset + _FRAME.size <= len(data):
+            length, crc = _FRAME.unpack_from(data, offset)
+            payload = data[offset + _FRAME.size:offset + _FRAME.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            try:
+                _apply(calls, payload)
+            except Exception as e:
+                logger.error(f"Error replaying call journal record: {str(e)}")
+                break
+            offset += _FRAME.size + length
+            count += 1
+        if offset < len(data):
+            logger.warning(f"Truncating {len(data) - offset} bytes of incomplete records "
+                           f"from {os.path.basename(path)}")
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        return count
+
+    def recover(self):
+        """
+        Rebuild the active calls from the latest snapshot and the journal,
+        then compact them into a fresh snapshot and start appending.
+
+        Returns:
+            list: (call_sid, from_number, to_number, start_time, ivr_selection)
+                tuples of the calls that were active
+        """
+        start = time.perf_counter()
+        files = self._list_files()
+
+        calls = None
+        snapshot_seq = None
+        for seq in reversed(files['snapshot']):
+            try:
+                calls = self._load_snapshot(seq)
+            except OSError as e:
+                logger.error(f"Error reading call snapshot {seq}: {str(e)}")
+                calls = None
+            if calls is not None:
+                snapshot_seq = seq
+                break
+            logger.warning(f"Ignoring invalid call snapshot {seq}")
+        if calls is None:
+            calls = {}
+
+        replayed = 0
+        for seq in files['journal']:
+            if snapshot_seq is None or seq >= snapshot_seq:
+                replayed += self._replay_segment(seq, calls)
+
+        # Compact what was recovered and continue in a new segment
+        last_seq = max(files['journal'] + files['snapshot'] + [0])
+        self._segment_seq = last_seq + 1
+        self._write_snapshot(self._segment_seq, [_CallTuple(call) for call in calls.values()])
+        self._file = open(self._path('journal', self._segment_seq), 'ab')
+        self._delete_before(self._segment_seq)
+
+        logger.info("Recovered %d active calls (%d journal records replayed) in %.1fms",
+                    len(calls), replayed, (time.perf_counter() - start) * 1000)
+        return list(calls.values())
+
+    def start(self):
+        """Start the group commit thread. Call after recover()."""
+        self._thread = threading.Thread(target=self._run, name='call-journal', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Commit the buffered records and stop the commit thread."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        else:
+            self._commit()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lock_file.close()
+
+    # Appending; callers serialize these calls (MemoryCallStore holds its lock)
+
+    def _append(self, payload):
+        frame = _frame(payload)
+        with self._lock:
+            self._buffer.append(frame)
+            self._records_since_snapshot += 1
+
+    def record_start(self, call):
+        """Journal a new (or replaced) call record."""
+        self._append(bytes((RECORD_START,)) + _encode_call(call))
+
+    def record_ivr(self, call_sid, ivr_selection):
+        """Journal an IVR selection."""
+        sid = call_sid.encode('utf-8')
+        self._append(_IVR.pack(RECORD_IVR, int(ivr_selection), len(sid)) + sid)
+
+    def record_end(self, call_sid):
+        """Journal the end of a call."""
+        sid = call_sid.encode('utf-8')
+        self._append(_END.pack(RECORD_END, len(sid)) + sid)
+
+    def record_clear(self):
+        """Journal the removal of all calls."""
+        self._append(bytes((RECORD_CLEAR,)))
+
+    def snapshot_due(self):
+        """Whether enough records were appended since the last snapshot."""
+        return self._records_since_snapshot >= self.snapshot_interval
+
+    def rotate(self, calls):
+        """
+        Start a new segment whose snapshot holds `calls`.
+
+        Must be called in order with the record_* calls, with `calls` being
+        the active calls after all records appended so far; the snapshot is
+        encoded and written by the commit thread.
+
+        Args:
+            calls (tuple): Immutable sequence of the active CallRecord objects
+        """
+        with self._lock:
+            self._segment_seq += 1
+            self._buffer.append(_Rotation(self._segment_seq, calls))
+            self._records_since_snapshot = 0
+        self._wakeup.set()
+
+    # Commit thread
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.commit_interval)
+            self._wakeup.clear()
+            self._commit()
+        self._commit()
+
+    def _commit(self):
+        with self._lock:
+            items, self._buffer = self._buffer, []
+        if not items:
+            return
+        try:
+            pending = []
+            for item in items:
+                if isinstance(item, _Rotation):
+                    self._flush(pending)
+                    pending = []
+                    self._rotate_segment(item)
+                else:
+                    pending.append(item)
+            self._flush(pending)
+        except Exception as e:
+            self._commit_errors.inc()
+            logger.error(f"Error writing call journal: {str(e)}")
+
+    def _rotate_segment(self, rotation):
+        """
+        Switch to the segment of a rotation once its snapshot is written.
+
+        If the snapshot can't be written, appending continues in the current
+        segment, which recovery still replays on top of the previous snapshot.
+        """
+        path = self._path('journal', rotation.seq)
+        try:
+            new_file = open(path, 'ab')
+        except OSError as e:
+            self._snapshot_errors.inc()
+            logger.error(f"Error starting call journal segment {rotation.seq}, "
+                         f"continuing in the current one: {str(e)}")
+            return
+        try:
+            self._write_snapshot(rotation.seq, rotation.calls)
+        except Exception as e:
+            new_file.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._snapshot_errors.inc()
+            logger.error(f"Error writing call snapshot {rotation.seq}, "
+                         f"continuing in the current segment: {str(e)}")
+            return
+        self._file.close()
+        self._file = new_file
+        self._delete_before(rotation.seq)
+
+    def _flush(self, frames):
+        if not frames:
+            return
+        start = time.perf_counter()
+        self._file.write(b''.join(frames))
+        self._file.flush()
+        os.fdatasync(self._file.fileno())
+        self._commit_latency.observe(time.perf_counter() - start)
+
+    def _write_snapshot(self, seq, calls):
+        """Write a snapshot atomically (temporary file, fsync, rename)."""
+        body = b''.join([SNAPSHOT_MAGIC, _COUNT.pack(len(calls))] +
+                        [_encode_call(call) for call in calls])
+        path = self._path('snapshot', seq)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(body)
+            f.write(struct.pack('<I', zlib.crc32(body)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _delete_before(self, seq):
+        """Delete segments and snapshots made obsolete by the snapshot `seq`."""
+        files = self._list_files()
+        for kind, seqs in files.items():
+            for old_seq in seqs:
+                if old_seq < seq:
+                    try:
+                        os.remove(self._path(kind, old_seq))
+                    except OSError as e:
+                        logger.error(f"Error deleting old call journal file: {str(e)}")
+
+class _CallTuple:
+    """Adapts a recovered call tuple to the attributes _encode_call reads."""
+
+    __slots__ = ('call_sid', 'from_number', 'to_number', 'start_time', 'ivr_selection')
+
+    def __init__(self, call):
+        (self.call_sid, self.from_number, self.to_number,
+         self.start_time, self.ivr_selection) = call
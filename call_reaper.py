@@ -0,0 +1,341 @@
+"""
+Expiry of calls whose status callback never arrived.
+
+If Twilio's /call_status callback is lost (or went to a worker that died),
+a call would stay active forever and count against MAX_CALLS. The reaper
+gives every call a deadline derived from its TwiML plan:
+
+- No IVR selection yet, in a menu: the menu is answered or abandoned
+  within CALL_IDLE_TIMEOUT seconds.
+- No IVR selection, in a flow node without a menu (e.g. announcements or
+  audio): only the maximum lifetime applies.
+- Music: MUSIC_LOOPS plays of music.mp3, plus REAPER_GRACE_SECONDS.
+- Beep: BEEP_LOOPS cycles of the beep track, plus the grace period; with
+  BEEP_LOOPS=0 (until hang-up) only the maximum lifetime applies.
+- Every call: at most CALL_MAX_LIFETIME seconds after it started.
+
+Deadlines are kept in a heap. Scheduling is O(log n), and each wake-up only
+touches the entries that are due, never the whole set of calls. Every
+transition schedules a new deadline with a new generation number, so
+earlier entries of the call become stale; they are recognized by their
+generation and skipped when they come due, and the heap is compacted once
+most of it is stale. Deadlines are on call_clock(), the clock call start
+times come from.
+
+Transitions may be handled by another worker sharing the call store, which
+schedules the new deadline in its own reaper. So when a deadline comes due,
+the call's IVR selection is read back from the store; if it is not the one
+the deadline was planned for, the call is rescheduled from its current
+selection instead of being ended.
+
+With REAPER_RECONCILE enabled, a call whose deadline passes is first looked
+up through the Twilio Calls API. A call Twilio reports as still in progress
+is given another grace period (up to the maximum lifetime), and one that
+Twilio reports as ended is ended here too.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+
+from audio_assets import audio_assets, mp3_duration, BEEP_TRACK_NAME
+from call_store_backends import IvrSelection, call_clock
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_LIFETIME = 4 * 3600
+DEFAULT_IDLE_TIMEOUT = 120
+DEFAULT_GRACE_SECONDS = 60
+
+# Assumed length of one play of the music when music.mp3 is not a local file
+DEFAULT_MUSIC_PLAY_SECONDS = 300
+
+# Twilio call statuses of calls that are still going
+ACTIVE_TWILIO_STATUSES = ('queued', 'ringing', 'in-progress')
+
+CALLS_REAPED = Counter(
+    'calls_reaped_total', "Active calls ended by the reaper, by reason.", ['reason'])
+REAPER_SCHEDULED = Gauge('reaper_scheduled_deadlines', "Deadlines waiting in the reaper's heap.")
+
+# Stale heap entries below which the heap is never compacted
+MIN_COMPACT_ENTRIES = 1024
+
+# Reasons a call was reaped
+REASON_PLAN = 'plan'
+REASON_IDLE = 'idle'
+REASON_LIFETIME = 'lifetime'
+REASON_TWILIO = 'twilio'
+
+def _env_seconds(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logger.warning(f"Invalid {name} value, using {default}")
+        return default
+
+def twilio_call_status(call_sid):
+    """
+    Look up a call's status through the Twilio Calls API.
+
+    Returns:
+        str: The Twilio call status, or None if Twilio is not configured
+    """
+    from twilio_utils import get_twilio_client
+    client = get_twilio_client()
+    if client is None:
+        return None
+    return client.calls(call_sid).fetch().status
+
+class CallReaper:
+    """Background thread ending calls whose deadline has passed."""
+
+    def __init__(self, get_call, end_call, max_lifetime=None, idle_timeout=None,
+                 grace=None, status_lookup=None):
+        """
+        Args:
+            get_call (callable): Returns the active CallRecord for a call SID, or None
+            end_call (callable): Ends a call by SID (publishing and recording it)
+            max_lifetime (float): Seconds after its start a call is always
+                ended; defaults to CALL_MAX_LIFETIME
+            idle_timeout (float): Seconds a call may stay in the IVR menu;
+                defaults to CALL_IDLE_TIMEOUT
+            grace (float): Seconds added to planned playback; defaults to
+                REAPER_GRACE_SECONDS
+            status_lookup (callable): Returns the Twilio status for a call
+                SID, used to reconcile before reaping; None to skip
+        """
+        self.get_call = get_call
+        self.end_call = end_call
+        self.max_lifetime = (max_lifetime if max_lifetime is not None
+                             else _env_seconds('CALL_MAX_LIFETIME', DEFAULT_MAX_LIFETIME))
+        self.idle_timeout = (idle_timeout if idle_timeout is not None
+                             else _env_seconds('CALL_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT))
+        self.grace = grace if grace is not None else _env_seconds('REAPER_GRACE_SECONDS',
+                                                                  DEFAULT_GRACE_SECONDS)
+        self.status_lookup = status_lookup
+
+        self._condition = threading.Condition(threading.Lock())
+        # (deadline, generation, call_sid, reason, ivr_selection) tuples
+        self._heap = []
+        # Key: call SID, Value: generation of its current deadline
+        self._generations = {}
+        # Entries in the heap that are no longer their call's current deadline
+        self._stale = 0
+        self._next_generation = itertools.count()
+        self._thread = None
+        self._stopped = False
+        self._reaped = {reason: CALLS_REAPED.labels(reason)
+                        for reason in (REASON_PLAN, REASON_IDLE, REASON_LIFETIME, REASON_TWILIO)}
+        REAPER_SCHEDULED.labels().set_function(lambda: len(self._heap))
+
+    def plan_seconds(self, ivr_selection, in_menu=True):
+        """
+        Get how long the TwiML for an IVR selection keeps a call going.
+
+        Args:
+            ivr_selection (IvrSelection): The call's selection
+            in_menu (bool): Whether a call without a selection is in a menu
+                waiting for input, rather than e.g. listening to audio
+
+        Returns:
+            tuple: (seconds or None if unbounded, reason)
+        """
+        from twilio_utils import MUSIC_LOOPS, get_beep_loops
+        if ivr_selection == IvrSelection.NONE:
+            if not in_menu:
+                return None, REASON_LIFETIME
+            return self.idle_timeout, REASON_IDLE
+        if ivr_selection == IvrSelection.MUSIC:
+            music = audio_assets.get('music.mp3')
+            play = (mp3_duration(music.body) if music is not None else None) \
+                or DEFAULT_MUSIC_PLAY_SECONDS
+            return MUSIC_LOOPS * play + self.grace, REASON_PLAN
+        loops = get_beep_loops()
+        track = audio_assets.get(BEEP_TRACK_NAME)
+        if loops == 0 or track is None:
+            return None, REASON_LIFETIME
+        return loops * (mp3_duration(track.body) or 0) + self.grace, REASON_PLAN
+
+    def schedule(self, call, now=None, in_menu=True):
+        """
+        Set a call's deadline from its start time and current IVR selection,
+        replacing its earlier deadline.
+
+        Call this when a call is admitted and whenever it moves to another
+        node of the IVR flow.
+
+        Args:
+            call (CallRecord): The call
+            now (float): Current time, defaults to call_clock()
+            in_menu (bool): Whether a call without a selection is in a menu
+                waiting for input (see plan_seconds)
+        """
+        now = call_clock() if now is None else now
+        deadline, reason = self._deadline(call, now, in_menu)
+        self._push(deadline, call.call_sid, reason, call.ivr_selection)
+
+    def _deadline(self, call, now, in_menu=True):
+        """Get a call's deadline and its reason from its current IVR selection."""
+        deadline = call.start_time + self.max_lifetime
+        seconds, reason = self.plan_seconds(call.ivr_selection, in_menu)
+        if seconds is not None and now + seconds < deadline:
+            return now + seconds, reason
+        return deadline, REASON_LIFETIME
+
+    def _push(self, deadline, call_sid, reason, ivr_selection):
+        with self._condition:
+            generation = next(self._next_generation)
+            if self._generations.get(call_sid) is not None:
+                self._stale += 1
+            self._generations[call_sid] = generation
+            earliest = self._heap[0][0] if self._heap else None
+            heapq.heappush(self._heap, (deadline, generation, call_sid, reason, ivr_selection))
+            if earliest is None or deadline < earliest:
+                self._condition.notify()
+            self._compact()
+
+    def forget(self, call_sid):
+        """
+        Drop a call's deadline, e.g. when its status callback ended it.
+
+        Args:
+            call_sid (str): The Twilio call SID
+        """
+        with self._condition:
+            if self._generations.pop(call_sid, None) is not None:
+                self._stale += 1
+                self._compact()
+
+    def _compact(self):
+        # Must be called with the lock held. Rebuilding is O(n) but happens
+        # only after n/2 entries went stale, so it is O(1) per transition
+        if self._stale < MIN_COMPACT_ENTRIES or self._stale * 2 < len(self._heap):
+            return
+        generations = self._generations
+        self._heap = [entry for entry in self._heap if generations.get(entry[2]) == entry[1]]
+        heapq.heapify(self._heap)
+        self._stale = 0
+
+    def _is_current(self, generation, call_sid):
+        """Whether a popped entry is its call's latest deadline; forgets the call if so."""
+        with self._condition:
+            if self._generations.get(call_sid) != generation:
+                self._stale -= 1
+                return False
+            del self._generations[call_sid]
+            return True
+
+    def pop_expired(self, now=None):
+        """
+        Remove and return the entries whose deadline has passed.
+
+        Returns:
+            list: (deadline, generation, call_sid, reason, ivr_selection) tuples
+        """
+        now = call_clock() if now is None else now
+        expired = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                expired.append(heapq.heappop(self._heap))
+        return expired
+
+    def reap(self, now=None):
+        """
+        End the calls whose deadline has passed.
+
+        Returns:
+            int: Number of calls ended
+        """
+        now = call_clock() if now is None else now
+        ended = 0
+        for deadline, generation, call_sid, reason, selection in self.pop_expired(now):
+            if not self._is_current(generation, call_sid):
+                # A later transition scheduled a newer deadline
+                continue
+            call = self.get_call(call_sid)
+            if call is None:
+                # Already ended
+                continue
+            if call.ivr_selection != selection:
+                # Moved on through another worker since this deadline was set
+                deadline, reason = self._deadline(call, now)
+                if deadline > now:
+                    self._push(deadline, call_sid, reason, call.ivr_selection)
+                    continue
+            if self.status_lookup is not None:
+                try:
+                    status = self.status_lookup(call_sid)
+                except Exception as e:
+                    logger.error(f"Error looking up call status for {call_sid}: {str(e)}")
+                    status = None
+                if status in ACTIVE_TWILIO_STATUSES:
+                    retry = min(now + self.grace, call.start_time + self.max_lifetime)
+                    if retry > now:
+                        logger.info("Call %s is still %s at Twilio, keeping it", call_sid, status)
+                        self._push(retry, call_sid, REASON_LIFETIME, call.ivr_selection)
+                        continue
+                elif status is not None:
+                    reason = REASON_TWILIO
+            try:
+                self.end_call(call_sid)
+            except Exception as e:
+                logger.error(f"Error reaping call {call_sid}: {str(e)}")
+                continue
+            logger.warning("Reaped call %s (%s): no status callback after %.0fs",
+                           call_sid, reason, now - call.start_time)
+            self._reaped[reason].inc()
+            ended += 1
+        return ended
+
+    def start(self, calls=()):
+        """
+        Start the reaper thread.
+
+        Only the first call has an effect.
+
+        Args:
+            calls: Calls that are already active (e.g. recovered from the journal)
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='call-reaper', daemon=True)
+        for call in calls:
+            self.schedule(call)
+        self._thread.start()
+        # Threads don't survive fork(), e.g. gunicorn --preload workers
+        os.register_at_fork(after_in_child=self._restart)
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, name='call-reaper', daemon=True)
+        self._thread.start()
+
+    def _restart(self):
+        # The lock may have been held by the parent's reaper thread
+        self._condition = threading.Condition(threading.Lock())
+        self._start_thread()
+
+    def stop(self):
+        """Stop the reaper thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                timeout = self._heap[0][0] - call_clock() if self._heap else None
+                if timeout is None or timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Error reaping calls: {str(e)}")
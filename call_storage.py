@@ -1,101 +1,291 @@
 """
-In-memory storage for active calls.
-This module replaces the database-based call storage with a simpler in-memory solution.
+Storage for active calls.
+
+The functions in this module delegate to a pluggable storage backend (see
+call_store_backends). By default calls are kept in memory in the current
+process; set CALL_STORE=sqlite to share them between worker processes.
+
+Calls are returned as CallRecord objects, which are shared rather than
+copied and must not be modified; use CallRecord.to_dict() to serialize them.
 """
 
-from datetime import datetime
-import threading
+import functools
+import time
+
+from call_store_backends import (
+    create_call_store,
+    CallRecord,
+    CallSnapshot,
+    IvrSelection,
+    AdmissionResult,
+    ADMITTED,
+    DUPLICATE,
+    BUSY,
+    QUEUED,
+    Waiter
+)
+from metrics import STORE_LATENCY, ACTIVE_CALLS, WAITING_CALLS
+
+# Active storage backend
+_store = create_call_store()
+
+ACTIVE_CALLS.labels().set_function(lambda: _store.get_call_count())
+WAITING_CALLS.labels().set_function(lambda: _store.get_waiting_count())
+
+def _timed(operation):
+    """Decorator recording the duration of a storage operation."""
+    histogram = STORE_LATENCY.labels(operation)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def set_call_store(store):
+    """
+    Replace the storage backend.
+
+    Args:
+        store (CallStore): The new storage backend
+
+    Returns:
+        CallStore: The previous storage backend
+    """
+    global _store
+    previous, _store = _store, store
+    return previous
+
+def get_call_store():
+    """
+    Get the active storage backend.
 
-# Thread-safe dictionary to store active calls
-# Key: call_sid, Value: call data dictionary
-_active_calls = {}
-_lock = threading.RLock()  # Reentrant lock for thread safety
+    Returns:
+        CallStore: The storage backend
+    """
+    return _store
 
+@_timed('add_call')
 def add_call(call_sid, from_number, to_number):
     """
     Add a new call to the active calls storage.
-    
+
     Args:
         call_sid (str): The Twilio call SID
         from_number (str): The caller's phone number
         to_number (str): The called phone number
-    
+
     Returns:
-        dict: The created call record
+        CallRecord: The created call record
+    """
+    return _store.add_call(call_sid, from_number, to_number)
+
+@_timed('try_admit')
+def try_admit(call_sid, from_number, to_number, max_calls=None, tenant=None,
+              tenant_max_calls=None):
     """
-    with _lock:
-        call_data = {
-            'call_sid': call_sid,
-            'from_number': from_number,
-            'to_number': to_number,
-            'start_time': datetime.utcnow().isoformat(),
-            'ivr_selection': None
-        }
-        _active_calls[call_sid] = call_data
-        return call_data.copy()
+    Admit a new call if it is not already active and capacity allows.
+
+    The duplicate check, the capacity checks and the insert happen under a
+    single lock acquisition (a single write transaction for shared
+    backends), so concurrent callers can never push the store over
+    max_calls, or a tenant over tenant_max_calls.
 
+    Args:
+        call_sid (str): The Twilio call SID
+        from_number (str): The caller's phone number
+        to_number (str): The called phone number
+        max_calls (int): Maximum number of simultaneous calls, or None for no limit
+        tenant (str): Tenant the call is counted against, or None
+        tenant_max_calls (int): Maximum number of simultaneous calls of the
+            tenant, or None for no limit
+
+    Returns:
+        AdmissionResult: status is ADMITTED, DUPLICATE or BUSY; call is the
+            new or existing call record (None when BUSY)
+    """
+    return _store.try_admit(call_sid, from_number, to_number, max_calls,
+                            tenant, tenant_max_calls)
+
+@_timed('try_admit_queued')
+def try_admit_queued(call_sid, from_number, to_number, max_calls, max_waiting, stale_after,
+                     tenant=None, tenant_max_calls=None):
+    """
+    Admit a call, or hold it in the FIFO waiting room while at capacity.
+
+    Callers are admitted in arrival order: a new caller is only admitted
+    while nobody is waiting, and a waiting caller once fewer callers are
+    ahead of it than there are free lines. Enqueueing, admitting the head
+    and removing a waiter are O(1) (an ordered dict in memory, indexed
+    tables in SQLite).
+
+    Args:
+        call_sid (str): The Twilio call SID
+        from_number (str): The caller's phone number
+        to_number (str): The called phone number
+        max_calls (int): Maximum number of simultaneous calls
+        max_waiting (int): Maximum number of callers in the waiting room
+        stale_after (float): Seconds after which a waiter that stopped
+            polling is dropped
+        tenant (str): Tenant the call is counted against, or None
+        tenant_max_calls (int): Maximum number of simultaneous calls of the
+            tenant, or None for no limit
+
+    Returns:
+        AdmissionResult: status is ADMITTED, DUPLICATE, QUEUED or BUSY (the
+            waiting room is full); waited is the seconds an admitted caller
+            spent in the waiting room, or None if it never waited
+    """
+    return _store.try_admit_queued(call_sid, from_number, to_number, max_calls,
+                                   max_waiting, stale_after, tenant, tenant_max_calls)
+
+@_timed('get_tenant_call_count')
+def get_tenant_call_count(tenant):
+    """
+    Get count of active calls admitted for a tenant.
+
+    Args:
+        tenant (str): The tenant name
+
+    Returns:
+        int: Number of the tenant's active calls
+    """
+    return _store.get_tenant_call_count(tenant)
+
+@_timed('get_call_tenants')
+def get_call_tenants():
+    """
+    Get the tenants active calls were admitted for.
+
+    Returns:
+        dict: Tenant by call SID, for the calls counted against a tenant
+    """
+    return _store.get_call_tenants()
+
+@_timed('remove_waiter')
+def remove_waiter(call_sid):
+    """
+    Remove a caller from the waiting room, e.g. when it hangs up.
+
+    Args:
+        call_sid (str): The Twilio call SID
+
+    Returns:
+        Waiter: The removed waiter, or None if the caller wasn't waiting
+    """
+    return _store.remove_waiter(call_sid)
+
+@_timed('get_waiting_count')
+def get_waiting_count():
+    """
+    Get count of callers in the waiting room.
+
+    Returns:
+        int: Number of waiting callers
+    """
+    return _store.get_waiting_count()
+
+@_timed('update_ivr_selection')
 def update_ivr_selection(call_sid, selection):
     """
     Update the IVR selection for a call.
-    
+
     Args:
         call_sid (str): The Twilio call SID
         selection (str): The IVR selection ('music' or 'beep')
-    
+
     Returns:
-        dict: The updated call record or None if not found
+        CallRecord: The updated call record or None if not found
     """
-    with _lock:
-        if call_sid in _active_calls:
-            _active_calls[call_sid]['ivr_selection'] = selection
-            return _active_calls[call_sid].copy()
-        return None
+    return _store.update_ivr_selection(call_sid, selection)
 
+@_timed('end_call')
 def end_call(call_sid):
     """
     Remove a call from active calls when it ends.
-    
+
     Args:
         call_sid (str): The Twilio call SID
-    
+
     Returns:
-        dict: The call data that was removed, or None if not found
+        CallRecord: The call that was removed, or None if not found
     """
-    with _lock:
-        if call_sid in _active_calls:
-            call_data = _active_calls.pop(call_sid)
-            return call_data
-        return None
+    return _store.end_call(call_sid)
 
+@_timed('get_active_calls')
 def get_active_calls():
     """
     Get all active calls.
-    
+
+    Returns:
+        tuple: Active calls as CallRecord objects
+    """
+    return _store.get_active_calls()
+
+@_timed('get_snapshot')
+def get_snapshot():
+    """
+    Get an immutable snapshot of the active calls.
+
+    With the in-memory store this never waits for writers: every write
+    publishes a new snapshot, and readers between writes share it along
+    with its cached JSON encoding.
+
     Returns:
-        list: List of active calls as dictionaries
+        CallSnapshot: The active calls, their count and version
     """
-    with _lock:
-        return list(_active_calls.values())
+    return _store.get_snapshot()
 
+@_timed('get_call_count')
 def get_call_count():
     """
     Get count of active calls.
-    
+
     Returns:
         int: Number of active calls
     """
-    with _lock:
-        return len(_active_calls)
+    return _store.get_call_count()
 
+@_timed('get_call')
 def get_call(call_sid):
     """
     Get a specific call by SID.
-    
+
     Args:
         call_sid (str): The Twilio call SID
-    
+
+    Returns:
+        CallRecord: Call record or None if not found
+    """
+    return _store.get_call(call_sid)
+
+@_timed('get_version')
+def get_version():
+    """
+    Get the current version of the active calls.
+
+    Returns:
+        int: Version number, incremented by every change
+    """
+    return _store.get_version()
+
+@_timed('get_changes')
+def get_changes(since=None):
+    """
+    Get the changes to the active calls made after a version.
+
+    Args:
+        since (int): Version the caller last saw, or None for a full snapshot
+
     Returns:
-        dict: Call data or None if not found
+        dict: With 'version' and 'full'. Full snapshots (returned when the
+            bounded change log no longer reaches back to `since`) carry
+            'calls'; deltas carry 'added' and 'updated' call records and the
+            'removed' call SIDs.
     """
-    with _lock:
-        return _active_calls.get(call_sid, {}).copy()
\ No newline at end of file
+    return _store.get_changes(since)
@@ -0,0 +1,967 @@
+"""
+Storage backends for active calls.
+
+MemoryCallStore keeps calls in a dictionary local to the process.
+SqliteCallStore keeps them in a local SQLite database in WAL mode so that
+every worker process of the same deployment sees the same set of calls.
+
+Both return the active calls newest first, so API clients never sort them.
+"""
+
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from enum import IntEnum
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from call_journal import CallJournal, JournalLockedError, DEFAULT_COMMIT_INTERVAL
+from metrics import TimedLock, STORE_LOCK_WAIT, STORE_LOCK_HOLD
+
+logger = logging.getLogger(__name__)
+
+# Possible outcomes of CallStore.try_admit and CallStore.try_admit_queued
+ADMITTED = 'admitted'
+DUPLICATE = 'duplicate'
+BUSY = 'busy'
+QUEUED = 'queued'
+
+# Result of an admission attempt: one of the outcomes above, the call
+# record (the new record, the existing one for duplicates, None when busy
+# or queued) and, for callers admitted from the waiting room, the seconds
+# they waited
+AdmissionResult = namedtuple('AdmissionResult', ['status', 'call', 'waited'], defaults=[None])
+
+# A caller in the waiting room. Tickets increase in arrival order; last_seen
+# is when the caller last polled from hold
+Waiter = namedtuple('Waiter', ['ticket', 'call_sid', 'from_number', 'to_number',
+                               'enqueued_at', 'last_seen'])
+
+# Kinds of entries in the change log
+CHANGE_ADDED = 'added'
+CHANGE_UPDATED = 'updated'
+CHANGE_REMOVED = 'removed'
+CHANGE_CLEARED = 'cleared'
+
+# Wait and hold times of the store's write lock (the SQLite write transaction)
+_lock_wait = STORE_LOCK_WAIT.labels()
+_lock_hold = STORE_LOCK_HOLD.labels()
+
+# Number of changes kept for incremental readers
+DEFAULT_CHANGE_LOG_SIZE = 1000
+
+# Offset from the monotonic clock to the UTC epoch, fixed at startup
+_EPOCH_OFFSET = time.time() - time.monotonic()
+
+def call_clock():
+    """
+    Get the current time as a UTC epoch, read from the monotonic clock.
+
+    Call start times and durations both use this clock, so a wall clock
+    adjustment never makes a duration jump or go negative.
+
+    Returns:
+        float: Seconds since the epoch
+    """
+    return time.monotonic() + _EPOCH_OFFSET
+
+class IvrSelection(IntEnum):
+    """IVR menu option chosen by a caller."""
+
+    NONE = 0
+    MUSIC = 1
+    BEEP = 2
+
+    @property
+    def label(self):
+        """Name used in the API ('music', 'beep'), or None."""
+        return None if self is IvrSelection.NONE else self.name.lower()
+
+    @classmethod
+    def from_label(cls, label):
+        """Look up a selection by its API name; None means no selection."""
+        return cls.NONE if label is None else cls[label.upper()]
+
+class CallRecord:
+    """
+    An active call.
+
+    Records are treated as immutable once stored, so readers can share them
+    without copying; updates store a modified copy (see replace()).
+
+    Attributes:
+        call_sid (str): The Twilio call SID
+        from_number (str): The caller's phone number (interned)
+        to_number (str): The called phone number (interned)
+        start_time (float): Start of the call as a UTC epoch
+        ivr_selection (IvrSelection): The caller's IVR selection
+    """
+
+    __slots__ = ('call_sid', 'from_number', 'to_number', 'start_time', 'ivr_selection')
+
+    def __init__(self, call_sid, from_number, to_number, start_time,
+                 ivr_selection=IvrSelection.NONE):
+        self.call_sid = call_sid
+        # Test numbers repeat heavily, so share one string per number
+        self.from_number = sys.intern(from_number) if from_number is not None else None
+        self.to_number = sys.intern(to_number) if to_number is not None else None
+        self.start_time = start_time
+        self.ivr_selection = ivr_selection
+
+    def replace(self, **changes):
+        """Return a copy of the record with some attributes changed."""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return CallRecord(**values)
+
+    def to_dict(self, now=None):
+        """
+        Convert the record to the JSON shape used by the API.
+
+        Args:
+            now (float): Time to compute the duration at, from call_clock();
+                pass one value for all calls of a response
+
+        Returns:
+            dict: call_sid, from_number, to_number, start_time (UTC ISO
+                format), ivr_selection ('music', 'beep' or None) and
+                duration (whole seconds)
+        """
+        data = self._base_dict()
+        data['duration'] = self.duration(call_clock() if now is None else now)
+        return data
+
+    def _base_dict(self):
+        start = datetime.fromtimestamp(self.start_time, timezone.utc).replace(tzinfo=None)
+        return {
+            'call_sid': self.call_sid,
+            'from_number': self.from_number,
+            'to_number': self.to_number,
+            'start_time': start.isoformat(),
+            'ivr_selection': self.ivr_selection.label
+        }
+
+    def duration(self, now):
+        """Get the whole seconds the call has lasted at `now`."""
+        # Clocks of different worker processes may differ slightly
+        return max(0, int(now - self.start_time))
+
+    def __eq__(self, other):
+        if not isinstance(other, CallRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return (f"CallRecord({self.call_sid!r}, {self.from_number!r}, {self.to_number!r}, "
+                f"{self.start_time!r}, {self.ivr_selection!r})")
+
+class CallSnapshot:
+    """
+    Immutable view of the active calls at one version.
+
+    The JSON encoding of each call, without its duration, is computed on
+    first use and then reused by every reader of the same snapshot; only
+    the durations are formatted per request.
+    """
+
+    __slots__ = ('version', 'calls', '_fragments')
+
+    def __init__(self, version, calls):
+        """
+        Args:
+            version (int): Store version the snapshot was taken at
+            calls (tuple): The active CallRecord objects, newest first
+        """
+        self.version = version
+        self.calls = calls
+        self._fragments = None
+
+    @property
+    def count(self):
+        """Number of active calls."""
+        return len(self.calls)
+
+    def to_json(self, now=None, offset=0, limit=None):
+        """
+        Get a page of the calls encoded as a JSON array in the API shape.
+
+        Args:
+            now (float): Time to compute durations at, defaults to call_clock()
+            offset (int): Number of calls to skip
+            limit (int): Maximum number of calls, or None for all
+
+        Returns:
+            bytes: UTF-8 encoded JSON, calls newest first
+        """
+        fragments = self._fragments
+        if fragments is None:
+            # Concurrent first readers may both encode; the results are identical.
+            # Each fragment is an object without its closing brace.
+            fragments = tuple(json.dumps(call._base_dict(), separators=(',', ':'))
+                              .encode('utf-8')[:-1] for call in self.calls)
+            self._fragments = fragments
+        now = call_clock() if now is None else now
+        end = None if limit is None else offset + limit
+        calls = self.calls[offset:end]
+        return b'[' + b','.join(
+            b'%s,"duration":%d}' % (fragment, call.duration(now))
+            for fragment, call in zip(fragments[offset:end], calls)
+        ) + b']'
+
+class CallStore:
+    """
+    Interface implemented by call storage backends.
+
+    Backends store and return CallRecord objects; callers must not modify
+    returned records.
+    """
+
+    def add_call(self, call_sid, from_number, to_number):
+        """Add a call and return the created record."""
+        raise NotImplementedError
+
+    def try_admit(self, call_sid, from_number, to_number, max_calls=None,
+                  tenant=None, tenant_max_calls=None):
+        """
+        Add a call unless it already exists or the store is at capacity.
+
+        The duplicate check, the capacity checks and the insert happen
+        atomically with respect to every other user of the store.
+
+        Args:
+            max_calls (int): Maximum number of active calls, or None for no limit
+            tenant (str): Tenant the call is counted against, or None
+            tenant_max_calls (int): Maximum number of active calls of the
+                tenant, or None for no limit
+
+        Returns:
+            AdmissionResult: The admission decision and the call record
+        """
+        raise NotImplementedError
+
+    def get_tenant_call_count(self, tenant):
+        """Return the number of active calls admitted for a tenant."""
+        raise NotImplementedError
+
+    def get_call_tenants(self):
+        """Return the tenant of each active call admitted for one, by call SID."""
+        raise NotImplementedError
+
+    def try_admit_queued(self, call_sid, from_number, to_number, max_calls,
+                         max_waiting, stale_after, tenant=None, tenant_max_calls=None):
+        """
+        Admit a call, or keep it in a FIFO waiting room while at capacity.
+
+        New callers are admitted only while nobody is waiting. A waiting
+        caller is admitted once fewer callers are ahead of it than there are
+        free lines. Waiters that haven't polled for stale_after seconds are
+        dropped from the head of the queue. All of this happens atomically
+        with respect to every other user of the store.
+
+        The waiting room is shared by all tenants. A caller whose tenant is
+        at its limit keeps its place, and callers behind it are admitted
+        while more lines are free than callers ahead of them.
+
+        Args:
+            max_calls (int): Maximum number of active calls
+            max_waiting (int): Maximum number of waiting callers
+            stale_after (float): Seconds after which a silent waiter is dropped
+            tenant (str): Tenant the call is counted against, or None
+            tenant_max_calls (int): Maximum number of active calls of the
+                tenant, or None for no limit
+
+        Returns:
+            AdmissionResult: 'admitted' (with the seconds waited if the
+                caller was queued), 'duplicate', 'queued', or 'busy' when
+                the waiting room is full
+        """
+        raise NotImplementedError
+
+    def remove_waiter(self, call_sid):
+        """Remove a caller from the waiting room and return its Waiter, or None."""
+        raise NotImplementedError
+
+    def get_waiting_count(self):
+        """Return the number of callers in the waiting room."""
+        raise NotImplementedError
+
+    def update_ivr_selection(self, call_sid, selection):
+        """Set the IVR selection of a call and return the updated record."""
+        raise NotImplementedError
+
+    def end_call(self, call_sid):
+        """Remove a call and return the removed record."""
+        raise NotImplementedError
+
+    def get_active_calls(self):
+        """Return a sequence of all active call records, newest first."""
+        raise NotImplementedError
+
+    def get_snapshot(self):
+        """Return a CallSnapshot of the active calls."""
+        raise NotImplementedError
+
+    def get_call_count(self):
+        """Return the number of active calls."""
+        raise NotImplementedError
+
+    def get_call(self, call_sid):
+        """Return a call record, or None if not found."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all calls and empty the waiting room."""
+        raise NotImplementedError
+
+    def get_version(self):
+        """Return the version number, incremented by every change."""
+        raise NotImplementedError
+
+    def get_changes(self, since=None):
+        """
+        Get the changes made after a version.
+
+        Args:
+            since (int): Version the caller last saw, or None for a full snapshot
+
+        Returns:
+            dict: {'version', 'full': True, 'calls'} when the change log no
+                longer covers the requested version, otherwise
+                {'version', 'full': False, 'added', 'updated', 'removed'}.
+                Full snapshots list the calls newest first; added calls are
+                listed in the order they started.
+        """
+        raise NotImplementedError
+
+def _full_snapshot(version, calls):
+    return {'version': version, 'full': True, 'calls': calls}
+
+def _build_changes(version, entries, lookup):
+    """
+    Collapse change log entries into a delta.
+
+    Args:
+        version (int): Current version
+        entries (list): (call_sid, kind) tuples in version order
+        lookup (callable): Returns the current record of a call, or None
+
+    Returns:
+        dict: Delta as described in CallStore.get_changes, or None if the
+            entries contain a reset that requires a full snapshot
+    """
+    # Key: call_sid, Value: whether the call was added within the range
+    touched = {}
+    for call_sid, kind in entries:
+        if kind == CHANGE_CLEARED:
+            return None
+        touched[call_sid] = touched.get(call_sid, False) or kind == CHANGE_ADDED
+
+    added, updated, removed = [], [], []
+    for call_sid, was_added in touched.items():
+        call = lookup(call_sid)
+        if call is None:
+            # Calls both added and removed within the range were never seen
+            if not was_added:
+                removed.append(call_sid)
+        elif was_added:
+            added.append(call)
+        else:
+            updated.append(call)
+    return {'version': version, 'full': False,
+            'added': added, 'updated': updated, 'removed': removed}
+
+def _new_call_record(call_sid, from_number, to_number):
+    return CallRecord(call_sid, from_number, to_number, call_clock())
+
+class MemoryCallStore(CallStore):
+    """Call storage in a dictionary local to the current process."""
+
+    def __init__(self, change_log_size=DEFAULT_CHANGE_LOG_SIZE, journal=None):
+        """
+        Args:
+            change_log_size (int): Number of changes kept for get_changes()
+            journal (CallJournal): Journal to recover the active calls from
+                and to record changes in, or None to keep calls only in memory
+        """
+        # Key: call_sid, Value: CallRecord. Calls are inserted as they start,
+        # so the dict's insertion order is start time order, oldest first
+        self._active_calls = {}
+        self._journal = journal
+        if journal is not None:
+            recovered = sorted(journal.recover(), key=lambda call: call[3])
+            for call_sid, from_number, to_number, start_time, ivr in recovered:
+                self._active_calls[call_sid] = CallRecord(
+                    call_sid, from_number, to_number, start_time, IvrSelection(ivr))
+            journal.start()
+        # Reentrant lock for thread safety; reports its wait and hold times
+        self._lock = TimedLock(_lock_wait, _lock_hold)
+        # Versions start at the creation time in milliseconds so that clients
+        # holding a version from a previous process always get a full snapshot
+        self._version = int(time.time() * 1000)
+        # (version, call_sid, kind) tuples, oldest first
+        self._changes = deque(maxlen=change_log_size)
+        # Built on the first read after a write and reused until the next
+        # write, so writes stay O(1); read without taking the lock
+        self._snapshot = None
+        # Key: call_sid, Value: Waiter, in arrival order. Not journaled:
+        # after a restart waiting callers rejoin at the back when they poll
+        self._waiting = OrderedDict()
+        self._next_ticket = 0
+        # Key: tenant, Value: number of its active calls; and the tenant of
+        # each active call admitted for one. Not journaled: recovered calls
+        # count against MAX_CALLS only
+        self._tenant_counts = {}
+        self._call_tenants = {}
+
+    def _current_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = CallSnapshot(self._version,
+                                            tuple(reversed(self._active_calls.values())))
+                    self._snapshot = snapshot
+        return snapshot
+
+    def _record_change(self, call_sid, kind):
+        # Must be called with the lock held, after the change is journaled
+        self._version += 1
+        self._changes.append((self._version, call_sid, kind))
+        self._snapshot = None
+        if self._journal is not None and self._journal.snapshot_due():
+            # The snapshot is immutable, so it can be written out later
+            self._journal.rotate(self._current_snapshot().calls)
+
+    def add_call(self, call_sid, from_number, to_number):
+        with self._lock:
+            call_data = _new_call_record(call_sid, from_number, to_number)
+            # A restarted call moves to the end, keeping start time order
+            kind = CHANGE_UPDATED if self._active_calls.pop(call_sid, None) else CHANGE_ADDED
+            self._active_calls[call_sid] = call_data
+            if self._journal is not None:
+                self._journal.record_start(call_data)
+            self._record_change(call_sid, kind)
+            return call_data
+
+    def _tenant_full(self, tenant, tenant_max_calls):
+        return (tenant is not None and tenant_max_calls is not None
+                and self._tenant_counts.get(tenant, 0) >= tenant_max_calls)
+
+    def _admit(self, call_sid, from_number, to_number, tenant):
+        # Must be called with the lock held
+        call = self.add_call(call_sid, from_number, to_number)
+        if tenant is not None:
+            self._call_tenants[call_sid] = tenant
+            self._tenant_counts[tenant] = self._tenant_counts.get(tenant, 0) + 1
+        return call
+
+    def _release_tenant(self, call_sid):
+        # Must be called with the lock held
+        tenant = self._call_tenants.pop(call_sid, None)
+        if tenant is not None:
+            count = self._tenant_counts[tenant] - 1
+            if count:
+                self._tenant_counts[tenant] = count
+            else:
+                del self._tenant_counts[tenant]
+
+    def try_admit(self, call_sid, from_number, to_number, max_calls=None,
+                  tenant=None, tenant_max_calls=None):
+        with self._lock:
+            existing = self._active_calls.get(call_sid)
+            if existing is not None:
+                return AdmissionResult(DUPLICATE, existing)
+            if max_calls is not None and len(self._active_calls) >= max_calls:
+                return AdmissionResult(BUSY, None)
+            if self._tenant_full(tenant, tenant_max_calls):
+                return AdmissionResult(BUSY, None)
+            return AdmissionResult(ADMITTED, self._admit(call_sid, from_number, to_number, tenant))
+
+    def get_tenant_call_count(self, tenant):
+        return self._tenant_counts.get(tenant, 0)
+
+    def get_call_tenants(self):
+        with self._lock:
+            return dict(self._call_tenants)
+
+    def try_admit_queued(self, call_sid, from_number, to_number, max_calls,
+                         max_waiting, stale_after, tenant=None, tenant_max_calls=None):
+        with self._lock:
+            existing = self._active_calls.get(call_sid)
+            if existing is not None:
+                return AdmissionResult(DUPLICATE, existing)
+            now = call_clock()
+            waiting = self._waiting
+            # Drop callers that stopped polling (their hang-up was missed)
+            while waiting:
+                head = next(iter(waiting.values()))
+                if head.last_seen >= now - stale_after:
+                    break
+                waiting.popitem(last=False)
+            free = max_calls - len(self._active_calls)
+
+            waiter = waiting.get(call_sid)
+            if waiter is not None:
+                # Tickets of callers that left leave gaps, so this overestimates
+                # the number of callers ahead, never letting anyone skip ahead
+                ahead = waiter.ticket - next(iter(waiting.values())).ticket
+                if ahead < free and not self._tenant_full(tenant, tenant_max_calls):
+                    del waiting[call_sid]
+                    call = self._admit(call_sid, waiter.from_number, waiter.to_number, tenant)
+                    return AdmissionResult(ADMITTED, call, now - waiter.enqueued_at)
+                waiting[call_sid] = waiter._replace(last_seen=now)
+                return AdmissionResult(QUEUED, None)
+
+            if not waiting and free > 0 and not self._tenant_full(tenant, tenant_max_calls):
+                return AdmissionResult(ADMITTED,
+                                       self._admit(call_sid, from_number, to_number, tenant))
+            if len(waiting) >= max_waiting:
+                return AdmissionResult(BUSY, None)
+            self._next_ticket += 1
+            waiting[call_sid] = Waiter(self._next_ticket, call_sid, from_number, to_number, now, now)
+            return AdmissionResult(QUEUED, None)
+
+    def remove_waiter(self, call_sid):
+        with self._lock:
+            return self._waiting.pop(call_sid, None)
+
+    def get_waiting_count(self):
+        return len(self._waiting)
+
+    def update_ivr_selection(self, call_sid, selection):
+        with self._lock:
+            call_data = self._active_calls.get(call_sid)
+            if call_data is None:
+                return None
+            call_data = call_data.replace(ivr_selection=IvrSelection.from_label(selection))
+            self._active_calls[call_sid] = call_data
+            if self._journal is not None:
+                self._journal.record_ivr(call_sid, call_data.ivr_selection)
+            self._record_change(call_sid, CHANGE_UPDATED)
+            return call_data
+
+    def end_call(self, call_sid):
+        with self._lock:
+            call_data = self._active_calls.pop(call_sid, None)
+            if call_data is not None:
+                self._release_tenant(call_sid)
+                if self._journal is not None:
+                    self._journal.record_end(call_sid)
+                self._record_change(call_sid, CHANGE_REMOVED)
+            return call_data
+
+    # Reads below take the lock only to build a snapshot after a write;
+    # otherwise they use the cached snapshot, or a single dict operation,
+    # which is atomic
+
+    def get_active_calls(self):
+        return self._current_snapshot().calls
+
+    def get_snapshot(self):
+        return self._current_snapshot()
+
+    def get_call_count(self):
+        return len(self._active_calls)
+
+    def get_call(self, call_sid):
+        return self._active_calls.get(call_sid)
+
+    def clear(self):
+        with self._lock:
+            self._active_calls.clear()
+            self._tenant_counts.clear()
+            self._call_tenants.clear()
+            self._waiting.clear()
+            self._next_ticket = 0
+            if self._journal is not None:
+                self._journal.record_clear()
+            self._record_change(None, CHANGE_CLEARED)
+
+    def get_version(self):
+        return self._version
+
+    def get_changes(self, since=None):
+        with self._lock:
+            version = self._version
+            # The log covers `since` if it still holds the change right after it
+            covered = (since is not None and since <= version and
+                       (since == version or
+                        (self._changes and self._changes[0][0] <= since + 1)))
+            if covered:
+                entries = [(call_sid, kind) for change_version, call_sid, kind
+                           in self._changes if change_version > since]
+                changes = _build_changes(version, entries,
+                                         lambda call_sid: self._active_calls.get(call_sid))
+                if changes is not None:
+                    return changes
+            return _full_snapshot(version, self._current_snapshot().calls)
+
+# All active calls, newest first (uses the calls_start_time index)
+_SELECT_ACTIVE_CALLS = "SELECT * FROM calls ORDER BY start_time DESC"
+
+class SqliteCallStore(CallStore):
+    """
+    Call storage shared between processes through a local SQLite database.
+
+    The database runs in WAL mode so readers never block the writer. Every
+    thread of every process uses its own connection.
+
+    Active calls outlive the processes using the database, so there is no
+    default path that a restarted app could silently pick up again.
+    """
+
+    def __init__(self, path, timeout=10.0, change_log_size=DEFAULT_CHANGE_LOG_SIZE):
+        """
+        Args:
+            path (str): Database file
+            timeout (float): Seconds to wait for a write lock held by another
+                connection
+            change_log_size (int): Number of changes kept for get_changes()
+
+        Raises:
+            ValueError: If no path is given
+        """
+        if not path:
+            raise ValueError("The SQLite call store needs a database path")
+        self.path = path
+        self.timeout = timeout
+        self.change_log_size = change_log_size
+        self._local = threading.local()
+        # Last snapshot read, reused while the version is unchanged
+        self._snapshot = None
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS calls ("
+            "call_sid TEXT PRIMARY KEY, "
+            "from_number TEXT, "
+            "to_number TEXT, "
+            "start_time REAL, "
+            "ivr_selection INTEGER)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS calls_start_time ON calls (start_time)")
+        # Tenant of each active call admitted for one
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS call_tenants ("
+            "call_sid TEXT PRIMARY KEY, "
+            "tenant TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS call_tenants_tenant ON call_tenants (tenant)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS waiting ("
+            "ticket INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "call_sid TEXT UNIQUE, "
+            "from_number TEXT, "
+            "to_number TEXT, "
+            "enqueued_at REAL, "
+            "last_seen REAL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            "version INTEGER PRIMARY KEY, "
+            "call_sid TEXT, "
+            "kind TEXT)"
+        )
+
+    def _connect(self):
+        # Connections must not be shared across fork(), so they are tracked per PID
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run statements in a write transaction.
+
+        BEGIN IMMEDIATE takes the database write lock up front, so no other
+        process can modify the calls between reads and writes inside it.
+        """
+        conn = self._connect()
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        acquired_at = time.perf_counter()
+        _lock_wait.observe(acquired_at - start)
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            _lock_hold.observe(time.perf_counter() - acquired_at)
+
+    def _row_to_record(self, row):
+        if not row:
+            return None
+        call_sid, from_number, to_number, start_time, ivr_selection = row
+        return CallRecord(call_sid, from_number, to_number, start_time,
+                          IvrSelection(ivr_selection))
+
+    def _insert(self, conn, call_data):
+        conn.execute(
+            "INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?, ?)",
+            (call_data.call_sid, call_data.from_number, call_data.to_number,
+             call_data.start_time, int(call_data.ivr_selection))
+        )
+
+    def _record_change(self, conn, call_sid, kind):
+        # Must be called inside a write transaction
+        (version,) = conn.execute(
+            "INSERT INTO changes (version, call_sid, kind) "
+            "SELECT COALESCE(MAX(version), 0) + 1, ?, ? FROM changes RETURNING version",
+            (call_sid, kind)
+        ).fetchone()
+        conn.execute("DELETE FROM changes WHERE version <= ?",
+                     (version - self.change_log_size,))
+
+    def add_call(self, call_sid, from_number, to_number):
+        call_data = _new_call_record(call_sid, from_number, to_number)
+        with self._transaction() as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM calls WHERE call_sid = ?", (call_sid,)
+            ).fetchone()
+            self._insert(conn, call_data)
+            self._record_change(conn, call_sid, CHANGE_UPDATED if exists else CHANGE_ADDED)
+        return call_data
+
+    def _tenant_full(self, conn, tenant, tenant_max_calls):
+        if tenant is None or tenant_max_calls is None:
+            return False
+        (count,) = conn.execute(
+            "SELECT COUNT(*) FROM call_tenants WHERE tenant = ?", (tenant,)
+        ).fetchone()
+        return count >= tenant_max_calls
+
+    def _admit(self, conn, call_sid, from_number, to_number, tenant):
+        # Must be called inside a write transaction
+        call_data = _new_call_record(call_sid, from_number, to_number)
+        self._insert(conn, call_data)
+        if tenant is not None:
+            conn.execute("INSERT OR REPLACE INTO call_tenants VALUES (?, ?)", (call_sid, tenant))
+        self._record_change(conn, call_sid, CHANGE_ADDED)
+        return call_data
+
+    def try_admit(self, call_sid, from_number, to_number, max_calls=None,
+                  tenant=None, tenant_max_calls=None):
+        with self._transaction() as conn:
+            existing = conn.execute(
+                "SELECT * FROM calls WHERE call_sid = ?", (call_sid,)
+            ).fetchone()
+            if existing:
+                return AdmissionResult(DUPLICATE, self._row_to_record(existing))
+            if max_calls is not None:
+                (count,) = conn.execute("SELECT COUNT(*) FROM calls").fetchone()
+                if count >= max_calls:
+                    return AdmissionResult(BUSY, None)
+            if self._tenant_full(conn, tenant, tenant_max_calls):
+                return AdmissionResult(BUSY, None)
+            return AdmissionResult(ADMITTED,
+                                   self._admit(conn, call_sid, from_number, to_number, tenant))
+
+    def get_tenant_call_count(self, tenant):
+        (count,) = self._connect().execute(
+            "SELECT COUNT(*) FROM call_tenants WHERE tenant = ?", (tenant,)
+        ).fetchone()
+        return count
+
+    def get_call_tenants(self):
+        return dict(self._connect().execute("SELECT call_sid, tenant FROM call_tenants"))
+
+    def try_admit_queued(self, call_sid, from_number, to_number, max_calls,
+                         max_waiting, stale_after, tenant=None, tenant_max_calls=None):
+        with self._transaction() as conn:
+            existing = conn.execute(
+                "SELECT * FROM calls WHERE call_sid = ?", (call_sid,)
+            ).fetchone()
+            if existing:
+                return AdmissionResult(DUPLICATE, self._row_to_record(existing))
+            now = call_clock()
+            # Drop callers that stopped polling from the head of the queue
+            while True:
+                head = conn.execute(
+                    "SELECT ticket, last_seen FROM waiting ORDER BY ticket LIMIT 1"
+                ).fetchone()
+                if head is None or head[1] >= now - stale_after:
+                    break
+                conn.execute("DELETE FROM waiting WHERE ticket = ?", (head[0],))
+            (count,) = conn.execute("SELECT COUNT(*) FROM calls").fetchone()
+            free = max_calls - count
+
+            row = conn.execute(
+                "SELECT * FROM waiting WHERE call_sid = ?", (call_sid,)
+            ).fetchone()
+            if row is not None:
+                waiter = Waiter(*row)
+                # Gaps left by callers that hung up only overestimate the queue ahead
+                if waiter.ticket - head[0] < free \
+                        and not self._tenant_full(conn, tenant, tenant_max_calls):
+                    conn.execute("DELETE FROM waiting WHERE ticket = ?", (waiter.ticket,))
+                    call_data = self._admit(conn, call_sid, waiter.from_number,
+                                            waiter.to_number, tenant)
+                    return AdmissionResult(ADMITTED, call_data, now - waiter.enqueued_at)
+                conn.execute("UPDATE waiting SET last_seen = ? WHERE ticket = ?",
+                             (now, waiter.ticket))
+                return AdmissionResult(QUEUED, None)
+
+            (waiting,) = conn.execute("SELECT COUNT(*) FROM waiting").fetchone()
+            if not waiting and free > 0 and not self._tenant_full(conn, tenant, tenant_max_calls):
+                return AdmissionResult(ADMITTED,
+                                       self._admit(conn, call_sid, from_number, to_number, tenant))
+            if waiting >= max_waiting:
+                return AdmissionResult(BUSY, None)
+            conn.execute(
+                "INSERT INTO waiting (call_sid, from_number, to_number, enqueued_at, last_seen) "
+                "VALUES (?, ?, ?, ?, ?)", (call_sid, from_number, to_number, now, now))
+            return AdmissionResult(QUEUED, None)
+
+    def remove_waiter(self, call_sid):
+        with self._transaction() as conn:
+            row = conn.execute(
+                "DELETE FROM waiting WHERE call_sid = ? RETURNING *", (call_sid,)
+            ).fetchone()
+        return Waiter(*row) if row else None
+
+    def get_waiting_count(self):
+        (count,) = self._connect().execute("SELECT COUNT(*) FROM waiting").fetchone()
+        return count
+
+    def update_ivr_selection(self, call_sid, selection):
+        with self._transaction() as conn:
+            row = conn.execute(
+                "UPDATE calls SET ivr_selection = ? WHERE call_sid = ? RETURNING *",
+                (int(IvrSelection.from_label(selection)), call_sid)
+            ).fetchone()
+            if row:
+                self._record_change(conn, call_sid, CHANGE_UPDATED)
+        return self._row_to_record(row)
+
+    def end_call(self, call_sid):
+        with self._transaction() as conn:
+            row = conn.execute(
+                "DELETE FROM calls WHERE call_sid = ? RETURNING *", (call_sid,)
+            ).fetchone()
+            if row:
+                conn.execute("DELETE FROM call_tenants WHERE call_sid = ?", (call_sid,))
+                self._record_change(conn, call_sid, CHANGE_REMOVED)
+        return self._row_to_record(row)
+
+    def get_active_calls(self):
+        rows = self._connect().execute(_SELECT_ACTIVE_CALLS).fetchall()
+        return [self._row_to_record(row) for row in rows]
+
+    def get_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.get_version():
+            return snapshot
+
+        conn = self._connect()
+        # A read transaction gives a consistent view of calls and version
+        conn.execute("BEGIN")
+        try:
+            (version,) = conn.execute(
+                "SELECT COALESCE(MAX(version), 0) FROM changes"
+            ).fetchone()
+            rows = conn.execute(_SELECT_ACTIVE_CALLS).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        snapshot = CallSnapshot(version, tuple(self._row_to_record(row) for row in rows))
+        self._snapshot = snapshot
+        return snapshot
+
+    def get_call_count(self):
+        (count,) = self._connect().execute("SELECT COUNT(*) FROM calls").fetchone()
+        return count
+
+    def get_call(self, call_sid):
+        row = self._connect().execute(
+            "SELECT * FROM calls WHERE call_sid = ?", (call_sid,)
+        ).fetchone()
+        return self._row_to_record(row)
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM calls")
+            conn.execute("DELETE FROM call_tenants")
+            conn.execute("DELETE FROM waiting")
+            self._record_change(conn, None, CHANGE_CLEARED)
+
+    def get_version(self):
+        (version,) = self._connect().execute(
+            "SELECT COALESCE(MAX(version), 0) FROM changes"
+        ).fetchone()
+        return version
+
+    def get_changes(self, since=None):
+        conn = self._connect()
+        # A read transaction gives a consistent view of calls and changes
+        conn.execute("BEGIN")
+        try:
+            (oldest, version) = conn.execute(
+                "SELECT MIN(version), COALESCE(MAX(version), 0) FROM changes"
+            ).fetchone()
+            covered = (since is not None and since <= version and
+                       (since == version or (oldest is not None and oldest <= since + 1)))
+            if covered:
+                entries = conn.execute(
+                    "SELECT call_sid, kind FROM changes WHERE version > ? ORDER BY version",
+                    (since,)
+                ).fetchall()
+                changes = _build_changes(
+                    version, entries,
+                    lambda call_sid: self._row_to_record(conn.execute(
+                        "SELECT * FROM calls WHERE call_sid = ?", (call_sid,)
+                    ).fetchone())
+                )
+                if changes is not None:
+                    return changes
+            rows = conn.execute(_SELECT_ACTIVE_CALLS).fetchall()
+            return _full_snapshot(version, [self._row_to_record(row) for row in rows])
+        finally:
+            conn.execute("COMMIT")
+
+def create_call_store(backend=None):
+    """
+    Create the call storage backend selected by configuration.
+
+    Args:
+        backend (str): 'memory' or 'sqlite'; defaults to the CALL_STORE
+            environment variable, then 'memory'
+
+    Returns:
+        CallStore: The storage backend
+
+    Raises:
+        ValueError: For an unknown backend, or 'sqlite' without CALL_STORE_PATH
+    """
+    backend = (backend or os.environ.get('CALL_STORE', 'memory')).lower()
+    if backend == 'memory':
+        journal_dir = os.environ.get('CALL_JOURNAL_DIR')
+        if not journal_dir:
+            return MemoryCallStore()
+        try:
+            commit_ms = float(os.environ.get('CALL_JOURNAL_COMMIT_MS', DEFAULT_COMMIT_INTERVAL * 1000))
+            journal = CallJournal(journal_dir, commit_interval=commit_ms / 1000)
+        except (JournalLockedError, OSError, ValueError) as e:
+            logger.error(f"Error opening call journal: {str(e)}")
+            return MemoryCallStore()
+        return MemoryCallStore(journal=journal)
+    if backend == 'sqlite':
+        path = os.environ.get('CALL_STORE_PATH')
+        if not path:
+            raise ValueError("CALL_STORE_PATH must be set with CALL_STORE=sqlite")
+        return SqliteCallStore(path)
+    raise ValueError(f"Unknown call store backend: {backend}")
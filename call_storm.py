@@ -0,0 +1,302 @@
+"""
+Outbound call-storm generator for capacity tests.
+
+Places calls through the Twilio REST API at a target rate and points each
+one at the app's music or beep flow (/outbound_call). Every placed call is
+tracked in call storage like an incoming call, so with a shared store
+(CALL_STORE=sqlite) it shows up live on the dashboard and is ended by the
+app's /call_status webhook.
+
+Arrivals follow a constant, ramp (linear from zero to the target rate) or
+Poisson profile. API requests are limited to TWILIO_CALLS_PER_SECOND (the
+account's outbound calls-per-second limit) and TWILIO_MAX_CONCURRENCY in
+flight; throttled requests are retried with backoff. With --max-active the
+storm also waits while that many calls are active.
+
+Examples:
+    python call_storm.py --to +15551230000 --calls 100 --rate 2 --flow music
+    python call_storm.py --to +15551230000 --calls 50 --profile ramp --ramp 30
+    python call_storm.py --to +15551230000 --calls 20 --api-url http://localhost:8080
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+from load_env import load_env_variables
+from twilio_utils import get_twilio_client, get_twilio_concurrency, DEFAULT_BASE_URL
+from twilio_batch import call_with_retries, DEFAULT_RETRIES
+
+logger = logging.getLogger(__name__)
+
+PROFILES = ('constant', 'ramp', 'poisson')
+FLOWS = ('music', 'beep')
+
+# Twilio's default outbound calls per second for an account
+DEFAULT_CALLS_PER_SECOND = 1.0
+
+def get_calls_per_second():
+    """
+    Get the most outbound calls to place per second.
+
+    Returns:
+        float: Value of TWILIO_CALLS_PER_SECOND, or DEFAULT_CALLS_PER_SECOND
+            if unset or invalid
+    """
+    try:
+        value = float(os.environ.get('TWILIO_CALLS_PER_SECOND', DEFAULT_CALLS_PER_SECOND))
+        return value if value > 0 else DEFAULT_CALLS_PER_SECOND
+    except ValueError:
+        logger.warning("Invalid TWILIO_CALLS_PER_SECOND value, using the default")
+        return DEFAULT_CALLS_PER_SECOND
+
+def arrival_offsets(calls, rate, profile='constant', ramp_seconds=0.0):
+    """
+    Get the times at which to place calls.
+
+    Args:
+        calls (int): Number of calls
+        rate (float): Target calls per second
+        profile (str): 'constant', 'ramp' or 'poisson'
+        ramp_seconds (float): For 'ramp', seconds to rise from zero to the
+            target rate
+
+    Returns:
+        list: Seconds from the start of the storm, one per call, ascending
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown arrival profile: {profile}")
+    offsets = []
+    now = 0.0
+    # Calls that arrive while the rate ramps up
+    ramp_calls = rate * ramp_seconds / 2 if profile == 'ramp' else 0
+    for i in range(calls):
+        if profile == 'poisson':
+            now += random.expovariate(rate)
+            offsets.append(now)
+        elif i < ramp_calls:
+            # The rate grows linearly, so i calls have arrived after sqrt(2 R i / rate)
+            offsets.append(math.sqrt(2 * ramp_seconds * i / rate))
+        else:
+            offsets.append(ramp_seconds * (profile == 'ramp') + (i - ramp_calls) / rate)
+    return offsets
+
+class RateLimiter:
+    """Token bucket spacing out API requests to at most `rate` per second."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be made."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class CallStorm:
+    """A campaign of outbound calls placed on a schedule."""
+
+    def __init__(self, to_numbers, from_number, calls, rate, profile='constant',
+                 ramp_seconds=0.0, flow='music', base_url=None, client=None,
+                 concurrency=None, calls_per_second=None, max_active=None,
+                 retries=DEFAULT_RETRIES):
+        """
+        Args:
+            to_numbers (list): Numbers to call, used in turn
+            from_number (str): Twilio number the calls come from
+            calls (int): Number of calls to place
+            rate (float): Target calls per second
+            profile (str): Arrival profile: 'constant', 'ramp' or 'poisson'
+            ramp_seconds (float): Duration of the ramp for the 'ramp' profile
+            flow (str): TwiML flow the calls play: 'music' or 'beep'
+            base_url (str): Public URL of the app, defaults to BASE_URL
+            client (Client): Twilio client, defaults to get_twilio_client()
+            concurrency (int): API requests in flight, defaults to
+                TWILIO_MAX_CONCURRENCY
+            calls_per_second (float): API rate limit, defaults to
+                TWILIO_CALLS_PER_SECOND
+            max_active (int): Wait while this many calls are active, or None
+            retries (int): Retries of a throttled or failed API request
+        """
+        if flow not in FLOWS:
+            raise ValueError(f"Unknown flow: {flow}")
+        self.to_numbers = list(to_numbers)
+        self.from_number = from_number
+        self.calls = calls
+        self.flow = flow
+        self.base_url = (base_url or os.environ.get('BASE_URL', DEFAULT_BASE_URL)).rstrip('/')
+        self.client = client or get_twilio_client()
+        if self.client is None:
+            raise RuntimeError("Twilio credentials not found in environment variables")
+        self.concurrency = concurrency or get_twilio_concurrency()
+        self.limiter = RateLimiter(calls_per_second or get_calls_per_second())
+        self.max_active = max_active
+        self.retries = retries
+        if rate > self.limiter.rate:
+            logger.warning("Target rate %.2f/s is above the API limit of %.2f calls/s",
+                           rate, self.limiter.rate)
+        self.offsets = arrival_offsets(calls, rate, profile, ramp_seconds)
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.placed = []
+        self.errors = []
+        # Seconds each create request took, including retries
+        self.latencies = []
+        self.started = None
+        self.finished = None
+
+    def _place(self, index):
+        """Place one call and track it in call storage."""
+        from call_handler import handle_call_start, update_call_ivr
+
+        to_number = self.to_numbers[index % len(self.to_numbers)]
+        url = f"{self.base_url}/outbound_call?" + urllib.parse.urlencode({'flow': self.flow})
+
+        def create(_):
+            self.limiter.acquire()
+            return self.client.calls.create(
+                to=to_number, from_=self.from_number, url=url, method='POST',
+                status_callback=f"{self.base_url}/call_status", status_callback_method='POST')
+
+        start = time.perf_counter()
+        try:
+            call = call_with_retries(create, index, self.retries)
+        except Exception as e:
+            logger.error(f"Error placing call to {to_number}: {str(e)}")
+            with self._lock:
+                self.errors.append(str(e))
+            return
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.placed.append(call.sid)
+            self.latencies.append(latency)
+        try:
+            handle_call_start(call.sid, self.from_number, to_number)
+            update_call_ivr(call.sid, self.flow)
+        except Exception as e:
+            logger.error(f"Error tracking call {call.sid}: {str(e)}")
+
+    def _wait_for_capacity(self):
+        from call_handler import get_call_count
+        while self.max_active is not None and get_call_count() >= self.max_active:
+            if self._stopped.wait(0.1):
+                return
+
+    def run(self):
+        """
+        Place the calls on schedule and wait for the API requests to finish.
+
+        Returns:
+            dict: Summary (see summary())
+        """
+        self.started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix='call-storm') as executor:
+            for index, offset in enumerate(self.offsets):
+                delay = self.started + offset - time.monotonic()
+                if delay > 0 and self._stopped.wait(delay):
+                    break
+                self._wait_for_capacity()
+                if self._stopped.is_set():
+                    break
+                executor.submit(self._place, index)
+        self.finished = time.monotonic()
+        return self.summary()
+
+    def stop(self):
+        """Stop placing further calls."""
+        self._stopped.set()
+
+    def summary(self):
+        """
+        Get the progress of the storm.
+
+        Returns:
+            dict: placed, failed, elapsed seconds, achieved calls per second
+                and p50/p95 create request latency in milliseconds
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            placed, failed = len(self.placed), len(self.errors)
+        end = self.finished or time.monotonic()
+        elapsed = end - self.started if self.started else 0.0
+
+        def percentile(fraction):
+            if not latencies:
+                return 0.0
+            return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+
+        return {
+            'calls': self.calls,
+            'placed': placed,
+            'failed': failed,
+            'elapsed': elapsed,
+            'calls_per_second': placed / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95)
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Place outbound test calls through Twilio.")
+    parser.add_argument('--to', action='append', required=True,
+                        help="Number to call (repeat to rotate through several)")
+    parser.add_argument('--from', dest='from_number',
+                        help="Twilio number to call from (default: TWILIO_PHONE_NUMBER)")
+    parser.add_argument('--calls', type=int, default=10, help="Number of calls")
+    parser.add_argument('--rate', type=float, default=1.0, help="Target calls per second")
+    parser.add_argument('--profile', choices=PROFILES, default='constant',
+                        help="Arrival profile")
+    parser.add_argument('--ramp', type=float, default=10.0,
+                        help="Seconds to ramp up to the target rate (--profile ramp)")
+    parser.add_argument('--flow', choices=FLOWS, default='music', help="TwiML the calls play")
+    parser.add_argument('--max-active', type=int, help="Wait while this many calls are active")
+    parser.add_argument('--concurrency', type=int, help="API requests in flight")
+    parser.add_argument('--api-url', help="Twilio API base URL, e.g. a local stub")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    load_env_variables()
+    if os.environ.get('CALL_STORE', 'memory').lower() == 'memory':
+        logger.warning("With CALL_STORE=memory the calls are tracked only in this process, "
+                       "not on the dashboard")
+    from_number = args.from_number or os.environ.get('TWILIO_PHONE_NUMBER')
+    if not from_number:
+        parser.error("--from or TWILIO_PHONE_NUMBER is required")
+
+    client = get_twilio_client()
+    if client is not None and args.api_url:
+        client.api.base_url = args.api_url
+    storm = CallStorm(args.to, from_number, args.calls, args.rate, profile=args.profile,
+                      ramp_seconds=args.ramp, flow=args.flow, client=client,
+                      concurrency=args.concurrency, max_active=args.max_active)
+    try:
+        summary = storm.run()
+    except KeyboardInterrupt:
+        storm.stop()
+        summary = storm.summary()
+    print(f"placed {summary['placed']}/{summary['calls']} calls ({summary['failed']} failed) "
+          f"in {summary['elapsed']:.1f}s, {summary['calls_per_second']:.2f} calls/s")
+    print(f"create request p50 {summary['p50_ms']:.1f} ms, p95 {summary['p95_ms']:.1f} ms")
+    return 1 if summary['failed'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,437 @@
+"""
+Cluster mode: several instances of the app sharing one call limit and dashboard.
+
+Set CLUSTER_COORDINATOR to the URL of the coordination store
+(coordinator.py) and CLUSTER_NODE_URL to the URL the other instances reach
+this one at. Then:
+
+- Each instance (node) owns a shard of the calls. The owner of a CallSid is
+  chosen by rendezvous hashing over the live nodes, so a node joining or
+  leaving moves only the calls it gains or loses. A Twilio webhook that
+  reaches another node is forwarded to the owner, so every webhook of a
+  call, including its final /call_status, is handled where the call is
+  stored.
+- MAX_CALLS, and each tenant's max_calls, hold across the cluster. Before
+  admitting a call a node takes a lease on it from the coordinator, which
+  grants at most MAX_CALLS leases, and gives the lease back when the call
+  ends. A node's leases are renewed together by its heartbeat, so the
+  leases of a node that dies are freed when its heartbeat expires.
+- Each heartbeat carries a summary of the node's calls (count and IVR mix)
+  and returns the live nodes with theirs. /api/dashboard_data merges these
+  summaries rather than collecting every node's list of calls.
+
+If the coordinator cannot be reached, a node admits calls up to its share
+of MAX_CALLS (MAX_CALLS divided by the live nodes) and re-takes the leases
+of its calls once the coordinator answers again. Run one process per node:
+async_app.py, or gunicorn with one worker and several threads, since a
+node forwarding a webhook waits for another node that may be forwarding
+to it. The waiting room is per process and is not used in cluster mode.
+"""
+
+import functools
+import hashlib
+import http.client
+import json
+import logging
+import os
+import threading
+from urllib.parse import urlsplit
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEARTBEAT_SECONDS = 2.0
+
+# Missed heartbeats after which a node is considered dead
+MISSED_HEARTBEATS = 3
+
+# Seconds to wait for the coordinator, and for the owner of a forwarded webhook
+COORDINATOR_TIMEOUT = 2.0
+FORWARD_TIMEOUT = 10.0
+
+# Header carrying CLUSTER_SECRET on requests to the coordinator
+SECRET_HEADER = 'X-Cluster-Secret'
+
+# Header marking a webhook forwarded by another node, which is never forwarded again
+FORWARDED_HEADER = 'X-Cluster-Forwarded'
+
+# Request headers passed on to the owner of a forwarded webhook
+FORWARDED_REQUEST_HEADERS = ('Content-Type', 'X-Twilio-Signature')
+
+# Response headers passed back from the owner of a forwarded webhook
+FORWARDED_RESPONSE_HEADERS = ('Content-Type', 'ETag')
+
+def get_coordinator_url():
+    """
+    Get the URL of the coordination store.
+
+    Returns:
+        str: Value of CLUSTER_COORDINATOR, or None if cluster mode is off
+    """
+    return os.environ.get('CLUSTER_COORDINATOR') or None
+
+def get_cluster_secret():
+    """
+    Get the secret the nodes present to the coordinator.
+
+    Returns:
+        str: Value of CLUSTER_SECRET, or None if unset
+    """
+    return os.environ.get('CLUSTER_SECRET') or None
+
+def cluster_enabled():
+    """Whether this instance runs as a node of a cluster."""
+    return get_coordinator_url() is not None
+
+def get_heartbeat_seconds():
+    """
+    Get the seconds between heartbeats.
+
+    Returns:
+        float: Value of CLUSTER_HEARTBEAT_SECONDS, or DEFAULT_HEARTBEAT_SECONDS
+            if unset or invalid
+    """
+    try:
+        value = float(os.environ.get('CLUSTER_HEARTBEAT_SECONDS', DEFAULT_HEARTBEAT_SECONDS))
+        return value if value > 0 else DEFAULT_HEARTBEAT_SECONDS
+    except ValueError:
+        logger.warning(f"Invalid CLUSTER_HEARTBEAT_SECONDS value, using {DEFAULT_HEARTBEAT_SECONDS}")
+        return DEFAULT_HEARTBEAT_SECONDS
+
+_MASK64 = (1 << 64) - 1
+
+@functools.lru_cache(maxsize=1024)
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def shard_weight(node_id, call_sid_hash):
+    """
+    Rendezvous hashing weight of a node for a call; the highest weight owns it.
+
+    The call's hash is computed once and mixed with each node's (the
+    splitmix64 finalizer), rather than hashing every (node, call) pair.
+    """
+    x = _hash64(node_id) ^ call_sid_hash
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+def shard_owner(members, call_sid):
+    """
+    Get the node owning a call.
+
+    Args:
+        members: (node ID, URL) tuples of the live nodes
+        call_sid (str): The Twilio call SID
+
+    Returns:
+        tuple: (node ID, URL) of the owner, or None without live nodes
+    """
+    if not members:
+        return None
+    call_sid_hash = int.from_bytes(
+        hashlib.blake2b(call_sid.encode('utf-8'), digest_size=8).digest(), 'big')
+    return max(members, key=lambda member: shard_weight(member[0], call_sid_hash))
+
+class _HttpClient:
+    """POSTs to one base URL, keeping one connection open per thread."""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self._https = parts.scheme == 'https'
+        self._netloc = parts.netloc
+        self._prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            connection = self._local.connection = cls(self._netloc, timeout=self.timeout)
+        return connection
+
+    def post(self, path, body, headers):
+        """
+        POST a body and read the response.
+
+        Returns:
+            tuple: (status code, response headers, response body)
+        """
+        for attempt in (1, 2):
+            connection = self._connection()
+            try:
+                connection.request('POST', self._prefix + path, body=body, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have closed an idle kept-alive connection
+                connection.close()
+                self._local.connection = None
+                if attempt == 2:
+                    raise
+            except OSError:
+                connection.close()
+                self._local.connection = None
+                raise
+
+class CoordinatorClient:
+    """Client of a coordination store served by coordinator.py."""
+
+    def __init__(self, url, timeout=COORDINATOR_TIMEOUT, secret=None):
+        """
+        Args:
+            url (str): URL of the coordinator
+            timeout (float): Seconds to wait for a response
+            secret (str): Secret sent with every request, defaults to
+                CLUSTER_SECRET
+        """
+        self.url = url
+        self._http = _HttpClient(url, timeout)
+        self._headers = {'Content-Type': 'application/json'}
+        secret = secret or get_cluster_secret()
+        if secret:
+            self._headers[SECRET_HEADER] = secret
+
+    def _call(self, operation, **arguments):
+        status, _, body = self._http.post('/' + operation, json.dumps(arguments).encode('utf-8'),
+                                          self._headers)
+        if status != 200:
+            raise RuntimeError(f"Coordinator {operation} failed with HTTP {status}: {body[:200]!r}")
+        return json.loads(body)
+
+    def heartbeat(self, node, incarnation, url, summary=None, ttl=None, released=()):
+        return self._call('heartbeat', node=node, incarnation=incarnation, url=url,
+                          summary=summary, ttl=ttl, released=list(released))
+
+    def acquire(self, node, incarnation, call_sid, limit=None, tenant=None, tenant_limit=None):
+        return self._call('acquire', node=node, incarnation=incarnation, call_sid=call_sid,
+                          limit=limit, tenant=tenant, tenant_limit=tenant_limit)
+
+    def restore(self, node, incarnation, calls):
+        return self._call('restore', node=node, incarnation=incarnation, calls=dict(calls))
+
+    def release(self, call_sid):
+        return self._call('release', call_sid=call_sid)
+
+class ClusterNode:
+    """This instance's membership of a cluster: heartbeats, shards and leases."""
+
+    def __init__(self, summary, active_calls, coordinator=None, node_id=None, url=None,
+                 heartbeat_seconds=None):
+        """
+        Args:
+            summary: Function returning the summary of this node's calls
+            active_calls: Function returning this node's calls, as a dict
+                of the tenant (or None) of each call by call SID
+            coordinator: The coordination store, or a client of it; a
+                CoordinatorClient for CLUSTER_COORDINATOR if None
+            node_id (str): ID of this node, defaults to CLUSTER_NODE_ID or
+                else the node's URL
+            url (str): URL other nodes reach this node at, defaults to
+                CLUSTER_NODE_URL
+            heartbeat_seconds (float): Seconds between heartbeats, defaults
+                to get_heartbeat_seconds()
+        """
+        self._summary = summary
+        self._active_calls = active_calls
+        self.coordinator = coordinator
+        self.node_id = node_id
+        self.url = url
+        self.heartbeat_seconds = heartbeat_seconds
+        # ID of this process; a restarted node is a new incarnation
+        self.incarnation = uuid.uuid4().hex
+        # (node ID, URL) of the live nodes, sorted, replaced as a whole
+        self._members = ()
+        # Live nodes as reported by the last heartbeat
+        self._nodes = []
+        self._leases = 0
+        # SIDs whose release could not be sent, retried with the next heartbeat
+        self._unsent_releases = []
+        # Whether the coordinator may be missing some of this node's leases
+        self._resync = False
+        self._forwarders = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.running = False
+
+    def start(self):
+        """Register with the coordinator and start sending heartbeats."""
+        if self.running:
+            return
+        if self.coordinator is None:
+            self.coordinator = CoordinatorClient(get_coordinator_url())
+        self.url = self.url or os.environ.get('CLUSTER_NODE_URL')
+        if not self.url:
+            raise ValueError("CLUSTER_NODE_URL must be set in cluster mode")
+        self.url = self.url.rstrip('/')
+        self.node_id = self.node_id or os.environ.get('CLUSTER_NODE_ID') or self.url
+        self.heartbeat_seconds = self.heartbeat_seconds or get_heartbeat_seconds()
+        # Calls recovered from the journal need their leases
+        self._resync = True
+        self.heartbeat()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='cluster-heartbeat', daemon=True)
+        self._thread.start()
+        self.running = True
+        logger.info("Cluster node %s started (%d live nodes)", self.node_id, len(self._members))
+
+    def stop(self):
+        """Stop sending heartbeats; the coordinator frees this node's leases when they expire."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.running = False
+
+    def _run(self):
+        while not self._stop.wait(self.heartbeat_seconds):
+            self.heartbeat()
+
+    def heartbeat(self):
+        """Publish this node's summary and refresh the live nodes."""
+        with self._lock:
+            released, self._unsent_releases = self._unsent_releases, []
+        try:
+            reply = self.coordinator.heartbeat(
+                self.node_id, self.incarnation, self.url, self._summary(),
+                self.heartbeat_seconds * MISSED_HEARTBEATS, released)
+            if not reply['known'] or self._resync:
+                self._resync = False
+                reply['leases'] = self.coordinator.restore(
+                    self.node_id, self.incarnation, self._active_calls())['leases']
+        except Exception as e:
+            logger.error(f"Error sending cluster heartbeat: {str(e)}")
+            with self._lock:
+                self._unsent_releases[:0] = released
+            return
+        self._nodes = reply['nodes']
+        self._members = tuple((node['node'], node['url']) for node in reply['nodes'])
+        self._leases = reply['leases']
+
+    def owner_url(self, call_sid):
+        """
+        Get the URL of the node owning a call.
+
+        Args:
+            call_sid (str): The Twilio call SID
+
+        Returns:
+            str: The owner's URL, or None if this node owns the call
+        """
+        members = self._members
+        if len(members) < 2:
+            return None
+        owner = shard_owner(members, call_sid)
+        return None if owner[0] == self.node_id else owner[1]
+
+    def get_fair_share(self, max_calls):
+        """
+        Get this node's share of the cluster's calls.
+
+        Args:
+            max_calls (int): The cluster-wide limit
+
+        Returns:
+            int: max_calls divided by the live nodes, rounded down
+        """
+        return max_calls // max(len(self._members), 1)
+
+    def acquire(self, call_sid, max_calls=None, tenant=None, tenant_max_calls=None):
+        """
+        Take the lease of a call if the cluster and the tenant have room.
+
+        Args:
+            call_sid (str): The Twilio call SID
+            max_calls (int): Most calls cluster-wide, or None for no limit
+            tenant (str): Tenant the call is counted against, or None
+            tenant_max_calls (int): Most calls of the tenant, or None for no limit
+
+        Returns:
+            bool: Whether the lease was granted
+
+        Raises:
+            Exception: If the coordinator cannot be reached; the leases of
+                the calls admitted meanwhile are restored with the next
+                heartbeat
+        """
+        try:
+            reply = self.coordinator.acquire(self.node_id, self.incarnation, call_sid,
+                                             max_calls, tenant, tenant_max_calls)
+        except Exception:
+            self._resync = True
+            raise
+        if not reply['known']:
+            # The coordinator lost this node's leases; restore them
+            self._resync = True
+        return reply['granted']
+
+    def release(self, call_sid):
+        """Give back the lease of an ended call; retried with the next heartbeat on failure."""
+        try:
+            self.coordinator.release(call_sid)
+        except Exception as e:
+            logger.error(f"Error releasing call lease: {str(e)}")
+            with self._lock:
+                self._unsent_releases.append(call_sid)
+
+    def get_nodes(self):
+        """
+        Get the summaries of the live nodes.
+
+        This node's summary is current; the others' are as of their last
+        heartbeat.
+
+        Returns:
+            list: node, url, summary and age (seconds since the summary) of
+                each live node, by node ID
+        """
+        nodes = [node for node in self._nodes if node['node'] != self.node_id]
+        nodes.append({'node': self.node_id, 'url': self.url, 'summary': self._summary(), 'age': 0.0})
+        nodes.sort(key=lambda node: node['node'])
+        return nodes
+
+    def get_lease_count(self):
+        """Leases held cluster-wide as of the last heartbeat."""
+        return self._leases
+
+    def forward(self, url, path_qs, body, headers):
+        """
+        Send a webhook on to the node owning its call.
+
+        Args:
+            url (str): The owner's URL
+            path_qs (str): Request path and query string
+            body (bytes): The raw request body
+            headers: Mapping of the request headers
+
+        Returns:
+            tuple: (status code, dict of response headers, response body)
+        """
+        forwarder = self._forwarders.get(url)
+        if forwarder is None:
+            forwarder = self._forwarders.setdefault(url, _HttpClient(url, FORWARD_TIMEOUT))
+        status, response_headers, response_body = forwarder.post(
+            path_qs, body, self.forward_headers(headers))
+        return status, response_headers_to_return(response_headers), response_body
+
+    def forward_headers(self, headers):
+        """
+        Get the headers of a webhook forwarded to the node owning its call.
+
+        Args:
+            headers: Mapping of the original request's headers
+
+        Returns:
+            dict: The headers the owner needs, marked as forwarded
+        """
+        forwarded = {name: headers[name] for name in FORWARDED_REQUEST_HEADERS
+                     if headers.get(name) is not None}
+        forwarded[FORWARDED_HEADER] = self.node_id
+        return forwarded
+
+def response_headers_to_return(headers):
+    """Get the headers of an owner's response to pass back to Twilio."""
+    return {name: headers[name] for name in FORWARDED_RESPONSE_HEADERS
+            if headers.get(name) is not None}
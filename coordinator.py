@@ -0,0 +1,325 @@
+"""
+Coordination store for cluster mode (see cluster).
+
+Holds what the nodes of a cluster share: the live nodes with their URLs and
+call summaries, and the leases on the cluster's call tokens. Every node
+talks to one coordinator over HTTP, each operation a small JSON POST:
+
+- heartbeat: register or renew a node, publish its summary, return the
+  live nodes
+- acquire: take the lease of one call if the cluster (and the call's
+  tenant) is below its limit
+- restore: re-take the leases of calls a node already holds, with their
+  tenants, after the coordinator or the node restarted
+- release: give a call's lease back
+
+Leases belong to their node and live as long as its heartbeat, so a node
+that dies frees its leases when its heartbeat expires. A node that restarts
+comes back with a new incarnation, which drops the leases of the previous
+one.
+
+State is kept in memory. This server is the stand-in used for local
+clusters and tests; run it as a single always-on process:
+
+    python coordinator.py --port 5100
+
+It listens on 127.0.0.1 unless given --host. When CLUSTER_SECRET is set,
+requests without it in the X-Cluster-Secret header are refused with 401;
+set it on the coordinator and every node before listening on a shared
+network.
+"""
+
+import argparse
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import socket
+import threading
+import time
+
+from cluster import SECRET_HEADER, get_cluster_secret
+from logging_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds a node stays live without a heartbeat when it did not send its own TTL
+DEFAULT_NODE_TTL = 6.0
+
+# Seconds between scans for expired nodes
+EXPIRE_INTERVAL = 0.5
+
+class CoordinationStore:
+    """Live nodes and call leases of a cluster."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        # Key: node ID, Value: dict with incarnation, url, summary, ttl,
+        # expires and seen (clock time of the last heartbeat)
+        self._nodes = {}
+        # Key: call SID, Value: (node ID, tenant)
+        self._leases = {}
+        # Key: node ID, Value: set of the SIDs it holds leases for
+        self._node_leases = {}
+        # Key: tenant, Value: number of its leases
+        self._tenant_leases = {}
+        self._next_expiry = 0.0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        # Must be called with the lock held
+        if now < self._next_expiry:
+            return
+        self._next_expiry = now + EXPIRE_INTERVAL
+        for node_id in [node_id for node_id, node in self._nodes.items() if node['expires'] <= now]:
+            logger.warning("Node %s missed its heartbeats, releasing %d leases",
+                           node_id, len(self._node_leases.get(node_id, ())))
+            self._drop_node(node_id)
+
+    def _drop_node(self, node_id):
+        # Must be called with the lock held
+        self._nodes.pop(node_id, None)
+        for call_sid in self._node_leases.pop(node_id, ()):
+            self._remove_lease(call_sid)
+
+    def _remove_lease(self, call_sid):
+        # Must be called with the lock held
+        node_id, tenant = self._leases.pop(call_sid)
+        node_leases = self._node_leases.get(node_id)
+        if node_leases is not None:
+            node_leases.discard(call_sid)
+        if tenant is not None:
+            count = self._tenant_leases[tenant] - 1
+            if count:
+                self._tenant_leases[tenant] = count
+            else:
+                del self._tenant_leases[tenant]
+
+    def _add_lease(self, node_id, call_sid, tenant):
+        # Must be called with the lock held
+        if call_sid in self._leases:
+            self._remove_lease(call_sid)
+        self._leases[call_sid] = (node_id, tenant)
+        self._node_leases.setdefault(node_id, set()).add(call_sid)
+        if tenant is not None:
+            self._tenant_leases[tenant] = self._tenant_leases.get(tenant, 0) + 1
+
+    def _check_in(self, node_id, incarnation, now, ttl=None):
+        """
+        Renew a node, registering it if it is new or restarted.
+
+        Must be called with the lock held.
+
+        Returns:
+            dict: The node's entry, with 'known' False if it was registered
+                just now (its earlier leases, if any, are gone)
+        """
+        node = self._nodes.get(node_id)
+        if node is not None and node['incarnation'] != incarnation:
+            logger.info("Node %s restarted, releasing %d leases",
+                        node_id, len(self._node_leases.get(node_id, ())))
+            self._drop_node(node_id)
+            node = None
+        known = node is not None
+        if node is None:
+            node = self._nodes[node_id] = {
+                'incarnation': incarnation, 'url': None, 'summary': None,
+                'ttl': DEFAULT_NODE_TTL, 'seen': now
+            }
+        if ttl is not None:
+            node['ttl'] = ttl
+        node['expires'] = now + node['ttl']
+        node['known'] = known
+        return node
+
+    def heartbeat(self, node, incarnation, url, summary=None, ttl=None, released=()):
+        """
+        Register or renew a node and publish its summary.
+
+        Args:
+            node (str): The node ID
+            incarnation (str): ID of the node's current process
+            url (str): URL other nodes reach the node at
+            summary (dict): Summary of the node's calls
+            ttl (float): Seconds the node stays live without a heartbeat
+            released: SIDs of calls whose release the node could not send
+
+        Returns:
+            dict: 'known' (False if the node must restore its leases),
+                'nodes' (node, url, summary and seconds since its heartbeat
+                for each live node) and 'leases' (leases held cluster-wide)
+        """
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            entry = self._check_in(node, incarnation, now, ttl)
+            entry['url'], entry['summary'], entry['seen'] = url, summary, now
+            for call_sid in released:
+                if call_sid in self._leases:
+                    self._remove_lease(call_sid)
+            nodes = [
+                {'node': node_id, 'url': other['url'], 'summary': other['summary'],
+                 'age': now - other['seen']}
+                for node_id, other in sorted(self._nodes.items()) if other['url'] is not None
+            ]
+            return {'known': entry['known'], 'nodes': nodes, 'leases': len(self._leases)}
+
+    def acquire(self, node, incarnation, call_sid, limit=None, tenant=None, tenant_limit=None):
+        """
+        Take the lease of a call if the cluster and the tenant have room.
+
+        Taking the lease of a call that already has one always succeeds.
+
+        Args:
+            node (str): The node ID
+            incarnation (str): ID of the node's current process
+            call_sid (str): The Twilio call SID
+            limit (int): Most leases cluster-wide, or None for no limit
+            tenant (str): Tenant the call is counted against, or None
+            tenant_limit (int): Most leases of the tenant, or None for no limit
+
+        Returns:
+            dict: 'granted' and 'known' (False if the node must restore its
+                other leases)
+        """
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            known = self._check_in(node, incarnation, now)['known']
+            existing = self._leases.get(call_sid)
+            if existing is not None:
+                if existing[0] != node:
+                    self._add_lease(node, call_sid, existing[1])
+                return {'granted': True, 'known': known}
+            if limit is not None and len(self._leases) >= limit:
+                return {'granted': False, 'known': known}
+            if (tenant is not None and tenant_limit is not None
+                    and self._tenant_leases.get(tenant, 0) >= tenant_limit):
+                return {'granted': False, 'known': known}
+            self._add_lease(node, call_sid, tenant)
+            return {'granted': True, 'known': known}
+
+    def restore(self, node, incarnation, calls):
+        """
+        Take the leases of calls a node already holds, whatever the limits.
+
+        Args:
+            node (str): The node ID
+            incarnation (str): ID of the node's current process
+            calls (dict): Tenant (or None) of each of the node's active
+                calls, by call SID
+
+        Returns:
+            dict: 'leases' held cluster-wide
+        """
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            self._check_in(node, incarnation, now)
+            for call_sid, tenant in calls.items():
+                existing = self._leases.get(call_sid)
+                if tenant is None and existing is not None:
+                    tenant = existing[1]
+                self._add_lease(node, call_sid, tenant)
+            return {'leases': len(self._leases)}
+
+    def release(self, call_sid):
+        """
+        Give back the lease of a call, whichever node holds it.
+
+        Returns:
+            dict: 'released', False if the call had no lease
+        """
+        with self._lock:
+            if call_sid not in self._leases:
+                return {'released': False}
+            self._remove_lease(call_sid)
+            return {'released': True}
+
+# Operations served over HTTP, as POST /<name> with the arguments as a JSON object
+OPERATIONS = ('heartbeat', 'acquire', 'restore', 'release')
+
+def create_server(store, host='127.0.0.1', port=0, secret=None):
+    """
+    Create an HTTP server for a coordination store.
+
+    Args:
+        store (CoordinationStore): The store to serve
+        host (str): Interface to listen on
+        port (int): Port to listen on, 0 for any free port
+        secret (str): Secret every request must carry in SECRET_HEADER,
+            or None to accept any request
+
+    Returns:
+        ThreadingHTTPServer: The server, not yet serving
+    """
+    expected = secret.encode('utf-8') if secret else None
+
+    class CoordinatorHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            # Headers and body are written separately; don't let Nagle delay the body
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def _send(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+            if expected is not None and not hmac.compare_digest(
+                    self.headers.get(SECRET_HEADER, '').encode('utf-8'), expected):
+                self._send(401, {'error': "Missing or wrong cluster secret"})
+                return
+            name = self.path.strip('/')
+            if name not in OPERATIONS:
+                self._send(404, {'error': f"Unknown operation {name!r}"})
+                return
+            try:
+                result = getattr(store, name)(**json.loads(body or b'{}'))
+            except (TypeError, ValueError) as e:
+                self._send(400, {'error': str(e)})
+                return
+            except Exception as e:
+                logger.error(f"Error handling {name}: {str(e)}")
+                self._send(500, {'error': str(e)})
+                return
+            self._send(200, result)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), CoordinatorHandler)
+    server.daemon_threads = True
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the coordination store of a cluster.")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Interface to listen on, e.g. 0.0.0.0 for nodes on other hosts")
+    parser.add_argument('--port', type=int, default=5100)
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    secret = get_cluster_secret()
+    if secret is None and args.host not in ('127.0.0.1', 'localhost', '::1'):
+        logger.warning("Listening on %s without CLUSTER_SECRET; anyone who can reach "
+                       "the coordinator can take and release leases", args.host)
+    server = create_server(CoordinationStore(), args.host, args.port, secret)
+    logger.info("Coordinator listening on %s:%d", args.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
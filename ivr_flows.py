@@ -0,0 +1,396 @@
+"""
+Data-driven IVR flows.
+
+The IVR menu is a graph of nodes read from a flow file (IVR_FLOW_FILE,
+defaulting to flows/default.json; .yaml files are read when PyYAML is
+installed). Each node has:
+
+- steps: the TwiML verbs played on entering the node, in order. Each verb is
+  one of say, play, pause, gather, beep, redirect or hangup.
+- digits: the node to go to for each digit string the caller may press.
+- otherwise: where to go for any other digits (default: the node again).
+- selection: the IVR selection recorded for the call on entering the node
+  ('music' or 'beep'), if any.
+
+When a flow is loaded it is validated and compiled. Every node's TwiML is
+rendered up front and again only when BASE_URL, BEEP_LOOPS or HOLD_SECONDS
+change. All transitions go into one dict keyed on (node, digits), so a
+webhook is answered with one lookup however many nodes the flow has.
+
+A gather step posts the digits to /handle_ivr?node=<id>, so the node a caller
+is in travels with the call instead of being stored. The flow file is checked
+for changes at most once per RELOAD_CHECK_SECONDS, and a changed flow replaces
+the old one atomically. Calls in progress continue from the same node if it
+still exists, and from the start node otherwise. A flow that fails to load
+is logged and the previous flow stays in use.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import quote
+
+from twilio.twiml.voice_response import VoiceResponse, Gather
+
+from audio_assets import audio_assets, BEEP_SOURCE_NAME, BEEP_TRACK_NAME, BEEP_SILENCE_SECONDS
+from call_store_backends import IvrSelection
+from twilio_utils import render_twiml, get_beep_loops, twiml_config_key, DEFAULT_BASE_URL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLOW_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flows', 'default.json')
+
+# Seconds between checks of the flow file for changes
+RELOAD_CHECK_SECONDS = 1.0
+
+# Beep cycles played when the beep track could not be built (about a minute)
+BEEP_FALLBACK_CYCLES = 20
+
+class FlowError(ValueError):
+    """Raised for a flow file that is invalid."""
+
+def get_flow_file():
+    """
+    Get the path of the IVR flow file.
+
+    Returns:
+        str: Value of IVR_FLOW_FILE, or DEFAULT_FLOW_FILE if unset
+    """
+    return os.environ.get('IVR_FLOW_FILE') or DEFAULT_FLOW_FILE
+
+def _node_url(node_id):
+    return '/handle_ivr?node=' + quote(node_id, safe='')
+
+def _audio_url(base_url, name):
+    # Names of files in static/audio are served by the app; URLs are played as is
+    if '://' in name:
+        return name
+    return f"{base_url}/static/audio/{name}"
+
+def _add_beep(response, base_url, loop):
+    if audio_assets.get(BEEP_TRACK_NAME) is not None:
+        # One fetch of the beep-plus-silence track, looped by Twilio
+        response.play(_audio_url(base_url, BEEP_TRACK_NAME), loop=loop)
+    else:
+        # The track could not be built from the beep file
+        for _ in range(BEEP_FALLBACK_CYCLES):
+            response.play(_audio_url(base_url, BEEP_SOURCE_NAME), loop=1)
+            response.pause(length=BEEP_SILENCE_SECONDS)
+
+class FlowNode:
+    """A validated node of a flow."""
+
+    __slots__ = ('node_id', 'steps', 'selection', 'menu')
+
+    def __init__(self, node_id, steps, selection):
+        self.node_id = node_id
+        self.steps = steps
+        self.selection = selection
+        # Whether the node waits for the caller's input
+        self.menu = any(kind == 'gather' for kind, _ in steps)
+
+    def render(self, base_url):
+        """
+        Build the TwiML played on entering the node.
+
+        Args:
+            base_url (str): Public URL of the app, for audio files
+
+        Returns:
+            VoiceResponse: TwiML response object
+        """
+        response = VoiceResponse()
+        for kind, value in self.steps:
+            if kind == 'say':
+                response.say(value)
+            elif kind == 'play':
+                response.play(_audio_url(base_url, value['file']), loop=value['loop'])
+            elif kind == 'pause':
+                response.pause(length=value)
+            elif kind == 'beep':
+                _add_beep(response, base_url, value if value is not None else get_beep_loops())
+            elif kind == 'gather':
+                gather = Gather(num_digits=value['num_digits'], action=_node_url(self.node_id),
+                                method="POST", timeout=value['timeout'])
+                for prompt_kind, prompt in value['prompts']:
+                    if prompt_kind == 'say':
+                        gather.say(prompt)
+                    else:
+                        gather.play(_audio_url(base_url, prompt))
+                response.append(gather)
+            elif kind == 'redirect':
+                response.redirect(value)
+            elif kind == 'hangup':
+                response.hangup()
+        return response
+
+def _positive_int(node_id, name, value):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise FlowError(f"Node {node_id!r}: {name} must be a non-negative integer")
+    return value
+
+def _compile_step(node_id, step, node_ids):
+    """Validate a step and convert it to a (kind, value) tuple."""
+    if not isinstance(step, dict) or len(step) - ('loop' in step) != 1:
+        raise FlowError(f"Node {node_id!r}: each step must have exactly one verb")
+    kind = next(key for key in step if key != 'loop')
+    value = step[kind]
+    if kind == 'say':
+        return kind, str(value)
+    if kind == 'play':
+        return kind, {'file': str(value), 'loop': _positive_int(node_id, 'loop', step.get('loop', 1))}
+    if kind == 'pause':
+        return kind, _positive_int(node_id, 'pause', value)
+    if kind == 'beep':
+        loop = value.get('loop') if isinstance(value, dict) else None
+        return kind, None if loop is None else _positive_int(node_id, 'loop', loop)
+    if kind == 'gather':
+        if not isinstance(value, dict):
+            raise FlowError(f"Node {node_id!r}: gather must be an object")
+        prompts = [(prompt_kind, str(value[prompt_kind]))
+                   for prompt_kind in ('say', 'play') if prompt_kind in value]
+        return kind, {
+            'prompts': prompts,
+            'num_digits': _positive_int(node_id, 'num_digits', value.get('num_digits', 1)),
+            'timeout': _positive_int(node_id, 'timeout', value.get('timeout', 5))
+        }
+    if kind == 'redirect':
+        # A path (e.g. /incoming_call) or the ID of a node to enter
+        target = str(value)
+        if target.startswith('/'):
+            return kind, target
+        if target not in node_ids:
+            raise FlowError(f"Node {node_id!r}: redirect to unknown node {target!r}")
+        return kind, _node_url(target)
+    if kind == 'hangup':
+        return kind, None
+    raise FlowError(f"Node {node_id!r}: unknown step {kind!r}")
+
+def _node_ref(nodes, target, message):
+    """Check that a reference names a node of the flow."""
+    if not isinstance(target, str) or target not in nodes:
+        raise FlowError(f"{message} {target!r}")
+    return target
+
+class CompiledFlow:
+    """A flow compiled into lookup tables, with its rendered TwiML."""
+
+    def __init__(self, definition, source=None):
+        """
+        Args:
+            definition (dict): The parsed flow file
+            source (str): Where the flow was loaded from, for messages
+
+        Raises:
+            FlowError: If the flow is invalid
+        """
+        nodes = definition.get('nodes') if isinstance(definition, dict) else None
+        if not isinstance(nodes, dict) or not nodes:
+            raise FlowError("A flow needs a 'nodes' object")
+        for node_id in nodes:
+            if not isinstance(node_id, str):
+                raise FlowError(f"Node IDs must be strings, not {node_id!r}")
+        self.source = source
+        self.start = _node_ref(nodes, definition.get('start', next(iter(nodes))),
+                               "Unknown start node")
+
+        # Key: node ID, Value: FlowNode
+        self.nodes = {}
+        # Key: (node ID, digits), Value: node ID
+        self.transitions = {}
+        # Key: node ID, Value: node ID entered for digits without a transition
+        self.fallbacks = {}
+        for node_id, node in nodes.items():
+            if not isinstance(node, dict):
+                raise FlowError(f"Node {node_id!r} must be an object")
+            steps = node.get('steps', [])
+            if not isinstance(steps, list):
+                raise FlowError(f"Node {node_id!r}: steps must be a list")
+            steps = [_compile_step(node_id, step, nodes) for step in steps]
+            selection = node.get('selection')
+            try:
+                IvrSelection.from_label(selection)
+            except (KeyError, AttributeError):
+                raise FlowError(f"Node {node_id!r}: unknown selection {selection!r}")
+            self.nodes[node_id] = FlowNode(node_id, steps, selection)
+
+            digits_map = node.get('digits', {})
+            if not isinstance(digits_map, dict):
+                raise FlowError(f"Node {node_id!r}: digits must be an object")
+            for digits, target in digits_map.items():
+                self.transitions[(node_id, str(digits))] = _node_ref(
+                    nodes, target, f"Node {node_id!r}: digits {digits!r} go to unknown node")
+            self.fallbacks[node_id] = _node_ref(
+                nodes, node.get('otherwise', node_id),
+                f"Node {node_id!r}: otherwise goes to unknown node")
+
+        # Rendered TwiML by node ID, for the configuration in _rendered_key
+        self._rendered = {}
+        self._rendered_key = None
+        self._render_lock = threading.Lock()
+
+    def next_node(self, node_id, digits):
+        """
+        Get the node a caller goes to.
+
+        Args:
+            node_id (str): The node the caller is in; unknown or missing
+                nodes (e.g. removed by a reload) mean the start node
+            digits (str): The digits pressed, or None to enter node_id
+
+        Returns:
+            str: ID of the node to enter
+        """
+        if node_id not in self.nodes:
+            node_id = self.start
+        if digits is None:
+            return node_id
+        target = self.transitions.get((node_id, digits))
+        return target if target is not None else self.fallbacks[node_id]
+
+    def twiml(self, node_id):
+        """
+        Get the rendered TwiML of a node.
+
+        Args:
+            node_id (str): ID of a node of this flow
+
+        Returns:
+            CachedTwiml: Rendered body bytes with ETag and Content-Length
+        """
+        key = twiml_config_key()
+        if key != self._rendered_key:
+            self._render_all(key)
+        return self._rendered[node_id]
+
+    def _render_all(self, key):
+        with self._render_lock:
+            if key == self._rendered_key:
+                return
+            base_url = os.environ.get('BASE_URL', DEFAULT_BASE_URL)
+            self._rendered = {
+                node_id: render_twiml(lambda node=node: node.render(base_url), 'node:' + node_id)
+                for node_id, node in self.nodes.items()
+            }
+            self._rendered_key = key
+
+def load_flow(path):
+    """
+    Load and compile a flow file.
+
+    Args:
+        path (str): A .json file, or a .yaml/.yml file if PyYAML is installed
+
+    Returns:
+        CompiledFlow: The compiled flow
+
+    Raises:
+        FlowError: If the file is invalid, or its TwiML cannot be rendered
+        OSError: If the file cannot be read
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise FlowError("PyYAML is required for YAML flow files")
+        try:
+            definition = yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            raise FlowError(f"Invalid YAML: {str(e)}")
+    else:
+        try:
+            definition = json.loads(data)
+        except ValueError as e:
+            raise FlowError(f"Invalid JSON: {str(e)}")
+    flow = CompiledFlow(definition, path)
+    try:
+        # Render before the flow is used, so no webhook waits for it
+        flow.twiml(flow.start)
+    except Exception as e:
+        raise FlowError(f"Cannot render the flow's TwiML: {str(e)}")
+    return flow
+
+class FlowRegistry:
+    """The current flow, reloaded when the flow file changes."""
+
+    def __init__(self, path=None, reload_interval=RELOAD_CHECK_SECONDS):
+        """
+        Args:
+            path (str): Flow file, defaults to get_flow_file()
+            reload_interval (float): Seconds between checks for changes
+        """
+        self.path = path
+        self.reload_interval = reload_interval
+        self._flow = None
+        # (path, mtime, size) of the file last read, valid or not
+        self._seen = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the current flow, reloading it first if the file changed.
+
+        Returns:
+            CompiledFlow: The flow
+
+        Raises:
+            FlowError: If no valid flow was ever loaded
+        """
+        if time.monotonic() >= self._next_check or self._flow is None:
+            self.reload()
+        if self._flow is None:
+            raise FlowError(f"No IVR flow loaded from {self.path or get_flow_file()}")
+        return self._flow
+
+    def reload(self):
+        """Load the flow file if it changed since it was last loaded."""
+        with self._lock:
+            self._next_check = time.monotonic() + self.reload_interval
+            path = self.path or get_flow_file()
+            try:
+                stat = os.stat(path)
+                seen = (path, stat.st_mtime, stat.st_size)
+                if seen == self._seen:
+                    return
+                # An invalid file is reported once, not on every check
+                self._seen = seen
+                flow = load_flow(path)
+            except (OSError, FlowError) as e:
+                # The last good flow, if any, stays in use
+                logger.error(f"Error loading IVR flow {path}: {str(e)}")
+                return
+            self._flow = flow
+            logger.info(f"Loaded IVR flow {path} ({len(flow.nodes)} nodes)")
+
+# The IVR flow served by the app
+flows = FlowRegistry()
+
+# Registries of the tenants' flow files, by path
+_tenant_flows = {}
+_tenant_flows_lock = threading.Lock()
+
+def get_flow(path=None):
+    """
+    Get the current flow of a flow file.
+
+    Args:
+        path (str): A tenant's flow file, or None for the app's flow
+
+    Returns:
+        CompiledFlow: The flow
+
+    Raises:
+        FlowError: If no valid flow was ever loaded from the file
+    """
+    if path is None:
+        return flows.get()
+    registry = _tenant_flows.get(path)
+    if registry is None:
+        with _tenant_flows_lock:
+            registry = _tenant_flows.setdefault(path, FlowRegistry(path))
+    return registry.get()
@@ -0,0 +1,309 @@
+"""
+Webhook load generator for the telephony testing platform.
+
+Replays the webhook sequence Twilio sends for a call (incoming_call ->
+handle_ivr -> call_status) against a running server, or directly against
+the Flask app through its test client, and reports throughput and per-route
+latency percentiles. No Twilio account or network access is needed.
+
+Examples:
+    python loadgen.py --calls 500 --concurrency 50 --rate 100
+    python loadgen.py --url http://localhost:5000 --calls 1000 --duration 2
+    python loadgen.py --calls 500 --save-baseline baseline.json
+    python loadgen.py --calls 500 --compare-baseline baseline.json
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+logger = logging.getLogger(__name__)
+
+ROUTES = ['/incoming_call', '/handle_ivr', '/call_status']
+
+def signature_headers(base_url, route, fields):
+    """
+    Sign a webhook like Twilio does when the app validates signatures.
+
+    Args:
+        base_url (str): URL the request is sent to, without the route;
+            BASE_URL takes precedence, as in the app
+        route (str): The webhook route
+        fields (dict): The form fields
+
+    Returns:
+        dict: The X-Twilio-Signature header, or no headers if
+            TWILIO_VALIDATE_SIGNATURES is off
+    """
+    from twilio_signature import signatures_enabled, get_signature_validator
+    if not signatures_enabled():
+        return {}
+    validator = get_signature_validator()
+    if validator is None:
+        return {}
+    url = os.environ.get('BASE_URL', base_url).rstrip('/') + route
+    return {'X-Twilio-Signature': validator.compute(url, fields.items())}
+
+class HttpTarget:
+    """Sends webhooks to a running server over HTTP."""
+
+    def __init__(self, base_url, timeout=10.0):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def post(self, route, fields):
+        """
+        POST form-encoded fields to a route.
+
+        Returns:
+            tuple: (status code, response body as bytes)
+        """
+        data = urllib.parse.urlencode(fields).encode('ascii')
+        req = urllib.request.Request(self.base_url + route, data=data, method='POST',
+                                     headers=signature_headers(self.base_url, route, fields))
+        req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+class FlaskTarget:
+    """Sends webhooks straight to the Flask app through its test client."""
+
+    def __init__(self):
+        from app import app
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, route, fields):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post(route, data=fields,
+                               headers=signature_headers('http://localhost', route, fields))
+        return response.status_code, response.get_data()
+
+class LatencyRecorder:
+    """Collects per-route latencies and outcomes from many threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {route: [] for route in ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+        self.outcomes = {'admitted': 0, 'busy': 0, 'failed': 0}
+
+    def record(self, route, latency, ok):
+        with self._lock:
+            self.latencies[route].append(latency)
+            if not ok:
+                self.errors[route] += 1
+
+    def outcome(self, name):
+        with self._lock:
+            self.outcomes[name] += 1
+
+def percentile(sorted_values, fraction):
+    """Return the value at the given fraction (0-1) of a sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def simulate_call(target, recorder, call_duration, number_pool, to_number):
+    """Replay the webhooks of one call."""
+    call_sid = 'CA' + uuid.uuid4().hex
+    from_number = random.choice(number_pool)
+
+    def post(route, fields):
+        fields = dict(fields, CallSid=call_sid, From=from_number, To=to_number)
+        start = time.perf_counter()
+        try:
+            status, body = target.post(route, fields)
+        except Exception as e:
+            logger.debug(f"{route} failed: {str(e)}")
+            status, body = None, b''
+        recorder.record(route, time.perf_counter() - start, status == 200)
+        return status, body
+
+    status, body = post('/incoming_call', {'CallStatus': 'ringing', 'Direction': 'inbound'})
+    if status != 200:
+        recorder.outcome('failed')
+        return
+    if b'<Hangup' in body:
+        # Rejected (busy or error): Twilio reports the call as completed
+        recorder.outcome('busy')
+        post('/call_status', {'CallStatus': 'completed'})
+        return
+
+    recorder.outcome('admitted')
+    post('/handle_ivr', {'Digits': random.choice(['1', '2']), 'CallStatus': 'in-progress'})
+    if call_duration > 0:
+        time.sleep(random.uniform(0.5, 1.5) * call_duration)
+    post('/call_status', {'CallStatus': 'completed'})
+
+def run_load(target, calls, concurrency, rate, call_duration, arrivals='poisson',
+             number_count=50, to_number='+15550000000'):
+    """
+    Replay a number of calls and measure the webhook latencies.
+
+    Args:
+        target: HttpTarget or FlaskTarget
+        calls (int): Number of calls to place
+        concurrency (int): Maximum number of calls in progress at once
+        rate (float): Call arrivals per second (0 for as fast as possible)
+        call_duration (float): Mean seconds between IVR selection and hang-up
+        arrivals (str): 'poisson' or 'constant' inter-arrival times
+        number_count (int): Number of distinct caller numbers
+        to_number (str): The dialed number
+
+    Returns:
+        dict: Report with totals, throughput and per-route latency percentiles
+    """
+    recorder = LatencyRecorder()
+    number_pool = [f"+1555{i:07d}" for i in range(number_count)]
+
+    # One unrecorded call first, so one-time setup (imports, TwiML rendering,
+    # connection setup) does not show up in the percentiles
+    simulate_call(target, LatencyRecorder(), 0, number_pool, to_number)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        next_arrival = start
+        for _ in range(calls):
+            if rate > 0:
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                interval = random.expovariate(rate) if arrivals == 'poisson' else 1.0 / rate
+                next_arrival += interval
+            executor.submit(simulate_call, target, recorder, call_duration,
+                            number_pool, to_number)
+    elapsed = time.perf_counter() - start
+
+    requests = sum(len(values) for values in recorder.latencies.values())
+    report = {
+        'calls': calls,
+        'elapsed': elapsed,
+        'requests': requests,
+        'requests_per_second': requests / elapsed if elapsed else 0.0,
+        'calls_per_second': calls / elapsed if elapsed else 0.0,
+        'outcomes': recorder.outcomes,
+        'routes': {}
+    }
+    for route in ROUTES:
+        latencies = sorted(recorder.latencies[route])
+        report['routes'][route] = {
+            'requests': len(latencies),
+            'errors': recorder.errors[route],
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000
+        }
+    return report
+
+def print_report(report):
+    """Print a load test report as a table."""
+    print(f"{report['calls']} calls, {report['requests']} requests in {report['elapsed']:.2f}s")
+    print(f"throughput: {report['calls_per_second']:.1f} calls/s, "
+          f"{report['requests_per_second']:.1f} requests/s")
+    outcomes = report['outcomes']
+    print(f"admitted: {outcomes['admitted']}, busy: {outcomes['busy']}, "
+          f"failed: {outcomes['failed']}")
+    print(f"{'route':<16} {'requests':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, stats in report['routes'].items():
+        print(f"{route:<16} {stats['requests']:>9} {stats['errors']:>7} "
+              f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+
+def compare_to_baseline(report, baseline, tolerance):
+    """
+    Compare a report with a saved baseline.
+
+    Args:
+        report (dict): Report from run_load
+        baseline (dict): Previously saved report
+        tolerance (float): Allowed relative slowdown, e.g. 0.2 for 20%
+
+    Returns:
+        list: Descriptions of the regressions found
+    """
+    regressions = []
+    if report['requests_per_second'] < baseline['requests_per_second'] * (1 - tolerance):
+        regressions.append(
+            f"throughput {report['requests_per_second']:.1f} req/s < "
+            f"baseline {baseline['requests_per_second']:.1f} req/s")
+    for route, stats in report['routes'].items():
+        base = baseline['routes'].get(route)
+        if not base:
+            continue
+        for key in ['p50_ms', 'p95_ms', 'p99_ms']:
+            if stats[key] > base[key] * (1 + tolerance):
+                regressions.append(
+                    f"{route} {key} {stats[key]:.2f} > baseline {base[key]:.2f}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay Twilio webhook load against the app.")
+    parser.add_argument('--url', help="Base URL of a running server "
+                        "(default: call the Flask app in-process)")
+    parser.add_argument('--calls', type=int, default=200, help="Number of calls")
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help="Maximum calls in progress at once")
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help="Call arrivals per second (0: as fast as possible)")
+    parser.add_argument('--arrivals', choices=['poisson', 'constant'], default='poisson',
+                        help="Inter-arrival time distribution")
+    parser.add_argument('--duration', type=float, default=0.0,
+                        help="Mean call duration in seconds after the IVR selection")
+    parser.add_argument('--to', default='+15550000000', help="Dialed number")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    parser.add_argument('--save-baseline', metavar='FILE', help="Save the report as a baseline")
+    parser.add_argument('--compare-baseline', metavar='FILE',
+                        help="Fail if the results regress from a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed relative regression from the baseline")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        target = HttpTarget(args.url)
+    else:
+        # Keep the app's debug logging from dominating in-process measurements
+        logging.disable(logging.INFO)
+        target = FlaskTarget()
+
+    report = run_load(target, args.calls, args.concurrency, args.rate, args.duration,
+                      arrivals=args.arrivals, to_number=args.to)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.compare_baseline:
+        with open(args.compare_baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
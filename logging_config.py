@@ -0,0 +1,221 @@
+"""
+Logging setup for the app.
+
+By default records are written as text lines to stderr. Set LOG_FORMAT=json
+to write one JSON object per record instead. When LOG_QUEUE_SIZE is above
+zero (the default), request threads only put records on a bounded queue, and
+a background thread formats them and writes them in batches. If the queue
+is full, records are dropped and counted in the log_records_dropped_total
+metric rather than blocking a webhook.
+
+Environment variables:
+    LOG_LEVEL: Minimum level (default INFO; DEBUG is opt-in)
+    LOG_FORMAT: 'text' (default) or 'json'
+    LOG_QUEUE_SIZE: Records buffered for the background writer (default
+        10000; 0 writes synchronously)
+"""
+
+import atexit
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+
+from metrics import Counter, Gauge
+
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_QUEUE_SIZE = 10000
+
+# Most records written by the background thread in one write
+BATCH_SIZE = 256
+
+TEXT_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+LOG_DROPPED = Counter('log_records_dropped_total', "Log records dropped because the log queue was full.")
+LOG_QUEUE_DEPTH = Gauge('log_queue_depth', "Log records waiting for the background writer.")
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects."""
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        # Structured fields passed with extra={...}
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+class QueueLogHandler(logging.Handler):
+    """
+    Puts records on a bounded queue for a background writer.
+
+    The message is merged with its arguments and the traceback rendered
+    before queueing, as logging.handlers.QueueHandler.prepare does, so the
+    writer never sees arguments that changed after the call; the formatter
+    still runs on the writer thread. Records the queue has no room for are
+    dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__()
+        self.queue = log_queue
+        self._dropped = LOG_DROPPED.labels()
+
+    def handle(self, record):
+        # No handler lock needed: the queue is thread safe
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        try:
+            # Arguments may be mutable objects the caller changes after logging
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                # Tracebacks reference frames that may change; format them now
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._dropped.inc()
+
+class BatchingLogWriter:
+    """Background thread that formats queued records and writes them in batches."""
+
+    def __init__(self, log_queue, stream, formatter, batch_size=BATCH_SIZE):
+        self.queue = log_queue
+        self.stream = stream
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def restart(self, log_queue=None):
+        """
+        Start a new thread, e.g. in a forked worker process.
+
+        Args:
+            log_queue (queue.Queue): Queue to read from instead of the current one
+        """
+        if log_queue is not None:
+            self.queue = log_queue
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write the remaining records and stop the thread."""
+        try:
+            self.queue.put(None, timeout=5)
+        except queue.Full:
+            return
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._write([record for record in batch if record is not None])
+            if stop:
+                return
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception as e:
+                lines.append(f"Error formatting log record from {record.name}: {str(e)}")
+        if not lines:
+            return
+        try:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+        except Exception:
+            # Nowhere left to report a broken log stream
+            pass
+
+_writer = None
+_configured = False
+
+def configure_logging(level=None, log_format=None, queue_size=None, stream=None):
+    """
+    Configure the root logger. Only the first call has an effect.
+
+    Arguments default to the LOG_LEVEL, LOG_FORMAT and LOG_QUEUE_SIZE
+    environment variables.
+
+    Args:
+        level (str): Minimum level name, e.g. 'INFO'
+        log_format (str): 'text' or 'json'
+        queue_size (int): Records buffered for the background writer; 0
+            writes synchronously
+        stream: File object to write to, defaults to stderr
+    """
+    global _writer, _configured
+    if _configured:
+        return
+    _configured = True
+    root = logging.getLogger()
+
+    level = (level or os.environ.get('LOG_LEVEL', DEFAULT_LOG_LEVEL)).upper()
+    log_format = (log_format or os.environ.get('LOG_FORMAT', 'text')).lower()
+    if queue_size is None:
+        try:
+            queue_size = int(os.environ.get('LOG_QUEUE_SIZE', DEFAULT_QUEUE_SIZE))
+        except ValueError:
+            queue_size = DEFAULT_QUEUE_SIZE
+    stream = stream or sys.stderr
+
+    formatter = JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    if queue_size > 0:
+        log_queue = queue.Queue(maxsize=queue_size)
+        handler = QueueLogHandler(log_queue)
+        _writer = BatchingLogWriter(log_queue, stream, formatter)
+        _writer.start()
+        atexit.register(_writer.stop)
+
+        def restart_after_fork():
+            # Threads don't survive fork(), e.g. gunicorn --preload workers, and
+            # the parent's writer may have held the queue's lock at fork time
+            child_queue = queue.Queue(maxsize=queue_size)
+            handler.queue = child_queue
+            _writer.restart(child_queue)
+            LOG_QUEUE_DEPTH.labels().set_function(child_queue.qsize)
+
+        os.register_at_fork(after_in_child=restart_after_fork)
+        LOG_QUEUE_DEPTH.labels().set_function(log_queue.qsize)
+    else:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(formatter)
+
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level, logging.INFO))
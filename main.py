@@ -2,9 +2,10 @@ import logging
 import os
 from load_env import load_env_variables
 from app import app
+from logging_config import configure_logging
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (already done when app was imported; LOG_LEVEL=DEBUG for debug logs)
+configure_logging()
 
 # Load environment variables from Replit Secrets
 load_env_variables()
@@ -0,0 +1,277 @@
+"""
+Low-overhead metrics exported in the Prometheus text format at /metrics.
+
+Counters, gauges and histograms keep their values in preallocated slots:
+recording a value takes a short lock and updates existing numbers, without
+building any per-request objects. Labelled metrics create one child per
+label value up front (see labels()), which the hot path keeps a reference to.
+
+Values are per process. With several gunicorn workers each worker reports
+its own metrics.
+"""
+
+from bisect import bisect_left
+import threading
+import time
+
+# Upper bounds in seconds of the default latency histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metrics in the order they are rendered
+_registry = []
+
+def _format_labels(label_names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _CounterChild:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        # acquire()/release() rather than `with`: cheaper, and nothing in
+        # between can raise
+        lock = self._lock
+        lock.acquire()
+        self.value += amount
+        lock.release()
+
+class _GaugeChild:
+    __slots__ = ('_lock', 'value', 'function')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """Read the value from a function when metrics are collected."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+class _HistogramChild:
+    __slots__ = ('_lock', 'bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self.bounds = bounds
+        # One count per bucket plus the +Inf bucket; not cumulative
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        lock = self._lock
+        lock.acquire()
+        self.counts[index] += 1
+        self.sum += value
+        lock.release()
+
+class _Metric:
+    """Base class of the metric types; holds the children per label value."""
+
+    type_name = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            # Unlabelled metrics have a single child, labels()
+            self._children[()] = self._new_child()
+        _registry.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        Get the child metric for a set of label values, creating it if needed.
+
+        Look children up once and keep them; this call is not meant for the
+        hot path.
+
+        Args:
+            *values: One value per label name
+
+        Returns:
+            The child counter, gauge or histogram
+        """
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}")
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self, values, child):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        for values, child in list(self._children.items()):
+            lines.extend(self._samples(values, child))
+        return lines
+
+class Counter(_Metric):
+    """A count that only goes up."""
+
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _samples(self, values, child):
+        return [f'{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}']
+
+class Gauge(_Metric):
+    """A value that can go up and down, or is read from a function."""
+
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def _samples(self, values, child):
+        return [f'{self.name}{_format_labels(self.label_names, values)} {_format_value(child.get())}']
+
+class Histogram(_Metric):
+    """Counts of observed values in fixed buckets, plus their sum and count."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _samples(self, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            samples.append(f'{self.name}_bucket{_format_labels(self.label_names, values, le)} '
+                           f'{cumulative}')
+        labels = _format_labels(self.label_names, values)
+        samples.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        samples.append(f'{self.name}_count{labels} {cumulative}')
+        return samples
+
+class TimedLock:
+    """
+    Reentrant lock that records how long the outermost acquisition waited
+    for the lock and how long it was held.
+    """
+
+    def __init__(self, wait, hold):
+        """
+        Args:
+            wait: Histogram child for the wait times
+            hold: Histogram child for the hold times
+        """
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._acquired_at = 0.0
+        self.wait = wait
+        self.hold = hold
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            self._acquired_at = acquired_at = time.perf_counter()
+            self.wait.observe(acquired_at - start)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            self.hold.observe(time.perf_counter() - self._acquired_at)
+        self._lock.release()
+
+def render():
+    """
+    Render all metrics in the Prometheus text exposition format.
+
+    Returns:
+        bytes: The metrics document
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+# Metrics exported by the app
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', "Time to handle a request, by route.", ['route'])
+
+STORE_LATENCY = Histogram(
+    'call_store_operation_duration_seconds', "Time of call storage operations.", ['operation'])
+
+STORE_LOCK_WAIT = Histogram(
+    'call_store_lock_wait_seconds', "Time spent waiting for the call store write lock.")
+
+STORE_LOCK_HOLD = Histogram(
+    'call_store_lock_hold_seconds', "Time the call store write lock is held.")
+
+TWIML_RENDER = Histogram(
+    'twiml_render_duration_seconds', "Time to render a TwiML document, by response type.",
+    ['response_type'])
+
+ACTIVE_CALLS = Gauge('active_calls', "Number of active calls.")
+
+ADMISSIONS = Counter(
+    'call_admissions_total',
+    "Admission decisions by status (admitted, duplicate, busy, queued).", ['status'])
+
+WAITING_CALLS = Gauge('waiting_room_calls', "Number of callers in the waiting room.")
+
+WAITING_ROOM_WAIT = Histogram(
+    'waiting_room_wait_seconds', "Time callers admitted from the waiting room waited.",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
+
+WAITING_ROOM_ABANDONED = Counter(
+    'waiting_room_abandoned_total', "Callers that hung up while in the waiting room.")
+
+ADMISSION_CAPACITY = Gauge(
+    'admission_capacity', "Current limit on active calls (MAX_CALLS, lowered under load with ADAPTIVE_CAPACITY).")
+
+IVR_SELECTIONS = Counter('ivr_selections_total', "IVR menu selections.", ['selection'])
@@ -7,6 +7,17 @@ let callChartInstance;
 let lastCallCount = 0;
 let callData = [];
 
+// Version of the active calls last applied, null until the first snapshot
+let callsVersion = null;
+
+// Key: call SID, Value: {call, element, received} for each call shown in the
+// list; received is the performance.now() time call.duration was reported at
+const callItems = new Map();
+
+// Whether changes are pushed by the server instead of polled
+let pushUpdatesActive = false;
+let pollTimer = null;
+
 // Initialize the dashboard when the DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
     console.log('Dashboard initializing...');
@@ -18,12 +29,93 @@ document.addEventListener('DOMContentLoaded', function() {
     // Initialize the call chart
     initializeCallChart();
     
+    // Advance the shown durations between updates
+    setInterval(updateDurations, 1000);
+    
+    // Show the waiting room when enabled (WAITING_ROOM is set by the template)
+    if (typeof WAITING_ROOM !== 'undefined' && WAITING_ROOM) {
+        fetchQueueStatus();
+        setInterval(fetchQueueStatus, 3000);
+    }
+    
+    // Show the cluster's nodes in cluster mode (CLUSTER is set by the template)
+    if (typeof CLUSTER !== 'undefined' && CLUSTER) {
+        fetchClusterStatus();
+        setInterval(fetchClusterStatus, 3000);
+    }
+    
+    // Use server push when enabled (PUSH_UPDATES is set by the template)
+    if (typeof PUSH_UPDATES !== 'undefined' && PUSH_UPDATES) {
+        startPushUpdates();
+    } else {
+        startPolling();
+    }
+});
+
+// Poll for changes every 3 seconds
+function startPolling() {
+    pushUpdatesActive = false;
+    
     // Initial data load
     fetchInitialData();
     
     // Start polling for updates
-    setInterval(fetchDashboardData, 3000);
-});
+    pollTimer = setInterval(fetchDashboardData, 3000);
+}
+
+// Receive changes pushed by the server over SSE, or by long polling
+function startPushUpdates() {
+    pushUpdatesActive = true;
+    
+    // Pushes arrive irregularly, so record chart points on a timer
+    setInterval(() => updateCallChart(callItems.size, new Date()), 3000);
+    
+    if (!window.EventSource) {
+        longPoll(null);
+        return;
+    }
+    
+    const source = new EventSource('/api/events');
+    source.onopen = function() {
+        // Events may have been missed while disconnected; reload everything
+        callsVersion = null;
+        fetchDashboardData();
+    };
+    source.addEventListener('calls', function(event) {
+        updateDashboard(JSON.parse(event.data));
+    });
+    source.onerror = function() {
+        if (source.readyState === EventSource.CLOSED) {
+            console.warn('Event stream closed, falling back to polling');
+            startPolling();
+        }
+    };
+}
+
+// Long-poll for events published after an event ID
+function longPoll(after) {
+    const url = after === null ? '/api/events/poll' : `/api/events/poll?after=${after}`;
+    
+    fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                throw new Error(data.error);
+            }
+            if (after === null || data.resync) {
+                // Missed events: reload everything
+                callsVersion = null;
+                fetchDashboardData();
+            } else {
+                data.events.forEach(updateDashboard);
+            }
+            longPoll(data.last_id);
+        })
+        .catch(error => {
+            console.error('Error long-polling events:', error);
+            setTimeout(() => longPoll(null), 3000);
+        });
+}
 
 // Initialize the call history chart
 function initializeCallChart() {
@@ -54,11 +146,18 @@ function fetchInitialData() {
     fetchDashboardData();
 }
 
-// Fetch dashboard data using our new combined endpoint
+// Fetch the changes to the active calls since the last applied version
 function fetchDashboardData() {
-    fetch('/api/dashboard_data')
+    const url = callsVersion === null
+        ? '/api/dashboard_changes'
+        : `/api/dashboard_changes?since=${callsVersion}`;
+    
+    fetch(url)
         .then(response => response.json())
         .then(data => {
+            if (data.error) {
+                throw new Error(data.error);
+            }
             updateDashboard(data);
         })
         .catch(error => console.error('Error fetching dashboard data:', error));
@@ -66,88 +165,200 @@ function fetchDashboardData() {
 
 // Update the dashboard with new data
 function updateDashboard(data) {
+    // Patch the active calls list
+    applyCallChanges(data);
+    
     // Update call count
-    const count = data.count || 0;
+    const count = callItems.size;
     callCountElement.textContent = count;
     
     // Update call count appearance based on capacity
     updateCallCountAppearance(count);
     
-    // Update active calls list
-    updateCallsList(data.calls || []);
-    
-    // Update chart with new data point
-    updateCallChart(count, data.timestamp);
+    // Update chart with new data point (on a timer when pushing)
+    if (!pushUpdatesActive) {
+        updateCallChart(count, data.timestamp);
+    }
     
     // Record the last call count
     lastCallCount = count;
 }
 
-// Update the calls list in the UI
-function updateCallsList(calls) {
-    // Clear existing content
-    callListElement.innerHTML = '';
+// Apply a delta (or a full snapshot) of the active calls to the list
+function applyCallChanges(data) {
+    if (data.full) {
+        // Drop calls that are no longer active, then upsert the snapshot
+        const activeSids = new Set(data.calls.map(call => call.call_sid));
+        callItems.forEach((item, callSid) => {
+            if (!activeSids.has(callSid)) {
+                removeCallItem(callSid);
+            }
+        });
+        // The server lists calls newest first: append them in that order
+        data.calls.forEach(call => callListElement.appendChild(upsertCallItem(call)));
+    } else {
+        data.removed.forEach(removeCallItem);
+        // Added calls come in the order they started and are newer than
+        // every call shown, so each goes to the top of the list
+        data.added.forEach(call => {
+            const element = upsertCallItem(call);
+            callListElement.insertBefore(element, firstCallElement());
+        });
+        data.updated.forEach(upsertCallItem);
+    }
+    
+    // Pushed events carry no version; only snapshots and polled deltas do
+    if (data.version !== undefined) {
+        callsVersion = data.version;
+    }
+    updateNoCallsMessage();
+}
+
+// Update a shown call, or create its list item; returns the item's element
+function upsertCallItem(call) {
+    const existing = callItems.get(call.call_sid);
+    if (existing) {
+        existing.call = call;
+        existing.received = performance.now();
+        renderCallItem(existing.element, call);
+        return existing.element;
+    }
     
-    if (calls.length === 0) {
-        // Show a message when no active calls
-        const noCallsMessage = document.createElement('div');
+    const callItem = document.createElement('div');
+    callItem.className = 'call-item p-3 mb-2 border rounded';
+    callItem.setAttribute('data-call-sid', call.call_sid);
+    renderCallItem(callItem, call);
+    callItems.set(call.call_sid, {call: call, element: callItem, received: performance.now()});
+    return callItem;
+}
+
+// First call item in the list, or null if none is shown
+function firstCallElement() {
+    return callListElement.querySelector('.call-item');
+}
+
+// Show each call's duration as reported by the server plus the time since
+function updateDurations() {
+    const now = performance.now();
+    callItems.forEach(item => {
+        const seconds = item.call.duration + (now - item.received) / 1000;
+        item.element.querySelector('.call-duration').textContent = formatDuration(seconds);
+    });
+}
+
+// Remove a call from the list
+function removeCallItem(callSid) {
+    const item = callItems.get(callSid);
+    if (item) {
+        item.element.remove();
+        callItems.delete(callSid);
+    }
+}
+
+// Show a message when there are no active calls
+function updateNoCallsMessage() {
+    let noCallsMessage = document.getElementById('no-calls-message');
+    if (!noCallsMessage) {
+        // Replace the placeholder rendered by the template
+        callListElement.innerHTML = '';
+        noCallsMessage = document.createElement('div');
+        noCallsMessage.id = 'no-calls-message';
         noCallsMessage.className = 'text-center py-4 text-muted';
         noCallsMessage.innerHTML = '<i class="fas fa-phone-slash me-2"></i>No active calls';
         callListElement.appendChild(noCallsMessage);
-        return;
+        callItems.forEach(item => callListElement.appendChild(item.element));
+    }
+    noCallsMessage.style.display = callItems.size === 0 ? '' : 'none';
+}
+
+// Render the contents of a call list item
+function renderCallItem(callItem, call) {
+    // Format the phone numbers for display
+    const fromNumber = formatPhoneNumber(call.from_number);
+    const toNumber = formatPhoneNumber(call.to_number);
+    
+    // Format duration
+    const duration = call.duration ? formatDuration(call.duration) : '00:00';
+    
+    // Determine IVR selection text and icon
+    let ivrSelectionText = 'Waiting for selection...';
+    let ivrSelectionIcon = '<i class="fas fa-question-circle text-warning"></i>';
+    
+    if (call.ivr_selection === 'music') {
+        ivrSelectionText = 'Playing Music';
+        ivrSelectionIcon = '<i class="fas fa-music text-primary"></i>';
+    } else if (call.ivr_selection === 'beep') {
+        ivrSelectionText = 'Playing Beep (3s)';
+        ivrSelectionIcon = '<i class="fas fa-volume-up text-info"></i>';
     }
     
-    // Sort calls by start time (newest first)
-    calls.sort((a, b) => new Date(b.start_time) - new Date(a.start_time));
-    
-    // Create list items for each call
-    calls.forEach(call => {
-        const callItem = document.createElement('div');
-        callItem.className = 'call-item p-3 mb-2 border rounded';
-        callItem.setAttribute('data-call-sid', call.call_sid);
-        
-        // Format the phone numbers for display
-        const fromNumber = formatPhoneNumber(call.from_number);
-        const toNumber = formatPhoneNumber(call.to_number);
-        
-        // Format duration
-        const duration = call.duration ? formatDuration(call.duration) : '00:00';
-        
-        // Determine IVR selection text and icon
-        let ivrSelectionText = 'Waiting for selection...';
-        let ivrSelectionIcon = '<i class="fas fa-question-circle text-warning"></i>';
-        
-        if (call.ivr_selection === 'music') {
-            ivrSelectionText = 'Playing Music';
-            ivrSelectionIcon = '<i class="fas fa-music text-primary"></i>';
-        } else if (call.ivr_selection === 'beep') {
-            ivrSelectionText = 'Playing Beep (3s)';
-            ivrSelectionIcon = '<i class="fas fa-volume-up text-info"></i>';
-        }
-        
-        // Build the call item HTML
-        callItem.innerHTML = `
-            <div class="d-flex justify-content-between align-items-center">
-                <div class="call-info">
-                    <div class="call-number mb-1">
-                        <i class="fas fa-phone-alt me-2 text-success"></i>
-                        <span class="fw-bold">${fromNumber}</span> → ${toNumber}
-                    </div>
-                    <div class="call-details d-flex align-items-center">
-                        <span class="me-3 text-muted small">
-                            <i class="far fa-clock me-1"></i>${duration}
-                        </span>
-                        <span class="ivr-selection small">
-                            ${ivrSelectionIcon} ${ivrSelectionText}
-                        </span>
-                    </div>
+    // Build the call item HTML
+    callItem.innerHTML = `
+        <div class="d-flex justify-content-between align-items-center">
+            <div class="call-info">
+                <div class="call-number mb-1">
+                    <i class="fas fa-phone-alt me-2 text-success"></i>
+                    <span class="fw-bold">${fromNumber}</span> → ${toNumber}
+                </div>
+                <div class="call-details d-flex align-items-center">
+                    <span class="me-3 text-muted small">
+                        <i class="far fa-clock me-1"></i><span class="call-duration">${duration}</span>
+                    </span>
+                    <span class="ivr-selection small">
+                        ${ivrSelectionIcon} ${ivrSelectionText}
+                    </span>
                 </div>
-                <span class="call-sid small text-muted">${call.call_sid.substr(-8)}</span>
             </div>
-        `;
-        
-        callListElement.appendChild(callItem);
+            <span class="call-sid small text-muted">${call.call_sid.substr(-8)}</span>
+        </div>
+    `;
+}
+
+// Fetch the waiting room depth and wait percentiles
+function fetchQueueStatus() {
+    fetch('/api/queue')
+        .then(response => response.json())
+        .then(updateQueueStatus)
+        .catch(error => console.error('Error fetching queue status:', error));
+}
+
+function updateQueueStatus(data) {
+    if (data.error) return;
+    document.getElementById('queue-depth').textContent = data.waiting;
+    document.getElementById('queue-size').textContent = data.size;
+    document.getElementById('queue-capacity').textContent = data.capacity;
+    document.getElementById('queue-wait-p50').textContent = formatDuration(data.p50);
+    document.getElementById('queue-wait-p95').textContent = formatDuration(data.p95);
+    document.getElementById('queue-admitted').textContent = data.admitted;
+    document.getElementById('queue-abandoned').textContent = data.abandoned;
+}
+
+// Fetch the cluster's merged call count and node summaries
+function fetchClusterStatus() {
+    fetch('/api/dashboard_data')
+        .then(response => response.json())
+        .then(updateClusterStatus)
+        .catch(error => console.error('Error fetching cluster status:', error));
+}
+
+function updateClusterStatus(data) {
+    if (data.error || !data.nodes) return;
+    document.getElementById('cluster-count').textContent = data.count;
+    document.getElementById('cluster-node-count').textContent = data.nodes.length;
+    document.getElementById('cluster-leases').textContent = data.leases;
+    const rows = data.nodes.map(node => {
+        const summary = node.summary || {count: 0, ivr: {music: 0, beep: 0}};
+        const row = document.createElement('tr');
+        [node.node, summary.count, summary.ivr.music, summary.ivr.beep,
+         `${Math.round(node.age)}s ago`].forEach((value, index) => {
+            const cell = document.createElement('td');
+            cell.textContent = value;
+            if (index > 0) cell.className = 'text-end';
+            row.appendChild(cell);
+        });
+        return row;
     });
+    document.getElementById('cluster-nodes').replaceChildren(...rows);
 }
 
 // Update the call count appearance based on capacity
@@ -0,0 +1,236 @@
+"""
+Routing of dialed numbers to tenants.
+
+With TENANTS_FILE set, each call is routed by the number it dialed (the
+webhook's To field) to a tenant, which has its own IVR flow and limit on
+simultaneous calls:
+
+    {
+        "default_country_code": "1",
+        "tenants": {
+            "acme": {
+                "numbers": ["+1 (555) 123-0000", "+15551230001"],
+                "flow": "flows/acme.json",
+                "max_calls": 10
+            }
+        }
+    }
+
+Numbers are normalized to E.164 and indexed in one dict, so routing a call
+costs one normalization and one lookup however many numbers are configured.
+Relative flow paths are resolved against the tenants file's directory, and
+every tenant's flow is compiled when the file is loaded, so a broken flow
+is reported then rather than on a call.
+Calls to other numbers use the default flow (IVR_FLOW_FILE) and only the
+global MAX_CALLS limit; tenant calls count against both.
+
+The file is checked for changes at most once per RELOAD_CHECK_SECONDS, and
+a new index replaces the old one atomically. An invalid file is logged and
+the previous index stays in use.
+"""
+
+from collections import namedtuple
+import json
+import logging
+import os
+import threading
+import time
+
+from ivr_flows import FlowError, load_flow
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the tenants file for changes
+RELOAD_CHECK_SECONDS = 1.0
+
+# Country code of numbers configured without one
+DEFAULT_COUNTRY_CODE = '1'
+
+# Where calls to a number go: the tenant (None for unrouted numbers), the
+# path of its IVR flow file (None for the default flow) and its limit on
+# simultaneous calls (None for no limit of its own)
+Route = namedtuple('Route', ['tenant', 'flow_file', 'max_calls'])
+
+DEFAULT_ROUTE = Route(None, None, None)
+
+class TenantConfigError(ValueError):
+    """Raised for a tenants file that is invalid."""
+
+def normalize_number(number, country_code=DEFAULT_COUNTRY_CODE):
+    """
+    Normalize a phone number to E.164.
+
+    Args:
+        number (str): A number such as '+15551230000', '(555) 123-0000' or
+            '0044 20 7946 0000'
+        country_code (str): Country code of numbers given without one
+
+    Returns:
+        str: The number in E.164 form, or None if it isn't a phone number
+            (e.g. a 'client:' or SIP address)
+    """
+    if not number:
+        return None
+    # Twilio sends E.164 numbers, so most lookups take this path
+    if number[0] == '+' and number[1:].isdigit() and number.isascii():
+        return number if 8 <= len(number) <= 16 else None
+    number = number.strip()
+    if any(ch.isalpha() for ch in number):
+        return None
+    digits = ''.join(ch for ch in number if '0' <= ch <= '9')
+    if number.startswith('+'):
+        pass
+    elif number.startswith('00'):
+        # International dialing prefix
+        digits = digits[2:]
+    elif len(digits) > 10 and digits.startswith(country_code):
+        pass
+    else:
+        # A national number; drop the trunk prefix
+        digits = country_code + (digits[1:] if digits.startswith('0') else digits)
+    normalized = '+' + digits
+    return normalized if 8 <= len(normalized) <= 16 else None
+
+def get_tenants_file():
+    """
+    Get the path of the tenants file.
+
+    Returns:
+        str: Value of TENANTS_FILE, or None if unset
+    """
+    return os.environ.get('TENANTS_FILE') or None
+
+def build_index(definition, base_dir='.'):
+    """
+    Build the number index of a tenants file.
+
+    Args:
+        definition (dict): The parsed tenants file
+        base_dir (str): Directory relative flow paths are resolved against
+
+    Returns:
+        tuple: (dict of Route by E.164 number, dict of Route by tenant,
+            default country code)
+
+    Raises:
+        TenantConfigError: If the definition is invalid
+    """
+    tenants = definition.get('tenants') if isinstance(definition, dict) else None
+    if not isinstance(tenants, dict):
+        raise TenantConfigError("A tenants file needs a 'tenants' object")
+    country_code = str(definition.get('default_country_code', DEFAULT_COUNTRY_CODE)).lstrip('+')
+    if not country_code.isdigit():
+        raise TenantConfigError(f"Invalid default_country_code {country_code!r}")
+
+    index = {}
+    routes = {}
+    compiled = set()
+    for name, tenant in tenants.items():
+        if not isinstance(tenant, dict):
+            raise TenantConfigError(f"Tenant {name!r} must be an object")
+        max_calls = tenant.get('max_calls')
+        if max_calls is not None and (not isinstance(max_calls, int)
+                                      or isinstance(max_calls, bool) or max_calls < 0):
+            raise TenantConfigError(f"Tenant {name!r}: max_calls must be a non-negative integer")
+        flow_file = tenant.get('flow')
+        if flow_file is not None:
+            flow_file = os.path.normpath(os.path.join(base_dir, flow_file))
+            if flow_file not in compiled:
+                try:
+                    load_flow(flow_file)
+                except (OSError, FlowError) as e:
+                    raise TenantConfigError(f"Tenant {name!r}: flow file {flow_file}: {str(e)}")
+                compiled.add(flow_file)
+        route = Route(name, flow_file, max_calls)
+        routes[name] = route
+
+        numbers = tenant.get('numbers', [])
+        if not isinstance(numbers, list):
+            raise TenantConfigError(f"Tenant {name!r}: numbers must be a list")
+        for number in numbers:
+            if not isinstance(number, (str, int)) or isinstance(number, bool):
+                raise TenantConfigError(f"Tenant {name!r}: invalid number {number!r}")
+            normalized = normalize_number(str(number), country_code)
+            if normalized is None:
+                raise TenantConfigError(f"Tenant {name!r}: invalid number {number!r}")
+            other = index.get(normalized)
+            if other is not None and other.tenant != name:
+                raise TenantConfigError(
+                    f"Number {normalized} belongs to both {other.tenant!r} and {name!r}")
+            index[normalized] = route
+    return index, routes, country_code
+
+class TenantRouter:
+    """Routes dialed numbers to tenants, reloading the tenants file when it changes."""
+
+    def __init__(self, path=None, reload_interval=RELOAD_CHECK_SECONDS):
+        """
+        Args:
+            path (str): Tenants file, defaults to get_tenants_file()
+            reload_interval (float): Seconds between checks for changes
+        """
+        self.path = path
+        self.reload_interval = reload_interval
+        # (number index, routes by tenant, default country code), replaced as a whole
+        self._config = ({}, {}, DEFAULT_COUNTRY_CODE)
+        # (path, mtime, size) of the file last read, valid or not
+        self._seen = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def lookup(self, number):
+        """
+        Get the route of a dialed number.
+
+        Args:
+            number (str): The dialed number (the webhook's To field)
+
+        Returns:
+            Route: The tenant's route, or DEFAULT_ROUTE for other numbers
+        """
+        if time.monotonic() >= self._next_check:
+            self.reload()
+        index, _, country_code = self._config
+        if not index:
+            return DEFAULT_ROUTE
+        return index.get(normalize_number(number, country_code), DEFAULT_ROUTE)
+
+    def get_routes(self):
+        """
+        Get the configured tenants.
+
+        Returns:
+            dict: Route by tenant name
+        """
+        if time.monotonic() >= self._next_check:
+            self.reload()
+        return self._config[1]
+
+    def reload(self):
+        """Load the tenants file if it changed since it was last loaded."""
+        with self._lock:
+            self._next_check = time.monotonic() + self.reload_interval
+            path = self.path or get_tenants_file()
+            if path is None:
+                if self._seen is not None:
+                    self._config, self._seen = ({}, {}, DEFAULT_COUNTRY_CODE), None
+                return
+            try:
+                stat = os.stat(path)
+                seen = (path, stat.st_mtime, stat.st_size)
+                if seen == self._seen:
+                    return
+                # An invalid file is reported once, not on every check
+                self._seen = seen
+                with open(path, 'rb') as f:
+                    definition = json.loads(f.read())
+                config = build_index(definition, os.path.dirname(os.path.abspath(path)))
+            except (OSError, ValueError) as e:
+                logger.error(f"Error loading tenants file {path}: {str(e)}")
+                return
+            self._config = config
+            logger.info(f"Loaded tenants file {path} ({len(config[1])} tenants, "
+                        f"{len(config[0])} numbers)")
+
+# Routes of the app's numbers
+tenant_router = TenantRouter()
@@ -0,0 +1,93 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+import uuid
+
+import pytest
+from twilio.rest import Client
+
+from call_store_backends import MemoryCallStore, SqliteCallStore
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    """An empty call store of each backend."""
+    if request.param == 'memory':
+        return MemoryCallStore()
+    return SqliteCallStore(str(tmp_path / 'calls.db'))
+
+class FakeTwilio:
+    """
+    A local HTTP server answering Twilio call create, fetch and update requests.
+
+    failures maps a call SID ('Calls' for creating calls) to the HTTP status
+    codes of its first requests; later requests succeed.
+    """
+
+    def __init__(self, latency=0.01, failures=None):
+        self.latency = latency
+        self.failures = {sid: list(codes) for sid, codes in (failures or {}).items()}
+        # (method, call SID, time.monotonic() of arrival) of every request
+        self.requests = []
+        self.in_flight = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self, status):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                call_sid = self.path.rsplit('/', 1)[-1].split('.')[0]
+                with fake.lock:
+                    fake.requests.append((self.command, call_sid, time.monotonic()))
+                    fake.in_flight += 1
+                    fake.peak = max(fake.peak, fake.in_flight)
+                    codes = fake.failures.get(call_sid)
+                    code = codes.pop(0) if codes else 200
+                time.sleep(fake.latency)
+                with fake.lock:
+                    fake.in_flight -= 1
+                if call_sid == 'Calls':
+                    call_sid, status = 'CA' + uuid.uuid4().hex, 'queued'
+                if code == 200:
+                    body = {'sid': call_sid, 'status': status}
+                else:
+                    body = {'code': 20000 + code, 'message': 'Fake error', 'status': code}
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond('in-progress')
+
+            def do_POST(self):
+                self._respond('completed')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def attempts(self, call_sid):
+        return sum(1 for _, sid, _ in self.requests if sid == call_sid)
+
+@pytest.fixture
+def twilio():
+    """A started fake Twilio API and a client pointed at it."""
+    fake = FakeTwilio()
+    threading.Thread(target=fake.server.serve_forever, daemon=True).start()
+    client = Client('AC' + '0' * 32, 'token')
+    client.api.base_url = fake.base_url
+    yield fake, client
+    fake.server.shutdown()
+    fake.server.server_close()
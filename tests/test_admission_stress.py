@@ -0,0 +1,106 @@
+"""Concurrent admissions never exceed the capacity limit."""
+
+import multiprocessing
+import threading
+import time
+
+from call_store_backends import ADMITTED, BUSY, DUPLICATE, SqliteCallStore
+
+# Limit for the thread tests, well below the number of threads
+MAX_CALLS = 10
+
+def _hammer(store, max_calls, worker_id, attempts, held, peak, lock, barrier):
+    """Admit, hold and end calls, recording the most calls held at once."""
+    barrier.wait()
+    for i in range(attempts):
+        call_sid = f"CA{worker_id:04d}{i:06d}"
+        result = store.try_admit(call_sid, '+15550000000', '+15551111111', max_calls)
+        if result.status == ADMITTED:
+            # Counted from after the admission until before the end, so the
+            # count can only trail the store's, never lead it
+            with lock:
+                held.value += 1
+                peak.value = max(peak.value, held.value, store.get_call_count())
+            time.sleep(0.001)
+            with lock:
+                held.value -= 1
+            store.end_call(call_sid)
+        else:
+            assert result.status == BUSY
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+
+def test_threads_never_exceed_limit(store):
+    threads_count, attempts = 50, 40
+    held, peak, lock = _Value(), _Value(), threading.Lock()
+    barrier = threading.Barrier(threads_count)
+    threads = [threading.Thread(target=_hammer,
+                                args=(store, MAX_CALLS, i, attempts, held, peak, lock, barrier))
+               for i in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 0 < peak.value <= MAX_CALLS
+    assert store.get_call_count() == 0
+
+def _process_worker(path, max_calls, worker_id, attempts, held, peak, lock, barrier):
+    _hammer(SqliteCallStore(path), max_calls, worker_id, attempts, held, peak, lock, barrier)
+
+def test_processes_never_exceed_limit_on_shared_store(tmp_path):
+    path = str(tmp_path / 'calls.db')
+    SqliteCallStore(path)
+    processes_count, attempts, max_calls = 4, 100, 2
+    context = multiprocessing.get_context('spawn')
+    held, peak = context.Value('i', 0, lock=False), context.Value('i', 0, lock=False)
+    lock, barrier = context.Lock(), context.Barrier(processes_count)
+    processes = [context.Process(target=_process_worker,
+                                 args=(path, max_calls, i, attempts, held, peak, lock, barrier))
+                 for i in range(processes_count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    assert 0 < peak.value <= max_calls
+    assert SqliteCallStore(path).get_call_count() == 0
+
+def _filling_worker(path, max_calls, worker_id, attempts, results, barrier):
+    store = SqliteCallStore(path)
+    barrier.wait()
+    statuses = []
+    for i in range(attempts):
+        # Every worker also tries a call that all of them receive
+        call_sid = 'CAshared' if i == attempts // 2 else f"CA{worker_id:04d}{i:06d}"
+        statuses.append((call_sid, store.try_admit(call_sid, '+15550000000', '+15551111111',
+                                                   max_calls).status))
+    results.put(statuses)
+
+def test_processes_fill_a_shared_store_to_capacity(tmp_path):
+    path = str(tmp_path / 'calls.db')
+    SqliteCallStore(path)
+    processes_count, attempts, max_calls = 4, 50, 7
+    context = multiprocessing.get_context('spawn')
+    results, barrier = context.Queue(), context.Barrier(processes_count)
+    processes = [context.Process(target=_filling_worker,
+                                 args=(path, max_calls, i, attempts, results, barrier))
+                 for i in range(processes_count)]
+    for process in processes:
+        process.start()
+    statuses = [status for _ in processes for status in results.get(timeout=60)]
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    admitted = [call_sid for call_sid, status in statuses if status == ADMITTED]
+    # Calls are never ended, so exactly the capacity is admitted
+    assert len(admitted) == max_calls
+    assert len(set(admitted)) == max_calls
+    assert {status for _, status in statuses} <= {ADMITTED, BUSY, DUPLICATE}
+    store = SqliteCallStore(path)
+    assert store.get_call_count() == max_calls
+    assert sorted(call.call_sid for call in store.get_active_calls()) == sorted(admitted)
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+
+# Runs in a fresh interpreter so modules imported by other tests don't matter
+SCRIPT = """
+import asyncio, sys, threading
+from aiohttp.test_utils import TestClient, TestServer
+import async_app
+
+async def main():
+    async with TestClient(TestServer(async_app.create_app())) as client:
+        for _ in range(2):
+            response = await client.get('/')
+            assert response.status == 200
+            assert '/static/js/dashboard.js' in await response.text()
+        reapers = [t for t in threading.enumerate() if t.name == 'call-reaper']
+        assert len(reapers) == 1, reapers
+    assert 'app' not in sys.modules
+    assert not [t for t in threading.enumerate() if t.name == 'call-reaper']
+
+asyncio.run(main())
+"""
+
+def test_dashboard_and_services_without_flask_app():
+    result = subprocess.run([sys.executable, '-c', SCRIPT], capture_output=True, text=True,
+                            timeout=60)
+    assert result.returncode == 0, result.stderr
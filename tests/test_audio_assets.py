@@ -0,0 +1,99 @@
+import os
+import threading
+
+import audio_assets
+from audio_assets import AudioAssetCache
+
+def test_reload_skips_files_removed_during_scan(tmp_path, monkeypatch):
+    (tmp_path / 'kept.wav').write_bytes(b'kept')
+    (tmp_path / 'removed.wav').write_bytes(b'removed')
+    cache = AudioAssetCache(str(tmp_path), reload_interval=0)
+    assert cache.get('removed.wav') is not None
+
+    real_scandir = os.scandir
+
+    def scandir_then_remove(path):
+        # The file disappears between the directory scan and its stat()
+        entries = list(real_scandir(path))
+        (tmp_path / 'removed.wav').unlink(missing_ok=True)
+        return iter(entries)
+
+    monkeypatch.setattr(audio_assets.os, 'scandir', scandir_then_remove)
+    (tmp_path / 'kept.wav').write_bytes(b'changed')
+    cache.reload()
+
+    assert cache.get('removed.wav') is None
+    assert cache.get('kept.wav').body == b'changed'
+
+BEEP = os.path.join(audio_assets.AUDIO_DIR, audio_assets.BEEP_SOURCE_NAME)
+
+def _beep():
+    with open(BEEP, 'rb') as f:
+        return f.read()
+
+def test_beep_track_is_the_beep_then_silence():
+    beep = _beep()
+    track = audio_assets.build_beep_track(beep, 3)
+    # Tags and the VBR header frame are stripped; only audio frames remain
+    assert track[:3] != b'ID3' and audio_assets._is_valid_mp3(track)
+    beep_seconds = audio_assets.mp3_duration(beep)
+    # Whole frames of silence, so at most one frame (26ms) longer
+    assert 3 <= audio_assets.mp3_duration(track) - beep_seconds < 3.03
+    assert audio_assets.build_beep_track(b'not an mp3', 3) is None
+
+def test_beep_track_is_rebuilt_with_its_source(tmp_path):
+    (tmp_path / 'beep.mp3').write_bytes(_beep())
+    cache = AudioAssetCache(str(tmp_path), reload_interval=3600)
+    sources = []
+    cache.add_derived('cycle.mp3', 'beep.mp3',
+                      lambda beep: sources.append(beep) or audio_assets.build_beep_track(beep, 1))
+    track = cache.get('cycle.mp3')
+    assert track.content_type == 'audio/mpeg'
+    assert 1 < audio_assets.mp3_duration(track.body) < 2
+
+    cache.reload()
+    assert len(sources) == 1
+    (tmp_path / 'beep.mp3').write_bytes(_beep() + b'\0')
+    cache.reload()
+    assert sources[-1] == _beep() + b'\0'
+    assert cache.get('cycle.mp3').body == track.body
+    (tmp_path / 'beep.mp3').unlink()
+    cache.reload()
+    assert cache.get('cycle.mp3') is None
+
+def test_app_serves_the_beep_track():
+    response = audio_assets.audio_assets.respond(audio_assets.BEEP_TRACK_NAME)
+    assert response.status == 200
+    assert response.headers['Content-Type'] == 'audio/mpeg'
+    assert audio_assets.mp3_duration(response.body) > audio_assets.BEEP_SILENCE_SECONDS
+
+def test_requests_never_wait_for_a_reload(tmp_path, monkeypatch):
+    (tmp_path / 'a.wav').write_bytes(b'old')
+    cache = AudioAssetCache(str(tmp_path), reload_interval=0)
+    scanning, release = threading.Event(), threading.Event()
+    scans = []
+    real_scandir = os.scandir
+
+    def slow_scandir(path):
+        scans.append(path)
+        scanning.set()
+        release.wait(5)
+        return real_scandir(path)
+
+    monkeypatch.setattr(audio_assets.os, 'scandir', slow_scandir)
+    (tmp_path / 'a.wav').write_bytes(b'new')
+    threads = [threading.Thread(target=lambda: results.append(cache.get('a.wav').body))
+               for _ in range(20)]
+    results = []
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    # Every request was served from the current files while one reload ran
+    assert results == [b'old'] * 20
+    assert scanning.wait(5)
+    assert len(scans) == 1
+
+    release.set()
+    cache.reload()
+    assert cache.get('a.wav').body == b'new'
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+
+import pytest
+
+import webhooks
+from broadcaster import Broadcaster
+
+def _events(body):
+    return json.loads(body)
+
+def test_subscribers_get_every_frame():
+    broadcaster = Broadcaster()
+    first, second = broadcaster.subscribe(), broadcaster.subscribe()
+    assert broadcaster.subscriber_count() == 2
+    broadcaster.publish('call', {'call_sid': 'CA1'})
+    broadcaster.publish('call', {'call_sid': 'CA2'})
+    expected = [b'id: 1\nevent: call\ndata: {"call_sid":"CA1"}\n\n',
+                b'id: 2\nevent: call\ndata: {"call_sid":"CA2"}\n\n']
+    assert first.get_frames(0) == expected
+    assert second.get_frames(0) == expected
+    # Frames are handed out once
+    assert first.get_frames(0) == []
+
+    first.close()
+    assert broadcaster.subscriber_count() == 1
+    broadcaster.publish('call', {'call_sid': 'CA3'})
+    assert first.get_frames(0) == []
+    assert len(second.get_frames(0)) == 1
+
+def test_slow_subscribers_are_dropped():
+    broadcaster = Broadcaster()
+    slow, fast = broadcaster.subscribe(max_queue=2), broadcaster.subscribe(max_queue=2)
+    notified = []
+    broadcaster.subscribe(notify=lambda: notified.append(1) or 1 / 0)
+    for i in range(3):
+        broadcaster.publish('call', {'i': i})
+        assert len(fast.get_frames(0)) == 1
+    # The third frame didn't fit, so the slow subscriber has to resync
+    assert slow.get_frames(0) is None
+    assert broadcaster.subscriber_count() == 2
+    # A failing waker doesn't stop delivery
+    assert len(notified) == 3
+
+def test_get_frames_waits_for_a_publish():
+    broadcaster = Broadcaster()
+    subscription = broadcaster.subscribe()
+    start = time.monotonic()
+    assert subscription.get_frames(0.05) == []
+    assert time.monotonic() - start >= 0.05
+
+    timer = threading.Timer(0.05, broadcaster.publish, ('call', {}))
+    timer.start()
+    assert len(subscription.get_frames(5)) == 1
+    timer.join()
+
+def test_wait_for_events_returns_events_after_an_id():
+    broadcaster = Broadcaster()
+    for i in range(3):
+        broadcaster.publish('call', {'i': i})
+    assert _events(broadcaster.wait_for_events(1, 0)) == {
+        'last_id': 3, 'resync': False, 'events': [{'i': 1}, {'i': 2}]}
+
+def test_wait_for_events_times_out():
+    broadcaster = Broadcaster()
+    broadcaster.publish('call', {})
+    start = time.monotonic()
+    assert _events(broadcaster.wait_for_events(1, 0.05)) == {
+        'last_id': 1, 'resync': False, 'events': []}
+    assert time.monotonic() - start >= 0.05
+
+    timer = threading.Timer(0.05, broadcaster.publish, ('call', {'i': 2}))
+    timer.start()
+    assert _events(broadcaster.wait_for_events(1, 5))['events'] == [{'i': 2}]
+    timer.join()
+
+@pytest.mark.parametrize('after', [0, 5])
+def test_wait_for_events_resyncs_outside_the_history(after):
+    broadcaster = Broadcaster(history_size=2)
+    for i in range(4):
+        broadcaster.publish('call', {'i': i})
+    # Events 1 and 2 are gone, and event 5 never happened
+    assert _events(broadcaster.wait_for_events(after, 0)) == {
+        'last_id': 4, 'resync': True, 'events': []}
+    assert _events(broadcaster.wait_for_events(2, 0))['resync'] is False
+
+@pytest.mark.parametrize('timeout, expected', [
+    (None, webhooks.LONG_POLL_MAX_SECONDS),
+    (3, 3),
+    (3600, webhooks.LONG_POLL_MAX_SECONDS),
+    (-1, 0),
+    (float('nan'), 0),
+])
+def test_long_poll_timeouts_are_clamped(timeout, expected):
+    assert webhooks.long_poll_window(7, timeout) == (7, expected)
+
+def test_first_long_poll_returns_the_current_id():
+    assert webhooks.long_poll_window(None, 10) == (webhooks.broadcaster.get_last_id(), 0)
@@ -0,0 +1,91 @@
+import pytest
+
+import webhooks
+from call_storage import get_call_store
+from call_store_backends import MemoryCallStore, SqliteCallStore
+
+LOG_SIZE = 5
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    """An empty call store of each backend with a short change log."""
+    if request.param == 'memory':
+        return MemoryCallStore(change_log_size=LOG_SIZE)
+    return SqliteCallStore(str(tmp_path / 'calls.db'), change_log_size=LOG_SIZE)
+
+def _add(store, *call_sids):
+    for call_sid in call_sids:
+        store.add_call(call_sid, '+15550000000', '+15551111111')
+
+def _sids(calls):
+    return [call.call_sid for call in calls]
+
+def test_deltas_catch_up_from_a_version(store):
+    _add(store, 'CA1', 'CA2')
+    since = store.get_version()
+    _add(store, 'CA3', 'CA4')
+    store.update_ivr_selection('CA3', 'music')
+    store.update_ivr_selection('CA1', 'beep')
+    store.end_call('CA2')
+
+    changes = store.get_changes(since)
+    assert changes['full'] is False
+    assert changes['version'] == store.get_version() == since + 5
+    # Added calls in start order, with their latest state
+    assert _sids(changes['added']) == ['CA3', 'CA4']
+    assert changes['added'][0].ivr_selection.label == 'music'
+    assert _sids(changes['updated']) == ['CA1']
+    assert changes['removed'] == ['CA2']
+
+    # Nothing has changed since the current version
+    assert store.get_changes(changes['version']) == {
+        'version': changes['version'], 'full': False, 'added': [], 'updated': [], 'removed': []}
+
+def test_calls_added_and_removed_between_polls_are_not_reported(store):
+    since = store.get_version()
+    _add(store, 'CA1')
+    store.end_call('CA1')
+    changes = store.get_changes(since)
+    assert (changes['added'], changes['updated'], changes['removed']) == ([], [], [])
+
+def test_versions_outside_the_log_get_a_full_snapshot(store):
+    since = store.get_version()
+    _add(store, 'CA1', 'CA2', 'CA3')
+    # Just within the log
+    assert store.get_changes(since)['full'] is False
+    _add(store, 'CA4', 'CA5', 'CA6')
+    version = store.get_version()
+
+    for stale in (since, None, version + 1):
+        changes = store.get_changes(stale)
+        assert changes['full'] is True
+        assert changes['version'] == version
+        # Newest first
+        assert _sids(changes['calls']) == ['CA6', 'CA5', 'CA4', 'CA3', 'CA2', 'CA1']
+
+def test_clearing_requires_a_full_snapshot(store):
+    _add(store, 'CA1')
+    since = store.get_version()
+    store.clear()
+    _add(store, 'CA2')
+    changes = store.get_changes(since)
+    assert changes['full'] is True
+    assert _sids(changes['calls']) == ['CA2']
+
+def test_dashboard_changes_serialize_the_calls():
+    store = get_call_store()
+    store.clear()
+    try:
+        since = store.get_version()
+        _add(store, 'CA1')
+        data = webhooks.dashboard_changes(since)
+        assert data['full'] is False
+        assert [call['call_sid'] for call in data['added']] == ['CA1']
+        assert data['added'][0]['from_number'] == '+15550000000'
+        assert 'timestamp' in data
+
+        data = webhooks.dashboard_changes(None)
+        assert data['full'] is True
+        assert [call['call_sid'] for call in data['calls']] == ['CA1']
+    finally:
+        store.clear()
@@ -0,0 +1,138 @@
+import gzip
+import subprocess
+import sys
+import time
+
+import pytest
+
+import call_export
+from call_export import (CallExporter, aggregate, list_export_files, read_csv, read_jsonl,
+                         COLUMNS)
+from call_store_backends import CallRecord, IvrSelection
+
+def _call(call_sid, start):
+    return CallRecord(call_sid, '+15550000000', '+15551111111', start, IvrSelection.MUSIC)
+
+def _exported(directory):
+    return sorted(row for path in list_export_files(str(directory), 'jsonl')
+                  for row in read_jsonl(path))
+
+def test_default_end_time_uses_the_call_clock(tmp_path, monkeypatch):
+    monkeypatch.setattr(call_export, 'call_clock', lambda: 1_000_100.0)
+    exporter = CallExporter(str(tmp_path), formats=['jsonl'], flush_seconds=60, batch_size=100)
+    exporter.start()
+    try:
+        exporter.record(_call('CA1', 1_000_000.0))
+    finally:
+        exporter.close()
+    assert _exported(tmp_path) == [(1_000_000.0, 1_000_100.0, int(IvrSelection.MUSIC))]
+
+def _export(directory, formats, batches):
+    exporter = CallExporter(str(directory), formats=formats, flush_seconds=60, batch_size=100)
+    exporter.start()
+    try:
+        for batch in batches:
+            for call_sid, start, end in batch:
+                exporter.record(_call(call_sid, start), end)
+            exporter.flush()
+    finally:
+        exporter.close()
+    return exporter
+
+# Noon today: exporters keep appending only to the files of recent days
+NOON = time.time() // 86400 * 86400 + 43200
+BATCHES = [[('CA1', NOON, NOON + 30), ('CA2', NOON + 10, NOON + 70)],
+           [('CA3', NOON + 100, NOON + 101.5)]]
+
+@pytest.mark.parametrize('name', ['jsonl', 'csv', 'parquet'])
+def test_formats_round_trip(tmp_path, name):
+    if name == 'parquet':
+        pytest.importorskip('pyarrow')
+    _export(tmp_path, [name], BATCHES)
+    assert len(list_export_files(str(tmp_path), name)) == (2 if name == 'parquet' else 1)
+    (day,) = aggregate(str(tmp_path), name).values()
+    assert day['calls'] == 3
+    assert day['avg_duration'] == pytest.approx((30 + 60 + 1.5) / 3)
+    assert day['ivr_mix'] == {'none': 0, 'music': 3, 'beep': 0}
+
+def test_csv_has_one_header_and_all_columns(tmp_path):
+    _export(tmp_path, ['csv'], BATCHES)
+    (path,) = list_export_files(str(tmp_path), 'csv')
+    lines = gzip.open(path, 'rt').read().splitlines()
+    assert lines[0] == ','.join(COLUMNS)
+    assert len(lines) == 4
+    assert lines[3].split(',') == ['CA3', '+15550000000', '+15551111111', repr(NOON + 100),
+                                   repr(NOON + 101.5), '1.5', 'music']
+    assert list(read_csv(path))[0] == (NOON, NOON + 30, int(IvrSelection.MUSIC))
+
+def test_parquet_is_readable_by_pyarrow(tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    _export(tmp_path, ['parquet'], BATCHES[:1])
+    (path,) = list_export_files(str(tmp_path), 'parquet')
+    table = parquet.read_table(path)
+    assert table.column_names == list(COLUMNS)
+    assert table.column('call_sid').to_pylist() == ['CA1', 'CA2']
+    assert table.column('duration').to_pylist() == [30.0, 60.0]
+
+def test_parquet_falls_back_to_csv_without_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setattr(call_export, 'parquet_available', lambda: False)
+    exporter = _export(tmp_path, ['jsonl', 'parquet'], BATCHES)
+    assert exporter.formats == ['jsonl', 'csv']
+    assert len(list_export_files(str(tmp_path), 'csv')) == 1
+
+def test_failed_writes_are_not_counted_as_exported(tmp_path, monkeypatch):
+    exporter = CallExporter(str(tmp_path), formats=['jsonl', 'csv'], flush_seconds=60,
+                            batch_size=100)
+    exporter.start()
+    exported = {name: exporter._exported[name].value for name in exporter.formats}
+    failed = {name: exporter._failed[name].value for name in exporter.formats}
+    append = exporter._append
+
+    def append_failing_csv(name, day, data):
+        if name == 'csv':
+            raise OSError("No space left on device")
+        append(name, day, data)
+
+    monkeypatch.setattr(exporter, '_append', append_failing_csv)
+    try:
+        for call_sid, start, end in BATCHES[0]:
+            exporter.record(_call(call_sid, start), end)
+        assert exporter.flush() == 0
+    finally:
+        exporter.close()
+    assert exporter._exported['jsonl'].value == exported['jsonl'] + 2
+    assert exporter._exported['csv'].value == exported['csv']
+    assert exporter._failed['csv'].value == failed['csv'] + 2
+    assert exporter._failed['jsonl'].value == failed['jsonl']
+
+FORK_SCRIPT = """
+import os, sys, time
+from call_export import CallExporter
+from call_store_backends import CallRecord, IvrSelection
+
+exporter = CallExporter(sys.argv[1], formats=['jsonl'], flush_seconds=0.05, batch_size=100)
+exporter.start()
+exporter.record(CallRecord('CAparent1', None, None, 1000.0, IvrSelection.NONE), 1010.0)
+pid = os.fork()
+if pid == 0:
+    written = exporter._exported['jsonl'].value
+    exporter.record(CallRecord('CAchild', None, None, 2000.0, IvrSelection.NONE), 2010.0)
+    # Written by the child's own writer thread, without close()
+    for _ in range(100):
+        if exporter._exported['jsonl'].value > written:
+            break
+        time.sleep(0.05)
+    os._exit(0 if exporter._exported['jsonl'].value > written else 1)
+_, status = os.waitpid(pid, 0)
+exporter.record(CallRecord('CAparent2', None, None, 3000.0, IvrSelection.NONE), 3010.0)
+exporter.close()
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+
+def test_writer_runs_in_forked_child(tmp_path):
+    result = subprocess.run([sys.executable, '-c', FORK_SCRIPT, str(tmp_path)],
+                            capture_output=True, text=True, timeout=30)
+    assert result.returncode == 0, result.stderr
+    # The calls waiting at the fork are written once, by the parent
+    assert [row[0] for row in _exported(tmp_path)] == [1000.0, 2000.0, 3000.0]
+    assert len(list_export_files(str(tmp_path), 'jsonl')) >= 2
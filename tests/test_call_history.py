@@ -0,0 +1,62 @@
+import pytest
+
+import call_history
+from call_history import CallHistory
+from call_store_backends import CallRecord, IvrSelection
+
+NOW = 1_800_000_000.0
+
+def _record(history, count, duration, selection=IvrSelection.NONE):
+    for i in range(count):
+        history.record(CallRecord(f"CA{i}", '+15550000000', '+15551111111',
+                                  NOW - duration, selection), end_time=NOW)
+
+def test_subsecond_percentiles():
+    history = CallHistory(1000)
+    _record(history, 100, 0.006)
+    stats = history.get_stats(NOW - 3600, NOW)
+    assert stats['calls'] == 100
+    assert stats['p95_duration'] <= 0.01
+
+def test_evicts_oldest_calls():
+    history = CallHistory(10)
+    _record(history, 25, 30, IvrSelection.MUSIC)
+    stats = history.get_stats(NOW - 3600, NOW)
+    assert len(history) == 10
+    assert stats['calls'] == 10
+    assert stats['ivr_mix']['music'] == 10
+
+def test_rejects_inverted_window():
+    history = CallHistory(10)
+    with pytest.raises(ValueError):
+        history.get_stats(NOW + 60, NOW)
+
+def test_keeps_interned_numbers_of_retained_calls():
+    history = CallHistory(3)
+    for i in range(5):
+        history.record(CallRecord(f"CA{i}", f"+1555000000{i}", '+15551111111',
+                                  NOW - 10, IvrSelection.BEEP), end_time=NOW + i)
+    calls = history.get_recent_calls()
+    assert [call['from_number'] for call in calls] == ['+15550000004', '+15550000003', '+15550000002']
+    assert {call['to_number'] for call in calls} == {'+15551111111'}
+    assert calls[0]['duration'] == 14
+    assert calls[0]['ivr_selection'] == 'beep'
+    # Numbers of evicted calls are released and their slots reused
+    assert len(history._number_index) == 4
+    assert len(history._numbers) == 4
+    assert history.get_recent_calls(1) == calls[:1]
+
+@pytest.mark.parametrize('start, end', [
+    (float('-inf'), NOW), (NOW, float('inf')), (float('nan'), NOW), (None, float('nan')),
+])
+def test_rejects_non_finite_windows(start, end):
+    with pytest.raises(ValueError):
+        CallHistory(10).get_stats(start, end)
+
+def test_rejects_empty_capacity(monkeypatch):
+    with pytest.raises(ValueError):
+        CallHistory(0)
+    monkeypatch.setenv('CALL_HISTORY_SIZE', '0')
+    assert call_history._capacity_from_env() == call_history.DEFAULT_CAPACITY
+    monkeypatch.setenv('CALL_HISTORY_SIZE', '500')
+    assert call_history._capacity_from_env() == 500
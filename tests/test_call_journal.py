@@ -0,0 +1,46 @@
+
+from call_journal import CallJournal
+from call_store_backends import MemoryCallStore
+
+def _journaled_store(directory, **options):
+    return MemoryCallStore(journal=CallJournal(str(directory), commit_interval=0.001, **options))
+
+def test_recovers_active_calls(tmp_path):
+    store = _journaled_store(tmp_path, snapshot_interval=5)
+    for i in range(20):
+        store.try_admit(f"CA{i}", '+15550000000', '+15551111111')
+    store.update_ivr_selection('CA3', 'music')
+    for i in range(10):
+        store.end_call(f"CA{i * 2}")
+    store._journal.close()
+
+    recovered = _journaled_store(tmp_path)
+    assert sorted(call.call_sid for call in recovered.get_active_calls()) == \
+        sorted(f"CA{i}" for i in range(1, 20, 2))
+    assert recovered.get_call('CA3').ivr_selection.label == 'music'
+    recovered._journal.close()
+
+def test_failed_snapshot_keeps_journaling(tmp_path, monkeypatch):
+    store = _journaled_store(tmp_path, snapshot_interval=5)
+    journal = store._journal
+    write_snapshot = journal._write_snapshot
+
+    def failing_snapshot(seq, calls):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(journal, '_write_snapshot', failing_snapshot)
+    for i in range(12):
+        store.try_admit(f"CA{i}", '+15550000000', '+15551111111')
+        journal._commit()
+    assert not journal._file.closed
+
+    # Later snapshots succeed again
+    monkeypatch.setattr(journal, '_write_snapshot', write_snapshot)
+    for i in range(12, 24):
+        store.try_admit(f"CA{i}", '+15550000000', '+15551111111')
+        journal._commit()
+    journal.close()
+
+    recovered = _journaled_store(tmp_path)
+    assert recovered.get_call_count() == 24
+    recovered._journal.close()
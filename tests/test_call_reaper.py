@@ -0,0 +1,168 @@
+import threading
+
+import pytest
+
+import call_reaper
+import twilio_utils
+from call_reaper import (CallReaper, twilio_call_status, REASON_IDLE, REASON_LIFETIME,
+                         REASON_TWILIO)
+from call_store_backends import CallRecord, IvrSelection, SqliteCallStore
+
+START = 1_000_000.0
+LIFETIME = 3600
+IDLE = 120
+
+class FakeCalls:
+    """Active calls with the get/end callbacks the reaper takes."""
+
+    def __init__(self, *calls):
+        self.active = {call.call_sid: call for call in calls}
+        self.ended = []
+
+    def get(self, call_sid):
+        return self.active.get(call_sid)
+
+    def end(self, call_sid):
+        self.ended.append(call_sid)
+        return self.active.pop(call_sid, None)
+
+class StubTwilioClient:
+    """Answers calls(sid).fetch().status from a dict, like the Twilio SDK."""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.fetched = []
+
+    def calls(self, call_sid):
+        client = self
+
+        class Context:
+            def fetch(self):
+                client.fetched.append(call_sid)
+                return type('CallInstance', (), {'status': client.statuses[call_sid]})()
+
+        return Context()
+
+def _call(call_sid, selection=IvrSelection.NONE):
+    return CallRecord(call_sid, '+15550000000', '+15551111111', START, selection)
+
+def _reaper(calls, **options):
+    return CallReaper(calls.get, calls.end, max_lifetime=LIFETIME, idle_timeout=IDLE,
+                      grace=60, **options)
+
+def test_menu_calls_are_reaped_when_idle():
+    calls = FakeCalls(_call('CA1'))
+    reaper = _reaper(calls)
+    reaper.schedule(calls.get('CA1'), now=START)
+    assert reaper.reap(now=START + IDLE - 1) == 0
+    assert reaper.reap(now=START + IDLE) == 1
+    assert calls.ended == ['CA1']
+
+def test_calls_outside_a_menu_only_expire_at_their_lifetime():
+    calls = FakeCalls(_call('CA1'))
+    reaper = _reaper(calls)
+    reaper.schedule(calls.get('CA1'), now=START)
+    # The caller moved on to a node playing audio, without a selection
+    reaper.schedule(calls.get('CA1'), now=START + 5, in_menu=False)
+    assert reaper.reap(now=START + IDLE + 10) == 0
+    assert reaper.reap(now=START + LIFETIME) == 1
+
+def test_reentering_the_same_selection_replaces_the_deadline():
+    calls = FakeCalls(_call('CA1', IvrSelection.MUSIC))
+    reaper = _reaper(calls)
+    seconds, _ = reaper.plan_seconds(IvrSelection.MUSIC)
+    reaper.schedule(calls.get('CA1'), now=START)
+    # A looping flow enters the music node again later
+    reaper.schedule(calls.get('CA1'), now=START + 100)
+    assert reaper.reap(now=START + seconds + 1) == 0
+    assert calls.ended == []
+    assert reaper.reap(now=START + 100 + seconds) == 1
+
+def test_workers_sharing_a_store_follow_transitions_made_elsewhere(tmp_path):
+    # Two workers, each with its own reaper, sharing one SQLite store
+    path = str(tmp_path / 'calls.db')
+    first, second = SqliteCallStore(path), SqliteCallStore(path)
+    reapers = [CallReaper(store.get_call, store.end_call, max_lifetime=LIFETIME,
+                          idle_timeout=IDLE, grace=60) for store in (first, second)]
+    call = first.add_call('CA1', '+15550000000', '+15551111111')
+    start = call.start_time
+    reapers[0].schedule(call, now=start)
+
+    # The caller picks music through the other worker
+    reapers[1].schedule(second.update_ivr_selection('CA1', 'music'), now=start + 5)
+    seconds, _ = reapers[0].plan_seconds(IvrSelection.MUSIC)
+
+    # The first worker's idle deadline finds the new selection and reschedules
+    assert reapers[0].reap(now=start + IDLE) == 0
+    assert first.get_call('CA1') is not None
+    assert reapers[1].reap(now=start + IDLE) == 0
+    # The music plan is then enforced by whichever worker comes first
+    assert reapers[1].reap(now=start + 5 + seconds) == 1
+    assert first.get_call('CA1') is None
+    assert reapers[0].reap(now=start + IDLE + seconds) == 0
+
+def test_ended_calls_are_forgotten(monkeypatch):
+    monkeypatch.setattr(call_reaper, 'MIN_COMPACT_ENTRIES', 4)
+    calls = FakeCalls(*[_call(f"CA{i}") for i in range(10)])
+    reaper = _reaper(calls)
+    for call in list(calls.active.values()):
+        reaper.schedule(call, now=START)
+    for i in range(8):
+        reaper.forget(f"CA{i}")
+    assert set(reaper._generations) == {'CA8', 'CA9'}
+    # Compacted once most of the heap was stale
+    assert len(reaper._heap) < 10
+    assert reaper.reap(now=START + LIFETIME) == 2
+    assert sorted(calls.ended) == ['CA8', 'CA9']
+    assert reaper._heap == [] and reaper._stale == 0
+
+def test_start_is_idempotent():
+    reaper = _reaper(FakeCalls())
+    reaper.start()
+    reaper.start()
+    try:
+        assert [t.name for t in threading.enumerate()].count('call-reaper') == 1
+    finally:
+        reaper.stop()
+
+@pytest.fixture
+def twilio_client(monkeypatch):
+    client = StubTwilioClient({})
+    monkeypatch.setattr(twilio_utils, 'get_twilio_client', lambda: client)
+    return client
+
+def test_reconcile_keeps_calls_twilio_reports_in_progress(twilio_client):
+    twilio_client.statuses['CA1'] = 'in-progress'
+    calls = FakeCalls(_call('CA1'))
+    reaper = _reaper(calls, status_lookup=twilio_call_status)
+    reaper.schedule(calls.get('CA1'), now=START)
+    reaped_before = reaper._reaped[REASON_TWILIO].value
+
+    assert reaper.reap(now=START + IDLE) == 0
+    assert twilio_client.fetched == ['CA1']
+    # Checked again after the grace period, and ended once Twilio says so
+    twilio_client.statuses['CA1'] = 'completed'
+    assert reaper.reap(now=START + IDLE + 60) == 1
+    assert calls.ended == ['CA1']
+    assert reaper._reaped[REASON_TWILIO].value == reaped_before + 1
+
+def test_reconcile_falls_back_to_the_deadline_on_lookup_errors(twilio_client):
+    calls = FakeCalls(_call('CA1'))
+    reaper = _reaper(calls, status_lookup=twilio_call_status)
+    reaper.schedule(calls.get('CA1'), now=START)
+    # The stub has no status for the call, so the lookup raises
+    assert reaper.reap(now=START + IDLE) == 1
+    assert calls.ended == ['CA1']
+
+def test_ended_calls_are_skipped():
+    calls = FakeCalls(_call('CA1'))
+    reaper = _reaper(calls)
+    reaper.schedule(calls.get('CA1'), now=START)
+    calls.active.clear()
+    assert reaper.reap(now=START + LIFETIME) == 0
+    assert reaper._generations == {}
+
+def test_reasons():
+    assert _reaper(FakeCalls()).plan_seconds(IvrSelection.NONE) == (IDLE, REASON_IDLE)
+    assert _reaper(FakeCalls()).plan_seconds(IvrSelection.NONE, in_menu=False) == \
+        (None, REASON_LIFETIME)
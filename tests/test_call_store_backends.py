@@ -0,0 +1,74 @@
+import pytest
+
+import call_store_backends
+from call_store_backends import (
+    ADMITTED, QUEUED, MemoryCallStore, SqliteCallStore, create_call_store)
+
+def _admit(store, call_sid):
+    return store.try_admit_queued(call_sid, '+15550000000', '+15551111111', max_calls=1,
+                                  max_waiting=5, stale_after=60)
+
+def test_clear_empties_the_waiting_room(store):
+    assert _admit(store, 'CA1').status == ADMITTED
+    assert _admit(store, 'CA2').status == QUEUED
+    assert _admit(store, 'CA3').status == QUEUED
+    assert store.get_waiting_count() == 2
+
+    store.clear()
+    assert store.get_call_count() == 0
+    assert store.get_waiting_count() == 0
+    # New callers are admitted without waiting behind the cleared ones
+    assert _admit(store, 'CA4').status == ADMITTED
+    assert _admit(store, 'CA2').status == QUEUED
+    assert store.get_waiting_count() == 1
+
+def test_call_tenants(store):
+    store.try_admit('CA1', '+15550000000', '+15551111111', tenant='acme')
+    store.try_admit('CA2', '+15550000000', '+15551111111')
+    store.try_admit('CA3', '+15550000000', '+15551111111', tenant='other')
+    store.end_call('CA3')
+    assert store.get_call_tenants() == {'CA1': 'acme'}
+
+def test_snapshots_follow_writes(store):
+    store.add_call('CA1', '+15550000000', '+15551111111')
+    store.add_call('CA2', '+15550000000', '+15551111111')
+    snapshot = store.get_snapshot()
+    assert [call.call_sid for call in snapshot.calls] == ['CA2', 'CA1']
+    assert snapshot.version == store.get_version()
+    assert store.get_snapshot() is snapshot
+
+    store.update_ivr_selection('CA1', 'music')
+    store.end_call('CA2')
+    assert [(call.call_sid, call.ivr_selection.label) for call in store.get_active_calls()] == \
+        [('CA1', 'music')]
+    assert store.get_snapshot().version > snapshot.version
+    assert store.get_call_count() == 1
+
+def test_memory_writes_do_not_copy_the_active_calls(monkeypatch):
+    built = []
+    snapshot_class = call_store_backends.CallSnapshot
+    monkeypatch.setattr(call_store_backends, 'CallSnapshot',
+                        lambda version, calls: built.append(len(calls)) or snapshot_class(version, calls))
+    store = MemoryCallStore()
+    for i in range(100):
+        store.add_call(f"CA{i}", '+15550000000', '+15551111111')
+    assert store.get_call_count() == 100
+    assert built == []
+    # Built once on read, then reused until the next write
+    assert len(store.get_active_calls()) == 100
+    assert len(store.get_snapshot().calls) == 100
+    assert built == [100]
+
+def test_sqlite_store_needs_a_path(tmp_path, monkeypatch):
+    with pytest.raises(ValueError):
+        SqliteCallStore(None)
+    monkeypatch.delenv('CALL_STORE_PATH', raising=False)
+    with pytest.raises(ValueError, match='CALL_STORE_PATH'):
+        create_call_store('sqlite')
+
+    path = str(tmp_path / 'calls.db')
+    monkeypatch.setenv('CALL_STORE_PATH', path)
+    store = create_call_store('sqlite')
+    store.add_call('CA1', '+15550000000', '+15551111111')
+    # Calls are kept in the file, for the reaper to end after a restart
+    assert SqliteCallStore(path).get_call('CA1').call_sid == 'CA1'
@@ -0,0 +1,63 @@
+import pytest
+
+from call_storage import set_call_store
+from call_store_backends import MemoryCallStore
+from call_storm import CallStorm
+
+TO_NUMBERS = ['+15550000001', '+15550000002']
+FROM_NUMBER = '+15550000000'
+
+@pytest.fixture
+def calls():
+    """An empty in-memory call store in place of the app's."""
+    store = MemoryCallStore()
+    previous = set_call_store(store)
+    yield store
+    set_call_store(previous)
+
+def _create_times(fake):
+    return [arrived for method, sid, arrived in fake.requests
+            if method == 'POST' and sid == 'Calls']
+
+def test_calls_are_placed_at_the_target_rate(twilio, calls):
+    fake, client = twilio
+    storm = CallStorm(TO_NUMBERS, FROM_NUMBER, 20, rate=40, client=client,
+                      calls_per_second=1000)
+    summary = storm.run()
+    times = _create_times(fake)
+    assert len(times) == 20
+    # 19 intervals of 25 ms
+    assert 0.45 <= times[-1] - times[0] <= 0.75
+    assert summary['elapsed'] >= storm.offsets[-1]
+    assert 25 <= summary['calls_per_second'] <= 44
+
+def test_api_requests_are_limited_to_the_calls_per_second(twilio, calls):
+    fake, client = twilio
+    storm = CallStorm(TO_NUMBERS, FROM_NUMBER, 10, rate=200, client=client,
+                      calls_per_second=20)
+    summary = storm.run()
+    times = _create_times(fake)
+    assert len(times) == 10
+    assert min(b - a for a, b in zip(times, times[1:])) >= 0.04
+    assert times[-1] - times[0] >= 0.44
+    assert summary['calls_per_second'] <= 22
+
+def test_results_are_accounted_for(twilio, calls):
+    fake, client = twilio
+    # One request is throttled and retried, one fails for good
+    fake.failures = {'Calls': [429, 400]}
+    storm = CallStorm(TO_NUMBERS, FROM_NUMBER, 6, rate=100, client=client,
+                      calls_per_second=1000, retries=2)
+    summary = storm.run()
+    assert summary['calls'] == 6
+    assert summary['placed'] == 5
+    assert summary['failed'] == 1
+    assert len(storm.errors) == 1
+    assert len(storm.latencies) == 5
+    assert 0 < summary['p50_ms'] <= summary['p95_ms']
+    assert fake.attempts('Calls') == 7
+    # Every placed call is tracked in call storage with its flow
+    assert calls.get_call_count() == 5
+    tracked = {call.call_sid: call for call in calls.get_active_calls()}
+    assert set(tracked) == set(storm.placed)
+    assert {call.ivr_selection.label for call in tracked.values()} == {'music'}
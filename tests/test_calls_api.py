@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timezone
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+import pytest
+
+import async_app
+import call_handler
+import call_history
+import call_store_backends
+import webhooks
+from call_history import CallHistory
+from call_storage import get_call_store
+from call_store_backends import CallRecord, CallSnapshot
+
+class FakeClock:
+    def __init__(self):
+        # Near the real time, so the app's reaper leaves the calls alone
+        self.now = float(int(call_store_backends.call_clock()))
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A settable call_clock() for the store, the API and the history."""
+    clock = FakeClock()
+    monkeypatch.setattr(call_store_backends, 'call_clock', clock)
+    monkeypatch.setattr(call_history, 'call_clock', clock)
+    monkeypatch.setattr(call_handler, 'call_history', CallHistory())
+    get_call_store().clear()
+    yield clock
+    get_call_store().clear()
+
+def _start_calls(clock, count):
+    for i in range(count):
+        get_call_store().add_call(f"CA{i}", '+15550000000', '+15551111111')
+        clock.now += 1
+
+def _get(path):
+    async def fetch():
+        async with TestClient(TestServer(async_app.create_app())) as client:
+            response = await client.get(path)
+            return response.status, response.headers, await response.read()
+    status, headers, body = asyncio.run(fetch())
+    assert status == 200
+    return json.loads(body), int(headers['X-Total-Count'])
+
+@pytest.mark.parametrize('offset, limit, expected', [
+    (None, None, (0, None)),
+    (-5, 10, (0, 10)),
+    (20, -1, (20, 0)),
+    (0, 10 ** 6, (0, webhooks.MAX_PAGE_SIZE)),
+])
+def test_page_bounds(offset, limit, expected):
+    assert webhooks.calls_page(offset, limit) == expected
+
+def test_pages_walk_the_calls_newest_first(clock):
+    _start_calls(clock, 7)
+    calls, total = _get('/api/calls')
+    assert total == 7
+    assert [call['call_sid'] for call in calls] == [f"CA{i}" for i in reversed(range(7))]
+
+    # The offset of the next page is the offset of this one plus its size
+    seen, offset = [], 0
+    while True:
+        page, total = _get(f"/api/calls?offset={offset}&limit=3")
+        assert total == 7 and len(page) <= 3
+        if not page:
+            break
+        seen.extend(page)
+        offset += len(page)
+    assert seen == calls
+
+    # Out of range and invalid parameters
+    assert _get('/api/calls?offset=100&limit=3') == ([], 7)
+    assert _get('/api/calls?offset=-3&limit=2')[0] == calls[:2]
+    assert _get('/api/calls?offset=x&limit=y')[0] == calls
+
+def test_active_calls_report_their_duration(clock):
+    _start_calls(clock, 3)
+    clock.now += 10.5
+    calls, _ = _get('/api/calls')
+    # One clock read for the whole response; durations are whole seconds
+    assert [call['duration'] for call in calls] == [11, 12, 13]
+    start = datetime.fromtimestamp(clock.now - 11.5, timezone.utc).replace(tzinfo=None)
+    assert calls[0]['start_time'] == start.isoformat()
+
+    # Clocks of other workers may be slightly behind a call's start
+    record = CallRecord('CA1', '+15550000000', '+15551111111', clock.now)
+    assert record.to_dict(clock.now - 2)['duration'] == 0
+    snapshot = CallSnapshot(1, (record,))
+    assert json.loads(snapshot.to_json(now=clock.now + 59.9))[0]['duration'] == 59
+
+def test_ended_calls_keep_their_duration(clock):
+    _start_calls(clock, 2)
+    clock.now += 30
+    call = call_handler.handle_call_end('CA0')
+    assert call.duration(clock.now) == 32
+
+    calls, total = _get('/api/calls')
+    assert total == 1
+    assert [call['call_sid'] for call in calls] == ['CA1']
+    stats = call_handler.call_history.get_stats(end=clock.now)
+    assert stats['calls'] == 1
+    assert stats['avg_duration'] == 32
+
+@pytest.mark.parametrize('query', ['start=-inf', 'end=inf', 'start=nan&end=1', 'start=2&end=1'])
+def test_invalid_history_windows_are_bad_requests(query):
+    async def fetch():
+        async with TestClient(TestServer(async_app.create_app())) as client:
+            response = await client.get(f"/api/history/stats?{query}")
+            return response.status, await response.json()
+    status, body = asyncio.run(fetch())
+    assert status == 400
+    assert 'error' in body
@@ -0,0 +1,221 @@
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from cluster import ClusterNode, CoordinatorClient, shard_owner
+
+SECRET = 'test-secret'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALL_SIDS = [f"CA{i:032d}" for i in range(300)]
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met in time")
+        time.sleep(0.02)
+
+def _start_coordinator(port):
+    """Start a coordinator process requiring SECRET and wait until it listens."""
+    process = subprocess.Popen([sys.executable, 'coordinator.py', '--port', str(port)],
+                               cwd=ROOT, env=dict(os.environ, CLUSTER_SECRET=SECRET),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def listening():
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return True
+        except OSError:
+            return False
+
+    try:
+        _wait_until(listening)
+    except TimeoutError:
+        process.kill()
+        raise
+    return process
+
+@pytest.fixture
+def coordinator():
+    """URL of a coordinator process requiring SECRET."""
+    port = _free_port()
+    process = _start_coordinator(port)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.wait()
+
+def _node(coordinator_url, node_id):
+    return ClusterNode(lambda: {'calls': 0}, dict,
+                       coordinator=CoordinatorClient(coordinator_url, secret=SECRET),
+                       node_id=node_id, url=f"http://{node_id}", heartbeat_seconds=0.1)
+
+def _owners(node):
+    return {call_sid: node.owner_url(call_sid) or node.url for call_sid in CALL_SIDS}
+
+def _shard_worker(coordinator_url, node_id, nodes, leaver, owners, leave, done):
+    node = _node(coordinator_url, node_id)
+    node.start()
+    _wait_until(lambda: len(node._members) == nodes)
+    owners.put((node_id, _owners(node)))
+    leave.wait()
+    if node_id == leaver:
+        node.stop()
+        return
+    _wait_until(lambda: len(node._members) == nodes - 1)
+    owners.put((node_id, _owners(node)))
+    done.wait()
+    node.stop()
+
+def _lease_worker(coordinator_url, node_id, limit, attempts, held, peak, lock, barrier):
+    node = _node(coordinator_url, node_id)
+    barrier.wait()
+    for i in range(attempts):
+        call_sid = f"CA{node_id}{i}"
+        if not node.acquire(call_sid, limit):
+            continue
+        with lock:
+            held.value += 1
+            peak.value = max(peak.value, held.value)
+        time.sleep(0.002)
+        with lock:
+            held.value -= 1
+        node.release(call_sid)
+
+def _holding_worker(coordinator_url, node_id, calls, acquired):
+    node = _node(coordinator_url, node_id)
+    node.start()
+    for i in range(calls):
+        node.acquire(f"CA{node_id}{i}")
+    acquired.set()
+    # Killed by the test while holding its leases
+    time.sleep(60)
+
+def _lease_count(client):
+    return client.heartbeat('observer', 'observer', None)['leases']
+
+def test_requests_need_the_cluster_secret(coordinator, monkeypatch):
+    monkeypatch.delenv('CLUSTER_SECRET', raising=False)
+    for secret in (None, 'wrong'):
+        with pytest.raises(RuntimeError, match='HTTP 401'):
+            CoordinatorClient(coordinator, secret=secret).release('CA1')
+    assert CoordinatorClient(coordinator, secret=SECRET).release('CA1') == {'released': False}
+
+    monkeypatch.setenv('CLUSTER_SECRET', SECRET)
+    assert CoordinatorClient(coordinator).release('CA1') == {'released': False}
+
+def test_nodes_agree_on_shard_owners(coordinator):
+    context = multiprocessing.get_context('spawn')
+    owners = context.Queue()
+    leave, done = context.Event(), context.Event()
+    node_ids = ['node0', 'node1', 'node2']
+    processes = [context.Process(target=_shard_worker,
+                                 args=(coordinator, node_id, 3, 'node2', owners, leave, done))
+                 for node_id in node_ids]
+    for process in processes:
+        process.start()
+    try:
+        before = dict(owners.get(timeout=15) for _ in node_ids)
+        leave.set()
+        after = dict(owners.get(timeout=15) for _ in node_ids[:2])
+    finally:
+        done.set()
+        for process in processes:
+            process.join(10)
+
+    # Every node routes every call to the same owner, the rendezvous choice
+    members = [(node_id, f"http://{node_id}") for node_id in node_ids]
+    expected = {call_sid: shard_owner(members, call_sid)[1] for call_sid in CALL_SIDS}
+    assert all(mapping == expected for mapping in before.values())
+    assert set(expected.values()) == {url for _, url in members}
+
+    # When a node leaves only its calls move
+    assert after['node0'] == after['node1']
+    for call_sid, url in expected.items():
+        if url != 'http://node2':
+            assert after['node0'][call_sid] == url
+        else:
+            assert after['node0'][call_sid] in ('http://node0', 'http://node1')
+
+def test_lease_acquire_and_release(coordinator):
+    client = CoordinatorClient(coordinator, secret=SECRET)
+    assert client.acquire('node0', 'a', 'CA1', limit=1)['granted']
+    # A call that has its lease keeps it, even at the limit
+    assert client.acquire('node1', 'b', 'CA1', limit=1)['granted']
+    assert not client.acquire('node1', 'b', 'CA2', limit=1)['granted']
+    assert client.release('CA1') == {'released': True}
+    assert client.release('CA1') == {'released': False}
+    assert client.acquire('node1', 'b', 'CA2', limit=1)['granted']
+    assert client.release('CA2') == {'released': True}
+    assert _lease_count(client) == 0
+
+def test_processes_never_exceed_the_cluster_limit(coordinator):
+    context = multiprocessing.get_context('spawn')
+    held, peak = context.Value('i', 0), context.Value('i', 0)
+    lock = context.Lock()
+    workers = 4
+    barrier = context.Barrier(workers)
+    processes = [context.Process(target=_lease_worker,
+                                 args=(coordinator, f"node{i}", 3, 100, held, peak, lock, barrier))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    assert [process.exitcode for process in processes] == [0] * workers
+    assert 0 < peak.value <= 3
+    assert _lease_count(CoordinatorClient(coordinator, secret=SECRET)) == 0
+
+def test_leases_of_a_dead_node_are_freed(coordinator):
+    context = multiprocessing.get_context('spawn')
+    acquired = context.Event()
+    process = context.Process(target=_holding_worker, args=(coordinator, 'node0', 3, acquired))
+    process.start()
+    try:
+        assert acquired.wait(15)
+        client = CoordinatorClient(coordinator, secret=SECRET)
+        assert _lease_count(client) == 3
+    finally:
+        process.kill()
+        process.join()
+    # Freed once the node misses its heartbeats (3 x 0.1s)
+    _wait_until(lambda: _lease_count(client) == 0)
+
+def test_tenant_limits_hold_after_the_coordinator_restarts():
+    port = _free_port()
+    process = _start_coordinator(port)
+    url = f"http://127.0.0.1:{port}"
+    calls = {}
+    node = ClusterNode(lambda: {'calls': len(calls)}, lambda: dict(calls),
+                       coordinator=CoordinatorClient(url, secret=SECRET),
+                       node_id='node0', url='http://node0', heartbeat_seconds=0.1)
+    try:
+        for call_sid in ('CA1', 'CA2'):
+            assert node.acquire(call_sid, 10, 'acme', 2)
+            calls[call_sid] = 'acme'
+        calls['CA3'] = None
+        assert node.acquire('CA3', 10)
+        assert not node.acquire('CA4', 10, 'acme', 2)
+
+        process.terminate()
+        process.wait()
+        process = _start_coordinator(port)
+        # The restarted coordinator doesn't know the node, which restores its leases
+        node.heartbeat()
+        assert node.get_lease_count() == 3
+        assert not node.acquire('CA4', 10, 'acme', 2)
+        assert node.acquire('CA5', 10, 'other', 2)
+    finally:
+        process.terminate()
+        process.wait()
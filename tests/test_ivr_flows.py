@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+
+import pytest
+
+from ivr_flows import CompiledFlow, FlowError, FlowRegistry, load_flow, DEFAULT_FLOW_FILE
+
+MENU = {
+    'start': 'menu',
+    'nodes': {
+        'menu': {
+            'steps': [{'say': "Welcome."},
+                      {'gather': {'say': "Press 1 for music.", 'num_digits': 1, 'timeout': 7}},
+                      {'redirect': 'menu'}],
+            'digits': {'1': 'music'},
+            'otherwise': 'menu'
+        },
+        'music': {'selection': 'music', 'steps': [{'play': 'music.mp3', 'loop': 3}]}
+    }
+}
+
+def _write(path, definition):
+    path.write_text(json.dumps(definition))
+    return str(path)
+
+def _with_node(**node):
+    return {'nodes': {'menu': node, 'music': {}}}
+
+def test_default_flow_loads():
+    flow = load_flow(DEFAULT_FLOW_FILE)
+    assert flow.start == 'welcome'
+    assert {'welcome', 'music', 'beep'} <= set(flow.nodes)
+    assert flow.nodes['welcome'].menu
+    assert flow.nodes['music'].selection == 'music'
+
+def test_transitions():
+    flow = CompiledFlow(MENU)
+    assert flow.next_node('menu', '1') == 'music'
+    assert flow.next_node('menu', '9') == 'menu'
+    assert flow.next_node('music', None) == 'music'
+    # Nodes removed by a reload continue from the start
+    assert flow.next_node('gone', None) == 'menu'
+
+@pytest.mark.parametrize('definition', [
+    [],
+    {'nodes': {}},
+    {'start': 'nowhere', 'nodes': {'menu': {}}},
+    {'start': ['menu'], 'nodes': {'menu': {}}},
+    {'nodes': {'menu': []}},
+    _with_node(steps={'say': "Hi"}),
+    _with_node(steps=5),
+    _with_node(steps=[{'say': "Hi", 'play': 'music.mp3'}]),
+    _with_node(steps=[{'dance': True}]),
+    _with_node(steps=[{'pause': -1}]),
+    _with_node(steps=[{'play': 'music.mp3', 'loop': 'forever'}]),
+    _with_node(steps=[{'gather': "Press 1"}]),
+    _with_node(steps=[{'redirect': 'nowhere'}]),
+    _with_node(digits=['music']),
+    _with_node(digits="1"),
+    _with_node(digits={'1': 'nowhere'}),
+    _with_node(digits={'1': ['music']}),
+    _with_node(otherwise='nowhere'),
+    _with_node(otherwise={'node': 'music'}),
+    _with_node(selection='jazz'),
+    _with_node(selection=1),
+])
+def test_invalid_flows_raise_flow_error(definition):
+    with pytest.raises(FlowError):
+        CompiledFlow(definition)
+
+def test_invalid_files_raise_flow_error(tmp_path):
+    path = tmp_path / 'flow.json'
+    path.write_text('{"nodes": ')
+    with pytest.raises(FlowError, match='Invalid JSON'):
+        load_flow(str(path))
+    with pytest.raises(FlowError):
+        load_flow(_write(path, _with_node(digits=5)))
+
+def test_rendered_twiml(monkeypatch):
+    monkeypatch.setenv('BASE_URL', 'https://ivr.example.com')
+    flow = CompiledFlow(MENU)
+    menu = flow.twiml('menu').body.decode('utf-8')
+    assert '<Say>Welcome.</Say>' in menu
+    assert ('<Gather action="/handle_ivr?node=menu" method="POST" numDigits="1" timeout="7">'
+            '<Say>Press 1 for music.</Say></Gather>') in menu
+    assert '<Redirect>/handle_ivr?node=menu</Redirect>' in menu
+    music = flow.twiml('music')
+    assert music.body == (b'<?xml version="1.0" encoding="UTF-8"?><Response>'
+                          b'<Play loop="3">https://ivr.example.com/static/audio/music.mp3</Play>'
+                          b'</Response>')
+    assert music.content_length == str(len(music.body))
+    # Rendered once per configuration
+    assert flow.twiml('music') is music
+    monkeypatch.setenv('BASE_URL', 'https://other.example.com')
+    assert b'https://other.example.com/static/audio/music.mp3' in flow.twiml('music').body
+
+def test_registry_reloads_changed_files_and_keeps_the_last_good_flow(tmp_path, caplog):
+    path = _write(tmp_path / 'flow.json', MENU)
+    registry = FlowRegistry(path, reload_interval=0)
+    first = registry.get()
+    assert registry.get() is first
+
+    changed = json.loads(json.dumps(MENU))
+    changed['nodes']['menu']['digits']['2'] = 'music'
+    _write(tmp_path / 'flow.json', changed)
+    os.utime(path, (1, 1))
+    second = registry.get()
+    assert second is not first
+    assert second.next_node('menu', '2') == 'music'
+
+    with caplog.at_level(logging.ERROR, logger='ivr_flows'):
+        _write(tmp_path / 'flow.json', _with_node(digits=['music']))
+        assert registry.get() is second
+    assert 'Error loading IVR flow' in caplog.text
+
+def test_registry_without_a_valid_flow_raises(tmp_path):
+    registry = FlowRegistry(str(tmp_path / 'missing.json'), reload_interval=0)
+    with pytest.raises(FlowError):
+        registry.get()
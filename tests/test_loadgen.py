@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from loadgen import ROUTES, compare_to_baseline, percentile, run_load
+
+@pytest.mark.parametrize('fraction, expected', [
+    (0.0, 1), (0.5, 51), (0.95, 96), (0.99, 100), (1.0, 100),
+])
+def test_percentile(fraction, expected):
+    assert percentile(list(range(1, 101)), fraction) == expected
+
+def test_percentile_of_few_values():
+    assert percentile([], 0.5) == 0.0
+    assert percentile([7], 0.99) == 7
+    assert percentile([1, 2], 0.5) == 2
+
+def _report(requests_per_second=100.0, **routes):
+    stats = {'requests': 10, 'errors': 0, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 4.0}
+    return {'requests_per_second': requests_per_second,
+            'routes': {route: dict(stats, **routes.get(route.strip('/'), {})) for route in ROUTES}}
+
+def test_no_regressions_within_the_tolerance():
+    baseline = _report()
+    assert compare_to_baseline(baseline, baseline, 0.2) == []
+    report = _report(81.0, incoming_call={'p95_ms': 2.39}, call_status={'p50_ms': 0.5})
+    assert compare_to_baseline(report, baseline, 0.2) == []
+
+def test_regressions_are_reported():
+    report = _report(79.0, incoming_call={'p95_ms': 2.5}, handle_ivr={'p99_ms': 5.0})
+    assert compare_to_baseline(report, _report(), 0.2) == [
+        "throughput 79.0 req/s < baseline 100.0 req/s",
+        "/incoming_call p95_ms 2.50 > baseline 2.00",
+        "/handle_ivr p99_ms 5.00 > baseline 4.00",
+    ]
+
+def test_routes_missing_from_the_baseline_are_skipped():
+    baseline = _report()
+    del baseline['routes']['/handle_ivr']
+    report = _report(handle_ivr={'p50_ms': 100.0})
+    assert compare_to_baseline(report, baseline, 0.2) == []
+
+class _Target:
+    """Answers every webhook with a TwiML document, the first one busy."""
+
+    def __init__(self, busy=1):
+        self.busy = busy
+        self.posts = []
+
+    def post(self, route, fields):
+        self.posts.append(route)
+        if route == '/incoming_call' and self.busy:
+            self.busy -= 1
+            return 200, b'<Response><Say>Busy</Say><Hangup/></Response>'
+        return 200, b'<Response/>'
+
+def test_reports_compare_with_a_saved_baseline(tmp_path):
+    # The first, unrecorded warm-up call takes the busy answer
+    report = run_load(_Target(), calls=20, concurrency=4, rate=0, call_duration=0)
+    assert report['outcomes'] == {'admitted': 20, 'busy': 0, 'failed': 0}
+    assert report['requests'] == 60
+    assert {route: stats['requests'] for route, stats in report['routes'].items()} == \
+        {route: 20 for route in ROUTES}
+
+    path = tmp_path / 'baseline.json'
+    path.write_text(json.dumps(report))
+    assert compare_to_baseline(report, json.loads(path.read_text()), 0.0) == []
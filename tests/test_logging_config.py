@@ -0,0 +1,59 @@
+import io
+import logging
+import queue
+import subprocess
+import sys
+
+from logging_config import BatchingLogWriter, QueueLogHandler
+
+def test_message_is_merged_before_queueing():
+    log_queue = queue.Queue()
+    stream = io.StringIO()
+    logger = logging.getLogger('test_logging_config.merge')
+    logger.propagate = False
+    logger.addHandler(QueueLogHandler(log_queue))
+
+    calls = ['CA1']
+    logger.warning("active: %s", calls)
+    calls.append('CA2')
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError:
+        logger.exception("failed")
+
+    writer = BatchingLogWriter(log_queue, stream, logging.Formatter('%(message)s'))
+    writer.start()
+    writer.stop()
+    lines = stream.getvalue().splitlines()
+    assert lines[0] == "active: ['CA1']"
+    assert lines[1] == "failed"
+    assert 'RuntimeError: boom' in stream.getvalue()
+
+FORK_SCRIPT = """
+import logging, os, sys
+from logging_config import configure_logging
+
+path = sys.argv[1]
+configure_logging(level='INFO', stream=open(path, 'a'))
+log = logging.getLogger('forked')
+log.info('parent before fork')
+pid = os.fork()
+if pid == 0:
+    log.info('child %d', os.getpid())
+    logging.shutdown()
+    import logging_config
+    logging_config._writer.stop()
+    os._exit(0)
+os.waitpid(pid, 0)
+log.info('parent after fork')
+"""
+
+def test_writer_runs_in_forked_child(tmp_path):
+    path = tmp_path / 'log.txt'
+    result = subprocess.run([sys.executable, '-c', FORK_SCRIPT, str(path)],
+                            capture_output=True, text=True, timeout=30)
+    assert result.returncode == 0, result.stderr
+    text = path.read_text()
+    assert 'parent before fork' in text
+    assert 'INFO:forked:child ' in text
+    assert 'parent after fork' in text
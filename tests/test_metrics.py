@@ -0,0 +1,88 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+import pytest
+
+import async_app
+import metrics
+from metrics import Counter, Gauge, Histogram
+
+@pytest.fixture
+def registry(monkeypatch):
+    """An empty metrics registry, so test metrics aren't exported by the app."""
+    monkeypatch.setattr(metrics, '_registry', [])
+
+def test_counter_exposition(registry):
+    requests = Counter('requests_total', "Requests handled.", ['route', 'status'])
+    requests.labels('/a', 200).inc()
+    requests.labels('/a', '200').inc(2)
+    requests.labels('/b', 500).inc()
+    assert metrics.render() == (
+        b'# HELP requests_total Requests handled.\n'
+        b'# TYPE requests_total counter\n'
+        b'requests_total{route="/a",status="200"} 3\n'
+        b'requests_total{route="/b",status="500"} 1\n')
+
+def test_gauge_exposition(registry):
+    calls = Gauge('calls', "Active calls.")
+    calls.labels().inc(3)
+    calls.labels().dec()
+    level = Gauge('level', "A level.", ['source'])
+    level.labels('set').set(0.5)
+    level.labels('function').set_function(lambda: 7)
+    assert metrics.render().decode().splitlines() == [
+        '# HELP calls Active calls.', '# TYPE calls gauge', 'calls 2',
+        '# HELP level A level.', '# TYPE level gauge',
+        'level{source="set"} 0.5', 'level{source="function"} 7']
+
+def test_histogram_exposition(registry):
+    latency = Histogram('latency_seconds', "Latency.", ['route'], buckets=(1, 0.1))
+    child = latency.labels('/a')
+    for value in (0.05, 0.1, 0.5, 2):
+        child.observe(value)
+    # Buckets are sorted, cumulative, and include the +Inf bucket
+    assert metrics.render().decode().splitlines() == [
+        '# HELP latency_seconds Latency.', '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a",le="1"} 3',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a"} 2.65',
+        'latency_seconds_count{route="/a"} 4']
+
+def test_labels_must_match_the_label_names(registry):
+    requests = Counter('requests_total', "Requests handled.", ['route'])
+    with pytest.raises(ValueError):
+        requests.labels()
+    with pytest.raises(ValueError):
+        requests.labels('/a', 200)
+    assert requests.labels('/a') is requests.labels('/a')
+
+def test_timed_lock_records_outermost_acquisitions(registry):
+    wait = Histogram('wait_seconds', "Wait.").labels()
+    hold = Histogram('hold_seconds', "Hold.").labels()
+    lock = metrics.TimedLock(wait, hold)
+    with lock:
+        with lock:
+            pass
+    assert sum(wait.counts) == sum(hold.counts) == 1
+
+def test_metrics_endpoint():
+    async def fetch():
+        async with TestClient(TestServer(async_app.create_app())) as client:
+            await client.get('/api/call_count')
+            response = await client.get('/metrics')
+            return response.status, response.headers['Content-Type'], await response.text()
+
+    status, content_type, text = asyncio.run(fetch())
+    assert status == 200
+    assert content_type == metrics.CONTENT_TYPE
+    lines = text.splitlines()
+    assert '# TYPE http_request_duration_seconds histogram' in lines
+    assert '# TYPE active_calls gauge' in lines
+    count = next(line for line in lines
+                 if line.startswith('http_request_duration_seconds_count{route="/api/call_count"}'))
+    assert int(count.split()[1]) >= 1
+    # Every sample line is `name{labels} value`
+    for line in lines:
+        if not line.startswith('#'):
+            float(line.rsplit(' ', 1)[1].replace('+Inf', 'inf'))
@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+
+from tenants import DEFAULT_ROUTE, Route, TenantConfigError, TenantRouter, build_index, normalize_number
+
+FLOW = {'start': 'hello', 'nodes': {'hello': {'steps': [{'say': "Hello."}, {'hangup': True}]}}}
+
+@pytest.mark.parametrize('number, expected', [
+    ('+15551230000', '+15551230000'),
+    ('+1 (555) 123-0000', '+15551230000'),
+    ('(555) 123-0000', '+15551230000'),
+    ('15551230000', '+15551230000'),
+    ('0044 20 7946 0000', '+442079460000'),
+    ('+44 20 7946 0000', '+442079460000'),
+    ('client:alice', None),
+    ('sip:alice@example.com', None),
+    ('+1234', None),
+    ('', None),
+    (None, None),
+])
+def test_normalize_number(number, expected):
+    assert normalize_number(number) == expected
+
+def test_national_numbers_take_the_country_code():
+    assert normalize_number('020 7946 0000', '44') == '+442079460000'
+
+@pytest.fixture
+def flow_file(tmp_path):
+    (tmp_path / 'acme.json').write_text(json.dumps(FLOW))
+    return 'acme.json'
+
+def test_numbers_of_a_tenant_share_its_route(tmp_path, flow_file):
+    index, routes, country_code = build_index({'tenants': {'acme': {
+        'numbers': ['+1 (555) 123-0000', 15551230001], 'flow': flow_file, 'max_calls': 2}}},
+        str(tmp_path))
+    route = Route('acme', os.path.join(str(tmp_path), flow_file), 2)
+    assert index == {'+15551230000': route, '+15551230001': route}
+    assert routes == {'acme': route}
+    assert country_code == '1'
+
+@pytest.mark.parametrize('tenant, message', [
+    ({'numbers': '+15551230000'}, 'numbers must be a list'),
+    ({'numbers': [True]}, 'invalid number'),
+    ({'numbers': ['client:alice']}, 'invalid number'),
+    ({'max_calls': -1}, 'max_calls'),
+    ({'flow': 'missing.json'}, 'missing.json'),
+    ({'flow': 'broken.json'}, 'broken.json'),
+])
+def test_invalid_tenants_are_rejected(tmp_path, tenant, message):
+    (tmp_path / 'broken.json').write_text(json.dumps({'start': 'nowhere', 'nodes': {}}))
+    with pytest.raises(TenantConfigError, match=message):
+        build_index({'tenants': {'acme': tenant}}, str(tmp_path))
+
+def test_a_number_belongs_to_one_tenant():
+    with pytest.raises(TenantConfigError, match='belongs to both'):
+        build_index({'tenants': {'acme': {'numbers': ['+15551230000']},
+                                 'other': {'numbers': ['(555) 123-0000']}}})
+
+def test_lookup_routes_dialed_numbers(tmp_path, flow_file):
+    path = tmp_path / 'tenants.json'
+    path.write_text(json.dumps({'tenants': {'acme': {'numbers': ['+15551230000'],
+                                                     'flow': flow_file}}}))
+    router = TenantRouter(str(path), reload_interval=0)
+    assert router.lookup('(555) 123-0000').tenant == 'acme'
+    assert router.lookup('+15559999999') == DEFAULT_ROUTE
+    assert router.lookup('client:alice') == DEFAULT_ROUTE
+
+    # An invalid file keeps the previous index
+    path.write_text(json.dumps({'tenants': {'acme': {'numbers': '+15551230000'}}}))
+    assert router.lookup('+15551230000').tenant == 'acme'
+
+    path.write_text(json.dumps({'tenants': {'other': {'numbers': ['+15551230000', '+15551230001']}}}))
+    assert router.lookup('+15551230001').tenant == 'other'
+    assert router.lookup('+15551230000').tenant == 'other'
+
+def test_lookup_without_a_tenants_file(monkeypatch):
+    monkeypatch.delenv('TENANTS_FILE', raising=False)
+    assert TenantRouter(reload_interval=0).lookup('+15551230000') == DEFAULT_ROUTE
@@ -0,0 +1,39 @@
+from twilio.base.exceptions import TwilioRestException
+
+from twilio_batch import fetch_call_statuses, hangup_calls
+
+def _sids(count):
+    return [f"CA{i:032d}" for i in range(count)]
+
+def test_batches_run_concurrently_up_to_the_limit(twilio):
+    fake, client = twilio
+    call_sids = _sids(20)
+    # Duplicates are requested once
+    batch = fetch_call_statuses(call_sids + call_sids[:5], client=client, concurrency=4)
+    assert batch.results == {sid: 'in-progress' for sid in call_sids}
+    assert batch.errors == {}
+    assert sorted(sid for _, sid, _ in fake.requests) == sorted(call_sids)
+    assert 1 < fake.peak <= 4
+
+def test_rate_limits_and_server_errors_are_retried(twilio):
+    fake, client = twilio
+    call_sids = _sids(3)
+    fake.failures = {call_sids[0]: [429, 429], call_sids[1]: [503]}
+    batch = hangup_calls(call_sids, client=client, retries=3, backoff=0.01)
+    assert batch.results == {sid: 'completed' for sid in call_sids}
+    assert batch.errors == {}
+    assert [fake.attempts(sid) for sid in call_sids] == [3, 2, 1]
+    assert {method for method, _, _ in fake.requests} == {'POST'}
+
+def test_partial_failures_are_reported_per_call(twilio):
+    fake, client = twilio
+    call_sids = _sids(4)
+    # Not retryable, retries exhausted, and recovered after one retry
+    fake.failures = {call_sids[0]: [404], call_sids[1]: [500, 500, 500], call_sids[2]: [429]}
+    batch = fetch_call_statuses(call_sids, client=client, retries=2, backoff=0.01)
+    assert batch.results == {call_sids[2]: 'in-progress', call_sids[3]: 'in-progress'}
+    assert set(batch.errors) == {call_sids[0], call_sids[1]}
+    assert all(isinstance(e, TwilioRestException) for e in batch.errors.values())
+    assert batch.errors[call_sids[0]].status == 404
+    assert batch.errors[call_sids[1]].status == 500
+    assert [fake.attempts(sid) for sid in call_sids] == [1, 3, 2, 1]
@@ -0,0 +1,97 @@
+from urllib.parse import urlencode
+
+import pytest
+from twilio.request_validator import RequestValidator
+
+import webhooks
+from twilio_signature import SignatureValidator, get_signature_validator, parse_form
+
+TOKEN = 'test-auth-token'
+URL = 'https://example.com/incoming_call?node=menu'
+FIELDS = {'CallSid': 'CA1', 'From': '+15550000000', 'To': '+15551111111', 'Digits': '1 2'}
+BODY = urlencode(FIELDS).encode()
+
+def _signature(url=URL, fields=FIELDS):
+    return RequestValidator(TOKEN).compute_signature(url, fields)
+
+def test_signatures_match_twilio():
+    validator = SignatureValidator(TOKEN)
+    assert validator.compute(URL, FIELDS.items()) == _signature()
+    assert validator.validate(URL, BODY, _signature())
+
+def test_tampered_requests_are_rejected():
+    validator = SignatureValidator(TOKEN)
+    tampered = urlencode(dict(FIELDS, To='+15552222222')).encode()
+    assert not validator.validate(URL, tampered, _signature())
+    assert not validator.validate('https://example.com/incoming_call', BODY, _signature())
+    assert not validator.validate(URL, BODY, SignatureValidator('other-token').compute(URL, FIELDS.items()))
+    assert not validator.validate(URL, BODY, None)
+
+def _counting(validator, monkeypatch):
+    """Record the URL of every signature the validator computes."""
+    computed = []
+    compute = validator.compute
+    monkeypatch.setattr(validator, 'compute', lambda url, pairs: computed.append(url) or compute(url, pairs))
+    return computed
+
+def test_verified_requests_are_cached(monkeypatch):
+    validator = SignatureValidator(TOKEN, cache_size=2)
+    computed = _counting(validator, monkeypatch)
+
+    # A retry of a verified request is a cache hit
+    assert validator.validate(URL, BODY, _signature())
+    assert validator.validate(URL, BODY, _signature())
+    assert len(computed) == 1
+
+    # A forged body with a known signature misses the cache and fails
+    assert not validator.validate(URL, BODY + b'&x=1', _signature())
+    assert len(computed) == 2
+
+    # The oldest entries are dropped beyond the size limit
+    for node in ('a', 'b'):
+        url = f"https://example.com/handle_ivr?node={node}"
+        assert validator.validate(url, BODY, _signature(url))
+    assert len(validator._verified) == 2
+    assert validator.validate(URL, BODY, _signature())
+    assert len(computed) == 5
+
+def test_cached_requests_expire(monkeypatch):
+    validator = SignatureValidator(TOKEN, cache_seconds=0)
+    computed = _counting(validator, monkeypatch)
+    assert validator.validate(URL, BODY, _signature())
+    assert validator.validate(URL, BODY, _signature())
+    assert len(computed) == 2
+
+def test_validator_follows_the_auth_token(monkeypatch):
+    for name in ('TWILIO_AUTH_TOKEN', 'TWILIO_TOKEN', 'TWILIO_AUTH'):
+        monkeypatch.delenv(name, raising=False)
+    assert get_signature_validator() is None
+    monkeypatch.setenv('TWILIO_AUTH_TOKEN', TOKEN)
+    validator = get_signature_validator()
+    assert validator.validate(URL, BODY, _signature())
+    assert get_signature_validator() is validator
+
+def test_parse_form():
+    assert parse_form(BODY) == FIELDS
+    assert parse_form(BODY, {'Digits'}) == {'Digits': '1 2'}
+    assert parse_form(b'a=1&a=2&b') == {'a': '1', 'b': ''}
+    assert parse_form(b'') == {}
+
+@pytest.fixture
+def signed(monkeypatch):
+    monkeypatch.setenv('TWILIO_AUTH_TOKEN', TOKEN)
+
+def test_webhooks_are_not_validated_by_default(signed, monkeypatch):
+    monkeypatch.delenv('TWILIO_VALIDATE_SIGNATURES', raising=False)
+    values = webhooks.parse_webhook('incoming_call', URL, b'', BODY, None)
+    assert values == {'CallSid': 'CA1', 'From': '+15550000000', 'To': '+15551111111'}
+
+def test_webhooks_with_invalid_signatures_are_rejected(signed, monkeypatch):
+    monkeypatch.setenv('TWILIO_VALIDATE_SIGNATURES', 'true')
+    counter = webhooks._rejected_counters['incoming_call']
+    rejected = counter.value
+    assert webhooks.parse_webhook('incoming_call', URL, b'node=menu', BODY, _signature()) == \
+        {'CallSid': 'CA1', 'From': '+15550000000', 'To': '+15551111111'}
+    assert webhooks.parse_webhook('incoming_call', URL, b'', BODY, 'forged') is None
+    assert webhooks.parse_webhook('incoming_call', URL, b'', BODY, None) is None
+    assert counter.value == rejected + 2
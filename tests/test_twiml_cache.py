@@ -0,0 +1,54 @@
+import asyncio
+import hashlib
+
+from aiohttp.test_utils import TestClient, TestServer
+import pytest
+
+import async_app
+from call_storage import get_call_store
+from twilio_utils import get_twiml, invalidate_twiml_cache
+
+def test_cache_hits_return_the_same_document():
+    first = get_twiml("busy")
+    assert get_twiml("busy") is first
+    assert first.etag == '"' + hashlib.sha1(first.body).hexdigest() + '"'
+    assert first.content_length == str(len(first.body))
+    assert b'<Hangup' in first.body
+
+def test_etags_are_stable_across_renders(monkeypatch):
+    monkeypatch.delenv('HOLD_SECONDS', raising=False)
+    before = get_twiml("hold")
+    invalidate_twiml_cache()
+    again = get_twiml("hold")
+    # Rendered again, to the same bytes and ETag
+    assert again is not before
+    assert (again.body, again.etag) == (before.body, before.etag)
+
+    monkeypatch.setenv('HOLD_SECONDS', '3')
+    changed = get_twiml("hold")
+    assert changed.etag != before.etag
+    assert b'<Pause length="3"' in changed.body
+    monkeypatch.delenv('HOLD_SECONDS')
+    assert get_twiml("hold").etag == before.etag
+
+@pytest.fixture
+def full(monkeypatch):
+    """No free lines, so every call gets the busy message."""
+    monkeypatch.setenv('MAX_CALLS', '0')
+    monkeypatch.delenv('WAITING_ROOM', raising=False)
+    monkeypatch.delenv('TWILIO_VALIDATE_SIGNATURES', raising=False)
+    get_call_store().clear()
+
+def test_webhooks_serve_the_cached_document(full):
+    async def post_calls():
+        async with TestClient(TestServer(async_app.create_app())) as client:
+            responses = []
+            for call_sid in ('CA1', 'CA2'):
+                response = await client.post('/incoming_call', data={
+                    'CallSid': call_sid, 'From': '+15550000000', 'To': '+15551111111'})
+                responses.append((response.status, response.headers['ETag'],
+                                  response.headers['Content-Type'], await response.read()))
+            return responses
+
+    busy = get_twiml("busy")
+    assert asyncio.run(post_calls()) == [(200, busy.etag, 'text/xml', busy.body)] * 2
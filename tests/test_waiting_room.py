@@ -0,0 +1,129 @@
+import pytest
+
+import call_handler
+import call_store_backends
+import webhooks
+from admission import WaitStats
+from call_storage import get_call_store
+from call_store_backends import ADMITTED, BUSY, QUEUED
+from ivr_flows import CompiledFlow
+
+FLOW = CompiledFlow({'start': 'hello', 'nodes': {'hello': {'steps': [{'say': "Hello."}]}}})
+
+class FakeClock:
+    def __init__(self):
+        self.now = call_store_backends.call_clock()
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(call_store_backends, 'call_clock', clock)
+    return clock
+
+def _admit(store, call_sid, max_calls=1, max_waiting=10, stale_after=60, **tenant):
+    return store.try_admit_queued(call_sid, '+15550000000', '+15551111111', max_calls,
+                                  max_waiting, stale_after, **tenant).status
+
+def test_callers_are_admitted_in_arrival_order(store):
+    assert _admit(store, 'CA0') == ADMITTED
+    for call_sid in ('CA1', 'CA2', 'CA3'):
+        assert _admit(store, call_sid) == QUEUED
+    assert store.get_waiting_count() == 3
+
+    store.end_call('CA0')
+    # A later caller asking first doesn't take the free line
+    assert _admit(store, 'CA3') == QUEUED
+    assert _admit(store, 'CA2') == QUEUED
+    # and neither does a new one
+    assert _admit(store, 'CA4') == QUEUED
+    assert _admit(store, 'CA1') == ADMITTED
+    assert [call.call_sid for call in store.get_active_calls()] == ['CA1']
+    assert store.get_waiting_count() == 3
+
+def test_callers_within_the_free_lines_are_admitted(store):
+    for call_sid in ('CA0', 'CA1'):
+        assert _admit(store, call_sid, max_calls=2) == ADMITTED
+    for call_sid in ('CA2', 'CA3', 'CA4'):
+        assert _admit(store, call_sid, max_calls=2) == QUEUED
+
+    store.end_call('CA0')
+    store.end_call('CA1')
+    # Two lines are free: the second in line is admitted before the first
+    # asks again, the third has to wait
+    assert _admit(store, 'CA4', max_calls=2) == QUEUED
+    assert _admit(store, 'CA3', max_calls=2) == ADMITTED
+    assert _admit(store, 'CA4', max_calls=2) == QUEUED
+    assert _admit(store, 'CA2', max_calls=2) == ADMITTED
+    assert _admit(store, 'CA4', max_calls=2) == QUEUED
+
+def test_waiting_room_size(store):
+    assert _admit(store, 'CA0') == ADMITTED
+    assert _admit(store, 'CA1', max_waiting=1) == QUEUED
+    assert _admit(store, 'CA2', max_waiting=1) == BUSY
+    # A waiting caller asking again keeps its place
+    assert _admit(store, 'CA1', max_waiting=1) == QUEUED
+
+def test_callers_that_hang_up_leave_the_queue(store):
+    assert _admit(store, 'CA0') == ADMITTED
+    assert _admit(store, 'CA1') == QUEUED
+    assert _admit(store, 'CA2') == QUEUED
+    assert store.remove_waiter('CA1').call_sid == 'CA1'
+    assert store.remove_waiter('CA1') is None
+
+    store.end_call('CA0')
+    assert _admit(store, 'CA2') == ADMITTED
+    assert store.get_waiting_count() == 0
+
+def test_silent_callers_are_dropped(store, clock):
+    assert _admit(store, 'CA0') == ADMITTED
+    assert _admit(store, 'CA1', stale_after=30) == QUEUED
+    clock.now += 20
+    assert _admit(store, 'CA2', stale_after=30) == QUEUED
+    clock.now += 20
+    store.end_call('CA0')
+    # CA1 hasn't asked for 40s, so CA2 is next in line
+    result = store.try_admit_queued('CA2', '+15550000000', '+15551111111', 1, 10, 30)
+    assert result.status == ADMITTED
+    assert result.waited == 20
+    assert store.get_waiting_count() == 0
+
+def test_tenants_at_their_limit_keep_their_place(store):
+    assert _admit(store, 'CA0', max_calls=3, tenant='acme', tenant_max_calls=1) == ADMITTED
+    assert _admit(store, 'CA1', max_calls=1) == QUEUED
+    assert _admit(store, 'CA2', max_calls=1) == QUEUED
+    # Lines are free, but acme is at its limit; the caller behind gets a line
+    assert _admit(store, 'CA1', max_calls=3, tenant='acme', tenant_max_calls=1) == QUEUED
+    assert _admit(store, 'CA2', max_calls=3) == ADMITTED
+    assert store.get_waiting_count() == 1
+
+@pytest.fixture
+def waiting_room(monkeypatch):
+    monkeypatch.setenv('WAITING_ROOM', 'true')
+    monkeypatch.setenv('MAX_CALLS', '1')
+    monkeypatch.delenv('ADAPTIVE_CAPACITY', raising=False)
+    monkeypatch.delenv('TENANTS_FILE', raising=False)
+    monkeypatch.setattr(webhooks, 'get_flow', lambda path=None: FLOW)
+    monkeypatch.setattr(call_handler, 'wait_stats', WaitStats())
+    get_call_store().clear()
+    yield
+    get_call_store().clear()
+
+def _call(call_sid, **fields):
+    return {'CallSid': call_sid, 'From': '+15550000000', 'To': '+15551111111', **fields}
+
+def test_webhooks_hold_callers_until_a_line_frees_up(waiting_room):
+    assert webhooks.incoming_call(_call('CA0')) == FLOW.twiml(FLOW.start)
+    assert webhooks.incoming_call(_call('CA1')) == webhooks.get_twiml("queued")
+    assert webhooks.incoming_call(_call('CA2')) == webhooks.get_twiml("queued")
+    assert webhooks.queue_admit(_call('CA1')) == webhooks.get_twiml("hold")
+
+    webhooks.call_status(_call('CA0', CallStatus='completed'))
+    assert webhooks.queue_admit(_call('CA1')) == FLOW.twiml(FLOW.start)
+    # CA2 hangs up while waiting
+    webhooks.call_status(_call('CA2', CallStatus='completed'))
+
+    status = webhooks.queue_status()
+    assert (status['waiting'], status['admitted'], status['abandoned']) == (0, 1, 1)
@@ -0,0 +1,57 @@
+import pytest
+
+import call_handler
+import webhooks
+from call_reaper import REASON_IDLE, REASON_LIFETIME
+from call_storage import get_call_store
+from ivr_flows import CompiledFlow, FlowError
+
+FLOW = CompiledFlow({
+    'start': 'menu',
+    'nodes': {
+        'menu': {
+            'steps': [{'gather': {'say': "Press 1 for news.", 'num_digits': 1}}],
+            'digits': {'1': 'news'}
+        },
+        'news': {
+            'steps': [{'say': "Today's news."}, {'play': 'music.mp3', 'loop': 3}]
+        }
+    }
+})
+
+@pytest.fixture
+def flow(monkeypatch):
+    monkeypatch.setattr(webhooks, 'get_flow', lambda path=None: FLOW)
+    get_call_store().clear()
+    yield FLOW
+    get_call_store().clear()
+
+def _latest_reason(call_sid):
+    reaper = call_handler.reaper
+    generation = reaper._generations[call_sid]
+    return next(entry[3] for entry in reaper._heap
+                if entry[1] == generation and entry[2] == call_sid)
+
+def _call(call_sid, **fields):
+    return {'CallSid': call_sid, 'From': '+15550000000', 'To': '+15551111111', **fields}
+
+def test_nodes_without_a_menu_are_not_reaped_as_idle(flow):
+    webhooks.incoming_call(_call('CAnews'))
+    assert _latest_reason('CAnews') == REASON_IDLE
+
+    webhooks.handle_ivr(_call('CAnews', node='menu', Digits='1'))
+    assert _latest_reason('CAnews') == REASON_LIFETIME
+
+def test_ended_calls_leave_the_reaper(flow):
+    webhooks.incoming_call(_call('CAdone'))
+    assert 'CAdone' in call_handler.reaper._generations
+
+    webhooks.call_status(_call('CAdone', CallStatus='completed'))
+    assert 'CAdone' not in call_handler.reaper._generations
+
+def test_a_broken_flow_takes_no_line(flow, monkeypatch):
+    def broken_flow(path=None):
+        raise FlowError("broken")
+    monkeypatch.setattr(webhooks, 'get_flow', broken_flow)
+    assert webhooks.incoming_call(_call('CAbroken')) == webhooks.get_twiml("error")
+    assert get_call_store().get_call_count() == 0
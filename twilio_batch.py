@@ -0,0 +1,203 @@
+"""
+Bulk Twilio operations on many calls, e.g. to clean up after a load test.
+
+Requests run concurrently on the shared Twilio client (see
+twilio_utils.get_twilio_client), at most TWILIO_MAX_CONCURRENCY at a time.
+Requests that fail with a rate limit (429), a server error (5xx) or a
+connection error are retried with exponential backoff and jitter.
+
+Run from the command line to act on the calls a running app reports:
+
+    python twilio_batch.py status --url http://localhost:5000
+    python twilio_batch.py hangup --url http://localhost:5000
+
+Without --url the calls in this process's call storage are used, which
+only finds calls with CALL_STORE=sqlite.
+"""
+
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import random
+import sys
+import time
+import urllib.request
+
+from requests.exceptions import ConnectionError, Timeout
+from twilio.base.exceptions import TwilioRestException
+
+from twilio_utils import get_twilio_client, get_twilio_concurrency
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+# Longest wait between two attempts, in seconds
+MAX_BACKOFF = 10.0
+
+# Results of a batch. Key: call SID; results holds the value returned for
+# each call that succeeded, errors the exception of each call that failed
+BatchResult = namedtuple('BatchResult', ['results', 'errors'])
+
+def _retryable(error):
+    """Whether a failed request may succeed when repeated."""
+    if isinstance(error, TwilioRestException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (ConnectionError, Timeout))
+
+def call_with_retries(func, call_sid, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """
+    Call a function for one call, retrying retryable Twilio errors.
+
+    Args:
+        func (callable): Called with the call SID
+        call_sid (str): The call SID (or other argument of func)
+        retries (int): Retries after a retryable error
+        backoff (float): Base delay in seconds of the first retry, doubled
+            for every further retry
+
+    Returns:
+        The value returned by func
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(call_sid)
+        except Exception as e:
+            if attempt >= retries or not _retryable(e):
+                raise
+            # Full jitter keeps retries of many calls from arriving together
+            delay = random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+            logger.warning("Retrying %s in %.2fs after error: %s", call_sid, delay, e)
+            time.sleep(delay)
+            attempt += 1
+
+def run_batch(func, call_sids, concurrency=None, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """
+    Run a function for many calls with bounded concurrency and retries.
+
+    Args:
+        func (callable): Called with a call SID; returns the call's result
+        call_sids: The call SIDs
+        concurrency (int): Calls in flight at once, defaults to
+            TWILIO_MAX_CONCURRENCY (the connections the client keeps open;
+            more concurrent calls open and discard extra connections)
+        retries (int): Retries of a call after a retryable error
+        backoff (float): Base delay in seconds of the first retry, doubled
+            for every further retry
+
+    Returns:
+        BatchResult: Results and errors by call SID
+    """
+    call_sids = list(dict.fromkeys(call_sids))
+    results, errors = {}, {}
+    if not call_sids:
+        return BatchResult(results, errors)
+    concurrency = concurrency or get_twilio_concurrency()
+
+    def run(call_sid):
+        try:
+            results[call_sid] = call_with_retries(func, call_sid, retries, backoff)
+        except Exception as e:
+            logger.error(f"Error processing call {call_sid}: {str(e)}")
+            errors[call_sid] = e
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(call_sids)),
+                            thread_name_prefix='twilio-batch') as executor:
+        # Consume the iterator so the pool's threads finish before returning
+        list(executor.map(run, call_sids))
+    return BatchResult(results, errors)
+
+def _active_call_sids():
+    from call_handler import get_active_calls
+    return [call.call_sid for call in get_active_calls()]
+
+def _require_client(client):
+    client = client or get_twilio_client()
+    if client is None:
+        raise RuntimeError("Twilio credentials not found in environment variables")
+    return client
+
+def fetch_call_statuses(call_sids=None, client=None, **options):
+    """
+    Fetch the Twilio status of many calls.
+
+    Args:
+        call_sids: The call SIDs, defaults to the active calls in call storage
+        client (Client): Twilio client, defaults to get_twilio_client()
+        **options: concurrency, retries and backoff (see run_batch)
+
+    Returns:
+        BatchResult: Twilio status ('in-progress', 'completed', ...) by call SID
+    """
+    client = _require_client(client)
+    if call_sids is None:
+        call_sids = _active_call_sids()
+    return run_batch(lambda call_sid: client.calls(call_sid).fetch().status,
+                     call_sids, **options)
+
+def hangup_calls(call_sids=None, client=None, **options):
+    """
+    Hang up many calls.
+
+    Twilio then sends each call's final status callback, which ends the call
+    in the app as usual.
+
+    Args:
+        call_sids: The call SIDs, defaults to the active calls in call storage
+        client (Client): Twilio client, defaults to get_twilio_client()
+        **options: concurrency, retries and backoff (see run_batch)
+
+    Returns:
+        BatchResult: The status Twilio reports after the update, by call SID
+    """
+    client = _require_client(client)
+    if call_sids is None:
+        call_sids = _active_call_sids()
+    return run_batch(lambda call_sid: client.calls(call_sid).update(status='completed').status,
+                     call_sids, **options)
+
+def fetch_app_call_sids(base_url, page_size=1000):
+    """
+    List the SIDs of the active calls of a running app through /api/calls.
+
+    Args:
+        base_url (str): URL of the app, e.g. http://localhost:5000
+        page_size (int): Calls requested per page
+
+    Returns:
+        list: Call SIDs, newest first
+    """
+    call_sids = []
+    while True:
+        url = f"{base_url.rstrip('/')}/api/calls?offset={len(call_sids)}&limit={page_size}"
+        with urllib.request.urlopen(url, timeout=30) as response:
+            page = json.load(response)
+        call_sids.extend(call['call_sid'] for call in page)
+        if len(page) < page_size:
+            return call_sids
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk Twilio operations on active calls.")
+    parser.add_argument('operation', choices=['status', 'hangup'])
+    parser.add_argument('--url', help="Running app to list the active calls from")
+    parser.add_argument('--concurrency', type=int, help="Requests in flight at once")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES)
+    parser.add_argument('call_sids', nargs='*', help="Calls to act on instead of all active calls")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    call_sids = args.call_sids or (fetch_app_call_sids(args.url) if args.url else None)
+    operation = fetch_call_statuses if args.operation == 'status' else hangup_calls
+    result = operation(call_sids, concurrency=args.concurrency, retries=args.retries)
+    for call_sid, status in result.results.items():
+        print(f"{call_sid} {status}")
+    for call_sid, error in result.errors.items():
+        print(f"{call_sid} error: {error}")
+    return 1 if result.errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Webhook form parsing and Twilio request signature validation.
+
+Twilio signs every webhook with the account's auth token: the
+X-Twilio-Signature header is the base64 HMAC-SHA1 of the full request URL
+followed by each POST field name and value, sorted by name. With
+TWILIO_VALIDATE_SIGNATURES=true, webhooks whose signature doesn't match are
+rejected before any call storage work.
+
+To keep this cheap on the hot path:
+
+- The HMAC state after absorbing the auth token is computed once and copied
+  per request.
+- Form bodies are parsed by hand. Without validation only the fields a
+  route uses are decoded.
+- Twilio retries a webhook with the same URL, body and signature, so
+  verified requests are remembered for SIGNATURE_CACHE_SECONDS and a retry
+  costs one dictionary lookup. The cache key includes the signature and the
+  raw body, so a forged body for a known CallSid is still verified.
+
+The URL is the one Twilio requested: BASE_URL plus the request path and
+query string, or the URL the request arrived at if BASE_URL is unset.
+"""
+
+import base64
+from collections import OrderedDict
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from urllib.parse import unquote_plus
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds a verified request is remembered, and the most requests remembered
+SIGNATURE_CACHE_SECONDS = 30
+SIGNATURE_CACHE_SIZE = 10000
+
+WEBHOOKS_REJECTED = Counter(
+    'webhook_requests_rejected_total', "Webhooks rejected for a missing or invalid Twilio signature.",
+    ['route'])
+
+def _unquote(text):
+    # Most fields have nothing to decode; unquote_plus costs about a microsecond
+    if '%' in text or '+' in text:
+        return unquote_plus(text)
+    return text
+
+def parse_form(body, names=None):
+    """
+    Parse a URL-encoded form.
+
+    Args:
+        body (bytes): The form body or query string
+        names: Field names to decode, or None for all fields
+
+    Returns:
+        dict: Field values by name (the first value of repeated fields)
+    """
+    values = {}
+    if not body:
+        return values
+    for part in body.decode('utf-8', 'replace').split('&'):
+        name, _, value = part.partition('=')
+        name = _unquote(name)
+        if (names is None or name in names) and name not in values:
+            values[name] = _unquote(value)
+    return values
+
+def parse_form_pairs(body):
+    """
+    Parse every field of a URL-encoded form, keeping repeated fields.
+
+    Returns:
+        list: (name, value) tuples in body order
+    """
+    if not body:
+        return []
+    pairs = []
+    for part in body.decode('utf-8', 'replace').split('&'):
+        if part:
+            name, _, value = part.partition('=')
+            pairs.append((_unquote(name), _unquote(value)))
+    return pairs
+
+def signatures_enabled():
+    """Whether webhooks must carry a valid Twilio signature."""
+    return os.environ.get('TWILIO_VALIDATE_SIGNATURES', '').lower() in ('1', 'true', 'yes')
+
+class SignatureValidator:
+    """Computes and checks X-Twilio-Signature values for one auth token."""
+
+    def __init__(self, auth_token, cache_seconds=SIGNATURE_CACHE_SECONDS,
+                 cache_size=SIGNATURE_CACHE_SIZE):
+        # HMAC state with the key already absorbed; copied for every request
+        self._mac = hmac.new(auth_token.encode('utf-8'), digestmod=hashlib.sha1)
+        self.cache_seconds = cache_seconds
+        self.cache_size = cache_size
+        # Key: (url, signature, body), Value: expiry. Entries share one TTL,
+        # so insertion order is expiry order
+        self._verified = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compute(self, url, pairs):
+        """
+        Compute the signature Twilio sends for a request.
+
+        Args:
+            url (str): The full URL Twilio requested
+            pairs: (name, value) tuples of the POST fields
+
+        Returns:
+            str: The base64 encoded signature
+        """
+        mac = self._mac.copy()
+        mac.update(url.encode('utf-8'))
+        for name, value in sorted(pairs):
+            mac.update(name.encode('utf-8'))
+            mac.update(value.encode('utf-8'))
+        return base64.b64encode(mac.digest()).decode('ascii')
+
+    def validate(self, url, body, signature, pairs=None):
+        """
+        Check a request's signature.
+
+        Args:
+            url (str): The full URL Twilio requested
+            body (bytes): The raw form body
+            signature (str): The X-Twilio-Signature header, or None
+            pairs: The parsed body fields, parsed here if None
+
+        Returns:
+            bool: Whether the signature is valid
+        """
+        if not signature:
+            return False
+        key = (url, signature, body)
+        now = time.monotonic()
+        expiry = self._verified.get(key)
+        if expiry is not None and expiry > now:
+            return True
+
+        if pairs is None:
+            pairs = parse_form_pairs(body)
+        expected = self.compute(url, pairs).encode('ascii')
+        if not hmac.compare_digest(expected, signature.encode('utf-8', 'replace')):
+            return False
+
+        with self._lock:
+            verified = self._verified
+            verified[key] = now + self.cache_seconds
+            # Drop expired entries, and the oldest ones beyond the size limit
+            while verified:
+                old_expiry = next(iter(verified.values()))
+                if old_expiry > now and len(verified) <= self.cache_size:
+                    break
+                verified.popitem(last=False)
+        return True
+
+# Validator for the current auth token
+_validator_token = None
+_validator = None
+_validator_lock = threading.Lock()
+
+def get_signature_validator():
+    """
+    Get the validator for webhook signatures.
+
+    Returns:
+        SignatureValidator: Validator for the auth token in the environment,
+            or None if no auth token is configured
+    """
+    global _validator_token, _validator
+    from twilio_utils import get_twilio_auth_token
+    token = get_twilio_auth_token()
+    if token != _validator_token:
+        with _validator_lock:
+            if token != _validator_token:
+                _validator = SignatureValidator(token) if token else None
+                _validator_token = token
+    return _validator
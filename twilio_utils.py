@@ -1,93 +1,176 @@
 import os
 import logging
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
-from twilio.twiml.voice_response import VoiceResponse, Gather, Play
+from twilio.twiml.voice_response import VoiceResponse
+
+from metrics import TWIML_RENDER
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+DEFAULT_BASE_URL = 'https://telephony-test-platform.replit.app'
+
+# Times the music is played for IVR option 1 (the music node of the default flow)
+MUSIC_LOOPS = 10
+
+# Beep cycles played for IVR option 2 (about a minute); BEEP_LOOPS=0 repeats
+# until the caller hangs up
+DEFAULT_BEEP_LOOPS = 20
+
+# Seconds a caller in the waiting room holds between admission checks
+DEFAULT_HOLD_SECONDS = 10
+
+# Pre-rendered TwiML document: immutable body bytes plus precomputed headers
+CachedTwiml = namedtuple('CachedTwiml', ['body', 'etag', 'content_length'])
+
+# Cache of rendered TwiML documents
+# Key: (config key, response_type), Value: CachedTwiml
+_twiml_cache = {}
+_twiml_cache_lock = threading.Lock()
+_twiml_config_version = 0
+
+# Environment variable names tried, in order, for the Twilio credentials
+TWILIO_SID_NAMES = ('TWILIO_ACCOUNT_SID', 'TWILIO_SID', 'TWILIO_ACCT_SID')
+TWILIO_TOKEN_NAMES = ('TWILIO_AUTH_TOKEN', 'TWILIO_TOKEN', 'TWILIO_AUTH')
+
+# Concurrent requests the Twilio client keeps connections for
+DEFAULT_TWILIO_CONCURRENCY = 8
+
+# Seconds before a Twilio REST request times out
+TWILIO_TIMEOUT = 10
+
+# Cached Twilio client and the credentials it was built with
+_client_key = None
+_client = None
+_client_lock = threading.Lock()
+
+def _first_env(names):
+    for name in names:
+        value = os.environ.get(name)
+        if value:
+            return name, value
+    return None, None
+
+def get_twilio_auth_token():
+    """
+    Get the Twilio auth token from the environment.
+
+    Returns:
+        str: The auth token, or None if not configured
+    """
+    return _first_env(TWILIO_TOKEN_NAMES)[1]
+
+def get_twilio_concurrency():
+    """
+    Get the number of concurrent requests to make to the Twilio API.
+
+    Returns:
+        int: Value of TWILIO_MAX_CONCURRENCY, or DEFAULT_TWILIO_CONCURRENCY
+            if unset or invalid
+    """
+    try:
+        return max(int(os.environ.get('TWILIO_MAX_CONCURRENCY', DEFAULT_TWILIO_CONCURRENCY)), 1)
+    except ValueError:
+        logger.warning("Invalid TWILIO_MAX_CONCURRENCY value, using the default")
+        return DEFAULT_TWILIO_CONCURRENCY
+
+def _build_client(account_sid, auth_token):
+    """Create a Twilio client whose HTTP session keeps connections alive."""
+    http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_TIMEOUT)
+    # One pooled connection per concurrent request; http:// for local test servers
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=get_twilio_concurrency())
+    http_client.session.mount('https://', adapter)
+    http_client.session.mount('http://', adapter)
+    return Client(account_sid, auth_token, http_client=http_client)
+
 def get_twilio_client():
     """
-    Get a Twilio client using environment variables.
-    
+    Get the process-wide Twilio client using environment variables.
+
+    The client and its HTTP connections are reused by every caller. A new
+    client is built only when the credentials in the environment change.
+
     Returns:
-        Client: Initialized Twilio client
+        Client: Initialized Twilio client, or None if credentials are missing
+    """
+    global _client_key, _client
+    sid_name, account_sid = _first_env(TWILIO_SID_NAMES)
+    token_name, auth_token = _first_env(TWILIO_TOKEN_NAMES)
+    key = (account_sid, auth_token)
+    if key == _client_key:
+        return _client
+
+    with _client_lock:
+        if key == _client_key:
+            return _client
+        client = None
+        if not account_sid or not auth_token:
+            logger.warning("Twilio credentials not found in environment variables")
+            logger.warning(f"Looked for SID in: {', '.join(TWILIO_SID_NAMES)}")
+            logger.warning(f"Looked for token in: {', '.join(TWILIO_TOKEN_NAMES)}")
+        else:
+            logger.info(f"Found Twilio SID using variable: {sid_name}")
+            logger.info(f"Found Twilio Auth Token using variable: {token_name}")
+            try:
+                client = _build_client(account_sid, auth_token)
+            except Exception as e:
+                # Not cached: the next call tries again
+                logger.error(f"Error initializing Twilio client: {str(e)}")
+                return None
+        # Publish the client before the key, for readers that skip the lock
+        _client = client
+        _client_key = key
+        return client
+
+def get_beep_loops():
+    """
+    Get the number of beep cycles to play from the environment.
+
+    Returns:
+        int: Value of BEEP_LOOPS, or DEFAULT_BEEP_LOOPS if unset or invalid
     """
-    # Try different possible environment variable names for Twilio credentials
-    possible_sid_names = ['TWILIO_ACCOUNT_SID', 'TWILIO_SID', 'TWILIO_ACCT_SID']
-    possible_token_names = ['TWILIO_AUTH_TOKEN', 'TWILIO_TOKEN', 'TWILIO_AUTH']
-    
-    account_sid = None
-    auth_token = None
-    
-    # Try to find the SID
-    for name in possible_sid_names:
-        if os.environ.get(name):
-            account_sid = os.environ.get(name)
-            logger.info(f"Found Twilio SID using variable: {name}")
-            break
-    
-    # Try to find the auth token
-    for name in possible_token_names:
-        if os.environ.get(name):
-            auth_token = os.environ.get(name)
-            logger.info(f"Found Twilio Auth Token using variable: {name}")
-            break
-    
-    if not account_sid or not auth_token:
-        logger.warning("Twilio credentials not found in environment variables")
-        logger.warning(f"Looked for SID in: {', '.join(possible_sid_names)}")
-        logger.warning(f"Looked for token in: {', '.join(possible_token_names)}")
-        return None
-    
     try:
-        return Client(account_sid, auth_token)
-    except Exception as e:
-        logger.error(f"Error initializing Twilio client: {str(e)}")
-        return None
+        return max(int(os.environ.get('BEEP_LOOPS', DEFAULT_BEEP_LOOPS)), 0)
+    except ValueError:
+        logger.warning("Invalid BEEP_LOOPS value, using the default")
+        return DEFAULT_BEEP_LOOPS
+
+def get_hold_seconds():
+    """
+    Get the seconds a waiting caller holds between admission checks.
+
+    Returns:
+        int: Value of HOLD_SECONDS, or DEFAULT_HOLD_SECONDS if unset or invalid
+    """
+    try:
+        value = int(os.environ.get('HOLD_SECONDS', DEFAULT_HOLD_SECONDS))
+        return value if value > 0 else DEFAULT_HOLD_SECONDS
+    except ValueError:
+        logger.warning("Invalid HOLD_SECONDS value, using the default")
+        return DEFAULT_HOLD_SECONDS
 
 def generate_twiml_response(response_type):
     """
-    Generate TwiML response based on the required response type.
+    Generate the TwiML of a message played outside the IVR flow.
+
+    The IVR menu itself comes from the flow file (see ivr_flows).
     
     Args:
         response_type (str): Type of response to generate 
-                           ('welcome', 'music', 'beep', 'error', 'busy', or 'invalid')
+                           ('error', 'busy', 'queued' or 'hold')
     
     Returns:
         VoiceResponse: TwiML response object
     """
     response = VoiceResponse()
     
-    if response_type == "welcome":
-        # Welcome message and menu
-        response.say("Welcome to the telephony testing service.")
-        response.pause(length=1)
-        
-        gather = Gather(num_digits=1, action="/handle_ivr", method="POST", timeout=10)
-        gather.say("Press 1 to listen to music. Press 2 to hear a beep every 3 seconds.")
-        response.append(gather)
-        
-        # If no input, repeat the menu
-        response.redirect("/incoming_call")
-    
-    elif response_type == "music":
-        # Play music
-        #response.say("Playing music now.")
-        # Use the URL of your deployed app to serve the audio file
-        base_url = os.environ.get('BASE_URL', 'https://telephony-test-platform.replit.app')
-        response.play(f"{base_url}/static/audio/music.mp3", loop=10)
-    
-    elif response_type == "beep":
-
-        # Play beep every 3 seconds
-        response.say("Playing a beep every 3 seconds.")
-        base_url = os.environ.get('BASE_URL', 'https://telephony-test-platform.replit.app')
-        for _ in range(20):  # Loop for about a minute (20 * 3 seconds)
-            response.play(f"{base_url}/static/audio/beep-02.mp3", loop=1)
-            response.pause(length=3)
-    
-    elif response_type == "error":
+    if response_type == "error":
         # Error handling
         response.say("We're sorry, but we encountered an error processing your call. Please try again later.")
         response.hangup()
@@ -97,16 +180,80 @@ def generate_twiml_response(response_type):
         response.say("We're sorry, but all lines are currently busy. The maximum number of simultaneous calls has been reached. Please try again later.")
         response.hangup()
     
-    elif response_type == "invalid":
-        # Invalid selection
-        response.say("Sorry, that's not a valid option.")
-        
-        gather = Gather(num_digits=1, action="/handle_ivr", method="POST", timeout=10)
-        gather.say("Press 1 to listen to music. Press 2 to hear a beep every 3 seconds.")
-        response.append(gather)
-        
-        # If no input again, end call
-        response.say("No input received. Goodbye.")
-        response.hangup()
+    elif response_type in ("queued", "hold"):
+        # Waiting room: hold, then ask for admission again
+        if response_type == "queued":
+            response.say("All lines are currently busy. Please hold and you will be connected shortly.")
+        response.pause(length=get_hold_seconds())
+        response.redirect("/queue_admit", method="POST")
     
     return response
+
+def render_twiml(build, label):
+    """
+    Render a TwiML document for caching.
+
+    Args:
+        build (callable): Returns the VoiceResponse to render
+        label (str): Name the render time is recorded under
+
+    Returns:
+        CachedTwiml: Rendered body bytes with ETag and Content-Length
+    """
+    start = time.perf_counter()
+    body = str(build()).encode('utf-8')
+    TWIML_RENDER.labels(label).observe(time.perf_counter() - start)
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return CachedTwiml(body, etag, str(len(body)))
+
+def twiml_config_key():
+    """
+    Get the key identifying the configuration TwiML documents depend on.
+
+    Returns:
+        tuple: (config version, BASE_URL, BEEP_LOOPS, HOLD_SECONDS)
+    """
+    return (_twiml_config_version, os.environ.get('BASE_URL', DEFAULT_BASE_URL),
+            os.environ.get('BEEP_LOOPS'), os.environ.get('HOLD_SECONDS'))
+
+def get_twiml(response_type):
+    """
+    Get the rendered TwiML document for a response type.
+
+    Each response type is rendered once per configuration and served from
+    the cache afterwards. Changing BASE_URL or calling
+    invalidate_twiml_cache() causes the next call to render it again.
+
+    Args:
+        response_type (str): Type of response (see generate_twiml_response)
+
+    Returns:
+        CachedTwiml: Rendered body bytes with ETag and Content-Length
+    """
+    key = (twiml_config_key(), response_type)
+    cached = _twiml_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with _twiml_cache_lock:
+        cached = _twiml_cache.get(key)
+        if cached is None:
+            cached = render_twiml(lambda: generate_twiml_response(response_type), response_type)
+
+            # Drop documents rendered for an older configuration
+            for stale_key in [k for k in _twiml_cache if k[0] != key[0]]:
+                del _twiml_cache[stale_key]
+            _twiml_cache[key] = cached
+            logger.debug("Rendered TwiML for %s (%d bytes)", response_type, len(cached.body))
+        return cached
+
+def invalidate_twiml_cache():
+    """
+    Discard all cached TwiML documents.
+
+    Call this after changing configuration that affects the rendered TwiML.
+    """
+    global _twiml_config_version
+    with _twiml_cache_lock:
+        _twiml_config_version += 1
+        _twiml_cache.clear()
@@ -0,0 +1,467 @@
+"""
+Framework-independent request handling for the app's routes.
+
+The Flask app (app.py) and the asyncio server (async_app.py) both extract the
+request fields, call these functions and wrap the result in their own
+response type, so both serving modes behave identically.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime
+
+from twilio_utils import get_twiml
+from ivr_flows import get_flow
+from tenants import tenant_router
+from call_handler import (
+    try_admit,
+    handle_call_end,
+    update_call_ivr,
+    enter_call_node,
+    get_call_count,
+    get_calls_snapshot,
+    get_call_changes,
+    get_history_stats,
+    get_queue_status,
+    cluster_node
+)
+from cluster import FORWARDED_HEADER
+from call_store_backends import BUSY, QUEUED, call_clock
+from broadcaster import broadcaster
+from twilio_signature import (
+    parse_form,
+    parse_form_pairs,
+    signatures_enabled,
+    get_signature_validator,
+    WEBHOOKS_REJECTED
+)
+
+logger = logging.getLogger(__name__)
+
+# Push live updates to the dashboard (SSE/long-poll) instead of polling.
+# Each open stream occupies a worker thread under the sync server, so only
+# enable this with threaded or async workers.
+PUSH_UPDATES = os.environ.get('PUSH_UPDATES', '').lower() in ('1', 'true', 'yes')
+
+# Seconds between SSE keep-alive comments, and before a stream is closed
+# so that the worker is freed and the client reconnects
+SSE_KEEPALIVE_SECONDS = 15
+SSE_MAX_SECONDS = 300
+
+# Longest time a long-poll request waits for an event
+LONG_POLL_MAX_SECONDS = 25
+
+# Largest page of calls returned by /api/calls
+MAX_PAGE_SIZE = 1000
+
+# Request fields each Twilio webhook uses
+WEBHOOK_FIELDS = {
+    'incoming_call': frozenset(['CallSid', 'From', 'To']),
+    'queue_admit': frozenset(['CallSid', 'From', 'To']),
+    'handle_ivr': frozenset(['CallSid', 'To', 'Digits', 'node']),
+    'outbound_call': frozenset(['CallSid', 'flow']),
+    'call_status': frozenset(['CallSid', 'CallStatus'])
+}
+
+# Webhook paths handled by the node owning the call in cluster mode (see cluster)
+SHARDED_WEBHOOKS = frozenset(['/incoming_call', '/queue_admit', '/handle_ivr', '/call_status'])
+
+_CALL_SID = frozenset(['CallSid'])
+
+# Counters of rejected webhooks by route
+_rejected_counters = {route: WEBHOOKS_REJECTED.labels(route) for route in WEBHOOK_FIELDS}
+
+# Call statuses that end a call
+FINAL_CALL_STATUSES = ('completed', 'busy', 'failed', 'canceled', 'no-answer')
+
+def serialize_calls(calls, now=None):
+    """Convert call records to their JSON shape, with durations at one time."""
+    now = call_clock() if now is None else now
+    return [call.to_dict(now) for call in calls]
+
+def _timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def webhook_url(path_qs, request_url):
+    """
+    Get the URL Twilio requested, which its signature covers.
+
+    Args:
+        path_qs (str): Request path and query string
+        request_url (str): URL the request arrived at
+
+    Returns:
+        str: BASE_URL plus the path and query string, or request_url if
+            BASE_URL is unset (e.g. behind a proxy that changes the scheme)
+    """
+    base_url = os.environ.get('BASE_URL')
+    return base_url.rstrip('/') + path_qs if base_url else request_url
+
+def parse_webhook(route, url, query_string, body, signature):
+    """
+    Parse a Twilio webhook and check its signature.
+
+    With signature validation off, only the fields the route uses are
+    decoded.
+
+    Args:
+        route (str): Name of the webhook (a WEBHOOK_FIELDS key)
+        url (str): The full URL Twilio requested (see webhook_url)
+        query_string (bytes): The raw query string
+        body (bytes): The raw form body
+        signature (str): The X-Twilio-Signature header, or None
+
+    Returns:
+        dict: The route's fields (query string values override form values,
+            like Flask's request.values), or None if the request must be
+            rejected
+    """
+    names = WEBHOOK_FIELDS[route]
+    if signatures_enabled():
+        validator = get_signature_validator()
+        pairs = parse_form_pairs(body)
+        if validator is None or not validator.validate(url, body, signature, pairs):
+            logger.warning("Rejected %s webhook with an invalid signature", route)
+            _rejected_counters[route].inc()
+            return None
+        values = {}
+        for name, value in pairs:
+            if name in names and name not in values:
+                values[name] = value
+    else:
+        values = parse_form(body, names)
+    if query_string:
+        values.update(parse_form(query_string, names))
+    return values
+
+def webhook_owner(path, query_string, body, headers):
+    """
+    Get the node a webhook must be forwarded to, in cluster mode.
+
+    Args:
+        path (str): The request path
+        query_string (bytes): The raw query string
+        body (bytes): The raw form body
+        headers: Mapping of the request headers
+
+    Returns:
+        str: URL of the node owning the webhook's call, or None if the
+            webhook is handled here
+    """
+    if path not in SHARDED_WEBHOOKS or not cluster_node.running or headers.get(FORWARDED_HEADER):
+        return None
+    call_sid = parse_form(query_string, _CALL_SID).get('CallSid') or \
+        parse_form(body, _CALL_SID).get('CallSid')
+    return cluster_node.owner_url(call_sid or '')
+
+def forward_webhook(path, path_qs, query_string, body, headers):
+    """
+    Send a webhook on to the node owning its call, in cluster mode.
+
+    The signature is checked by the owner, which sees the same URL, body
+    and X-Twilio-Signature header.
+
+    Args:
+        path (str): The request path
+        path_qs (str): Request path and query string
+        query_string (bytes): The raw query string
+        body (bytes): The raw form body
+        headers: Mapping of the request headers
+
+    Returns:
+        tuple: (status code, dict of headers, body) of the owner's
+            response, or None if the webhook is handled here
+    """
+    url = webhook_owner(path, query_string, body, headers)
+    if url is None:
+        return None
+    try:
+        return cluster_node.forward(url, path_qs, body, headers)
+    except Exception as e:
+        # The owner is probably gone; it drops out of the shards shortly
+        logger.error(f"Error forwarding webhook to {url}: {str(e)}")
+        return None
+
+def incoming_call(values):
+    """
+    Handle an incoming call webhook.
+
+    Args:
+        values: Mapping of the webhook's request fields
+
+    Returns:
+        CachedTwiml: TwiML for the IVR menu, or the busy/error message
+    """
+    try:
+        # Extract call data
+        call_sid = values.get('CallSid', 'unknown')
+        from_number = values.get('From', 'unknown')
+        to_number = values.get('To', 'unknown')
+
+        logger.debug("Incoming call from %s to %s with SID %s", from_number, to_number, call_sid)
+
+        # The tenant's IVR flow, loaded first so a broken flow never takes a line
+        route = tenant_router.lookup(to_number)
+        flow = get_flow(route.flow_file)
+
+        # Admit the call if we and the tenant of the number can accept more calls
+        result = try_admit(call_sid, from_number, to_number, route=route)
+        if result.status == BUSY:
+            return get_twiml("busy")
+        if result.status == QUEUED:
+            # Hold in the waiting room, then ask again at /queue_admit
+            return get_twiml("queued")
+
+        # TwiML for the start of the flow
+        _enter_start(call_sid, flow)
+        return flow.twiml(flow.start)
+
+    except Exception as e:
+        logger.error(f"Error handling incoming call: {str(e)}")
+        # Return a basic response in case of error
+        return get_twiml("error")
+
+def _enter_start(call_sid, flow):
+    """Let the reaper know when a flow doesn't start in a menu (admission assumes it does)."""
+    start = flow.nodes[flow.start]
+    if start.selection is not None:
+        update_call_ivr(call_sid, start.selection)
+    elif not start.menu:
+        enter_call_node(call_sid, False)
+
+def queue_admit(values):
+    """
+    Handle the webhook of a caller asking again from the waiting room.
+
+    Args:
+        values: Mapping of the webhook's request fields
+
+    Returns:
+        CachedTwiml: TwiML for the IVR menu once admitted, more hold while
+            still waiting, or the busy/error message
+    """
+    try:
+        call_sid = values.get('CallSid', 'unknown')
+        from_number = values.get('From', 'unknown')
+        to_number = values.get('To', 'unknown')
+
+        route = tenant_router.lookup(to_number)
+        flow = get_flow(route.flow_file)
+        result = try_admit(call_sid, from_number, to_number, route=route)
+        if result.status == BUSY:
+            return get_twiml("busy")
+        if result.status == QUEUED:
+            return get_twiml("hold")
+        _enter_start(call_sid, flow)
+        return flow.twiml(flow.start)
+
+    except Exception as e:
+        logger.error(f"Error handling queue admission: {str(e)}")
+        return get_twiml("error")
+
+def handle_ivr(values):
+    """
+    Process an IVR selection webhook.
+
+    The 'node' field names the node the caller is in, in the flow of the
+    dialed number's tenant (see ivr_flows and tenants); 'Digits' are the
+    digits pressed there, or absent when a redirect enters the node.
+
+    Args:
+        values: Mapping of the webhook's request fields
+
+    Returns:
+        CachedTwiml: TwiML of the node the caller goes to
+    """
+    try:
+        digits = values.get('Digits')
+        call_sid = values.get('CallSid', 'unknown')
+
+        logger.debug("IVR selection: %s for call %s", digits, call_sid)
+
+        flow = get_flow(tenant_router.lookup(values.get('To')).flow_file)
+        node_id = flow.next_node(values.get('node'), digits)
+        node = flow.nodes[node_id]
+        if node.selection is not None:
+            update_call_ivr(call_sid, node.selection)
+        else:
+            enter_call_node(call_sid, node.menu)
+        return flow.twiml(node_id)
+
+    except Exception as e:
+        logger.error(f"Error handling IVR: {str(e)}")
+        return get_twiml("error")
+
+def outbound_call(values):
+    """
+    Handle the answer webhook of an outbound test call (see call_storm).
+
+    The call was tracked when it was placed, so this only plays the IVR
+    flow node named by the 'flow' field (e.g. 'music' or 'beep').
+
+    Args:
+        values: Mapping of the webhook's request fields
+
+    Returns:
+        CachedTwiml: TwiML of the node
+    """
+    node_id = values.get('flow')
+    logger.debug("Outbound call %s answered, playing %s", values.get('CallSid', 'unknown'), node_id)
+    try:
+        flow = get_flow()
+    except Exception as e:
+        logger.error(f"Error loading IVR flow: {str(e)}")
+        return get_twiml("error")
+    if node_id not in flow.nodes:
+        logger.warning("Unknown outbound call flow: %s", node_id)
+        return get_twiml("error")
+    return flow.twiml(node_id)
+
+def call_status(values):
+    """
+    Handle a call status webhook.
+
+    Args:
+        values: Mapping of the webhook's request fields
+
+    Returns:
+        dict: {"status": "success"}, or an error status and message
+    """
+    try:
+        call_sid = values.get('CallSid', 'unknown')
+        status = values.get('CallStatus', 'unknown')
+
+        logger.debug("Call status update: %s - %s", call_sid, status)
+
+        if status in FINAL_CALL_STATUSES:
+            handle_call_end(call_sid)
+
+        return {"status": "success"}
+
+    except Exception as e:
+        logger.error(f"Error handling call status: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+def calls_page(offset=None, limit=None):
+    """
+    Normalize the pagination parameters of /api/calls.
+
+    Args:
+        offset (int): Number of calls to skip, or None
+        limit (int): Requested page size, or None for all calls
+
+    Returns:
+        tuple: (offset, limit) to pass to calls_json()
+    """
+    offset = max(offset or 0, 0)
+    if limit is not None:
+        limit = min(max(limit, 0), MAX_PAGE_SIZE)
+    return offset, limit
+
+def calls_json(offset=0, limit=None):
+    """
+    Get a page of the active calls as JSON, newest first.
+
+    Args:
+        offset (int): Number of calls to skip
+        limit (int): Maximum number of calls, or None for all
+
+    Returns:
+        tuple: (JSON array of the calls as bytes, total number of active calls)
+    """
+    snapshot = get_calls_snapshot()
+    return snapshot.to_json(offset=offset, limit=limit), snapshot.count
+
+def call_count():
+    """
+    Get the active call count.
+
+    Returns:
+        dict: {"count": n}
+    """
+    return {"count": get_call_count()}
+
+def dashboard_data():
+    """
+    Get the dashboard data (calls and count) as JSON.
+
+    In cluster mode the calls are this node's, and the count is merged from
+    the summaries of all live nodes, which are listed under 'nodes' (see
+    ClusterNode.get_nodes) along with the cluster's leases.
+
+    Returns:
+        bytes: JSON object with calls, count and timestamp
+    """
+    snapshot = get_calls_snapshot()
+    count = snapshot.count
+    cluster = ''
+    if cluster_node.running:
+        nodes = cluster_node.get_nodes()
+        count = sum((node['summary'] or {}).get('count', 0) for node in nodes)
+        cluster = f',"nodes":{json.dumps(nodes)},"leases":{cluster_node.get_lease_count()}'
+    # Splice in the snapshot's cached JSON instead of re-encoding the calls
+    return b''.join([
+        b'{"calls":', snapshot.to_json(),
+        f',"count":{count}{cluster},"timestamp":"{_timestamp()}"}}'.encode('utf-8')
+    ])
+
+def dashboard_changes(since):
+    """
+    Get the changes to the active calls since a version.
+
+    Args:
+        since (int): Version the client last saw, or None
+
+    Returns:
+        dict: Delta or full snapshot with a timestamp
+    """
+    data = get_call_changes(since)
+    now = call_clock()
+    for key in ("calls", "added", "updated"):
+        if key in data:
+            data[key] = serialize_calls(data[key], now)
+    data["timestamp"] = _timestamp()
+    return data
+
+def queue_status():
+    """
+    Get the state of the waiting room.
+
+    Returns:
+        dict: Callers waiting, capacity and wait percentiles
+    """
+    return get_queue_status()
+
+def history_stats(start, end):
+    """
+    Get statistics for completed calls in a time window.
+
+    Args:
+        start (float): Window start epoch, or None
+        end (float): Window end epoch, or None
+
+    Returns:
+        dict: Call rate, durations and IVR mix
+    """
+    return get_history_stats(start, end)
+
+def long_poll_window(after, timeout):
+    """
+    Normalize the parameters of a long-poll request.
+
+    Args:
+        after (int): Last event ID the client saw, or None on the first request
+        timeout (float): Requested wait in seconds, or None
+
+    Returns:
+        tuple: (after, timeout) to pass to the broadcaster, the timeout
+            clamped to 0..LONG_POLL_MAX_SECONDS
+    """
+    if after is None:
+        # First request: just report where the event stream is
+        return broadcaster.get_last_id(), 0
+    if timeout is None:
+        timeout = LONG_POLL_MAX_SECONDS
+    # Negative and NaN timeouts don't wait
+    return after, max(0, min(timeout, LONG_POLL_MAX_SECONDS))